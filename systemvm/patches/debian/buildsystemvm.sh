@@ -424,6 +424,8 @@ services() {
   chroot . chkconfig iptables-persistent off
   chroot . chkconfig --force --add cloud-passwd-srvr
   chroot . chkconfig cloud-passwd-srvr off
+  chroot . chkconfig --add cloud-configd
+  chroot . chkconfig cloud-configd on
   chroot . chkconfig --add cloud
   chroot . chkconfig cloud off
   chroot . chkconfig monit off
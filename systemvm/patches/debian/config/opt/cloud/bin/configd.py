@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Resident configuration daemon of the system vm.
+
+Every config push used to start a new interpreter running update_config.py,
+which imports the cs package, parses the data bags and converges from
+scratch. The daemon keeps all of it loaded: the data bags are parsed once
+and kept in memory (merge.DataBag.cache) until a push or another process
+rewrites them. The pushes still arrive in the /var/cache/cloud queue,
+update_config.py hands the name of the file over a unix socket and relays
+the output and the exit code of the push, so its command line contract does
+not change. It processes the push itself when the daemon is not running.
+The pushes are applied one at a time, in the order they arrive.
+"""
+
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import StringIO
+import sys
+import time
+from fcntl import flock, LOCK_EX, LOCK_UN
+from optparse import OptionParser
+
+SOCKET_PATH = "/var/run/cloud-configd.sock"
+LOCK_PATH = "/var/lock/cloud-config.lock"
+
+
+class PushLock(object):
+    """ Serializes the pushes of the daemon and of update_config.py run without it """
+
+    def __init__(self, path=LOCK_PATH):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, "a")
+        flock(self.handle, LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        flock(self.handle, LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message) + "\n")
+
+
+def recv_message(sock):
+    """ Reads a message up to its end of line, None if the peer went away first """
+    data = ""
+    while not data.endswith("\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data)
+
+
+def connect(path=SOCKET_PATH):
+    """ A socket connected to the daemon, None if it is not running """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def submit(name, path=SOCKET_PATH, out=sys.stdout):
+    """
+    Has the daemon apply the push of /var/cache/cloud/<name>, writes its output
+    to out and returns its exit code, None if the daemon is not running
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    try:
+        send_message(sock, {"file": name})
+        reply = recv_message(sock)
+    except socket.error as e:
+        logging.error("Lost the configuration daemon while processing %s: %s", name, e)
+        reply = None
+    finally:
+        sock.close()
+    if reply is None:
+        out.write("[ERROR] configd.py :: The daemon stopped while processing %s, check /var/log/cloud.log\n" % name)
+        return 1
+    out.write(reply["output"].encode("utf-8"))
+    return reply["code"]
+
+
+class ConfigDaemon(object):
+    """
+    Applies the pushes received on a unix socket, handler(name) applies one
+    and returns its exit code (update_config.process by default)
+    """
+
+    def __init__(self, path=SOCKET_PATH, handler=None, lock_path=LOCK_PATH):
+        if handler is None:
+            import update_config
+            handler = update_config.process
+        self.path = path
+        self.handler = handler
+        self.lock_path = lock_path
+        self.sock = None
+        self.running = False
+        self.stats = {"pushes": 0, "failures": 0, "busy": 0.0, "last": None, "started": time.time()}
+
+    def warm_up(self):
+        """ Parses the existing data bags so that the first push finds them in memory """
+        from merge import DataBag
+        DataBag.enable_cache()
+        if not os.path.isdir(DataBag.DPATH):
+            return
+        for name in sorted(os.listdir(DataBag.DPATH)):
+            if name.endswith(".json"):
+                db = DataBag()
+                db.setKey(name[:-len(".json")])
+                try:
+                    db.load()
+                except ValueError:
+                    logging.warning("Could not parse data bag %s", name)
+
+    def bind(self):
+        if os.path.exists(self.path):
+            sock = connect(self.path)
+            if sock is not None:
+                sock.close()
+                raise RuntimeError("A configuration daemon already listens on %s" % self.path)
+            # Left behind by a daemon which did not stop cleanly
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.sock.listen(64)
+        self.running = True
+
+    def serve_forever(self):
+        logging.info("Configuration daemon listening on %s", self.path)
+        while self.running:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error as e:
+                # Interrupted by stop()
+                if e.errno == errno.EINTR or not self.running:
+                    continue
+                raise
+            try:
+                self.handle(conn)
+            except socket.error as e:
+                logging.warning("Configuration daemon lost a client: %s", e)
+            finally:
+                conn.close()
+        self.close()
+
+    def stop(self, *args):
+        self.running = False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def handle(self, conn):
+        request = recv_message(conn)
+        if request is None:
+            return
+        if "file" in request:
+            send_message(conn, self.apply(request["file"]))
+        elif "stats" in request:
+            send_message(conn, self.get_stats())
+        else:
+            send_message(conn, {"code": 1, "output": "[ERROR] configd.py :: Invalid request\n"})
+
+    def apply(self, name):
+        """ Applies a push, its output is what update_config.py would have printed """
+        from cs.CsConfig import CsConfig
+        started = time.time()
+        output = StringIO.StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            with PushLock(self.lock_path):
+                # The command line data bag may change with any push
+                CsConfig.cl = None
+                returncode = self.handler(name) or 0
+        except SystemExit as e:
+            returncode = e.code or 0
+        except Exception:
+            logging.exception("Exception while processing %s", name)
+            print "[ERROR] configd.py :: Exception while processing %s, check /var/log/cloud.log" % name
+            returncode = 1
+        finally:
+            sys.stdout = stdout
+        elapsed = time.time() - started
+        self.stats["pushes"] += 1
+        self.stats["busy"] += elapsed
+        self.stats["last"] = {"file": name, "code": returncode, "seconds": round(elapsed, 3)}
+        if returncode:
+            self.stats["failures"] += 1
+        logging.info("Processed %s in %.3fs, exit code %s", name, elapsed, returncode)
+        return {"code": returncode, "output": output.getvalue()}
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["uptime"] = round(time.time() - stats.pop("started"), 3)
+        stats["busy"] = round(stats["busy"], 3)
+        return stats
+
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("-s", "--socket", dest="path", default=SOCKET_PATH, help="unix socket to listen on")
+    parser.add_option("--stats", dest="stats", action="store_true", default=False, help="print the statistics of the running daemon")
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.stats:
+        sock = connect(options.path)
+        if sock is None:
+            print "[ERROR] configd.py :: No daemon listens on %s" % options.path
+            return 1
+        try:
+            send_message(sock, {"stats": True})
+            print json.dumps(recv_message(sock), indent=4, sort_keys=True)
+        finally:
+            sock.close()
+        return 0
+
+    logging.basicConfig(filename='/var/log/cloud.log', level=logging.DEBUG, format='%(asctime)s  %(filename)s %(funcName)s:%(lineno)d %(message)s')
+    daemon = ConfigDaemon(options.path)
+    daemon.warm_up()
+    daemon.bind()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.serve_forever()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -19,6 +19,8 @@
 import sys
 import os
 import base64
+import hashlib
+import json
 
 from merge import DataBag
 from pprint import pprint
@@ -33,7 +35,7 @@ from fcntl import flock, LOCK_EX, LOCK_UN
 
 from cs.CsDatabag import CsDataBag, CsCmdLine
 import cs.CsHelper
-from cs.CsNetfilter import CsNetfilters
+from cs.CsNetfilter import CsNetfilters, CsNetfilter, CsChainSet
 from cs.CsDhcp import CsDhcp
 from cs.CsRedundant import *
 from cs.CsFile import CsFile
@@ -80,6 +82,9 @@ class CsAcl(CsDataBag):
         Deal with Network acls
     """
 
+    FW_CHAINS = [("filter", "ACL_INBOUND_*"), ("filter", "ACL_OUTBOUND_*"), ("mangle", "ACL_OUTBOUND_*"),
+                 ("mangle", "FIREWALL_*"), ("filter", "FW_OUTBOUND"), ("filter", "FW_EGRESS_RULES")]
+
     class AclIP():
         """ For type Virtual Router """
 
@@ -441,6 +446,10 @@ class CsSite2SiteVpn(CsDataBag):
     right is where the clients connect from
     """
 
+    FW_CHAINS = [("filter", "INPUT"), ("nat", "POSTROUTING"), ("mangle", "FORWARD"), ("mangle", "OUTPUT"), ("mangle", "INPUT")]
+    # Starts ipsec and removes the stale configurations on every push
+    RUN_EVERY_PUSH = True
+
     VPNCONFDIR = "/etc/ipsec.d"
 
     def process(self):
@@ -611,6 +620,10 @@ class CsVpnUser(CsDataBag):
 
 class CsRemoteAccessVpn(CsDataBag):
     VPNCONFDIR = "/etc/ipsec.d"
+    FW_CHAINS = [("filter", "INPUT"), ("filter", "FORWARD"), ("filter", "VPN_FORWARD"), ("nat", "PREROUTING"),
+                 ("mangle", "PREROUTING"), ("mangle", "VPN_*")]
+    # Starts ipsec and xl2tpd on every push
+    RUN_EVERY_PUSH = True
 
     def process(self):
         self.confips = []
@@ -714,6 +727,8 @@ class CsRemoteAccessVpn(CsDataBag):
 
 class CsForwardingRules(CsDataBag):
 
+    FW_CHAINS = [("nat", "PREROUTING"), ("nat", "POSTROUTING"), ("nat", "OUTPUT"), ("filter", "FORWARD")]
+
     def process(self):
         for public_ip in self.dbag:
             if public_ip == "id":
@@ -900,6 +915,103 @@ class CsForwardingRules(CsDataBag):
         self.fw.append(["nat", "front", "-A POSTROUTING -s %s -d %s -j SNAT -o eth0 --to-source %s" % (self.getNetworkByIp(rule['internal_ip']),rule["internal_ip"], self.getGuestIp())])
 
 
+class CsFirewall(object):
+    """
+    Regenerates the iptables rules of the data bags changed since the last push
+
+    The rules of every generator are kept in the "firewall" data bag along with a
+    digest of its data bag. A generator whose data bag did not change is not run,
+    its rules of the previous push are reused, unless it has RUN_EVERY_PUSH set:
+    its process also keeps a service running (ipsec, haproxy), which a push
+    heals. Only the chains owned by the
+    generators whose rules changed (their FW_CHAINS and the chains their old and
+    new rules are in) are compared with the live rules, and a push changing no
+    rule is not compared at all. Every generator runs and every chain is compared
+    for cmd_line.json, when the addresses or the command line change, and after
+    a reboot.
+    """
+
+    GENERATORS = [("networkacl", CsAcl), ("firewallrules", CsAcl), ("forwardingrules", CsForwardingRules),
+                  ("site2sitevpn", CsSite2SiteVpn), ("remoteaccessvpn", CsRemoteAccessVpn), ("loadbalancer", CsLoadBalancer)]
+    # The rules added by CsAddress, before the generators run
+    BASE = "address"
+    BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+    def __init__(self, config, full=False):
+        self.config = config
+        self.full = full
+        self.db = DataBag()
+        self.db.setKey("firewall")
+        self.db.load()
+
+    @staticmethod
+    def digest(*bags):
+        return hashlib.md5(json.dumps(bags, sort_keys=True)).hexdigest()
+
+    def get_boot_id(self):
+        try:
+            return open(self.BOOT_ID).read().strip()
+        except IOError:
+            return ""
+
+    def process(self):
+        """ Returns False when no rule changed and the live rules were left alone """
+        state = self.db.getDataBag()
+        fw = self.config.get_fw()
+        inputs = self.digest(self.config.address().dbag, self.config.cmdline().dbag, self.get_boot_id())
+        full = self.full or state.get("inputs") != inputs
+        fragments = {} if full else state.get("fragments", {})
+        digests = {} if full else state.get("digests", {})
+
+        new_fragments = {self.BASE: list(fw)}
+        new_digests = {}
+        ran = [self.BASE]
+        for name, generator in self.GENERATORS:
+            bag = generator(name, self.config)
+            new_digests[name] = self.digest(bag.get_bag())
+            start = len(fw)
+            if name in fragments and digests.get(name) == new_digests[name] and \
+                    not getattr(generator, "RUN_EVERY_PUSH", False):
+                fw.extend(fragments[name])
+            else:
+                logging.debug("Configuring %s rules", name)
+                if name == "firewallrules":
+                    bag.flushAllowAllEgressRules()
+                bag.process()
+                ran.append(name)
+            new_fragments[name] = fw[start:]
+
+        # Flushing the allow all egress rule changed the live rules
+        changed = [name for name in ran if name == "firewallrules" or new_fragments[name] != fragments.get(name)]
+        state = {"id": "firewall", "inputs": inputs, "digests": new_digests, "fragments": new_fragments}
+        if not changed:
+            logging.info("No iptables rule changed, not comparing them")
+            self.db.save(state)
+            return False
+
+        chains = None
+        if not full:
+            chains = CsChainSet()
+            owners = dict(self.GENERATORS)
+            for name in changed:
+                for table, chain in getattr(owners.get(name), "FW_CHAINS", []):
+                    chains.add(table, chain)
+                for entry in fragments.get(name, []) + new_fragments[name]:
+                    rule = CsNetfilter()
+                    rule.parse(entry[2])
+                    rule.set_table(entry[0])
+                    chains.add(rule.get_table(), rule.get_chain())
+            logging.info("Rules of %s changed, comparing chains %s", ", ".join(changed), chains)
+
+        logging.debug("Configuring iptables rules")
+        nf = CsNetfilters()
+        if not nf.compare(fw, chains):
+            # Compare every chain on the next push
+            state = {"id": "firewall"}
+        self.db.save(state)
+        return True
+
+
 def main(argv):
     # The file we are currently processing, if it is "cmd_line.json" everything will be processed.
     process_file = argv[1]
@@ -979,30 +1091,7 @@ def main(argv):
             mon.process()
 
         # If iptable rules have changed, apply them.
-        if iptables_change:
-            acls = CsAcl('networkacl', config)
-            acls.process()
-
-            acls = CsAcl('firewallrules', config)
-            acls.flushAllowAllEgressRules()
-            acls.process()
-
-            fwd = CsForwardingRules("forwardingrules", config)
-            fwd.process()
-
-            vpns = CsSite2SiteVpn("site2sitevpn", config)
-            vpns.process()
-
-            rvpn = CsRemoteAccessVpn("remoteaccessvpn", config)
-            rvpn.process()
-
-            lb = CsLoadBalancer("loadbalancer", config)
-            lb.process()
-
-            logging.debug("Configuring iptables rules")
-            nf = CsNetfilters()
-            nf.compare(config.get_fw())
-
+        if iptables_change and CsFirewall(config, process_file == "cmd_line.json").process():
             logging.debug("Configuring iptables rules done ...saving rules")
 
             # Save iptables configuration - will be loaded on reboot by the iptables-restore that is configured on /etc/rc.local
@@ -200,6 +200,14 @@ def save_iptables(command, iptables_file):
     fIptables.close()
 
 
+def execute_input(command, data):
+    """ Execute command with data on its standard input """
+    logging.debug("Executing: %s" % command)
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out, err = p.communicate(data)
+    return p.returncode, out, err
+
+
 def execute2(command):
     """ Execute command """
     logging.debug("Executing: %s" % command)
@@ -29,6 +29,10 @@ HAPROXY_CONF_P = "/etc/haproxy/haproxy.cfg"
 class CsLoadBalancer(CsDataBag):
     """ Manage Load Balancer entries """
 
+    FW_CHAINS = [("filter", "INPUT")]
+    # Brings the haproxy configuration in line on every push
+    RUN_EVERY_PUSH = True
+
     def process(self):
         if "config" not in self.dbag.keys():
             return
@@ -18,13 +18,18 @@
 import CsHelper
 from pprint import pprint
 from CsDatabag import CsDataBag, CsCmdLine
+from fnmatch import fnmatchcase
 import logging
+import os
+import re
+import time
 
 
 class CsChain(object):
 
     def __init__(self):
         self.chain = {}
+        self.chains = set()
         self.last_added = ''
         self.count = {}
 
@@ -33,6 +38,7 @@ class CsChain(object):
             self.chain.setdefault(table, []).append(chain)
         else:
             self.chain[table].append(chain)
+        self.chains.add((table, chain))
         if self.last_added != chain:
             self.last_added = chain
             self.count[chain] = 0
@@ -52,11 +58,34 @@ class CsChain(object):
         return self.last_added
 
     def has_chain(self, table, chain):
-        if table not in self.chain.keys():
-            return False
-        if chain not in self.chain[table]:
-            return False
-        return True
+        return (table, chain) in self.chains
+
+
+class CsChainSet(object):
+    """ A set of (table, chain), the chain may be a pattern such as FIREWALL_* """
+
+    def __init__(self, chains=()):
+        self.chains = set()
+        self.patterns = set()
+        for table, chain in chains:
+            self.add(table, chain)
+
+    def add(self, table, chain):
+        if table == '':
+            table = "filter"
+        if '*' in chain:
+            self.patterns.add((table, chain))
+        else:
+            self.chains.add((table, chain))
+
+    def __contains__(self, item):
+        if item in self.chains:
+            return True
+        table, chain = item
+        return any(t == table and fnmatchcase(chain, c) for (t, c) in self.patterns)
+
+    def __str__(self):
+        return ", ".join("%s:%s" % c for c in sorted(self.chains | self.patterns))
 
 
 class CsTable(object):
@@ -77,19 +106,128 @@ class CsTable(object):
         return self.last_added
 
 
+class CsNetfilterTransaction(object):
+    """ Changes to the netfilter tables, applied as one iptables-restore --noflush per table
+
+    A table is changed atomically: either all of its commands are applied, or none.
+    A delete (-D) rejected by iptables-restore is dropped and the table retried, however
+    many of them fail: the rule may already be gone, or hold options CsNetfilter.to_str
+    does not write back. Any other rejected command fails the table. When a table can
+    not be applied the tables committed before it are restored from their snapshot
+    (iptables-save output).
+    """
+
+    RESTORE = {4: "iptables-restore", 6: "ip6tables-restore"}
+
+    def __init__(self, snapshot=None, family=4):
+        self.family = family
+        self.restore = self.RESTORE[family]
+        self.snapshot = snapshot if snapshot is not None else {}
+        self.tables = []
+        self.commands = {}
+        self.metrics = []
+
+    def add(self, table, command):
+        if table not in self.commands:
+            self.tables.append(table)
+            self.commands[table] = []
+        self.commands[table].append(command)
+
+    def get_commands(self, table):
+        return self.commands.get(table, [])
+
+    def is_empty(self):
+        return not self.tables
+
+    def commit(self):
+        """ Applies the tables in turn, returns False if the transaction was rolled back """
+        committed = []
+        for table in self.tables:
+            if not self.__apply(table):
+                self.rollback(committed)
+                return False
+            committed.append(table)
+        return True
+
+    def rollback(self, tables):
+        for table in reversed(tables):
+            if table not in self.snapshot:
+                logging.error("No snapshot of table %s, it can not be rolled back", table)
+                continue
+            returncode, out, err = CsHelper.execute_input(self.restore, "\n".join(self.snapshot[table]) + "\n")
+            if returncode != 0:
+                logging.error("Rolling back table %s failed: %s", table, err.strip())
+            else:
+                logging.info("Rolled back table %s", table)
+
+    def __apply(self, table):
+        commands = list(self.commands[table])
+        skipped = []
+        attempts = 0
+        started = time.time()
+        committed = True
+        while commands:
+            attempts += 1
+            returncode, out, err = CsHelper.execute_input("%s --noflush" % self.restore,
+                                                          "*%s\n%s\nCOMMIT\n" % (table, "\n".join(commands)))
+            if returncode == 0:
+                break
+            index = self.__failed_command(err, len(commands))
+            if index is None or not commands[index].startswith("-D "):
+                logging.error("%s of table %s failed: %s", self.restore, table, err.strip())
+                committed = False
+                break
+            logging.error("Dropping \"%s\" from table %s: %s", commands[index], table, err.strip())
+            skipped.append(commands.pop(index))
+        metric = {"family": self.family, "table": table, "commands": len(self.commands[table]),
+                  "skipped": len(skipped), "attempts": attempts, "committed": committed,
+                  "seconds": round(time.time() - started, 6)}
+        self.metrics.append(metric)
+        logging.info("%s of table %s: %s commands, %s skipped, %s attempts, committed %s in %.3fs",
+                     self.restore, table, metric["commands"], metric["skipped"], attempts, committed, metric["seconds"])
+        return committed
+
+    @staticmethod
+    def __failed_command(err, count):
+        """ Index of the command iptables-restore failed on, None if it failed on COMMIT """
+        match = re.search(r"line:? (\d+)", err)
+        if match is None:
+            return None
+        # The input starts with the *table line
+        index = int(match.group(1)) - 2
+        if index < 0 or index >= count:
+            return None
+        return index
+
+    def get_metrics(self):
+        return self.metrics
+
+
 class CsNetfilters(object):
 
-    def __init__(self, load=True):
+    SAVE = {4: "iptables-save", 6: "ip6tables-save"}
+    # Standard rules by file, see del_standard
+    standard = {}
+
+    def __init__(self, load=True, family=4):
         self.rules = []
+        # The live rules by (table, chain), then by canonical match, in iptables-save order
+        self.index = {}
         self.table = CsTable()
         self.chain = CsChain()
+        self.family = family
+        # iptables-save output of each table, to roll the transaction back
+        self.snapshot = {}
+        self.transaction = CsNetfilterTransaction(self.snapshot, family)
         if load:
             self.get_all_rules()
 
     def get_all_rules(self):
-        for i in CsHelper.execute("iptables-save"):
+        for i in CsHelper.execute(self.SAVE[self.family]):
             if i.startswith('*'):  # Table
                 self.table.add(i[1:])
+            if self.table.last():
+                self.snapshot.setdefault(self.table.last(), []).append(i)
             if i.startswith(':'):  # Chain
                 self.chain.add(self.table.last(), i[1:].split(' ')[0])
             if i.startswith('-A'):  # Rule
@@ -103,9 +241,17 @@ class CsNetfilters(object):
 
     def save(self, rule):
         self.rules.append(rule)
+        self.index.setdefault((rule.get_table(), rule.get_chain()), {}).setdefault(rule.get_match(), []).append(rule)
 
     def get(self):
-        return self.rules
+        return [x for x in self.rules if self.__indexed(x)]
+
+    def get_chain_rules(self, table, chain):
+        """ The live rules of a chain, by canonical match """
+        return self.index.get((table, chain), {})
+
+    def __indexed(self, rule):
+        return rule.get_match() in self.index.get((rule.get_table(), rule.get_chain()), {})
 
     def has_table(self, table):
         return table in self.table.get()
@@ -114,43 +260,51 @@ class CsNetfilters(object):
         return self.chain.has_chain(table, chain)
 
     def has_rule(self, new_rule):
-        for r in self.get():
-            if new_rule == r:
-                if new_rule.get_count() > 0:
-                    continue
-                r.mark_seen()
-                return True
-        return False
-
-    def get_unseen(self):
-        del_list = [x for x in self.rules if x.unseen()]
+        # Numbered rules are always inserted again, at their position
+        if new_rule.get_count() > 0:
+            return False
+        rules = self.get_chain_rules(new_rule.get_table(), new_rule.get_chain()).get(new_rule.get_match())
+        if not rules:
+            return False
+        rules[0].mark_seen()
+        return True
+
+    def get_unseen(self, chains=None):
+        del_list = [x for x in self.get() if x.unseen() and self.__in_scope(x, chains)]
         for r in del_list:
-            cmd = "iptables -t %s %s" % (r.get_table(), r.to_str(True))
+            cmd = r.to_str(True)
             logging.debug("unseen cmd:  %s ", cmd)
-            CsHelper.execute(cmd)
+            self.transaction.add(r.get_table(), cmd)
             # print "Delete rule %s from table %s" % (r.to_str(True), r.get_table())
             logging.info("Delete rule %s from table %s", r.to_str(True), r.get_table())
 
-    def compare(self, list):
-        """ Compare reality with what is needed """
+    @staticmethod
+    def __in_scope(rule, chains):
+        return chains is None or (rule.get_table(), rule.get_chain()) in chains
+
+    def compare(self, list, chains=None):
+        """ Compare reality with what is needed, the changes are applied in one transaction
+        chains (a CsChainSet) limits the comparison to these chains, all by default
+        Returns False if the changes could not be applied """
         # PASS 1:  Ensure all chains are present
+        parsed = []
         for fw in list:
             new_rule = CsNetfilter()
             new_rule.parse(fw[2])
             new_rule.set_table(fw[0])
+            if not self.__in_scope(new_rule, chains):
+                continue
             self.add_chain(new_rule)
+            parsed.append((fw, new_rule))
 
         ruleSet = set()
         # PASS 2: Create rules
-        for fw in list:
+        for fw, new_rule in parsed:
             tupledFw = tuple(fw)
             if tupledFw in ruleSet :
                 logging.debug("Already processed : %s", tupledFw)
                 continue
 
-            new_rule = CsNetfilter()
-            new_rule.parse(fw[2])
-            new_rule.set_table(fw[0])
             if isinstance(fw[1], int):
                 new_rule.set_count(fw[1])
 
@@ -173,16 +327,20 @@ class CsNetfilters(object):
                         cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), rule_count))
                     else:
                         cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), fw[1]))
-                CsHelper.execute("iptables -t %s %s" % (new_rule.get_table(), cpy))
+                self.transaction.add(new_rule.get_table(), cpy)
                 ruleSet.add(tupledFw)
                 self.chain.add_rule(rule_chain)
         self.del_standard()
-        self.get_unseen()
+        self.get_unseen(chains)
+        if not self.transaction.commit():
+            logging.error("The iptables rules could not be applied, the tables were left as they were")
+            return False
+        return True
 
     def add_chain(self, rule):
         """ Add the given chain if it is not already present """
         if not self.has_chain(rule.get_table(), rule.get_chain()):
-            CsHelper.execute("iptables -t %s -N %s" % (rule.get_table(), rule.get_chain()))
+            self.transaction.add(rule.get_table(), "-N %s" % rule.get_chain())
             self.chain.add(rule.get_table(), rule.get_chain())
 
     def del_standard(self):
@@ -192,16 +350,31 @@ class CsNetfilters(object):
         type = CsCmdLine("cmdline").get_type()
 
         try:
+            rules = self.get_standard("/etc/iptables/iptables-%s" % type)
+        except (IOError, OSError):
+            logging.debug("Exception in del_standard, returning")
+            # Nothing can be done
+            return
+        for rule in rules:
+            self.delete(rule)
+
+    @classmethod
+    def get_standard(cls, path):
+        """ The rules of a standard rules file, parsed again only when it changes """
+        mtime = os.path.getmtime(path)
+        if path not in cls.standard or cls.standard[path][0] != mtime:
+            rules = []
             table = ''
-            for i in open("/etc/iptables/iptables-%s" % type):
+            for i in open(path):
                 if i.startswith('*'):  # Table
                     table = i[1:].strip()
                 if i.startswith('-A'):  # Rule
-                    self.del_rule(table, i.strip())
-        except IOError:
-            logging.debug("Exception in del_standard, returning")
-            # Nothing can be done
-            return
+                    nr = CsNetfilter()
+                    nr.parse(i.strip())
+                    nr.set_table(table)
+                    rules.append(nr)
+            cls.standard[path] = (mtime, rules)
+        return cls.standard[path][1]
 
     def del_rule(self, table, rule):
         nr = CsNetfilter()
@@ -212,13 +385,14 @@ class CsNetfilters(object):
     def delete(self, rule):
         """ Delete a rule from the list of configured rules
         The rule will not actually be removed on the host """
-        self.rules[:] = [x for x in self.rules if not x == rule]
+        self.get_chain_rules(rule.get_table(), rule.get_chain()).pop(rule.get_match(), None)
 
 
 class CsNetfilter(object):
 
     def __init__(self):
         self.rule = {}
+        self.match = None
         self.table = ''
         self.chain = ''
         self.seen = False
@@ -226,6 +400,7 @@ class CsNetfilter(object):
 
     def parse(self, rule):
         self.rule = self.__convert_to_dict(rule)
+        self.match = None
 
     def unseen(self):
         return self.seen is False
@@ -273,6 +448,12 @@ class CsNetfilter(object):
     def get_rule(self):
         return self.rule
 
+    def get_match(self):
+        """ Canonical form of the rule: its options and values, sorted """
+        if self.match is None:
+            self.match = tuple(sorted(self.rule.items()))
+        return self.match
+
     def to_str(self, delete=False):
         """ Convert the rule back into aynactically correct iptables command """
         # Order is important
@@ -298,9 +479,4 @@ class CsNetfilter(object):
             return False
         if rule.get_chain() != self.get_chain():
             return False
-        if len(rule.get_rule().items()) != len(self.get_rule().items()):
-            return False
-        common = set(rule.get_rule().items()) & set(self.get_rule().items())
-        if len(common) != len(rule.get_rule()):
-            return False
-        return True
+        return rule.get_match() == self.get_match()
@@ -0,0 +1,150 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Crash safe files of the data bags and of the processed pushes
+
+A journal is an append only file of JSON records, one per line. A record
+is written with a single write and synced before append returns, a crash
+can only leave the last line incomplete, which read skips. Files which are
+replaced as a whole are written to a temporary file which is renamed over
+them, a reader sees the old or the new content, never a truncated one.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+
+def dumps(data):
+    """ Compact JSON, without the spaces of the default separators """
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, content, mode=0644):
+    """ Replaces the file at path with content, atomically and durably """
+    dpath = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=dpath, prefix=".%s." % os.path.basename(path))
+    renamed = False
+    try:
+        handle = os.fdopen(fd, "w")
+        try:
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+        finally:
+            handle.close()
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+        renamed = True
+    finally:
+        if not renamed:
+            os.remove(tmp)
+    sync_dir(dpath)
+
+
+class Journal(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, record):
+        """ Appends a record, it is in the journal as a whole or not at all """
+        line = dumps(record) + "\n"
+        handle = open(self.path, "a+b")
+        try:
+            handle.seek(0, os.SEEK_END)
+            if handle.tell() > 0:
+                # Terminate the line a crash left incomplete, read skips it
+                handle.seek(-1, os.SEEK_END)
+                if handle.read(1) != "\n":
+                    line = "\n" + line
+                handle.seek(0, os.SEEK_END)
+            created = handle.tell() == 0
+            handle.write(line)
+            handle.flush()
+            os.fsync(handle.fileno())
+        finally:
+            handle.close()
+        if created:
+            sync_dir(os.path.dirname(self.path) or ".")
+
+    def read(self):
+        """ The records, the lines which can not be parsed are logged and skipped """
+        records = []
+        try:
+            handle = open(self.path)
+        except IOError:
+            return records
+        try:
+            for number, line in enumerate(handle, 1):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logging.warning("Skipping the incomplete record at line %s of %s", number, self.path)
+        finally:
+            handle.close()
+        return records
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def rewrite(self, records):
+        """ Replaces all the records atomically """
+        write_atomic(self.path, "".join(dumps(r) + "\n" for r in records))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            sync_dir(os.path.dirname(self.path) or ".")
+
+
+class BoundedJournal(Journal):
+    """ Keeps the newest records, about max_size bytes of them """
+
+    def __init__(self, path, max_size):
+        super(BoundedJournal, self).__init__(path)
+        self.max_size = max_size
+
+    def append(self, record):
+        super(BoundedJournal, self).append(record)
+        if self.size() > self.max_size:
+            self.trim()
+
+    def trim(self):
+        """ Drops the oldest records, keeping half of max_size so that it is not trimmed on every append """
+        kept = []
+        size = 0
+        for record in reversed(self.read()):
+            size += len(dumps(record)) + 1
+            if size > self.max_size / 2 and kept:
+                break
+            kept.append(record)
+        kept.reverse()
+        self.rewrite(kept)
@@ -17,6 +17,7 @@
 # under the License.
 
 import json
+import marshal
 import os
 import time
 import logging
@@ -36,21 +37,42 @@ import cs_remoteaccessvpn
 import cs_vpnusers
 import cs_staticroutes
 
+from journal import Journal, BoundedJournal, write_atomic
 from pprint import pprint
 
 
 class DataBag:
+    """
+    A data bag is kept in DPATH/<key>.json and in the journal DPATH/<key>.journal.
+    A save appends the top level keys it changed to the journal, as one record,
+    rather than rewriting the whole data bag. The journal is merged into the
+    data bag file, which is replaced atomically, once it holds COMPACT_RECORDS
+    records or is bigger than the file.
+    """
 
     DPATH = "/etc/cloudstack"
+    COMPACT_RECORDS = 256
+    # Parsed data bags of a resident process (see configd.py) by path,
+    # None when every load parses the file
+    cache = None
 
     def __init__(self):
         self.bdata = {}
 
+    @classmethod
+    def enable_cache(cls):
+        if cls.cache is None:
+            cls.cache = {}
+
     def load(self):
         data = self.bdata
-        if not os.path.exists(self.DPATH):
-            os.makedirs(self.DPATH)
-        self.fpath = self.DPATH + '/' + self.key + '.json'
+        self.__open()
+        cached = self.__cached()
+        if cached is not None:
+            logging.debug("Loading data bag type %s from cache", self.key)
+            (self.items, self.records) = cached
+            self.dbag = dict((k, marshal.loads(v)) for (k, v) in self.items.items())
+            return
         try:
             handle = open(self.fpath)
         except IOError:
@@ -60,22 +82,134 @@ class DataBag:
             logging.debug("Loading data bag type %s",  self.key)
             data = json.load(handle)
             handle.close()
+        records = self.journal.read()
+        for record in records:
+            data.update(record.get("set", {}))
+            for key in record.get("del", []):
+                data.pop(key, None)
+        self.records = len(records)
+        self.items = self.__serialize(data)
+        self.__cache()
         self.dbag = data
 
     def save(self, dbag):
-        try:
-            handle = open(self.fpath, 'w')
-        except IOError:
-            logging.error("Could not write data bag %s", self.key)
-        else:
-            logging.debug("Writing data bag type %s", self.key)
-            logging.debug(dbag)
-        jsono = json.dumps(dbag, indent=4, sort_keys=True)
-        handle.write(jsono)
+        items = self.__serialize(dbag)
+        record = {"set": dict((k, dbag[k]) for k in items if self.__changed(k, items[k], dbag[k])),
+                  "del": [k for k in self.items if k not in items]}
+        self.__commit(items, record, dbag)
+        self.dbag = dbag
+
+    def getItem(self, key, default=None):
+        """ The value of a top level key, only this value is copied out of the cache """
+        if not hasattr(self, "items"):
+            self.__open()
+            cached = self.__cached()
+            if cached is None:
+                self.load()
+            else:
+                (self.items, self.records) = cached
+        if key not in self.items:
+            return default
+        return marshal.loads(self.items[key])
+
+    def setItem(self, key, value):
+        """ Sets a top level key, writing only this key to the journal """
+        self.getItem(key)
+        items = dict(self.items)
+        items[key] = marshal.dumps(value)
+        self.__commit(items, {"set": {key: value}, "del": []})
+        if hasattr(self, "dbag"):
+            self.dbag[key] = value
+
+    def delItem(self, key):
+        self.getItem(key)
+        if key not in self.items:
+            return
+        items = dict(self.items)
+        del items[key]
+        self.__commit(items, {"set": {}, "del": [key]})
+        if hasattr(self, "dbag"):
+            self.dbag.pop(key, None)
 
     def getDataBag(self):
         return self.dbag
 
+    def __open(self):
+        if not os.path.exists(self.DPATH):
+            os.makedirs(self.DPATH)
+        self.fpath = self.DPATH + '/' + self.key + '.json'
+        self.journal = Journal(self.DPATH + '/' + self.key + '.journal')
+
+    def __changed(self, key, serialized, value):
+        """ A str and the same unicode string, or dicts in another order, are not marshalled alike """
+        previous = self.items.get(key)
+        return serialized != previous and (previous is None or marshal.loads(previous) != value)
+
+    def __commit(self, items, record, dbag=None):
+        if not (record["set"] or record["del"]):
+            logging.debug("Data bag type %s unchanged", self.key)
+            return
+        logging.debug("Writing data bag type %s", self.key)
+        logging.debug(record)
+        try:
+            if os.path.exists(self.fpath):
+                self.journal.append(record)
+                self.records += 1
+            if not os.path.exists(self.fpath) or self.records >= self.COMPACT_RECORDS or \
+                    self.journal.size() > os.path.getsize(self.fpath):
+                if dbag is None:
+                    dbag = dict((k, marshal.loads(v)) for (k, v) in items.items())
+                write_atomic(self.fpath, json.dumps(dbag, indent=4, sort_keys=True))
+                self.journal.remove()
+                self.records = 0
+        except (IOError, OSError):
+            logging.error("Could not write data bag %s", self.key)
+            self.__uncache()
+            raise
+        self.items = items
+        self.__cache()
+
+    @staticmethod
+    def __serialize(data):
+        """ The top level keys, their values marshalled to compare and copy them cheaply """
+        return dict((k, marshal.dumps(v)) for (k, v) in data.items())
+
+    def __signature(self):
+        """ Tells a data bag rewritten by another process since it was cached """
+        signature = []
+        for path in (self.fpath, self.journal.path):
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((st.st_ino, st.st_size, st.st_mtime, st.st_ctime))
+        if signature == [None, None]:
+            return None
+        return tuple(signature)
+
+    def __cached(self):
+        """ The marshalled values of the cached data bag and its number of journal records """
+        if DataBag.cache is None:
+            return None
+        entry = DataBag.cache.get(self.fpath)
+        if entry is None or entry[0] != self.__signature():
+            self.__uncache()
+            return None
+        return entry[1:]
+
+    def __cache(self):
+        if DataBag.cache is None:
+            return
+        signature = self.__signature()
+        if signature is None:
+            return
+        DataBag.cache[self.fpath] = (signature, self.items, self.records)
+
+    def __uncache(self):
+        if DataBag.cache is not None:
+            DataBag.cache.pop(self.fpath, None)
+
     def setKey(self, key):
         self.key = key
 
@@ -268,6 +402,9 @@ class QueueFile:
     fileName = ''
     configCache = "/var/cache/cloud"
     keep = True
+    # The processed files are kept in configCache/processed.journal, about
+    # historySize bytes of the most recent ones
+    historySize = 16 * 1024 * 1024
     data = {}
 
     def load(self, data):
@@ -286,9 +423,8 @@ class QueueFile:
             self.type = self.data["type"]
             handle.close()
             if self.keep:
-                self.__moveFile(fn, self.configCache + "/processed")
-            else:
-                os.remove(fn)
+                self.__keepFile()
+            os.remove(fn)
             proc = updateDataBag(self)
 
     def setFile(self, name):
@@ -303,11 +439,12 @@ class QueueFile:
     def setPath(self, path):
         self.configCache = path
 
-    def __moveFile(self, origPath, path):
-        if not os.path.exists(path):
-            os.makedirs(path)
-        timestamp = str(int(round(time.time())))
-        os.rename(origPath, path + "/" + self.fileName + "." + timestamp)
+    def getHistory(self):
+        return BoundedJournal(self.configCache + "/processed.journal", self.historySize)
+
+    def __keepFile(self):
+        timestamp = int(round(time.time()))
+        self.getHistory().append({"file": self.fileName, "time": timestamp, "data": self.data})
 
 
 class PrivateGatewayHack:
@@ -346,8 +483,7 @@ class PrivateGatewayHack:
     def load_inital_data(cls):
         initial_data_bag = DataBag()
         initial_data_bag.setKey('cmdline')
-        initial_data_bag.load()
-        initial_data = initial_data_bag.getDataBag()
+        initial_data = {'config': initial_data_bag.getItem('config', {})}
         logging.debug("Initial data = %s" % initial_data)
 
         return initial_data
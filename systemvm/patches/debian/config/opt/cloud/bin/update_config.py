@@ -17,44 +17,38 @@
 # under the License.
 
 import sys
-from merge import QueueFile
 import logging
 import subprocess
 from subprocess import PIPE, STDOUT
 import os
 import os.path
-import configure
+import configd
 import json
 
 logging.basicConfig(filename='/var/log/cloud.log', level=logging.DEBUG, format='%(asctime)s  %(filename)s %(funcName)s:%(lineno)d %(message)s')
 
-# first commandline argument should be the file to process
-if (len(sys.argv) != 2):
-    print "[ERROR]: Invalid usage"
-    sys.exit(1)
-
 # FIXME we should get this location from a configuration class
 jsonPath = "/var/cache/cloud/%s"
-jsonCmdConfigPath = jsonPath % sys.argv[1]
 currentGuestNetConfig = "/etc/cloudstack/guestnetwork.json"
 
 
-def finish_config():
+def finish_config(name):
+    import configure
     # Converge
-    returncode = configure.main(sys.argv)
-    sys.exit(returncode)
+    return configure.main([sys.argv[0], name])
 
 
-def process_file():
-    print "[INFO] Processing JSON file %s" % sys.argv[1]
+def process_file(name):
+    from merge import QueueFile
+    print "[INFO] Processing JSON file %s" % name
     qf = QueueFile()
-    qf.setFile(sys.argv[1])
+    qf.setFile(name)
     qf.load(None)
     # Converge
-    finish_config()
+    return finish_config(name)
 
 
-def is_guestnet_configured(guestnet_dict, keys):
+def is_guestnet_configured(guestnet_dict, keys, jsonCmdConfigPath):
 
     existing_keys = []
     new_eth_key = None
@@ -109,32 +103,61 @@ def is_guestnet_configured(guestnet_dict, keys):
 
     return exists
 
-if not (os.path.isfile(jsonCmdConfigPath) and os.access(jsonCmdConfigPath, os.R_OK)):
-    print "[ERROR] update_config.py :: You are telling me to process %s, but i can't access it" % jsonCmdConfigPath
-    sys.exit(1)
-
-# If the command line json file is unprocessed process it
-# This is important or, the control interfaces will get deleted!
-if os.path.isfile(jsonPath % "cmd_line.json"):
-    qf = QueueFile()
-    qf.setFile("cmd_line.json")
-    qf.load(None)
-
-# If the guest network is already configured and have the same IP, do not try to configure it again otherwise it will break
-if sys.argv[1] == "guest_network.json":
-    if os.path.isfile(currentGuestNetConfig):
-        file = open(currentGuestNetConfig)
-        guestnet_dict = json.load(file)
 
-        if not is_guestnet_configured(guestnet_dict, ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9']):
-            print "[INFO] update_config.py :: Processing Guest Network."
-            process_file()
+def process(name):
+    """
+    Applies the push of /var/cache/cloud/<name> and returns the exit code,
+    run in process or by the configuration daemon (configd.py)
+    """
+    # Imported here so that handing a push over to the daemon does not load the cs package
+    from merge import QueueFile, DataBag
+    jsonCmdConfigPath = jsonPath % name
+    if not (os.path.isfile(jsonCmdConfigPath) and os.access(jsonCmdConfigPath, os.R_OK)):
+        print "[ERROR] update_config.py :: You are telling me to process %s, but i can't access it" % jsonCmdConfigPath
+        return 1
+
+    # If the command line json file is unprocessed process it
+    # This is important or, the control interfaces will get deleted!
+    if os.path.isfile(jsonPath % "cmd_line.json"):
+        qf = QueueFile()
+        qf.setFile("cmd_line.json")
+        qf.load(None)
+
+    # If the guest network is already configured and have the same IP, do not try to configure it again otherwise it will break
+    if name == "guest_network.json":
+        if os.path.isfile(currentGuestNetConfig):
+            # The changes of the last pushes may still be in the journal of the data bag
+            db = DataBag()
+            db.setKey("guestnetwork")
+            db.load()
+            guestnet_dict = db.getDataBag()
+
+            if not is_guestnet_configured(guestnet_dict, ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9'], jsonCmdConfigPath):
+                print "[INFO] update_config.py :: Processing Guest Network."
+                return process_file(name)
+            else:
+                print "[INFO] update_config.py :: No need to process Guest Network."
+                return finish_config(name)
         else:
-            print "[INFO] update_config.py :: No need to process Guest Network."
-            finish_config()
+            print "[INFO] update_config.py :: No GuestNetwork configured yet. Configuring first one now."
+            return process_file(name)
     else:
-        print "[INFO] update_config.py :: No GuestNetwork configured yet. Configuring first one now."
-        process_file()
-else:
-    print "[INFO] update_config.py :: Processing incoming file => %s" % sys.argv[1]
-    process_file()
+        print "[INFO] update_config.py :: Processing incoming file => %s" % name
+        return process_file(name)
+
+
+def main(argv):
+    # first commandline argument should be the file to process
+    if (len(argv) != 2):
+        print "[ERROR]: Invalid usage"
+        return 1
+
+    # Hand the push over to the resident configuration daemon, process it here when it is not running
+    returncode = configd.submit(argv[1])
+    if returncode is None:
+        with configd.PushLock():
+            returncode = process(argv[1])
+    return returncode
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,92 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Times CsNetfilters loading and diffing synthetic rulesets, iptables is not called.
+
+    PYTHONPATH=../../patches/debian/config/opt/cloud/bin/ python BenchCsNetfilter.py 10000 100000
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+import mock
+from cs.CsNetfilter import CsNetfilters
+import merge
+
+# Rules per firewall chain
+CHAIN_SIZE = 500
+
+
+def filter_rule(i):
+    return "-A FIREWALL_10.0.%d.1 -s 10.%d.%d.0/24 -p tcp -m tcp --dport %d -j RETURN" % \
+        (i / CHAIN_SIZE % 256, i / 65536 % 256, i / 256 % 256, 1024 + i % 60000)
+
+
+def nat_rule(i):
+    return "-A PREROUTING -d 10.1.%d.%d/32 -p tcp -m tcp --dport %d -j DNAT --to-destination 192.168.%d.%d:22" % \
+        (i / 256 % 256, i % 256, 1024 + i % 60000, i / 256 % 256, i % 256)
+
+
+def ruleset(size, churn):
+    """ The iptables-save output holding size rules and the desired rules, churn of them changed """
+    rules = [("nat", nat_rule(i)) if i % 5 == 0 else ("filter", filter_rule(i)) for i in range(size)]
+    changed = int(size * churn)
+    desired = [[table, "", rule] for (table, rule) in rules[changed:]]
+    desired += [["nat", "", nat_rule(i)] if i % 5 == 0 else ["filter", "", filter_rule(i)]
+                for i in range(size, size + changed)]
+    live = []
+    for table in ("filter", "nat"):
+        live.append("*%s" % table)
+        chains = set(rule.split()[1] for (t, rule) in rules if t == table)
+        live += [":%s - [0:0]" % chain for chain in sorted(chains)]
+        live += [rule for (t, rule) in rules if t == table]
+        live.append("COMMIT")
+    return live, desired
+
+
+def run(size, churn):
+    live, desired = ruleset(size, churn)
+    with mock.patch('cs.CsNetfilter.CsHelper') as helper:
+        helper.execute.return_value = live
+        helper.execute_input.return_value = (0, "", "")
+        started = time.time()
+        netfilters = CsNetfilters()
+        loaded = time.time()
+        netfilters.compare(desired)
+        diffed = time.time()
+    changes = sum(m["commands"] for m in netfilters.transaction.get_metrics())
+    print "%7d rules: load %.3fs, diff %.3fs, %d changes" % (size, loaded - started, diffed - loaded, changes)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] [size ...]")
+    parser.add_option("-c", "--churn", dest="churn", type="float", default=0.05, help="share of the rules to replace")
+    (options, args) = parser.parse_args(argv[1:])
+    dpath = tempfile.mkdtemp()
+    merge.DataBag.DPATH = dpath
+    try:
+        for size in [int(a) for a in args] or [10000, 25000, 50000, 100000]:
+            run(size, options.churn)
+    finally:
+        shutil.rmtree(dpath)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
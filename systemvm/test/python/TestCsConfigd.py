@@ -0,0 +1,104 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import unittest
+import configd
+import merge
+
+
+class TestCsConfigd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        merge.DataBag.DPATH = self.tmp
+        self.path = os.path.join(self.tmp, "configd.sock")
+        self.pushes = []
+        self.daemon = None
+
+    def tearDown(self):
+        if self.daemon is not None:
+            self.daemon.stop()
+            configd.connect(self.path).close()
+            self.thread.join(10)
+        merge.DataBag.cache = None
+        merge.DataBag.DPATH = "."
+        shutil.rmtree(self.tmp)
+
+    def handler(self, name):
+        self.pushes.append(name)
+        if name == "broken.json":
+            raise ValueError("broken")
+        print "[INFO] processed %s" % name
+        return 0 if name != "failed.json" else 1
+
+    def start_daemon(self):
+        self.daemon = configd.ConfigDaemon(self.path, self.handler, os.path.join(self.tmp, "lock"))
+        self.daemon.warm_up()
+        self.daemon.bind()
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+
+    def submit(self, name):
+        out = StringIO.StringIO()
+        return configd.submit(name, self.path, out), out.getvalue()
+
+    def test_no_daemon(self):
+        self.assertEqual(self.submit("ips.json"), (None, ""))
+
+    def test_push(self):
+        self.start_daemon()
+        self.assertEqual(self.submit("ips.json"), (0, "[INFO] processed ips.json\n"))
+        self.assertEqual(self.submit("failed.json")[0], 1)
+        self.assertEqual(self.submit("broken.json")[0], 1)
+        self.assertEqual(self.submit("ips.json")[0], 0)
+        self.assertEqual(self.pushes, ["ips.json", "failed.json", "broken.json", "ips.json"])
+        stats = self.daemon.get_stats()
+        self.assertEqual(stats["pushes"], 4)
+        self.assertEqual(stats["failures"], 2)
+
+    def test_stale_socket(self):
+        self.start_daemon()
+        self.assertRaises(RuntimeError, configd.ConfigDaemon(self.path, self.handler).bind)
+
+    def test_databag_cache(self):
+        merge.DataBag.enable_cache()
+        db = merge.DataBag()
+        db.setKey("koffie")
+        db.load()
+        db.save({"id": "koffie", "eth0": [{"public_ip": "10.0.0.1"}]})
+
+        db.load()
+        bag = db.getDataBag()
+        self.assertEqual(bag["eth0"][0]["public_ip"], "10.0.0.1")
+        bag["eth0"].append({"public_ip": "10.0.0.2"})
+        db.load()
+        self.assertEqual(len(db.getDataBag()["eth0"]), 1)
+
+        # Rewritten by another process
+        with open(os.path.join(self.tmp, "koffie.json"), "w") as handle:
+            json.dump({"id": "koffie", "eth1": []}, handle)
+        db.load()
+        self.assertEqual(sorted(db.getDataBag().keys()), ["eth1", "id"])
+
+if __name__ == '__main__':
+    unittest.main()
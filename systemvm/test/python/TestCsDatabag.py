@@ -15,8 +15,13 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from cs.CsDatabag import CsDataBag
+from journal import BoundedJournal
 import merge
 
 
@@ -29,5 +34,109 @@ class TestCsDatabag(unittest.TestCase):
         csdatabag = CsDataBag("koffie")
         self.assertTrue(csdatabag is not None)
 
+
+class TestDataBagStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        merge.DataBag.DPATH = self.tmp
+
+    def tearDown(self):
+        merge.DataBag.cache = None
+        merge.DataBag.DPATH = "."
+        shutil.rmtree(self.tmp)
+
+    def load(self, key="vmdata"):
+        db = merge.DataBag()
+        db.setKey(key)
+        db.load()
+        return db
+
+    def read(self, name):
+        with open(os.path.join(self.tmp, name)) as handle:
+            return handle.read()
+
+    def test_journal(self):
+        db = self.load()
+        db.save({"id": "vmdata", "10.1.1.10": [["userdata", "user-data", "one"]], "10.1.1.11": []})
+        snapshot = self.read("vmdata.json")
+
+        dbag = self.load().getDataBag()
+        dbag["10.1.1.12"] = [["metadata", "vm-id", "12"]]
+        del dbag["10.1.1.11"]
+        db = self.load()
+        db.save(dbag)
+        # Only the changed keys are written, the data bag file is left alone
+        self.assertEqual(self.read("vmdata.json"), snapshot)
+        self.assertEqual(json.loads(self.read("vmdata.journal")),
+                         {"set": {"10.1.1.12": [["metadata", "vm-id", "12"]]}, "del": ["10.1.1.11"]})
+        self.assertEqual(self.load().getDataBag(), dbag)
+
+        # Saving an unchanged data bag writes nothing
+        db = self.load()
+        db.save(db.getDataBag())
+        self.assertEqual(len(self.read("vmdata.journal").splitlines()), 1)
+
+    def test_compaction(self):
+        db = self.load()
+        db.save({"id": "vmdata", "10.1.1.10": ["x" * 200]})
+        for i in range(3):
+            db = self.load()
+            db.setItem("10.1.1.%d" % (20 + i), i)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "vmdata.journal")))
+        # The journal became bigger than the data bag file
+        db.setItem("10.1.1.11", ["y" * 400])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "vmdata.journal")))
+        self.assertEqual(json.loads(self.read("vmdata.json"))["10.1.1.22"], 2)
+        self.assertEqual(self.load().getDataBag(), db.getDataBag())
+        self.assertEqual([f for f in os.listdir(self.tmp) if f.startswith(".")], [])
+
+    def test_incomplete_record(self):
+        db = self.load()
+        db.save({"id": "vmdata", "10.1.1.10": ["x" * 200]})
+        db.setItem("10.1.1.11", 1)
+        # A crash in the middle of writing a record
+        with open(os.path.join(self.tmp, "vmdata.journal"), "a") as handle:
+            handle.write('{"del":[],"set":{"10.1.1.12":')
+        self.assertEqual(sorted(self.load().getDataBag().keys()), ["10.1.1.10", "10.1.1.11", "id"])
+        self.load().setItem("10.1.1.13", 3)
+        self.assertEqual(sorted(self.load().getDataBag().keys()), ["10.1.1.10", "10.1.1.11", "10.1.1.13", "id"])
+
+    def test_items(self):
+        merge.DataBag.enable_cache()
+        db = self.load()
+        db.save({"id": "vmdata", "10.1.1.10": ["x" * 200]})
+        db = merge.DataBag()
+        db.setKey("vmdata")
+        self.assertEqual(db.getItem("10.1.1.10"), ["x" * 200])
+        self.assertEqual(db.getItem("10.1.1.11", []), [])
+        db.getItem("10.1.1.10").append("y")
+        db.delItem("10.1.1.10")
+        db.delItem("10.1.1.11")
+        self.assertEqual(self.load().getDataBag(), {"id": "vmdata"})
+        # Without the cache
+        merge.DataBag.cache = None
+        db = merge.DataBag()
+        db.setKey("vmdata")
+        self.assertEqual(db.getItem("id"), "vmdata")
+
+    def test_history(self):
+        cache = os.path.join(self.tmp, "cache")
+        os.makedirs(cache)
+        queue = merge.QueueFile()
+        queue.setPath(cache)
+        queue.historySize = 400
+        for i in range(10):
+            name = "vm_data.json.%d" % i
+            with open(os.path.join(cache, name), "w") as handle:
+                json.dump({"type": "vmdata", "vm_ip_address": "10.1.1.%d" % i, "vm_metadata": []}, handle)
+            queue.setFile(name)
+            queue.load(None)
+        self.assertEqual(os.listdir(cache), ["processed.journal"])
+        history = BoundedJournal(os.path.join(cache, "processed.journal"), 400).read()
+        self.assertTrue(0 < len(history) < 10)
+        self.assertEqual(history[-1]["file"], "vm_data.json.9")
+        self.assertEqual(history[-1]["data"]["vm_ip_address"], "10.1.1.9")
+
 if __name__ == '__main__':
     unittest.main()
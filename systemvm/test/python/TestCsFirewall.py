@@ -0,0 +1,152 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from configure import CsFirewall
+import merge
+
+BAGS = {}
+RUNS = []
+
+
+class FakeRules(object):
+    """ Adds a filter rule for every entry of its data bag """
+
+    FW_CHAINS = [("filter", "FW_OUTBOUND")]
+
+    def __init__(self, key, config):
+        self.key = key
+        self.fw = config.get_fw()
+
+    def get_bag(self):
+        return BAGS[self.key]
+
+    def process(self):
+        RUNS.append(self.key)
+        for rule in BAGS[self.key]["rules"]:
+            self.fw.append(["filter", "", rule])
+
+
+class FakeService(FakeRules):
+    """ Also keeps a service running, like the vpns and the load balancer """
+
+    RUN_EVERY_PUSH = True
+
+
+class TestCsFirewall(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        merge.DataBag.DPATH = self.tmp
+        BAGS.clear()
+        BAGS.update({"acl": {"rules": ["-A ACL_INBOUND_eth2 -j DROP"]},
+                     "fwd": {"rules": ["-A FORWARD -i eth0 -j ACCEPT"]}})
+        self.ips = {"eth0": [{"public_ip": "10.1.1.2"}]}
+        self.results = []
+        BAGS["vpn"] = {"rules": ["-A INPUT -i eth1 -p esp -j ACCEPT"]}
+        self.patches = [mock.patch.object(CsFirewall, "GENERATORS", [("acl", FakeRules), ("fwd", FakeRules),
+                                                                     ("vpn", FakeService)]),
+                        mock.patch.object(CsFirewall, "BOOT_ID", os.path.join(self.tmp, "boot_id")),
+                        mock.patch("configure.CsNetfilters")]
+        self.netfilters = [p.start() for p in self.patches][-1].return_value
+        self.netfilters.compare.side_effect = lambda fw, chains: self.results.pop(0) if self.results else True
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        del RUNS[:]
+        merge.DataBag.DPATH = "."
+        shutil.rmtree(self.tmp)
+
+    def push(self, full=False):
+        """ Returns whether the rules were compared, the rules and the chains compared """
+        del RUNS[:]
+        self.netfilters.compare.reset_mock()
+        fw = [["filter", "", "-A INPUT -i eth0 -p tcp -m tcp --dport 3922 -j ACCEPT"]]
+        config = mock.Mock()
+        config.get_fw.return_value = fw
+        config.address.return_value.dbag = self.ips
+        config.cmdline.return_value.dbag = {"config": {"type": "router"}}
+        compared = CsFirewall(config, full).process()
+        chains = self.netfilters.compare.call_args[0][1] if compared else None
+        return compared, fw, chains
+
+    def test_unchanged(self):
+        self.assertEqual(self.push()[::2], (True, None))
+        self.assertEqual(RUNS, ["acl", "fwd", "vpn"])
+        self.assertEqual(self.push(), (False, [["filter", "", "-A INPUT -i eth0 -p tcp -m tcp --dport 3922 -j ACCEPT"],
+                                               ["filter", "", "-A ACL_INBOUND_eth2 -j DROP"],
+                                               ["filter", "", "-A FORWARD -i eth0 -j ACCEPT"],
+                                               ["filter", "", "-A INPUT -i eth1 -p esp -j ACCEPT"]], None))
+        # The service is still looked after
+        self.assertEqual(RUNS, ["vpn"])
+
+    def test_changed_rules(self):
+        self.push()
+        BAGS["fwd"] = {"rules": ["-A FORWARD -i eth1 -j ACCEPT"]}
+        compared, fw, chains = self.push()
+        self.assertEqual(RUNS, ["fwd", "vpn"])
+        self.assertEqual(len(fw), 4)
+        self.assertTrue(("filter", "FORWARD") in chains)
+        self.assertTrue(("filter", "FW_OUTBOUND") in chains)
+        self.assertFalse(("filter", "ACL_INBOUND_eth2") in chains)
+        self.assertFalse(("filter", "INPUT") in chains)
+
+        # Same rules out of a changed data bag
+        BAGS["acl"] = {"rules": ["-A ACL_INBOUND_eth2 -j DROP"], "device": "eth2"}
+        self.assertFalse(self.push()[0])
+        self.assertEqual(RUNS, ["acl", "vpn"])
+
+    def test_full(self):
+        self.push()
+        # The addresses changed
+        self.ips["eth1"] = [{"public_ip": "10.1.1.3"}]
+        self.assertEqual(self.push()[::2], (True, None))
+        self.assertEqual(RUNS, ["acl", "fwd", "vpn"])
+
+        self.assertEqual(self.push(full=True)[::2], (True, None))
+        self.assertFalse(self.push()[0])
+
+        # Rebooted
+        with open(CsFirewall.BOOT_ID, "w") as handle:
+            handle.write("6e2d0e7e-3d4b-4b55-8f2c-0d1c8cc5d2a1\n")
+        self.assertEqual(self.push()[::2], (True, None))
+
+    def test_failed_compare(self):
+        self.push()
+        BAGS["fwd"] = {"rules": []}
+        self.results = [False]
+        self.assertTrue(self.push()[0])
+        # Everything is compared again
+        self.assertEqual(self.push()[::2], (True, None))
+        self.assertEqual(RUNS, ["acl", "fwd", "vpn"])
+
+    def test_changed_service_rules(self):
+        self.push()
+        BAGS["vpn"] = {"rules": ["-A INPUT -i eth1 -p udp -m udp --dport 500 -j ACCEPT"]}
+        compared, fw, chains = self.push()
+        self.assertTrue(compared)
+        self.assertEqual(RUNS, ["vpn"])
+        self.assertTrue(("filter", "INPUT") in chains)
+        self.assertFalse(("filter", "FORWARD") in chains)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,9 +16,24 @@
 # under the License.
 
 import unittest
-from cs.CsNetfilter import CsNetfilter
+import mock
+from cs.CsNetfilter import CsNetfilter, CsNetfilters, CsChainSet
 import merge
 
+IPTABLES_SAVE = """# Generated by iptables-save
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A POSTROUTING -o eth2 -j SNAT --to-source 10.1.1.2
+COMMIT
+*filter
+:INPUT DROP [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -i eth0 -p tcp -m tcp --dport 3922 -j ACCEPT
+-A INPUT -i eth1 -p tcp -m tcp --dport 8080 -j ACCEPT
+COMMIT""".splitlines()
+
 
 class TestCsNetfilter(unittest.TestCase):
 
@@ -29,5 +44,109 @@ class TestCsNetfilter(unittest.TestCase):
         csnetfilter = CsNetfilter()
         self.assertTrue(csnetfilter is not None)
 
+    def test_index(self):
+        with mock.patch('cs.CsNetfilter.CsHelper') as helper:
+            helper.execute.return_value = IPTABLES_SAVE + ["*mangle", "-A INPUT -i eth1 -j ACCEPT", "-A INPUT -i eth1 -j ACCEPT", "COMMIT"]
+            netfilters = CsNetfilters()
+        # The same rule, its options in another order
+        rule = CsNetfilter()
+        rule.parse("-A INPUT -p tcp -m tcp -i eth0 --dport 3922 -j ACCEPT")
+        rule.set_table("filter")
+        self.assertTrue(netfilters.has_rule(rule))
+        rule.set_table("nat")
+        self.assertFalse(netfilters.has_rule(rule))
+
+        # Only the first one of duplicated rules is kept
+        rule = CsNetfilter()
+        rule.parse("-A INPUT -i eth1 -j ACCEPT")
+        rule.set_table("mangle")
+        self.assertTrue(netfilters.has_rule(rule))
+        self.assertEqual([r.seen for r in netfilters.get_chain_rules("mangle", "INPUT")[rule.get_match()]], [True, False])
+
+        # Numbered rules are inserted again
+        rule.set_count(1)
+        self.assertFalse(netfilters.has_rule(rule))
+
+        netfilters.del_rule("filter", "-A INPUT -i eth1 -p tcp -m tcp --dport 8080 -j ACCEPT")
+        self.assertEqual(len(netfilters.get()), 4)
+        self.assertEqual(len(netfilters.get_chain_rules("filter", "INPUT")), 1)
+
+    def compare(self, results, chains=None):
+        """ Runs compare against IPTABLES_SAVE, iptables-restore answering results in turn """
+        with mock.patch('cs.CsNetfilter.CsHelper') as helper:
+            helper.execute.return_value = IPTABLES_SAVE
+            helper.execute_input.side_effect = results
+            netfilters = CsNetfilters()
+            netfilters.compare([["filter", "", "-A INPUT -i eth0 -p tcp -m tcp --dport 3922 -j ACCEPT"],
+                                ["filter", "front", "-A INPUT -i eth2 -p tcp -m tcp --dport 53 -j ACCEPT"],
+                                ["filter", "", "-A FW_EGRESS_RULES -j ACCEPT"],
+                                ["nat", "", "-A PREROUTING -d 10.1.1.2/32 -j FW_10.1.1.2"]], chains)
+            calls = [c[0] for c in helper.execute_input.call_args_list]
+        self.assertEqual([c[0][0] for c in helper.execute.call_args_list], ["iptables-save"])
+        return netfilters, calls
+
+    def test_compare_one_transaction_per_table(self):
+        netfilters, calls = self.compare([(0, "", "")] * 2)
+        self.assertEqual(calls, [("iptables-restore --noflush",
+                                  "*filter\n-N FW_EGRESS_RULES\n-I INPUT -i eth2 -p tcp -m tcp --dport 53 -j ACCEPT\n"
+                                  "-A FW_EGRESS_RULES -j ACCEPT\n-D INPUT -i eth1 -p tcp -m tcp --dport 8080 -j ACCEPT\nCOMMIT\n"),
+                                 ("iptables-restore --noflush",
+                                  "*nat\n-A PREROUTING -d 10.1.1.2/32 -j FW_10.1.1.2\n"
+                                  "-D POSTROUTING -o eth2 -j SNAT --to-source 10.1.1.2\nCOMMIT\n")])
+        self.assertEqual([(m["table"], m["commands"], m["committed"]) for m in netfilters.transaction.get_metrics()],
+                         [("filter", 4, True), ("nat", 2, True)])
+
+    def test_compare_drops_rejected_command(self):
+        netfilters, calls = self.compare([(1, "", "iptables-restore: line 5 failed"), (0, "", ""), (0, "", "")])
+        self.assertEqual(calls[1][1], "*filter\n-N FW_EGRESS_RULES\n-I INPUT -i eth2 -p tcp -m tcp --dport 53 -j ACCEPT\n"
+                                      "-A FW_EGRESS_RULES -j ACCEPT\nCOMMIT\n")
+        metric = netfilters.transaction.get_metrics()[0]
+        self.assertEqual((metric["skipped"], metric["attempts"], metric["committed"]), (1, 2, True))
+
+    def test_compare_rollback(self):
+        netfilters, calls = self.compare([(0, "", ""), (1, "", "iptables-restore: COMMIT failed"), (0, "", "")])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[2], ("iptables-restore", "\n".join(IPTABLES_SAVE[6:]) + "\n"))
+        self.assertFalse(netfilters.transaction.get_metrics()[1]["committed"])
+
+    def test_compare_drops_every_rejected_delete(self):
+        stale = ["-A INPUT -i eth%d -m connmark --mark 0x1/0xff -j ACCEPT" % i for i in range(12)]
+
+        def restore(command, data):
+            # Rejects the stale rules deletes, one at a time as iptables-restore does
+            for number, line in enumerate(data.splitlines(), 1):
+                if line.startswith("-D INPUT -i eth") and "connmark" in line:
+                    return (1, "", "iptables-restore: line %d failed" % number)
+            return (0, "", "")
+
+        with mock.patch('cs.CsNetfilter.CsHelper') as helper:
+            helper.execute.return_value = IPTABLES_SAVE[:-1] + stale + ["COMMIT"]
+            helper.execute_input.side_effect = restore
+            netfilters = CsNetfilters()
+            self.assertTrue(netfilters.compare([["filter", "", "-A INPUT -i eth0 -p tcp -m tcp --dport 3922 -j ACCEPT"]]))
+        metric = [m for m in netfilters.transaction.get_metrics() if m["table"] == "filter"][0]
+        self.assertEqual((metric["skipped"], metric["attempts"], metric["committed"]), (12, 13, True))
+
+    def test_compare_rejected_add(self):
+        netfilters, calls = self.compare([(1, "", "iptables-restore: line 3 failed")])
+        # Nothing was committed before the filter table, there is nothing to roll back
+        self.assertEqual(len(calls), 1)
+        metric = netfilters.transaction.get_metrics()[0]
+        self.assertEqual((metric["skipped"], metric["attempts"], metric["committed"]), (0, 1, False))
+
+    def test_chain_set(self):
+        chains = CsChainSet([("", "INPUT"), ("mangle", "FIREWALL_*")])
+        self.assertTrue(("filter", "INPUT") in chains)
+        self.assertFalse(("nat", "INPUT") in chains)
+        self.assertTrue(("mangle", "FIREWALL_10.1.1.2") in chains)
+        self.assertFalse(("filter", "FIREWALL_10.1.1.2") in chains)
+
+    def test_compare_scope(self):
+        # The rules of the other chains are neither added nor deleted
+        netfilters, calls = self.compare([(0, "", "")], CsChainSet([("nat", "*ROUTING")]))
+        self.assertEqual(calls, [("iptables-restore --noflush",
+                                  "*nat\n-A PREROUTING -d 10.1.1.2/32 -j FW_10.1.1.2\n"
+                                  "-D POSTROUTING -o eth2 -j SNAT --to-source 10.1.1.2\nCOMMIT\n")])
+
 if __name__ == '__main__':
     unittest.main()
@@ -36,7 +36,7 @@ function install_cloud_scripts() {
   rsync -av ./cloud_scripts/ /
   chmod +x /opt/cloud/bin/* \
     /root/{clearUsageRules.sh,reconfigLB.sh,monitorServices.py} \
-    /etc/init.d/{cloud,cloud-early-config,cloud-passwd-srvr,postinit} \
+    /etc/init.d/{cloud,cloud-early-config,cloud-passwd-srvr,cloud-configd,postinit} \
     /etc/cron.daily/cloud-cleanup \
     /etc/profile.d/cloud.sh
 
@@ -44,6 +44,8 @@ function install_cloud_scripts() {
   chkconfig cloud-early-config on
   chkconfig --add cloud-passwd-srvr
   chkconfig cloud-passwd-srvr off
+  chkconfig --add cloud-configd
+  chkconfig cloud-configd on
   chkconfig --add cloud
   chkconfig cloud off
 }
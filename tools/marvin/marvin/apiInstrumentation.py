@@ -0,0 +1,531 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Instrumentation hooks of the API client.
+       CSConnection.marvinRequest reports every call, along with the
+       time spent signing it, on the wire, waiting for its async job
+       and deserializing the response, to the hooks registered on
+       instrumentation. Nothing is measured while no hook is registered.
+       ApiStats keeps per command latency histograms, byte counts and
+       error rates, ApiTracer keeps trace spans nested under the test
+       being run (testClient.identifier)
+'''
+import bisect
+import collections
+import copy
+import csv
+import json
+import threading
+import time
+
+SIGN = "sign"
+HTTP = "http"
+ASYNC_WAIT = "asyncWait"
+DESERIALIZE = "deserialize"
+PHASES = (SIGN, HTTP, ASYNC_WAIT, DESERIALIZE)
+
+
+class ApiCall(object):
+
+    '''
+    @Desc : One marvinRequest as seen by the hooks
+            phases : seconds spent per phase, see PHASES
+            bytesSent, bytesReceived : size of the HTTP requests and
+                                       responses of the call
+            traceRoot : test running when the call was made
+            parent : enclosing call made by the same thread, if any
+    '''
+    __slots__ = ("command", "isAsync", "started", "ended", "phases",
+                 "bytesSent", "bytesReceived", "httpStatus", "jobid",
+                 "error", "traceRoot", "parent", "thread", "spanId")
+
+    def __init__(self, command, traceRoot, parent, spanId):
+        self.command = command
+        self.isAsync = False
+        self.started = time.time()
+        self.ended = None
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.httpStatus = None
+        self.jobid = None
+        self.error = None
+        self.traceRoot = traceRoot
+        self.parent = parent
+        self.thread = threading.current_thread().name
+        self.spanId = spanId
+
+    @property
+    def duration(self):
+        return (self.ended or time.time()) - self.started
+
+
+class InstrumentationHook(object):
+
+    '''
+    @Desc : Base class of the hooks, both methods are called on the
+            thread making the call and must not raise
+    '''
+
+    def callStarted(self, call):
+        pass
+
+    def callEnded(self, call):
+        pass
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+
+class _Phase(object):
+
+    __slots__ = ("call", "phase", "started")
+
+    def __init__(self, call, phase):
+        self.call = call
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.call.phases[self.phase] += time.time() - self.started
+        return False
+
+
+class Instrumentation(object):
+
+    '''
+    @Desc : Process wide registry of the hooks, along with the calls in
+            progress of every thread
+    '''
+    NULL_PHASE = _NullPhase()
+
+    def __init__(self):
+        self.__hooks = ()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__spanIds = iter(xrange(1, 1 << 62)).next
+        self.traceRoot = None
+
+    @property
+    def active(self):
+        return bool(self.__hooks)
+
+    def register(self, hook):
+        '''
+        @Name : register
+        @Desc : Adds a hook, a hook registered twice is called once
+        '''
+        with self.__lock:
+            if hook not in self.__hooks:
+                self.__hooks = self.__hooks + (hook,)
+        return hook
+
+    def unregister(self, hook):
+        with self.__lock:
+            self.__hooks = tuple(h for h in self.__hooks if h is not hook)
+
+    def setTraceRoot(self, name):
+        '''
+        @Name : setTraceRoot
+        @Desc : Names the test the next calls belong to, set along with
+                testClient.identifier
+        '''
+        self.traceRoot = name
+
+    def current(self):
+        '''
+        @Name : current
+        @Desc : Returns the call in progress on the calling thread
+        '''
+        stack = getattr(self.__local, "stack", None)
+        return stack[-1] if stack else None
+
+    def startCall(self, command):
+        '''
+        @Name : startCall
+        @Desc : Opens a call on the calling thread
+        @Output : ApiCall, None when no hook is registered
+        '''
+        hooks = self.__hooks
+        if not hooks:
+            return None
+        stack = getattr(self.__local, "stack", None)
+        if stack is None:
+            stack = self.__local.stack = []
+        call = ApiCall(command, self.traceRoot,
+                       stack[-1] if stack else None, self.__spanIds())
+        stack.append(call)
+        for hook in hooks:
+            hook.callStarted(call)
+        return call
+
+    def endCall(self, call, error=None):
+        '''
+        @Name : endCall
+        @Desc : Closes the call opened by startCall and hands it to the
+                hooks
+        '''
+        if call is None:
+            return
+        call.ended = time.time()
+        if error is not None:
+            call.error = error
+        stack = self.__local.stack
+        if call in stack:
+            stack.remove(call)
+        for hook in self.__hooks:
+            hook.callEnded(call)
+
+    def phase(self, name):
+        '''
+        @Name : phase
+        @Desc : Context manager charging the enclosed block to the given
+                phase of the call in progress on the calling thread
+        '''
+        stack = getattr(self.__local, "stack", None)
+        if not stack:
+            return Instrumentation.NULL_PHASE
+        return _Phase(stack[-1], name)
+
+    def addBytes(self, sent, received, status=None):
+        call = self.current()
+        if call is not None:
+            call.bytesSent += sent
+            call.bytesReceived += received
+            call.httpStatus = status
+
+
+instrumentation = Instrumentation()
+
+
+class Histogram(object):
+
+    '''
+    @Desc : Latency histogram with fixed, roughly logarithmic buckets
+            (1ms to 30min), the percentiles are bucket upper bounds
+    '''
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(Histogram.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else \
+                    min(self.min, value)
+                self.max = value if self.max is None else \
+                    max(self.max, value)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(Histogram.BOUNDS):
+                    return min(Histogram.BOUNDS[i], self.max)
+                return self.max
+        return self.max
+
+    def toDict(self):
+        return {"count": self.count,
+                "total": round(self.total, 6),
+                "mean": round(self.total / self.count, 6)
+                if self.count else None,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "buckets": dict(("le_%s" % bound, count) for bound, count
+                                in zip(Histogram.BOUNDS + ("inf",),
+                                       self.counts) if count)}
+
+
+class CommandStats(object):
+
+    '''
+    @Desc : Aggregated calls of one command
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.latency = Histogram()
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+
+    def add(self, call):
+        self.calls += 1
+        if call.error is not None:
+            self.errors += 1
+        self.bytesSent += call.bytesSent
+        self.bytesReceived += call.bytesReceived
+        self.latency.add(call.duration)
+        for phase in PHASES:
+            self.phases[phase].add(call.phases[phase])
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.bytesSent += other.bytesSent
+        self.bytesReceived += other.bytesReceived
+        self.latency.merge(other.latency)
+        for phase in PHASES:
+            self.phases[phase].merge(other.phases[phase])
+
+    def toDict(self):
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "errorRate": round(float(self.errors) / self.calls, 4)
+                if self.calls else 0.0,
+                "bytesSent": self.bytesSent,
+                "bytesReceived": self.bytesReceived,
+                "latency": self.latency.toDict(),
+                "phases": dict((phase, self.phases[phase].toDict())
+                               for phase in PHASES)}
+
+
+class ApiStats(InstrumentationHook):
+
+    '''
+    @Desc : Per command latency histograms (whole call and per phase),
+            byte counts and error rates of the calls made while the hook
+            is registered
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__commands = {}
+        self.started = time.time()
+
+    def callEnded(self, call):
+        with self.__lock:
+            stats = self.__commands.get(call.command)
+            if stats is None:
+                stats = self.__commands[call.command] = CommandStats()
+            stats.add(call)
+
+    def getCommands(self):
+        with self.__lock:
+            return copy.deepcopy(self.__commands)
+
+    def getTotal(self):
+        total = CommandStats()
+        for stats in self.getCommands().values():
+            total.merge(stats)
+        return total
+
+    def toDict(self):
+        commands = self.getCommands()
+        total = CommandStats()
+        for stats in commands.values():
+            total.merge(stats)
+        return {"started": self.started,
+                "elapsed": round(time.time() - self.started, 3),
+                "total": total.toDict(),
+                "commands": dict((name, stats.toDict()) for name, stats
+                                 in commands.iteritems())}
+
+    def exportJson(self, path):
+        with open(path, "w") as out:
+            json.dump(self.toDict(), out, indent=2, sort_keys=True)
+
+    def exportCsv(self, path):
+        '''
+        @Name : exportCsv
+        @Desc : Writes one row per command with the mean and percentiles
+                of the call and of every phase
+        '''
+        columns = ["command", "calls", "errors", "errorRate", "bytesSent",
+                   "bytesReceived"]
+        for name in ("latency",) + PHASES:
+            columns.extend("%s_%s" % (name, stat) for stat in
+                           ("mean", "p50", "p90", "p99", "max"))
+        with open(path, "wb") as out:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for command, stats in sorted(self.getCommands().iteritems()):
+                record = stats.toDict()
+                row = [command] + [record[c] for c in columns[1:6]]
+                for name in ("latency",) + PHASES:
+                    histogram = record["latency"] if name == "latency" \
+                        else record["phases"][name]
+                    row.extend(histogram[stat] for stat in
+                               ("mean", "p50", "p90", "p99", "max"))
+                writer.writerow(row)
+
+    def summary(self, top=15):
+        '''
+        @Name : summary
+        @Desc : Returns a printable table of the commands taking the
+                most time
+        '''
+        commands = self.getCommands()
+        total = CommandStats()
+        for stats in commands.values():
+            total.merge(stats)
+        lines = ["API calls: %d, errors: %d, sent: %d bytes, received: "
+                 "%d bytes" % (total.calls, total.errors, total.bytesSent,
+                               total.bytesReceived)]
+        if not total.calls:
+            return lines[0]
+        header = "%-40s %7s %6s" + " %9s" * 7
+        lines.append(header % ("Command", "Calls", "Err%", "Mean(s)",
+                               "p90(s)", "Max(s)", "Sign", "HTTP",
+                               "Async", "Deser"))
+
+        def row(name, stats):
+            latency = stats.latency
+            return header % (
+                name[:40], stats.calls,
+                "%.1f" % (100.0 * stats.errors / stats.calls),
+                "%.3f" % (latency.total / latency.count),
+                "%.3f" % latency.percentile(0.9), "%.3f" % latency.max,
+                "%.3f" % stats.phases[SIGN].total,
+                "%.3f" % stats.phases[HTTP].total,
+                "%.3f" % stats.phases[ASYNC_WAIT].total,
+                "%.3f" % stats.phases[DESERIALIZE].total)
+        ranked = sorted(commands.iteritems(),
+                        key=lambda item: item[1].latency.total,
+                        reverse=True)
+        for name, stats in ranked[:top]:
+            lines.append(row(name, stats))
+        lines.append(row("TOTAL", total))
+        return "\n".join(lines)
+
+
+class ApiTracer(InstrumentationHook):
+
+    '''
+    @Desc : Keeps a trace span per call, nested under the span of the
+            test it was made in and under its enclosing call, exported
+            in the trace event format (chrome://tracing, Perfetto)
+    @Input : maxSpans : most recent calls kept
+    '''
+
+    def __init__(self, maxSpans=100000):
+        self.__lock = threading.Lock()
+        self.__spans = collections.deque(maxlen=maxSpans)
+        self.__roots = collections.OrderedDict()
+
+    def callEnded(self, call):
+        span = {"id": call.spanId,
+                "parent": call.parent.spanId if call.parent else None,
+                "root": call.traceRoot,
+                "name": call.command,
+                "thread": call.thread,
+                "start": call.started,
+                "duration": call.duration,
+                "phases": dict((phase, round(seconds, 6)) for phase, seconds
+                               in call.phases.iteritems() if seconds),
+                "jobid": call.jobid,
+                "error": str(call.error) if call.error is not None
+                else None}
+        with self.__lock:
+            self.__spans.append(span)
+            root = self.__roots.get(call.traceRoot)
+            if root is None:
+                self.__roots[call.traceRoot] = [call.started, call.ended]
+            else:
+                root[0] = min(root[0], call.started)
+                root[1] = max(root[1], call.ended)
+
+    def getSpans(self):
+        '''
+        @Name : getSpans
+        @Desc : Returns the root span of every test, with the spans of
+                its calls (and theirs) as children
+        '''
+        with self.__lock:
+            spans = [dict(span, children=[]) for span in self.__spans]
+            roots = [{"name": name, "start": bounds[0],
+                      "duration": bounds[1] - bounds[0], "children": []}
+                     for name, bounds in self.__roots.iteritems()]
+        byId = dict((span["id"], span) for span in spans)
+        byRoot = dict((root["name"], root) for root in roots)
+        for span in spans:
+            parent = byId.get(span["parent"])
+            if parent is not None:
+                parent["children"].append(span)
+            else:
+                byRoot[span["root"]]["children"].append(span)
+        return roots
+
+    def exportJson(self, path):
+        '''
+        @Name : exportJson
+        @Desc : Writes the spans as trace events, every test is a
+                process of the trace and every thread a track
+        '''
+        with self.__lock:
+            spans = list(self.__spans)
+            roots = list(self.__roots.iteritems())
+        pids = dict((name, index + 1) for index, (name, bounds)
+                    in enumerate(roots))
+        events = []
+        for name, (start, end) in roots:
+            events.append({"name": "process_name", "ph": "M",
+                           "pid": pids[name],
+                           "args": {"name": str(name)}})
+            events.append({"name": str(name), "cat": "test", "ph": "X",
+                           "pid": pids[name], "tid": "test",
+                           "ts": int(start * 1e6),
+                           "dur": int((end - start) * 1e6)})
+        for span in spans:
+            args = {"jobid": span["jobid"], "error": span["error"]}
+            args.update(span["phases"])
+            events.append({"name": span["name"], "cat": "api", "ph": "X",
+                           "pid": pids[span["root"]],
+                           "tid": span["thread"],
+                           "ts": int(span["start"] * 1e6),
+                           "dur": int(span["duration"] * 1e6),
+                           "args": args})
+        with open(path, "w") as out:
+            json.dump({"traceEvents": events,
+                       "displayTimeUnit": "ms"}, out)
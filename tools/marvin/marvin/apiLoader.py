@@ -0,0 +1,163 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: On demand loading of the generated cloudstackAPI package.
+       The package binds a LazyModule per command instead of importing
+       the command modules, so "from marvin.cloudstackAPI import *"
+       costs one small object per command. A command module is imported
+       the first time one of its attributes is used, the api clients
+       create the method of a command on its first call, the commands
+       and their parameters are known from the generated apiIndex
+       without importing anything.
+       Benchmark : python -m marvin.apiLoader
+'''
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+
+    '''
+    @Desc : Stands for a module until one of its attributes is used,
+            it then imports the module and takes over its namespace
+    '''
+
+    def __getattr__(self, name):
+        module = self.__load()
+        try:
+            return getattr(module, name)
+        except AttributeError:
+            raise AttributeError("'module' object %s has no attribute '%s'"
+                                 % (self.__name__, name))
+
+    def __load(self):
+        fullName = self.__name__
+        module = sys.modules.get(fullName)
+        if module is None:
+            __import__(fullName)
+            module = sys.modules[fullName]
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self.__name__
+
+
+def install(namespace, packageName, names):
+    '''
+    @Name : install
+    @Desc : Binds a LazyModule for each of the names not already
+            defined in the namespace of the package
+    '''
+    for name in names:
+        if name in namespace:
+            continue
+        module = sys.modules.get("%s.%s" % (packageName, name))
+        namespace[name] = module if module is not None else \
+            LazyModule("%s.%s" % (packageName, name))
+
+
+def responseClass(packageName, name):
+    '''
+    @Name : responseClass
+    @Desc : Imports the module of a command and returns its response
+            class
+    '''
+    fullName = "%s.%s" % (packageName, name)
+    if fullName not in sys.modules:
+        __import__(fullName)
+    return getattr(sys.modules[fullName], name + "Response")
+
+
+if __name__ == "__main__":
+    '''
+    Compares the start up time and the RSS of a process importing the
+    api package eagerly (every command module, as the package used to)
+    and lazily, each scenario running in a fresh interpreter
+    '''
+    import optparse
+    import subprocess
+    import time
+
+    parser = optparse.OptionParser()
+    parser.add_option("-r", "--runs", dest="runs", type="int", default=5,
+                      help="interpreters started per scenario")
+    parser.add_option("--scenario", dest="scenario",
+                      help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    def residentSize():
+        '''
+        RSS in KB once the scenario ran, the peak (VmHWM, ru_maxrss) is
+        set by the start of the interpreter, not by the imports
+        '''
+        try:
+            with open("/proc/self/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except IOError:
+            pass
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if options.scenario:
+        started = time.time()
+        if options.scenario == "baseline":
+            import marvin
+        else:
+            from marvin.cloudstackAPI import *
+            from marvin.cloudstackAPI.apiIndex import COMMANDS
+            from marvin.cloudstackAPI.cloudstackAPIClient import \
+                CloudStackAPIClient
+            if options.scenario == "eager":
+                for command in COMMANDS:
+                    __import__("marvin.cloudstackAPI." + command)
+            client = CloudStackAPIClient(None)
+            '''
+            What a typical test uses: a few commands
+            '''
+            for command in ("listZones", "listTemplates",
+                            "deployVirtualMachine"):
+                if command in COMMANDS:
+                    getattr(client, command)
+        print "%.6f %d %d" % (time.time() - started, residentSize(),
+                              len([m for m, module in sys.modules.items()
+                                   if module is not None and
+                                   m.startswith("marvin.cloudstackAPI.")]))
+        sys.exit(0)
+
+    results = {}
+    for scenario in ("baseline", "eager", "lazy"):
+        samples = []
+        for i in range(options.runs):
+            out = subprocess.check_output(
+                [sys.executable, "-m", "marvin.apiLoader",
+                 "--scenario", scenario])
+            elapsed, rss, modules = out.split()
+            samples.append((float(elapsed), int(rss), int(modules)))
+        samples.sort()
+        results[scenario] = samples[len(samples) / 2]
+        print "%-8s import %.1fms, RSS %.1fMB, %d api modules " \
+              "loaded (median of %d)" % \
+              (scenario, results[scenario][0] * 1000,
+               results[scenario][1] / 1024.0, results[scenario][2],
+               options.runs)
+    base = results["baseline"][1]
+    print "RSS over the bare marvin import: eager +%.1fMB, lazy +%.1fMB" % \
+        ((results["eager"][1] - base) / 1024.0,
+         (results["lazy"][1] - base) / 1024.0)
@@ -0,0 +1,775 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Single threaded, non blocking API client for load generation.
+       A Reactor multiplexes the sockets of an AsyncHttpPool with
+       select.poll and runs generator based coroutines: a coroutine
+       yields a Future, another coroutine or a list of them and is
+       resumed with the result, raise Return(value) ends it with a value.
+       AsyncConnection signs the commands like CSConnection, sends them
+       over pooled keep-alive connections and waits for the async jobs
+       from one sweeping coroutine, no thread is needed whatever the
+       number of outstanding calls. The generated
+       cloudstackAPI.cloudstackAPIAsyncClient exposes every command:
+
+           def user(api):
+               zones = yield api.listZones(listZones.listZonesCmd())
+               vm = yield api.deployVirtualMachine(cmd)
+               raise Return(vm)
+
+           reactor = Reactor()
+           api = CloudStackAPIAsyncClient(AsyncConnection(conn, reactor))
+           vm = reactor.run(reactor.spawn(user(api)))
+'''
+import collections
+import errno
+import heapq
+import itertools
+import json
+import random
+import select
+import socket
+import sys
+import time
+import types
+import urllib
+import jsonHelper
+from marvin.apiInstrumentation import (ApiCall, ApiStats,
+                                       SIGN, HTTP, ASYNC_WAIT, DESERIALIZE)
+from marvin.asyncJobPoller import (sweepCommand, SWEEP_PAGE_SIZE,
+                                   SWEEP_MAX_PAGES)
+from marvin.cloudstackAPI import queryAsyncJobResult
+from marvin.cloudstackException import (CloudstackAPIException,
+                                        InvalidParameterException)
+from marvin.codes import (JOB_INPROGRESS, JOB_FAILED)
+
+
+class Return(Exception):
+
+    '''
+    @Desc : Raised by a coroutine to end with a value
+    '''
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+
+    '''
+    @Desc : Result of an operation not completed yet
+    '''
+    __slots__ = ("done", "result", "excInfo", "callbacks")
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.excInfo = None
+        self.callbacks = []
+
+    def addCallback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+
+    def set(self, result):
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        self.__complete()
+
+    def fail(self, error):
+        '''
+        @Input : error : exception or sys.exc_info() tuple
+        '''
+        if self.done:
+            return
+        if not isinstance(error, tuple):
+            error = (type(error), error, None)
+        self.done = True
+        self.excInfo = error
+        self.__complete()
+
+    def __complete(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def get(self):
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.result
+
+
+def gather(futures):
+    '''
+    @Name : gather
+    @Desc : Future of the list of results of futures, failing with the
+            first failure
+    '''
+    combined = Future()
+    futures = list(futures)
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    if not futures:
+        combined.set(results)
+
+    def collect(index, future):
+        if future.excInfo is not None:
+            combined.fail(future.excInfo)
+            return
+        results[index] = future.result
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            combined.set(results)
+    for index, future in enumerate(futures):
+        future.addCallback(lambda f, index=index: collect(index, f))
+    return combined
+
+
+class Task(Future):
+
+    '''
+    @Desc : Coroutine run by the reactor, done when the coroutine ends
+    '''
+    __slots__ = ("reactor", "coroutine")
+
+    def __init__(self, reactor, coroutine):
+        Future.__init__(self)
+        self.reactor = reactor
+        self.coroutine = coroutine
+        reactor.callSoon(self.__step, None, None)
+
+    def __step(self, value, excInfo):
+        try:
+            if excInfo is not None:
+                yielded = self.coroutine.throw(*excInfo)
+            else:
+                yielded = self.coroutine.send(value)
+        except StopIteration:
+            self.set(None)
+            return
+        except Return as r:
+            self.set(r.value)
+            return
+        except Exception:
+            self.fail(sys.exc_info())
+            return
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self.reactor, yielded)
+        elif isinstance(yielded, (list, tuple)):
+            yielded = gather(Task(self.reactor, item)
+                             if isinstance(item, types.GeneratorType)
+                             else item for item in yielded)
+        if not isinstance(yielded, Future):
+            self.reactor.callSoon(
+                self.__step, None,
+                (TypeError, TypeError("coroutine yielded %r, not a Future"
+                                      % (yielded,)), None))
+            return
+        yielded.addCallback(self.__resume)
+
+    def __resume(self, future):
+        self.reactor.callSoon(self.__step, future.result, future.excInfo)
+
+
+class Timer(object):
+
+    __slots__ = ("when", "fn", "args", "cancelled")
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor(object):
+
+    '''
+    @Desc : Event loop of the sockets, timers and coroutines of one
+            thread
+    '''
+    READ = select.POLLIN | select.POLLPRI
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def __init__(self):
+        self.__poller = select.poll()
+        self.__handlers = {}
+        self.__timers = []
+        self.__sequence = itertools.count()
+        self.__ready = collections.deque()
+
+    def callSoon(self, fn, *args):
+        self.__ready.append((fn, args))
+
+    def callLater(self, delay, fn, *args):
+        '''
+        @Name : callLater
+        @Output : Timer, see Timer.cancel
+        '''
+        timer = Timer(time.time() + delay, fn, args)
+        heapq.heappush(self.__timers,
+                       (timer.when, next(self.__sequence), timer))
+        return timer
+
+    def sleep(self, delay):
+        future = Future()
+        self.callLater(delay, future.set, None)
+        return future
+
+    def spawn(self, coroutine):
+        '''
+        @Name : spawn
+        @Desc : Schedules a coroutine (generator)
+        @Output : Task, the future of its result
+        '''
+        return Task(self, coroutine)
+
+    def watch(self, sock, events, handler):
+        '''
+        @Name : watch
+        @Desc : Calls handler(events) when sock is ready for events,
+                an events of 0 stops watching sock
+        '''
+        fd = sock.fileno()
+        if not events:
+            if self.__handlers.pop(fd, None) is not None:
+                self.__poller.unregister(fd)
+            return
+        if fd in self.__handlers:
+            self.__poller.modify(fd, events)
+        else:
+            self.__poller.register(fd, events)
+        self.__handlers[fd] = handler
+
+    def run(self, until=None):
+        '''
+        @Name : run
+        @Desc : Runs the loop until the future is done, or until there is
+                nothing left to do
+        @Output : result of until
+        '''
+        while until is None or not until.done:
+            while self.__ready:
+                fn, args = self.__ready.popleft()
+                fn(*args)
+                if until is not None and until.done:
+                    return until.get()
+            now = time.time()
+            while self.__timers and self.__timers[0][0] <= now:
+                timer = heapq.heappop(self.__timers)[2]
+                if not timer.cancelled:
+                    timer.fn(*timer.args)
+            if self.__ready:
+                continue
+            if not self.__handlers and \
+                    all(entry[2].cancelled for entry in self.__timers):
+                break
+            timeout = None
+            if self.__timers:
+                timeout = max(self.__timers[0][0] - time.time(), 0)
+            try:
+                events = self.__poller.poll(
+                    timeout * 1000 if timeout is not None else None)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                handler = self.__handlers.get(fd)
+                if handler is not None:
+                    handler(event)
+        if until is None:
+            return None
+        if not until.done:
+            raise RuntimeError("Nothing left to run, the future can "
+                               "never complete")
+        return until.get()
+
+
+class HttpError(Exception):
+    pass
+
+
+class _HttpConnection(object):
+
+    '''
+    One keep-alive HTTP/1.1 connection of an AsyncHttpPool
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.reactor = pool.reactor
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        code = self.sock.connect_ex((pool.host, pool.port))
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(code, errno.errorcode.get(code, code))
+        self.used = 0
+        self.closed = False
+        self.future = None
+        self.timer = None
+
+    def send(self, data, timeout):
+        self.future = Future()
+        self.out = data
+        self.buffer = []
+        self.received = 0
+        self.head = None
+        self.used += 1
+        self.timer = self.reactor.callLater(timeout, self.__timeout)
+        self.reactor.watch(self.sock, Reactor.WRITE | Reactor.ERROR,
+                           self.__onEvent)
+        return self.future
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.reactor.watch(self.sock, 0, None)
+            self.sock.close()
+
+    def __timeout(self):
+        self.__fail(TimeoutError("no response from %s:%s" %
+                                 (self.pool.host, self.pool.port)))
+
+    def __fail(self, error):
+        self.close()
+        if self.timer is not None:
+            self.timer.cancel()
+        future, self.future = self.future, None
+        if future is not None:
+            future.fail(error)
+
+    def __onEvent(self, event):
+        try:
+            if event & Reactor.WRITE and self.out:
+                sent = self.sock.send(self.out)
+                self.out = self.out[sent:]
+                if not self.out:
+                    self.reactor.watch(self.sock, Reactor.READ | Reactor.ERROR,
+                                       self.__onEvent)
+                return
+            if event & (Reactor.READ | Reactor.ERROR):
+                chunk = self.sock.recv(65536)
+                if not chunk and self.head is not None and \
+                        self.head[2] is None:
+                    self.__complete("".join(self.buffer)[self.head[1]:],
+                                    False)
+                    return
+                if not chunk:
+                    self.__fail(HttpError("connection closed by %s:%s" %
+                                          (self.pool.host, self.pool.port)))
+                    return
+                self.buffer.append(chunk)
+                self.received += len(chunk)
+                self.__parse()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__fail(e)
+
+    def __parse(self):
+        data = "".join(self.buffer)
+        self.buffer = [data]
+        if self.head is None:
+            end = data.find("\r\n\r\n")
+            if end < 0:
+                return
+            lines = data[:end].split("\r\n")
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            '''
+            (status, body offset, framing), a framing of None means the
+            body ends with the connection
+            '''
+            framing = None
+            if "content-length" in headers:
+                framing = int(headers["content-length"])
+            elif headers.get("transfer-encoding", "").lower() == "chunked":
+                framing = "chunked"
+            self.head = (int(lines[0].split()[1]), end + 4, framing)
+            self.keepAlive = framing is not None and \
+                headers.get("connection", "").lower() != "close"
+        status, start, framing = self.head
+        if framing is None:
+            return
+        if framing == "chunked":
+            body = self.__dechunk(data, start)
+        elif len(data) - start >= framing:
+            body = data[start:start + framing]
+        else:
+            body = None
+        if body is not None:
+            self.__complete(body, self.keepAlive)
+
+    def __complete(self, body, keepAlive):
+        self.reactor.watch(self.sock, 0, None)
+        self.timer.cancel()
+        future, self.future = self.future, None
+        self.pool.release(self, keepAlive)
+        future.set((self.head[0], body, self.received))
+
+    def __dechunk(self, data, position):
+        chunks = []
+        while True:
+            end = data.find("\r\n", position)
+            if end < 0:
+                return None
+            size = int(data[position:end].split(";")[0], 16)
+            if size == 0:
+                if data.find("\r\n", end + 2) < 0:
+                    return None
+                return "".join(chunks)
+            if len(data) < end + 2 + size + 2:
+                return None
+            chunks.append(data[end + 2:end + 2 + size])
+            position = end + 2 + size + 2
+
+
+class AsyncHttpPool(object):
+
+    '''
+    @Desc : Keep-alive connections to one host:port, at most
+            maxConnections of them, the requests beyond that wait for a
+            free connection
+    '''
+
+    def __init__(self, reactor, host, port, maxConnections=100,
+                 timeout=120):
+        self.reactor = reactor
+        self.host = host
+        self.port = port
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.__idle = []
+        self.__waiters = collections.deque()
+        self.__open = 0
+        self.stats = {"requests": 0, "connections": 0, "reused": 0,
+                      "waits": 0, "retries": 0}
+
+    def __acquire(self):
+        future = Future()
+        while self.__idle:
+            connection = self.__idle.pop()
+            if not connection.closed:
+                self.stats["reused"] += 1
+                future.set(connection)
+                return future
+        if self.__open < self.maxConnections:
+            self.__open += 1
+            self.stats["connections"] += 1
+            try:
+                future.set(_HttpConnection(self))
+            except Exception:
+                self.__open -= 1
+                future.fail(sys.exc_info())
+            return future
+        self.stats["waits"] += 1
+        self.__waiters.append(future)
+        return future
+
+    def release(self, connection, keepAlive=True):
+        if not keepAlive:
+            connection.close()
+        if connection.closed:
+            self.__open -= 1
+            if self.__waiters:
+                self.__open += 1
+                self.stats["connections"] += 1
+                try:
+                    self.__waiters.popleft().set(_HttpConnection(self))
+                except Exception:
+                    self.__open -= 1
+            return
+        if self.__waiters:
+            self.__waiters.popleft().set(connection)
+        else:
+            self.__idle.append(connection)
+
+    def request(self, method, path, params):
+        '''
+        @Name : request
+        @Desc : Sends a GET (params in the query string) or POST (params
+                form encoded) request
+        @Output : Future of (status, body, bytes received, bytes sent)
+        '''
+        query = urllib.urlencode(params)
+        if method == "POST":
+            data = "POST %s HTTP/1.1\r\nHost: %s:%s\r\nContent-Type: " \
+                   "application/x-www-form-urlencoded\r\nContent-Length: " \
+                   "%d\r\n\r\n%s" % (path, self.host, self.port, len(query),
+                                     query)
+        else:
+            data = "GET %s?%s HTTP/1.1\r\nHost: %s:%s\r\n\r\n" % \
+                   (path, query, self.host, self.port)
+        return self.reactor.spawn(self.__request(data))
+
+    def __request(self, data):
+        self.stats["requests"] += 1
+        for attempt in (0, 1):
+            connection = yield self.__acquire()
+            reused = connection.used > 0
+            try:
+                status, body, received = yield connection.send(
+                    data, self.timeout)
+            except (HttpError, socket.error):
+                self.release(connection)
+                '''
+                A kept alive connection may have been closed by the
+                server meanwhile, retry once on a new one
+                '''
+                if attempt == 0 and reused:
+                    self.stats["retries"] += 1
+                    continue
+                raise
+            except Exception:
+                self.release(connection)
+                raise
+            raise Return((status, body, received, len(data)))
+
+
+class _PendingJob(object):
+
+    __slots__ = ("jobid", "responsecls", "future", "deadline", "nextPoll",
+                 "polls", "started")
+
+    def __init__(self, jobid, responsecls, timeout, nextPoll):
+        self.jobid = jobid
+        self.responsecls = responsecls
+        self.future = Future()
+        self.started = time.time()
+        self.deadline = self.started + timeout
+        self.nextPoll = self.started + nextPoll
+        self.polls = 0
+
+
+class AsyncConnection(object):
+
+    '''
+    @Desc : Non blocking counterpart of CSConnection, all of its
+            methods are to be called from the reactor thread
+    @Input : connection : CSConnection providing the endpoint and the
+                          credentials, and signing the commands
+             reactor : Reactor running the calls
+             maxConnections : size of the HTTP connection pool
+             initialInterval, maxInterval : polling interval of the
+                                            async jobs
+             sweepThreshold : outstanding jobs from which one
+                              listAsyncJobs call answers for all of them
+    Every call is also recorded in stats, an apiInstrumentation.ApiStats
+    '''
+
+    def __init__(self, connection, reactor, maxConnections=100,
+                 initialInterval=0.5, maxInterval=5.0, sweepThreshold=2):
+        if connection.protocol != "http":
+            raise InvalidParameterException(
+                "The async client only supports http")
+        self.connection = connection
+        self.reactor = reactor
+        self.asyncTimeout = connection.asyncTimeout
+        self.path = "/" + connection.path.lstrip("/")
+        self.pool = AsyncHttpPool(reactor, connection.mgtSvr,
+                                  int(connection.port), maxConnections)
+        self.initialInterval = initialInterval
+        self.maxInterval = maxInterval
+        self.sweepThreshold = sweepThreshold
+        self.stats = ApiStats()
+        self.__pending = {}
+        self.__sweeper = None
+
+    def __copy__(self):
+        '''
+        The copies share the pool and the job sweeper
+        '''
+        return self
+
+    def request(self, cmd, response_type=None, method='GET', wait=True):
+        '''
+        @Name : request
+        @Desc : Sends a command, see CSConnection.marvinRequest
+        @Output : Future of the response, of the job result for the async
+                  commands unless wait is False
+        '''
+        return self.reactor.spawn(self.__request(cmd, response_type,
+                                                 method, wait))
+
+    def __request(self, cmd, response_type, method, wait):
+        call = ApiCall(cmd.__class__.__name__.replace("Cmd", ""),
+                       None, None, 0)
+        try:
+            started = time.time()
+            cmd_name, is_async, payload = self.connection.signRequest(cmd)
+            call.phases[SIGN] = time.time() - started
+            started = time.time()
+            status, body, received, sent = yield self.pool.request(
+                method, self.path, payload)
+            call.phases[HTTP] = time.time() - started
+            call.bytesSent, call.bytesReceived = sent, received
+            call.httpStatus = status
+            started = time.time()
+            try:
+                ret = jsonHelper.getResultObj(json.loads(body),
+                                              response_type)
+            except ValueError:
+                raise HttpError("HTTP %s: %s" % (status, body[:200]))
+            call.phases[DESERIALIZE] = time.time() - started
+            if is_async == "false" or not wait:
+                raise Return(ret)
+            call.isAsync = True
+            call.jobid = ret.jobid
+            started = time.time()
+            response = yield self.poll(ret.jobid, response_type)
+            call.phases[ASYNC_WAIT] = time.time() - started
+            if response.jobstatus == JOB_FAILED:
+                raise CloudstackAPIException(cmd_name,
+                                             "Job failed: %s" % response)
+            raise Return(response.jobresult)
+        except Return:
+            raise
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            call.ended = time.time()
+            self.stats.callEnded(call)
+
+    def poll(self, jobid, response_cls=None, timeout=None):
+        '''
+        @Name : poll
+        @Desc : Waits for an async job
+        @Output : Future of the queryAsyncJobResult response of the job
+        '''
+        job = _PendingJob(jobid, response_cls, timeout or self.asyncTimeout,
+                          self.__interval(0))
+        self.__pending[jobid] = job
+        if self.__sweeper is None:
+            self.__sweeper = self.reactor.spawn(self.__sweep())
+        return job.future
+
+    def __interval(self, polls):
+        interval = min(self.maxInterval,
+                       self.initialInterval * (2 ** polls))
+        return interval * (1 + random.uniform(-0.2, 0.2))
+
+    def __sweep(self):
+        '''
+        Polls the outstanding jobs, a listAsyncJobs call answers for all
+        of them once there are enough, only the finished ones are then
+        queried
+        '''
+        try:
+            while self.__pending:
+                delay = min(job.nextPoll for job in
+                            self.__pending.itervalues()) - time.time()
+                if delay > 0:
+                    '''
+                    Wakes up early enough for the jobs added meanwhile
+                    '''
+                    yield self.reactor.sleep(min(delay,
+                                                 self.initialInterval))
+                    continue
+                jobs = self.__pending.values()
+                now = time.time()
+                statuses = None
+                if len(jobs) >= self.sweepThreshold:
+                    statuses = yield self.__listJobs(jobs)
+                queries = []
+                for job in jobs:
+                    if statuses is not None and job.jobid in statuses:
+                        job.polls += 1
+                        if statuses[job.jobid] == JOB_INPROGRESS:
+                            self.__reschedule(job, now)
+                            continue
+                    elif job.nextPoll > now:
+                        continue
+                    queries.append(self.reactor.spawn(self.__query(job)))
+                if queries:
+                    yield queries
+        except Exception:
+            '''
+            Never leave the waiters pending
+            '''
+            for job in self.__pending.values():
+                self.__finish(job, error=sys.exc_info())
+        finally:
+            self.__sweeper = None
+
+    def __listJobs(self, jobs):
+        '''
+        Statuses of the jobs of the caller's account submitted since the
+        oldest outstanding one, see asyncJobPoller.sweepCommand
+        '''
+        started = min(job.started for job in jobs)
+        wanted = set(job.jobid for job in jobs)
+        statuses = {}
+        try:
+            for page in range(1, SWEEP_MAX_PAGES + 1):
+                result = (yield self.request(sweepCommand(started, page))) \
+                    or []
+                for job in result:
+                    statuses[job.jobid] = job.jobstatus
+                if len(result) < SWEEP_PAGE_SIZE or wanted <= set(statuses):
+                    break
+        except Exception:
+            raise Return(None)
+        raise Return(statuses)
+
+    def __query(self, job):
+        cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
+        cmd.jobid = job.jobid
+        job.polls += 1
+        try:
+            response = yield self.request(cmd,
+                                          response_type=job.responsecls)
+        except Exception:
+            self.__finish(job, error=sys.exc_info())
+            return
+        if response is not None and \
+                response.jobstatus != JOB_INPROGRESS:
+            self.__finish(job, response)
+            return
+        self.__reschedule(job, time.time())
+
+    def __reschedule(self, job, now):
+        if now >= job.deadline:
+            self.__finish(job, error=TimeoutError(
+                "Job %s did not complete in time" % job.jobid))
+            return
+        job.nextPoll = min(now + self.__interval(job.polls), job.deadline)
+
+    def __finish(self, job, response=None, error=None):
+        if self.__pending.pop(job.jobid, None) is None:
+            return
+        if error is not None:
+            job.future.fail(error)
+        else:
+            job.future.set(response)
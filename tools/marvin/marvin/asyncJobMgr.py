@@ -23,6 +23,9 @@ import copy
 import sys
 import jsonHelper
 import datetime
+from marvin.codes import FAILED, JOB_SUCCEEDED
+from marvin.apiInstrumentation import (instrumentation, ApiStats, Histogram,
+                                       SIGN, HTTP, DESERIALIZE)
 
 
 class job(object):
@@ -42,68 +45,88 @@ class jobStatus(object):
         self.duration = None
         self.jobId = None
         self.responsecls = None
+        '''
+        Seconds between the submission of the async job and the poller
+        noticing its completion
+        '''
+        self.asyncWait = None
 
     def __str__(self):
         return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
                                       in self.__dict__.iteritems()))
 
 
+class RateLimiter(object):
+
+    '''
+    @Desc : Spaces job submissions so that all the workers sharing
+            the limiter together submit at most rate jobs per second.
+            A rate of None (or 0) does not limit anything
+    '''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.__lock = threading.Lock()
+        self.__next = time.time()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.__lock:
+            now = time.time()
+            slot = max(now, self.__next)
+            self.__next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class workThread(threading.Thread):
 
-    def __init__(self, in_queue, outqueue, apiClient, db=None, lock=None):
+    '''
+    @Desc : Submits commands taken from in_queue using its own copy of
+            the api client, async commands are only submitted here and
+            waited for afterwards all together. A None job stops it
+    '''
+
+    def __init__(self, in_queue, outqueue, apiClient, db=None,
+                 limiter=None):
         threading.Thread.__init__(self)
         self.inqueue = in_queue
         self.output = outqueue
-        self.connection = apiClient.connection.__copy__()
-        self.db = None
-        self.lock = lock
-
-    def queryAsynJob(self, job):
-        if job.jobId is None:
-            return job
-
-        try:
-            self.lock.acquire()
-            result = self.connection.poll(job.jobId, job.responsecls).jobresult
-        except cloudstackException.CloudstackAPIException as e:
-            result = str(e)
-        finally:
-            self.lock.release()
-
-        job.result = result
-        return job
+        self.apiClient = copy.copy(apiClient)
+        self.connection = self.apiClient.connection
+        self.db = db
+        self.limiter = limiter if limiter is not None else RateLimiter()
 
     def executeCmd(self, job):
         cmd = job.cmd
 
         jobstatus = jobStatus()
-        jobId = None
         try:
-            self.lock.acquire()
-
+            try:
+                responseName =\
+                    cmd.__class__.__name__.replace("Cmd", "Response")
+                jobstatus.responsecls =\
+                    jsonHelper.getclassFromName(cmd, responseName)
+            except:
+                pass
+            self.limiter.acquire()
+            jobstatus.startTime = datetime.datetime.now()
             if cmd.isAsync == "false":
-                jobstatus.startTime = datetime.datetime.now()
-
-                result = self.connection.marvin_request(cmd)
+                result = self.connection.marvinRequest(
+                    cmd, response_type=jobstatus.responsecls)
                 jobstatus.result = result
+                jobstatus.status = True
                 jobstatus.endTime = datetime.datetime.now()
-                jobstatus.duration =\
-                    time.mktime(jobstatus.endTime.timetuple()) - time.mktime(
-                        jobstatus.startTime.timetuple())
+                jobstatus.duration = (jobstatus.endTime -
+                                      jobstatus.startTime).total_seconds()
             else:
-                result = self.connection.marvinRequest(cmd)
+                result = self.connection.marvinRequest(
+                    cmd, response_type=jobstatus.responsecls, wait=False)
                 if result is None:
                     jobstatus.status = False
                 else:
-                    jobId = result.jobid
-                    jobstatus.jobId = jobId
-                    try:
-                        responseName =\
-                            cmd.__class__.__name__.replace("Cmd", "Response")
-                        jobstatus.responsecls =\
-                            jsonHelper.getclassFromName(cmd, responseName)
-                    except:
-                        pass
+                    jobstatus.jobId = result.jobid
                     jobstatus.status = True
         except cloudstackException.CloudstackAPIException as e:
             jobstatus.result = str(e)
@@ -111,34 +134,46 @@ class workThread(threading.Thread):
         except:
             jobstatus.status = False
             jobstatus.result = sys.exc_info()
-        finally:
-            self.lock.release()
 
         return jobstatus
 
     def run(self):
-        while self.inqueue.qsize() > 0:
+        while True:
             job = self.inqueue.get()
-            if isinstance(job, jobStatus):
-                jobstatus = self.queryAsynJob(job)
-            else:
-                jobstatus = self.executeCmd(job)
-
-            self.output.put(jobstatus)
-            self.inqueue.task_done()
+            try:
+                if job is None:
+                    return
+                self.output.put(self.executeCmd(job))
+            finally:
+                self.inqueue.task_done()
 
 
 class jobThread(threading.Thread):
 
-    def __init__(self, inqueue, interval):
+    '''
+    @Desc : Runs the user jobs taken from inqueue, each job is handed
+            the api client of the thread running it
+    '''
+
+    def __init__(self, inqueue, interval, apiClient=None, limiter=None):
         threading.Thread.__init__(self)
         self.inqueue = inqueue
         self.interval = interval
+        self.apiClient = None
+        if apiClient is not None:
+            self.apiClient = copy.copy(apiClient)
+        self.limiter = limiter if limiter is not None else RateLimiter()
 
     def run(self):
-        while self.inqueue.qsize() > 0:
+        while True:
             job = self.inqueue.get()
+            if job is None:
+                self.inqueue.task_done()
+                return
             try:
+                if self.apiClient is not None:
+                    setattr(job, "apiClient", self.apiClient)
+                self.limiter.acquire()
                 job.run()
             except:
                 pass
@@ -156,15 +191,26 @@ class outputDict(object):
 
 class asyncJobMgr(object):
 
+    '''
+    @Desc : Load generation engine. Commands are submitted concurrently
+            by worker threads, each with its own api client, through a
+            bounded queue and at an optional target rate (jobs/sec).
+            Async jobs are then waited for together through the shared
+            AsyncJobPoller and their timings fetched from the DB with
+            one batched query. See getLoadReport for the throughput of
+            the last waitForComplete
+    '''
+
     def __init__(self, apiClient, db):
-        self.inqueue = Queue.Queue()
+        self.inqueue = []
         self.output = outputDict()
         self.outqueue = Queue.Queue()
         self.apiClient = apiClient
         self.db = db
+        self.loadReport = None
 
     def submitCmds(self, cmds):
-        if not self.inqueue.empty():
+        if len(self.inqueue) > 0:
             return False
         id = 0
         ids = []
@@ -172,91 +218,209 @@ class asyncJobMgr(object):
             asyncjob = job()
             asyncjob.id = id
             asyncjob.cmd = cmd
-            self.inqueue.put(asyncjob)
+            self.inqueue.append(asyncjob)
             id += 1
             ids.append(id)
         return ids
 
-    def updateTimeStamp(self, jobstatus):
-        jobId = jobstatus.jobId
-        if jobId is not None and self.db is not None:
+    def __runThreads(self, threads, jobs, queue):
+        '''
+        Feeds the jobs to the running threads through the bounded
+        queue, then stops them with one None job each
+        '''
+        for thread in threads:
+            thread.start()
+        for item in jobs:
+            queue.put(item)
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def updateTimeStamps(self, jobstatuses, batchSize=1000):
+        '''
+        @Name : updateTimeStamps
+        @Desc : Fills status, start/end time and duration of the async
+                jobs from the async_job table, one query per batchSize
+                jobs
+        '''
+        if self.db is None:
+            return
+        byJobId = dict((jobstatus.jobId, jobstatus) for jobstatus
+                       in jobstatuses if jobstatus.jobId is not None)
+        jobIds = byJobId.keys()
+        for i in range(0, len(jobIds), batchSize):
+            batch = jobIds[i:i + batchSize]
             result = self.db.execute(
-                "select job_status, created, last_updated from async_job where\
- id='%s'" % str(jobId))
-            if result is not None and len(result) > 0:
-                if result[0][0] == 1:
-                    jobstatus.status = True
-                else:
-                    jobstatus.status = False
-                    jobstatus.startTime = result[0][1]
-                    jobstatus.endTime = result[0][2]
-                    delta = jobstatus.endTime - jobstatus.startTime
-                    jobstatus.duration = delta.total_seconds()
-
-    def waitForComplete(self, workers=10):
-        self.inqueue.join()
-        lock = threading.Lock()
-        resultQueue = Queue.Queue()
-        '''intermediate result is stored in self.outqueue'''
-        for i in range(workers):
-            worker = workThread(self.outqueue, resultQueue, self.apiClient,
-                                self.db, lock)
-            worker.start()
-
-        self.outqueue.join()
+                "select uuid, job_status, created, last_updated from "
+                "async_job where uuid in (%s)" %
+                ", ".join(["%s"] * len(batch)), tuple(batch))
+            for row in result or []:
+                jobstatus = byJobId.get(row[0])
+                if jobstatus is None:
+                    continue
+                jobstatus.status = row[1] == 1
+                jobstatus.startTime = row[2]
+                jobstatus.endTime = row[3]
+                if row[2] is not None and row[3] is not None:
+                    jobstatus.duration = (row[3] - row[2]).total_seconds()
 
+    def updateTimeStamp(self, jobstatus):
+        self.updateTimeStamps([jobstatus])
+
+    def waitForComplete(self, workers=10, rate=None):
+        '''
+        @Name : waitForComplete
+        @Desc : Submits the queued commands with workers threads at
+                most rate jobs/sec, then waits for all the async jobs
+        '''
+        cmds, self.inqueue = self.inqueue, []
+        limiter = RateLimiter(rate)
+        queue = Queue.Queue(maxsize=workers * 2)
+        threads = [workThread(queue, self.outqueue, self.apiClient,
+                              self.db, limiter)
+                   for i in range(workers)]
+        stats = instrumentation.register(ApiStats())
+        try:
+            started = time.time()
+            self.__runThreads(threads, cmds, queue)
+            submitted = time.time()
+            asyncJobResult = self.__waitForJobs()
+        finally:
+            instrumentation.unregister(stats)
+        self.loadReport = self.__buildLoadReport(
+            asyncJobResult, stats, started, submitted, time.time(), workers)
+        return asyncJobResult
+
+    def __waitForJobs(self):
+        '''
+        Collects the submitted jobs and waits for the async ones
+        '''
         asyncJobResult = []
-        while resultQueue.qsize() > 0:
-            jobstatus = resultQueue.get()
-            self.updateTimeStamp(jobstatus)
-            asyncJobResult.append(jobstatus)
+        while self.outqueue.qsize() > 0:
+            asyncJobResult.append(self.outqueue.get())
 
+        '''
+        Track every job first so the poller sweeps them together
+        '''
+        connection = self.apiClient.connection
+        poller = connection.getAsyncJobPoller()
+        tracked = [(jobstatus, poller.track(jobstatus.jobId,
+                                            jobstatus.responsecls,
+                                            connection.asyncTimeout))
+                   for jobstatus in asyncJobResult
+                   if jobstatus.jobId is not None]
+        for jobstatus, pending in tracked:
+            try:
+                response = poller.result(pending)
+                if response == FAILED:
+                    jobstatus.status = False
+                else:
+                    jobstatus.result = response.jobresult
+                    jobstatus.status = response.jobstatus == JOB_SUCCEEDED
+            except Exception as e:
+                jobstatus.result = str(e)
+                jobstatus.status = False
+            if pending.endTime is not None:
+                jobstatus.asyncWait = pending.endTime - pending.startTime
+
+        self.updateTimeStamps(asyncJobResult)
         return asyncJobResult
 
-    def submitCmdsAndWait(self, cmds, workers=10):
+    def __buildLoadReport(self, jobstatuses, stats, started, submitted,
+                          ended, workers):
+        '''
+        @Name : __buildLoadReport
+        @Desc : Separates the time the management server took from the
+                client overhead (signing and deserializing) of the run
+        '''
+        total = stats.getTotal()
+        asyncWait = Histogram()
+        for jobstatus in jobstatuses:
+            if jobstatus.asyncWait is not None:
+                asyncWait.add(jobstatus.asyncWait)
+        '''
+        Server window: first job start to last job end, from the DB when
+        the timestamps could be fetched
+        '''
+        times = [(jobstatus.startTime, jobstatus.endTime)
+                 for jobstatus in jobstatuses
+                 if isinstance(jobstatus.startTime, datetime.datetime) and
+                 isinstance(jobstatus.endTime, datetime.datetime)]
+        window = None
+        if times:
+            window = (max(end for start, end in times) -
+                      min(start for start, end in times)).total_seconds()
+        overhead = total.phases[SIGN].total + total.phases[DESERIALIZE].total
+        succeeded = len([j for j in jobstatuses if j.status])
+        return {"jobs": len(jobstatuses),
+                "succeeded": succeeded,
+                "workers": workers,
+                "submitTime": round(submitted - started, 3),
+                "totalTime": round(ended - started, 3),
+                "submitRate": round(len(jobstatuses) /
+                                    max(submitted - started, 1e-6), 3),
+                "completionRate": round(succeeded /
+                                        max(ended - started, 1e-6), 3),
+                "serverWindow": window,
+                "serverThroughput": round(succeeded / window, 3)
+                if window else None,
+                "http": total.phases[HTTP].toDict(),
+                "asyncWait": asyncWait.toDict(),
+                "clientOverhead": round(overhead, 6),
+                "clientOverheadShare": round(overhead / total.latency.total,
+                                             4)
+                if total.latency.total else 0.0,
+                "apiCalls": total.calls,
+                "apiErrors": total.errors,
+                "bytesSent": total.bytesSent,
+                "bytesReceived": total.bytesReceived}
+
+    def getLoadReport(self):
+        '''
+        @Name : getLoadReport
+        @Desc : Returns the throughput of the last waitForComplete: the
+                client side submission and completion rates, the
+                management server throughput over the window of the
+                jobs, the HTTP and async wait latencies and the share of
+                the call time spent in the client (signing and
+                deserializing)
+        '''
+        return self.loadReport
+
+    def submitCmdsAndWait(self, cmds, workers=10, rate=None):
         '''
             put commands into a queue at first, then start workers numbers
             threads to execute this commands
         '''
         self.submitCmds(cmds)
-        lock = threading.Lock()
-        for i in range(workers):
-            worker = workThread(self.inqueue, self.outqueue, self.apiClient,
-                                self.db, lock)
-            worker.start()
-
-        return self.waitForComplete(workers)
+        return self.waitForComplete(workers, rate)
 
     def submitJobExecuteNtimes(self, job, ntimes=1, nums_threads=1,
-                               interval=1):
+                               interval=1, rate=None):
         '''
         submit one job and execute the same job ntimes, with nums_threads
         of threads
         '''
-        inqueue1 = Queue.Queue()
+        queue = Queue.Queue(maxsize=nums_threads * 2)
         lock = threading.Condition()
+        limiter = RateLimiter(rate)
+        threads = [jobThread(queue, interval, self.apiClient, limiter)
+                   for i in range(nums_threads)]
+        jobs = []
         for i in range(ntimes):
             newjob = copy.copy(job)
-            setattr(newjob, "apiClient", copy.copy(self.apiClient))
             setattr(newjob, "lock", lock)
-            inqueue1.put(newjob)
+            jobs.append(newjob)
+        self.__runThreads(threads, jobs, queue)
 
-        for i in range(nums_threads):
-            work = jobThread(inqueue1, interval)
-            work.start()
-        inqueue1.join()
-
-    def submitJobs(self, jobs, nums_threads=1, interval=1):
+    def submitJobs(self, jobs, nums_threads=1, interval=1, rate=None):
         '''submit n jobs, execute them with nums_threads of threads'''
-        inqueue1 = Queue.Queue()
+        queue = Queue.Queue(maxsize=nums_threads * 2)
         lock = threading.Condition()
-
+        limiter = RateLimiter(rate)
+        threads = [jobThread(queue, interval, self.apiClient, limiter)
+                   for i in range(nums_threads)]
         for job in jobs:
-            setattr(job, "apiClient", copy.copy(self.apiClient))
             setattr(job, "lock", lock)
-            inqueue1.put(job)
-
-        for i in range(nums_threads):
-            work = jobThread(inqueue1, interval)
-            work.start()
-        inqueue1.join()
+        self.__runThreads(threads, jobs, queue)
@@ -0,0 +1,337 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Completion engine for CloudStack async jobs.
+       Jobs are polled with an adaptive backoff (fast first polls,
+       exponential growth, jitter, capped interval). While several jobs
+       are outstanding for the same credentials, a single listAsyncJobs
+       sweep per tick answers all of them and queryAsyncJobResult is only
+       issued for the jobs the sweep reports as finished.
+'''
+import collections
+import copy
+import random
+import threading
+import time
+from cloudstackAPI import queryAsyncJobResult, listAsyncJobs
+from marvin.codes import (FAILED,
+                          JOB_INPROGRESS,
+                          JOB_SUCCEEDED,
+                          JOB_FAILED,
+                          JOB_CANCELLED)
+
+# Jobs listed per listAsyncJobs page of a sweep, and pages read per sweep
+SWEEP_PAGE_SIZE = 200
+SWEEP_MAX_PAGES = 5
+# Seconds the window of a sweep starts before the oldest outstanding job
+# was submitted, for a management server clock behind the local one
+SWEEP_CLOCK_SKEW = 300
+
+
+def sweepCommand(started, page):
+    '''
+    @Name : sweepCommand
+    @Desc : listAsyncJobs command for a page of a sweep. It lists the
+            jobs of the account of the api key only (no listall),
+            created since started (the local time the oldest
+            outstanding job was tracked at, after its submission) less
+            SWEEP_CLOCK_SKEW. The jobs
+            missing from the sweep are queried one by one
+    '''
+    cmd = listAsyncJobs.listAsyncJobsCmd()
+    cmd.startdate = time.strftime("%Y-%m-%dT%H:%M:%S+0000",
+                                  time.gmtime(started - SWEEP_CLOCK_SKEW))
+    cmd.page = page
+    cmd.pagesize = SWEEP_PAGE_SIZE
+    return cmd
+
+
+class PendingJob(object):
+
+    '''
+    @Desc : Book keeping of one async job being waited upon
+            polls : status checks done for the job, sweeps included
+            waitTime : seconds between registration and completion
+            wastedTime : upper bound of the time the job was complete
+                         before the poller noticed it
+    '''
+
+    def __init__(self, jobid, responsecls, timeout):
+        self.jobid = jobid
+        self.responsecls = responsecls
+        self.startTime = time.time()
+        self.endTime = None
+        self.deadline = self.startTime + timeout
+        self.nextPoll = self.startTime
+        self.lastPending = self.startTime
+        self.polls = 0
+        self.response = FAILED
+        self.error = None
+        self.timedOut = False
+        self.done = threading.Event()
+
+    def toDict(self):
+        end = self.endTime or time.time()
+        return {"jobid": self.jobid,
+                "polls": self.polls,
+                "waitTime": round(end - self.startTime, 3),
+                "wastedTime": round(end - self.lastPending, 3),
+                "timedOut": self.timedOut}
+
+
+class AsyncJobPoller(object):
+
+    '''
+    @Desc : Waits for async jobs submitted with one set of credentials.
+            One poller (and one polling thread, alive only while jobs
+            are pending) is shared by every connection using the same
+            Management Server and api key, so marvinRequest callers,
+            asyncJobMgr workers and lib/base.py helpers running in
+            parallel are answered by the same sweeps.
+    @Input : connection : CSConnection used for the status queries
+             initialInterval : delay before the first poll of a job
+             maxInterval : cap of the polling interval
+             multiplier : growth factor of the interval between polls
+             jitter : random +/- fraction applied to every interval
+             sweepThreshold : outstanding jobs from which listAsyncJobs
+                              sweeps are used instead of per job queries
+    '''
+    __registry = {}
+    __registryLock = threading.Lock()
+
+    def __init__(self, connection, initialInterval=0.5, maxInterval=5.0,
+                 multiplier=2.0, jitter=0.2, sweepThreshold=2,
+                 historySize=500):
+        self.connection = connection
+        self.logger = connection.logger
+        self.initialInterval = initialInterval
+        self.maxInterval = maxInterval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.sweepThreshold = sweepThreshold
+        self.__cond = threading.Condition()
+        self.__pending = {}
+        self.__thread = None
+        self.__history = collections.deque(maxlen=historySize)
+        self.__totals = {"jobs": 0, "polls": 0, "sweeps": 0,
+                         "queries": 0, "waitTime": 0.0,
+                         "wastedTime": 0.0, "timedOut": 0}
+
+    @classmethod
+    def getPoller(cls, connection, **kwargs):
+        '''
+        @Name : getPoller
+        @Desc : Returns the poller shared by the connections using
+                the same endpoint and credentials as connection
+        '''
+        key = (connection.baseUrl, connection.apiKey)
+        with cls.__registryLock:
+            poller = cls.__registry.get(key)
+            if poller is None:
+                poller = AsyncJobPoller(copy.copy(connection), **kwargs)
+                cls.__registry[key] = poller
+            return poller
+
+    def __debug(self, msg):
+        if self.logger is not None:
+            self.logger.debug(msg)
+
+    def track(self, jobid, responsecls=None, timeout=3600):
+        '''
+        @Name : track
+        @Desc : Registers the job without blocking, so that many jobs
+                can be outstanding (and swept together) before the
+                caller collects them through result
+        @Input : jobid : Async job to wait for
+                 responsecls : response class of the async command
+                 timeout : seconds to wait for the job
+        @Output : PendingJob to be passed to result
+        '''
+        job = PendingJob(jobid, responsecls, timeout)
+        job.nextPoll = job.startTime + self.__nextInterval(0)
+        self.__debug("=== Jobid: %s Started ===" % str(jobid))
+        with self.__cond:
+            self.__pending[id(job)] = job
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name="AsyncJobPoller")
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__cond.notify()
+        return job
+
+    def result(self, job):
+        '''
+        @Name : result
+        @Desc : Blocks until the tracked job is complete or timed out
+        @Output : queryAsyncJobResult response of the job, the last
+                  in progress response on timeout, FAILED if the job
+                  could never be queried
+        '''
+        while not job.done.wait(self.maxInterval + 1):
+            pass
+        self.__debug("===Jobid:%s ; StartTime:%s ; EndTime:%s ; "
+                     "TotalTime:%s ; Polls:%s ; WastedTime:%s===" %
+                     (str(job.jobid), time.ctime(job.startTime),
+                      time.ctime(job.endTime),
+                      str(int(job.endTime - job.startTime)),
+                      str(job.polls),
+                      "%.3f" % (job.endTime - job.lastPending)))
+        if job.error is not None:
+            raise job.error
+        return job.response
+
+    def wait(self, jobid, responsecls=None, timeout=3600):
+        '''
+        @Name : wait
+        @Desc : Blocks until the job is complete or timeout expires,
+                see track and result
+        '''
+        return self.result(self.track(jobid, responsecls, timeout))
+
+    def getStats(self):
+        '''
+        @Name : getStats
+        @Desc : Returns the totals of the poller along with the per job
+                poll counts and wasted wait time of the recent jobs
+        '''
+        with self.__cond:
+            stats = dict(self.__totals)
+            stats["pending"] = len(self.__pending)
+            stats["recentJobs"] = list(self.__history)
+        return stats
+
+    def __nextInterval(self, polls):
+        interval = min(self.maxInterval,
+                       self.initialInterval * (self.multiplier ** polls))
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return interval
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if not self.__pending:
+                    self.__thread = None
+                    return
+                jobs = self.__pending.values()
+                delay = min(job.nextPoll for job in jobs) - time.time()
+                if delay > 0:
+                    self.__cond.wait(delay)
+                    continue
+            try:
+                self.__tick(jobs)
+            except Exception as e:
+                '''
+                Never let the thread die with waiters still pending
+                '''
+                for job in jobs:
+                    job.error = e
+                    self.__finish(job)
+
+    def __tick(self, jobs):
+        '''
+        @Name : __tick
+        @Desc : Checks the due jobs; a single listAsyncJobs sweep answers
+                for all the outstanding jobs when there are enough of
+                them, the full result is then fetched only for the jobs
+                the sweep reports as complete
+        '''
+        now = time.time()
+        statuses = None
+        if len(jobs) >= self.sweepThreshold:
+            statuses = self.__sweep(jobs)
+        for job in jobs:
+            due = job.nextPoll <= now
+            if statuses is not None and job.jobid in statuses:
+                job.polls += 1
+                if statuses[job.jobid] == JOB_INPROGRESS:
+                    job.lastPending = now
+                    self.__reschedule(job, now)
+                    continue
+            elif not due:
+                continue
+            self.__query(job)
+
+    def __sweep(self, jobs):
+        try:
+            started = min(job.startTime for job in jobs)
+            wanted = set(job.jobid for job in jobs)
+            with self.__cond:
+                self.__totals["sweeps"] += 1
+            statuses = {}
+            for page in range(1, SWEEP_MAX_PAGES + 1):
+                result = self.connection.marvinRequest(
+                    sweepCommand(started, page)) or []
+                for asyncjob in result:
+                    statuses[asyncjob.jobid] = asyncjob.jobstatus
+                if len(result) < SWEEP_PAGE_SIZE or wanted <= set(statuses):
+                    break
+            return statuses
+        except Exception as e:
+            self.__debug("=== listAsyncJobs sweep failed, falling back "
+                         "to per job queries: %s ===" % str(e))
+            return None
+
+    def __query(self, job):
+        cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
+        cmd.jobid = job.jobid
+        now = time.time()
+        job.polls += 1
+        with self.__cond:
+            self.__totals["queries"] += 1
+        try:
+            response = self.connection.marvinRequest(
+                cmd, response_type=job.responsecls)
+        except Exception as e:
+            job.error = e
+            self.__finish(job)
+            return
+        if response is not None and response != FAILED:
+            job.response = response
+            if response.jobstatus in [JOB_SUCCEEDED, JOB_FAILED,
+                                      JOB_CANCELLED]:
+                self.__finish(job)
+                return
+        job.lastPending = now
+        self.__reschedule(job, now)
+
+    def __reschedule(self, job, now):
+        if now >= job.deadline:
+            job.timedOut = True
+            self.__finish(job)
+            return
+        job.nextPoll = min(now + self.__nextInterval(job.polls),
+                           job.deadline)
+        self.__debug("=== JobId:%s is Still Processing, "
+                     "Will TimeOut in:%s ====" %
+                     (str(job.jobid), str(int(job.deadline - now))))
+
+    def __finish(self, job):
+        with self.__cond:
+            if self.__pending.pop(id(job), None) is None:
+                return
+            job.endTime = time.time()
+            record = job.toDict()
+            self.__history.append(record)
+            self.__totals["jobs"] += 1
+            self.__totals["polls"] += job.polls
+            self.__totals["waitTime"] += record["waitTime"]
+            self.__totals["wastedTime"] += record["wastedTime"]
+            if job.timedOut:
+                self.__totals["timedOut"] += 1
+        job.done.set()
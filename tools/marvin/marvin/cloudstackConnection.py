@@ -15,25 +15,55 @@
 # specific language governing permissions and limitations
 # under the License.
 
-import requests
 import urllib
 import base64
 import hmac
 import hashlib
-import time
-from cloudstackAPI import queryAsyncJobResult
 import jsonHelper
+from marvin.cloudstackTransport import CSTransport
+from marvin.asyncJobPoller import AsyncJobPoller
+from marvin.apiInstrumentation import (instrumentation,
+                                       SIGN, HTTP, ASYNC_WAIT, DESERIALIZE)
 from marvin.codes import (
     FAILED,
-    JOB_FAILED,
-    JOB_CANCELLED,
-    JOB_SUCCEEDED
+    JOB_FAILED
 )
 from marvin.cloudstackException import (
     InvalidParameterException,
     GetDetailExceptionInfo)
 
 
+class CmdSchema(object):
+
+    '''
+    @Desc : Serialization layout of a command class, derived once per
+            class and reused for every command of that class
+            name : API name sent as the command parameter
+            classParams : class level attributes that are sent along
+                          with the instance attributes (the generated
+                          classes have none besides typeInfo)
+    '''
+    __cache = {}
+    RESERVED = frozenset(["isAsync", "required", "typeInfo"])
+
+    def __init__(self, cls):
+        self.name = cls.__name__.replace("Cmd", "").strip()
+        self.classParams = tuple(attribute for attribute in dir(cls)
+                                 if not attribute.startswith('__') and
+                                 attribute not in CmdSchema.RESERVED)
+
+    @classmethod
+    def get(cls, cmdcls):
+        '''
+        @Name : get
+        @Desc : Returns the schema of the command class
+        '''
+        schema = cls.__cache.get(cmdcls)
+        if schema is None:
+            schema = cls.__cache[cmdcls] = CmdSchema(cmdcls)
+        return schema
+
+
 class CSConnection(object):
 
     '''
@@ -58,6 +88,8 @@ class CSConnection(object):
         self.path = path
         self.retries = 5
         self.__lastError = ''
+        self.__hmac = None
+        self.__hmacKey = None
         self.mgtDetails = mgmtDet
         self.asyncTimeout = asyncTimeout
         self.auth = True
@@ -68,6 +100,23 @@ class CSConnection(object):
         self.httpsFlag = True if self.protocol == "https" else False
         self.baseUrl = "%s://%s:%d/%s"\
                        % (self.protocol, self.mgtSvr, self.port, self.path)
+        '''
+        Keep-alive connection pool shared by every connection
+        to this Management Server, tunable through the optional
+        poolSize, maxConnectionsPerHost and poolIdleTimeout
+        settings of the mgtSvr section
+        '''
+        self.__transport = CSTransport.acquire(
+            self.baseUrl,
+            poolSize=self.__getSetting("poolSize", 10),
+            maxConnectionsPerHost=self.__getSetting(
+                "maxConnectionsPerHost", None),
+            idleTimeout=self.__getSetting("poolIdleTimeout", 60),
+            logger=self.logger)
+
+    def __getSetting(self, name, default):
+        value = getattr(self.mgtDetails, name, None)
+        return default if value is None else value
 
     def __copy__(self):
         return CSConnection(self.mgtDetails,
@@ -78,43 +127,21 @@ class CSConnection(object):
     def __poll(self, jobid, response_cmd):
         '''
         @Name : __poll
-        @Desc: polls for the completion of a given jobid
+        @Desc: polls for the completion of a given jobid through the
+               AsyncJobPoller shared by the connections using the
+               same credentials
         @Input 1. jobid: Monitor the Jobid for CS
                2. response_cmd:response command for request cmd
         @return: FAILED if jobid is cancelled,failed
                  Else return async_response
         '''
         try:
-            cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
-            cmd.jobid = jobid
-            timeout = self.asyncTimeout
-            start_time = time.time()
-            end_time = time.time()
-            async_response = FAILED
-            self.logger.debug("=== Jobid: %s Started ===" % (str(jobid)))
-            while timeout > 0:
-                async_response = self.\
-                    marvinRequest(cmd, response_type=response_cmd)
-                if async_response != FAILED:
-                    job_status = async_response.jobstatus
-                    if job_status in [JOB_CANCELLED,
-                                      JOB_SUCCEEDED]:
-                        break
-                    elif job_status == JOB_FAILED:
-                        raise Exception("Job failed: %s"\
-                                         % async_response)
-                time.sleep(5)
-                timeout -= 5
-                self.logger.debug("=== JobId:%s is Still Processing, "
-                                  "Will TimeOut in:%s ====" % (str(jobid),
-                                                               str(timeout)))
-            end_time = time.time()
-            tot_time = int(start_time - end_time)
-            self.logger.debug(
-                "===Jobid:%s ; StartTime:%s ; EndTime:%s ; "
-                "TotalTime:%s===" %
-                (str(jobid), str(time.ctime(start_time)),
-                 str(time.ctime(end_time)), str(tot_time)))
+            with instrumentation.phase(ASYNC_WAIT):
+                async_response = self.getAsyncJobPoller().wait(
+                    jobid, response_cmd, self.asyncTimeout)
+            if async_response != FAILED and \
+                    async_response.jobstatus == JOB_FAILED:
+                raise Exception("Job failed: %s" % async_response)
             return async_response
         except Exception as e:
             self.__lastError = e
@@ -122,6 +149,53 @@ class CSConnection(object):
                                   str(self.__lastError))
             return FAILED
 
+    def getAsyncJobPoller(self):
+        '''
+        @Name : getAsyncJobPoller
+        @Desc : Returns the AsyncJobPoller shared by the connections
+                using the same credentials, its track/result methods
+                let callers wait for many jobs in one go
+        '''
+        return AsyncJobPoller.getPoller(
+            self,
+            initialInterval=self.__getSetting("asyncPollInterval", 0.5),
+            maxInterval=self.__getSetting("asyncPollMaxInterval", 5.0))
+
+    def poll(self, jobid, response_cmd=None):
+        '''
+        @Name : poll
+        @Desc : Waits for the given async job to complete
+        @Output: queryAsyncJobResult response of the job or FAILED
+        '''
+        return self.__poll(jobid, response_cmd)
+
+    def getAsyncJobStats(self):
+        '''
+        @Name : getAsyncJobStats
+        @Desc : Returns the poll counts and wait times of the async
+                jobs completed through this connection's credentials
+        '''
+        return self.getAsyncJobPoller().getStats()
+
+    def close(self):
+        '''
+        @Name : close
+        @Desc : Releases the pooled transport used by this connection
+        '''
+        if self.__transport is not None:
+            self.__transport.release()
+            self.__transport = None
+
+    def getPoolStats(self):
+        '''
+        @Name : getPoolStats
+        @Desc : Returns the statistics of the connection pool used
+                to reach the Management Server
+        '''
+        if self.__transport is None:
+            return {}
+        return self.__transport.getStats()
+
     def getLastError(self):
         '''
         @Name : getLastError
@@ -129,27 +203,47 @@ class CSConnection(object):
         '''
         return self.__lastError
 
+    __signOrders = {}
+    __encoded = {}
+
     def __sign(self, payload):
         """
         @Name : __sign
         @Desc:signs a given request URL when the apiKey and
-              secretKey are known
+              secretKey are known. The HMAC keyed with the secretKey is
+              built once and copied for every request, the lower cased
+              sort order is cached per parameter set and the encoding
+              of the (short) values repeated across requests is cached
         @Input: payload: dictionary of params be signed
         @Output: the signature of the payload
         """
-        params = zip(payload.keys(), payload.values())
-        params.sort(key=lambda k: str.lower(k[0]))
-        hash_str = "&".join(
-            ["=".join(
-                [str.lower(r[0]),
-                 str.lower(
-                     urllib.quote_plus(str(r[1]), safe="*")
-                ).replace("+", "%20")]
-            ) for r in params]
-        )
-        signature = base64.encodestring(hmac.new(
-            self.securityKey, hash_str, hashlib.sha1).digest()).strip()
-        return signature
+        if self.__hmacKey != self.securityKey:
+            self.__hmac = hmac.new(self.securityKey, digestmod=hashlib.sha1)
+            self.__hmacKey = self.securityKey
+        names = frozenset(payload)
+        order = CSConnection.__signOrders.get(names)
+        if order is None:
+            order = sorted(((str.lower(k), k) for k in payload),
+                           key=lambda k: k[0])
+            if len(CSConnection.__signOrders) > 10000:
+                CSConnection.__signOrders.clear()
+            CSConnection.__signOrders[names] = order
+        encoded = CSConnection.__encoded
+        parts = []
+        for lowered, k in order:
+            value = str(payload[k])
+            quoted = encoded.get(value)
+            if quoted is None:
+                quoted = str.lower(urllib.quote_plus(
+                    value, safe="*")).replace("+", "%20")
+                if len(value) <= 256:
+                    if len(encoded) > 10000:
+                        encoded.clear()
+                    encoded[value] = quoted
+            parts.append("%s=%s" % (lowered, quoted))
+        digest = self.__hmac.copy()
+        digest.update("&".join(parts))
+        return base64.encodestring(digest.digest()).strip()
 
     def __sendPostReqToCS(self, url, payload):
         '''
@@ -161,10 +255,12 @@ class CSConnection(object):
                  else FAILED
         '''
         try:
-            response = requests.post(url,
-                                     params=payload,
-                                     cert=self.certPath,
-                                     verify=self.httpsFlag)
+            with instrumentation.phase(HTTP):
+                response = self.__transport.request("POST", url,
+                                                    params=payload,
+                                                    cert=self.certPath,
+                                                    verify=self.httpsFlag)
+            self.__countBytes(response)
             return response
         except Exception as e:
             self.__lastError = e
@@ -183,10 +279,12 @@ class CSConnection(object):
                  else FAILED
         '''
         try:
-            response = requests.get(url,
-                                    params=payload,
-                                    cert=self.certPath,
-                                    verify=self.httpsFlag)
+            with instrumentation.phase(HTTP):
+                response = self.__transport.request("GET", url,
+                                                    params=payload,
+                                                    cert=self.certPath,
+                                                    verify=self.httpsFlag)
+            self.__countBytes(response)
             return response
         except Exception as e:
             self.__lastError = e
@@ -194,6 +292,18 @@ class CSConnection(object):
                                   str(self.__lastError))
             return FAILED
 
+    def __countBytes(self, response):
+        '''
+        Reports the size of the request and response to the call in
+        progress, if it is instrumented
+        '''
+        if instrumentation.current() is None:
+            return
+        request = response.request
+        instrumentation.addBytes(
+            len(request.url) + len(request.body or ""),
+            len(response.content), response.status_code)
+
     def __sendCmdToCS(self, command, auth=True, payload={}, method='GET'):
         """
         @Name : __sendCmdToCS
@@ -207,12 +317,7 @@ class CSConnection(object):
         @output: FAILED or else response from CS
         """
         try:
-            payload["command"] = command
-            payload["response"] = "json"
-
-            if auth:
-                payload["apiKey"] = self.apiKey
-                payload["signature"] = self.__sign(payload)
+            self.__signPayload(command, payload, auth)
 
             # Verify whether protocol is "http" or "https", then send the
             # request
@@ -235,6 +340,34 @@ class CSConnection(object):
                                   GetDetailExceptionInfo(e))
             return FAILED
 
+    def __signPayload(self, command, payload, auth):
+        '''
+        Adds the command, the response format and, with auth, the api key
+        and the signature to payload, charged to the SIGN phase
+        '''
+        with instrumentation.phase(SIGN):
+            payload["command"] = command
+            payload["response"] = "json"
+            if auth:
+                payload["apiKey"] = self.apiKey
+                payload["signature"] = self.__sign(payload)
+        return payload
+
+    def signRequest(self, cmd):
+        '''
+        @Name : signRequest
+        @Desc : Sanitizes and signs the command as marvinRequest does,
+                for the clients sending it over their own transport
+                (EX: asyncClient.AsyncConnection)
+        @Output : command name, whether it is async, parameters to send
+        '''
+        sanitize_cmd_out = self.__sanitizeCmd(cmd)
+        if sanitize_cmd_out == FAILED:
+            raise self.__lastError
+        cmd_name, is_async, payload = sanitize_cmd_out
+        return cmd_name, is_async, self.__signPayload(cmd_name, payload,
+                                                      self.auth)
+
     def __sanitizeCmd(self, cmd):
         """
         @Name : __sanitizeCmd
@@ -245,18 +378,19 @@ class CSConnection(object):
         """
         try:
             cmd_name = ''
+            schema = CmdSchema.get(cmd.__class__)
+            cmd_name = schema.name
+            attributes = vars(cmd)
             payload = {}
-            required = []
-            isAsync = "false"
-            for attribute in dir(cmd):
-                if not attribute.startswith('__'):
-                    if attribute == "isAsync":
-                        isAsync = getattr(cmd, attribute)
-                    elif attribute == "required":
-                        required = getattr(cmd, attribute)
-                    else:
-                        payload[attribute] = getattr(cmd, attribute)
-            cmd_name = cmd.__class__.__name__.replace("Cmd", "")
+            for attribute in schema.classParams:
+                if attribute not in attributes:
+                    payload[attribute] = getattr(cmd, attribute)
+            for attribute, value in attributes.iteritems():
+                if attribute not in CmdSchema.RESERVED and \
+                        not attribute.startswith('__'):
+                    payload[attribute] = value
+            isAsync = getattr(cmd, "isAsync", "false")
+            required = getattr(cmd, "required", [])
             for required_param in required:
                 if payload[required_param] is None:
                     self.logger.debug("CmdName: %s Parameter : %s is Required"
@@ -282,7 +416,7 @@ class CSConnection(object):
                                 for k, v in val.iteritems():
                                     payload["%s[%d].%s" % (param, i, k)] = v
                                 i += 1
-            return cmd_name.strip(), isAsync, payload
+            return cmd_name, isAsync, payload
         except Exception as e:
             self.__lastError = e
             self.logger.\
@@ -291,7 +425,8 @@ class CSConnection(object):
                                                  GetDetailExceptionInfo(e)))
             return FAILED
 
-    def __parseAndGetResponse(self, cmd_response, response_cls, is_async):
+    def __parseAndGetResponse(self, cmd_response, response_cls, is_async,
+                              wait=True):
         '''
         @Name : __parseAndGetResponse
         @Desc : Verifies the  Response(from CS) and returns an
@@ -299,21 +434,28 @@ class CSConnection(object):
         @Input: cmd_response: Command Response from cs
                 response_cls : Mapping class for this Response
                 is_async: Whether the cmd is async or not.
+                wait: Whether to wait for the async job to complete
         @Output:Response output from CS
         '''
         try:
-            try:
-                ret = jsonHelper.getResultObj(
-                    cmd_response.json(),
-                    response_cls)
-            except TypeError:
-                ret = jsonHelper.getResultObj(cmd_response.json, response_cls)
+            with instrumentation.phase(DESERIALIZE):
+                try:
+                    ret = jsonHelper.getResultObj(
+                        cmd_response.json(),
+                        response_cls)
+                except TypeError:
+                    ret = jsonHelper.getResultObj(cmd_response.json,
+                                                  response_cls)
 
             '''
             If the response is asynchronous, poll and return response
             else return response as it is
             '''
-            if is_async == "false":
+            call = instrumentation.current()
+            if call is not None and is_async != "false":
+                call.isAsync = True
+                call.jobid = getattr(ret, "jobid", None)
+            if is_async == "false" or not wait:
                 self.logger.debug("Response : %s" % str(ret))
                 return ret
             else:
@@ -326,16 +468,33 @@ class CSConnection(object):
                 exception("Exception:%s" % GetDetailExceptionInfo(e))
             return FAILED
 
-    def marvinRequest(self, cmd, response_type=None, method='GET', data=''):
+    def marvinRequest(self, cmd, response_type=None, method='GET', data='',
+                      wait=True):
         """
         @Name : marvinRequest
         @Desc: Handles Marvin Requests
         @Input  cmd: marvin's command from cloudstackAPI
                 response_type: response type of the command in cmd
                 method: HTTP GET/POST, defaults to GET
+                wait: For async commands, wait for the job to complete
+                      and return its result, else return the response
+                      carrying the jobid right after submission
         @Output: Response received from CS
                  Exception in case of Error\Exception
         """
+        call = instrumentation.startCall(
+            cmd.__class__.__name__.replace("Cmd", ""))
+        if call is None:
+            return self.__request(cmd, response_type, method, wait)
+        try:
+            ret = self.__request(cmd, response_type, method, wait)
+        except Exception as e:
+            instrumentation.endCall(call, e)
+            raise
+        instrumentation.endCall(call)
+        return ret
+
+    def __request(self, cmd, response_type, method, wait):
         try:
             '''
             1. Verify the Inputs Provided
@@ -369,7 +528,8 @@ class CSConnection(object):
             '''
             ret = self.__parseAndGetResponse(cmd_response,
                                              response_type,
-                                             is_async)
+                                             is_async,
+                                             wait)
             if ret == FAILED:
                 raise self.__lastError
             return ret
@@ -377,3 +537,108 @@ class CSConnection(object):
             self.logger.exception("marvinRequest : CmdName: %s Exception: %s" %
                                   (str(cmd), GetDetailExceptionInfo(e)))
             raise e
+
+
+if __name__ == "__main__":
+    '''
+    Compares the calls/sec of the command sanitization and request
+    signing before and after the per class schema and the reused HMAC
+    '''
+    import time
+    from marvin.cloudstackAPI import deployVirtualMachine
+    from marvin.jsonHelper import jsonLoader
+
+    def legacySanitize(cmd):
+        payload = {}
+        required = []
+        isAsync = "false"
+        for attribute in dir(cmd):
+            if not attribute.startswith('__'):
+                if attribute == "isAsync":
+                    isAsync = getattr(cmd, attribute)
+                elif attribute == "required":
+                    required = getattr(cmd, attribute)
+                else:
+                    payload[attribute] = getattr(cmd, attribute)
+        cmd_name = cmd.__class__.__name__.replace("Cmd", "")
+        for required_param in required:
+            if payload[required_param] is None:
+                return FAILED
+        for param, value in payload.items():
+            if value is None:
+                payload.pop(param)
+            elif param == 'typeInfo':
+                payload.pop(param)
+            elif isinstance(value, list):
+                if len(value) == 0:
+                    payload.pop(param)
+                else:
+                    if not isinstance(value[0], dict):
+                        payload[param] = ",".join(value)
+                    else:
+                        payload.pop(param)
+                        i = 0
+                        for val in value:
+                            for k, v in val.iteritems():
+                                payload["%s[%d].%s" % (param, i, k)] = v
+                            i += 1
+        return cmd_name.strip(), isAsync, payload
+
+    def legacySign(securityKey, payload):
+        params = zip(payload.keys(), payload.values())
+        params.sort(key=lambda k: str.lower(k[0]))
+        hash_str = "&".join(
+            ["=".join(
+                [str.lower(r[0]),
+                 str.lower(
+                     urllib.quote_plus(str(r[1]), safe="*")
+                ).replace("+", "%20")]
+            ) for r in params]
+        )
+        return base64.encodestring(hmac.new(
+            securityKey, hash_str, hashlib.sha1).digest()).strip()
+
+    mgmt = jsonLoader({"mgtSvrIp": "127.0.0.1", "port": 8080,
+                       "apiKey": "benchmark-api-key-" + "a" * 68,
+                       "securityKey": "benchmark-secret-key-" + "b" * 65,
+                       "certCAPath": "NA", "certPath": "NA"})
+    connection = CSConnection(mgmt)
+    sanitize = connection._CSConnection__sanitizeCmd
+    sign = connection._CSConnection__sign
+
+    cmd = deployVirtualMachine.deployVirtualMachineCmd()
+    cmd.zoneid = "a1b2c3d4-0000-4000-8000-000000000001"
+    cmd.serviceofferingid = "a1b2c3d4-0000-4000-8000-000000000002"
+    cmd.templateid = "a1b2c3d4-0000-4000-8000-000000000003"
+    cmd.displayname = "benchmark vm"
+    cmd.networkids = ["a1b2c3d4-0000-4000-8000-000000000004"]
+    cmd.details = [{"cpuNumber": "2", "memory": "1024"}]
+
+    def prepare(sanitizeFn, signFn):
+        name, isAsync, payload = sanitizeFn(cmd)
+        payload["command"] = name
+        payload["response"] = "json"
+        payload["apiKey"] = mgmt.apiKey
+        return signFn(payload)
+
+    assert prepare(legacySanitize,
+                   lambda p: legacySign(mgmt.securityKey, p)) == \
+        prepare(sanitize, sign), "signatures differ"
+
+    calls = 20000
+    start = time.time()
+    for i in xrange(calls):
+        prepare(legacySanitize, lambda p: legacySign(mgmt.securityKey, p))
+    before = time.time() - start
+
+    start = time.time()
+    for i in xrange(calls):
+        prepare(sanitize, sign)
+    after = time.time() - start
+
+    print "Calls: %d" % calls
+    print "dir() + per call HMAC : %.3fs (%.1f calls/sec)" % (before,
+                                                             calls / before)
+    print "schema + reused HMAC  : %.3fs (%.1f calls/sec)" % (after,
+                                                             calls / after)
+    connection.close()
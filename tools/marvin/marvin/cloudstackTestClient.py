@@ -16,8 +16,10 @@
 # under the License.
 
 from marvin.cloudstackConnection import CSConnection
+from marvin.apiInstrumentation import instrumentation
 from marvin.asyncJobMgr import asyncJobMgr
 from marvin.dbConnection import DbConnection
+from marvin.lookupCache import lookupCache
 from marvin.cloudstackAPI import *
 from marvin.codes import (FAILED, PASS, ADMIN, DOMAIN_ADMIN,
                           USER, SUCCESS, XEN_SERVER)
@@ -74,7 +76,11 @@ class CSTestClient(object):
 
     @identifier.setter
     def identifier(self, id):
+        '''
+        The API calls traced from now on are nested under this test
+        '''
         self.__id = id
+        instrumentation.setTraceRoot(id)
 
     def getParsedTestDataConfig(self):
         '''
@@ -194,7 +200,12 @@ class CSTestClient(object):
             else self.__dbSvrDetails.passwd
         db = 'cloud' if self.__dbSvrDetails.db is None \
             else self.__dbSvrDetails.db
-        self.__dbConnection = DbConnection(host, port, user, passwd, db)
+        poolSize = 5 if self.__dbSvrDetails.poolSize is None \
+            else self.__dbSvrDetails.poolSize
+        readOnly = str(self.__dbSvrDetails.readOnly).lower() == "true"
+        self.__dbConnection = DbConnection(host, port, user, passwd, db,
+                                           poolSize=poolSize,
+                                           readOnly=readOnly)
 
     def __getKeys(self, userid):
         '''
@@ -399,6 +410,15 @@ class CSTestClient(object):
         '''
         return self.__configObj
 
+    def getLookupCache(self):
+        '''
+        @Name : getLookupCache
+        @Desc : Provides the process wide cache of the zone, domain,
+                template and service offering lookups of lib.common,
+                EX: to bypass or invalidate it, see marvin.lookupCache
+        '''
+        return lookupCache
+
     def getApiClient(self):
         if self.__apiClient:
             self.__apiClient.id = self.identifier
@@ -417,18 +437,20 @@ class CSTestClient(object):
             return FAILED
         return self.__createUserApiClient(UserName, DomainName, type)
 
-    def submitCmdsAndWait(self, cmds, workers=1, apiclient=None):
+    def submitCmdsAndWait(self, cmds, workers=1, apiclient=None, rate=None):
         '''
-        @Desc : FixME, httplib has issue if more than one thread submitted
+        @Desc : submit the commands with workers threads, at most rate
+                jobs/sec if given, and wait for all of them to complete
         '''
         if not apiclient:
             apiclient = self.__apiClient
         if self.__asyncJobMgr is None:
             self.__asyncJobMgr = asyncJobMgr(apiclient,
                                              self.__dbConnection)
-        return self.__asyncJobMgr.submitCmdsAndWait(cmds, workers)
+        return self.__asyncJobMgr.submitCmdsAndWait(cmds, workers, rate)
 
-    def submitJob(self, job, ntimes=1, nums_threads=10, interval=1):
+    def submitJob(self, job, ntimes=1, nums_threads=10, interval=1,
+                  rate=None):
         '''
         @Desc : submit one job and execute the same job
                 ntimes, with nums_threads of threads
@@ -438,9 +460,10 @@ class CSTestClient(object):
                                              self.__dbConnection)
         self.__asyncJobMgr.submitJobExecuteNtimes(job, ntimes,
                                                   nums_threads,
-                                                  interval)
+                                                  interval,
+                                                  rate)
 
-    def submitJobs(self, jobs, nums_threads=10, interval=1):
+    def submitJobs(self, jobs, nums_threads=10, interval=1, rate=None):
         '''
         @Desc :submit n jobs, execute them with nums_threads
                of threads
@@ -448,4 +471,4 @@ class CSTestClient(object):
         if self.__asyncJobMgr is None:
             self.__asyncJobMgr = asyncJobMgr(self.__apiClient,
                                              self.__dbConnection)
-        self.__asyncJobMgr.submitJobs(jobs, nums_threads, interval)
+        self.__asyncJobMgr.submitJobs(jobs, nums_threads, interval, rate)
@@ -0,0 +1,291 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Pooled keep-alive HTTP transport used by CSConnection.
+       One transport is kept per Management Server endpoint and is
+       shared by every CSConnection (and its copies) talking to it,
+       so API calls reuse established TCP/TLS connections instead of
+       paying the connection setup for every request.
+'''
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connectionpool
+
+
+class PoolStats(object):
+
+    '''
+    @Desc : Thread safe counters describing the pool usage
+            requests : API requests sent through the transport
+            newConnections : TCP connections opened for those requests
+            reused : requests served over an already open connection
+            waitTime : seconds spent waiting for a free pooled connection
+            evictions : times the idle connections were dropped
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.requests = 0
+        self.newConnections = 0
+        self.waitTime = 0.0
+        self.evictions = 0
+
+    def addRequest(self):
+        with self.__lock:
+            self.requests += 1
+
+    def addConnection(self):
+        with self.__lock:
+            self.newConnections += 1
+
+    def addWait(self, seconds):
+        with self.__lock:
+            self.waitTime += seconds
+
+    def addEviction(self):
+        with self.__lock:
+            self.evictions += 1
+
+    def toDict(self):
+        with self.__lock:
+            return {"requests": self.requests,
+                    "newConnections": self.newConnections,
+                    "reused": max(self.requests - self.newConnections, 0),
+                    "waitTime": round(self.waitTime, 6),
+                    "evictions": self.evictions}
+
+    def __str__(self):
+        return '{%s}' % ', '.join('%s : %s' % (k, v) for (k, v)
+                                  in sorted(self.toDict().items()))
+
+
+class _StatsPoolMixin(object):
+
+    '''
+    Counts the connections opened by an urllib3 pool and the time
+    callers spend blocked while waiting for a pooled connection
+    '''
+    stats = None
+
+    def _new_conn(self):
+        self.stats.addConnection()
+        return super(_StatsPoolMixin, self)._new_conn()
+
+    def _get_conn(self, timeout=None):
+        start = time.time()
+        try:
+            return super(_StatsPoolMixin, self)._get_conn(timeout)
+        finally:
+            self.stats.addWait(time.time() - start)
+
+
+class _PooledAdapter(HTTPAdapter):
+
+    def __init__(self, stats, **kwargs):
+        self.__poolClasses = {
+            "http": type("StatsHTTPConnectionPool",
+                         (_StatsPoolMixin,
+                          connectionpool.HTTPConnectionPool),
+                         {"stats": stats}),
+            "https": type("StatsHTTPSConnectionPool",
+                          (_StatsPoolMixin,
+                           connectionpool.HTTPSConnectionPool),
+                          {"stats": stats})}
+        super(_PooledAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.__poolClasses
+
+
+class CSTransport(object):
+
+    '''
+    @Desc : Keep-alive connection pool towards one Management Server
+    @Input : baseUrl : API endpoint, EX: http://10.1.1.2:8080/client/api
+             poolSize : connections kept alive for this endpoint
+             maxConnectionsPerHost : If set, hard limit of concurrent
+                                     connections; callers block for a
+                                     free connection once reached
+             idleTimeout : seconds after which unused connections are
+                           dropped instead of reused
+    '''
+    __registry = {}
+    __registryLock = threading.Lock()
+
+    def __init__(self, baseUrl, poolSize=10, maxConnectionsPerHost=None,
+                 idleTimeout=60, logger=None):
+        self.baseUrl = baseUrl
+        self.logger = logger
+        self.idleTimeout = idleTimeout
+        self.__stats = PoolStats()
+        self.__lock = threading.Lock()
+        self.__inflight = 0
+        self.__lastUsed = time.time()
+        self.__refs = 0
+        self.__key = None
+        maxsize = poolSize
+        if maxConnectionsPerHost:
+            maxsize = maxConnectionsPerHost
+        self.__adapter = _PooledAdapter(self.__stats,
+                                        pool_connections=1,
+                                        pool_maxsize=maxsize,
+                                        pool_block=bool(
+                                            maxConnectionsPerHost))
+        self.__proxies = requests.utils.get_environ_proxies(baseUrl)
+
+    @classmethod
+    def acquire(cls, baseUrl, poolSize=10, maxConnectionsPerHost=None,
+                idleTimeout=60, logger=None):
+        '''
+        @Name : acquire
+        @Desc : Returns the transport shared for the given endpoint,
+                creating it on first use. Every acquire must be paired
+                with a release once the caller is done with it
+        '''
+        with cls.__registryLock:
+            transport = cls.__registry.get(baseUrl)
+            if transport is None:
+                transport = CSTransport(baseUrl, poolSize,
+                                        maxConnectionsPerHost,
+                                        idleTimeout, logger)
+                transport.__key = baseUrl
+                cls.__registry[baseUrl] = transport
+            transport.__refs += 1
+            return transport
+
+    def release(self):
+        '''
+        @Name : release
+        @Desc : Drops a reference taken through acquire, the pooled
+                connections are closed once nobody uses the transport
+        '''
+        with CSTransport.__registryLock:
+            self.__refs -= 1
+            if self.__refs > 0:
+                return
+            if CSTransport.__registry.get(self.__key) is self:
+                del CSTransport.__registry[self.__key]
+        self.__adapter.close()
+
+    def __evictIfIdle(self):
+        '''
+        Drops the pooled connections when the transport was not used
+        for more than idleTimeout seconds, the server side has most
+        likely closed them already. Caller holds self.__lock
+        '''
+        if self.idleTimeout is None or self.__inflight > 0:
+            return
+        if time.time() - self.__lastUsed > self.idleTimeout:
+            self.__adapter.poolmanager.clear()
+            self.__stats.addEviction()
+
+    def request(self, method, url, params=None, cert=None, verify=True,
+                timeout=None):
+        '''
+        @Name : request
+        @Desc : Sends the request over a pooled connection
+        @Input : method : GET/POST
+                 url : url to send the request to
+                 params : request parameters sent as query string
+                 cert, verify : as understood by requests
+        @Output : requests Response with its content already read, so
+                  the connection is back in the pool when this returns
+        '''
+        with self.__lock:
+            self.__evictIfIdle()
+            self.__inflight += 1
+        try:
+            prepared = requests.Request(method, url,
+                                        params=params).prepare()
+            self.__stats.addRequest()
+            response = self.__adapter.send(prepared,
+                                           timeout=timeout,
+                                           verify=verify,
+                                           cert=cert or None,
+                                           proxies=self.__proxies)
+            response.content
+            return response
+        finally:
+            with self.__lock:
+                self.__inflight -= 1
+                self.__lastUsed = time.time()
+
+    def getStats(self):
+        '''
+        @Name : getStats
+        @Desc : Returns the pool statistics as a dictionary
+        '''
+        return self.__stats.toDict()
+
+
+if __name__ == "__main__":
+    '''
+    Compares plain requests.get against the pooled transport using a
+    local stub management server answering every API call
+    '''
+    import BaseHTTPServer
+    import SocketServer
+
+    class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            body = '{ "listzonesresponse" : { } }'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class StubServer(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    stub = threading.Thread(target=server.serve_forever)
+    stub.daemon = True
+    stub.start()
+    url = "http://127.0.0.1:%d/client/api" % server.server_address[1]
+    calls = 2000
+    payload = {"command": "listZones", "response": "json"}
+
+    start = time.time()
+    for i in range(calls):
+        requests.get(url, params=payload).json()
+    unpooled = time.time() - start
+
+    transport = CSTransport.acquire(url)
+    start = time.time()
+    for i in range(calls):
+        transport.request("GET", url, payload).json()
+    pooled = time.time() - start
+
+    print "Calls: %d" % calls
+    print "requests.get : %.3fs (%.1f calls/sec)" % (unpooled,
+                                                     calls / unpooled)
+    print "CSTransport  : %.3fs (%.1f calls/sec)" % (pooled,
+                                                     calls / pooled)
+    print "Pool stats   : %s" % transport.getStats()
+    transport.release()
+    server.shutdown()
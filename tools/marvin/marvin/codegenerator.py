@@ -16,12 +16,17 @@
 # under the License.
 
 import xml.dom.minidom
+import hashlib
 import json
 from optparse import OptionParser
 from textwrap import dedent
 import os
 import sys
 import urllib2
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 
 class cmdParameterProperty(object):
@@ -51,17 +56,34 @@ class CodeGenerator(object):
     Apache CloudStack- marvin python classes can be generated from the json
     returned by API discovery or from the xml spec of commands generated by
     the ApiDocWriter. This class provides helper methods for these uses.
+
+    Generation is incremental: the hash of the spec of every command is
+    kept in cloudstackAPI/.codegen.json and a command module is only
+    generated again when its spec (or this generator) changed, the other
+    files are only rewritten when their content changed. The parsed specs
+    are cached in cacheFolder, keyed by the hash of the spec file or by
+    the version of the management server.
     """
     space = '    '
     newline = '\n'
     cmdsName = []
+    MANIFEST = ".codegen.json"
 
-    def __init__(self, outputFolder):
+    def __init__(self, outputFolder, cacheFolder=None, useCache=True):
         self.cmd = None
         self.code = ""
         self.required = []
+        self.cmdsIndex = {}
         self.subclass = []
         self.outputFolder = outputFolder
+        self.cacheFolder = cacheFolder or \
+            os.path.join(outputFolder, ".apiSpecCache")
+        self.useCache = useCache
+        self.filesWritten = 0
+        self.filesUnchanged = 0
+        self.specHashes = {}
+        self.generator = generatorDigest()
+        self.previousHashes = self.loadManifest()
         lic = """\
           # Licensed to the Apache Software Foundation (ASF) under one
           # or more contributor license agreements.  See the NOTICE file
@@ -118,6 +140,19 @@ class CodeGenerator(object):
 
         self.cmd = cmd
         self.cmdsName.append(self.cmd.name)
+        self.cmdsIndex[cmd.name] = (
+            str(cmd.async).lower() == "true",
+            tuple(str(req.name) for req in cmd.request
+                  if req.required == "true"),
+            tuple(str(req.name) for req in cmd.request))
+        specHash = hashlib.sha1(
+            json.dumps(cmdToDict(cmd), sort_keys=True)).hexdigest()
+        self.specHashes[cmd.name] = specHash
+        if self.previousHashes.get(cmd.name) == specHash and \
+                os.path.exists(self.apiPath("%s.py" % cmd.name)):
+            self.filesUnchanged += 1
+            return
+
         self.code = self.license
         self.code += self.newline
         self.code += '"""%s"""\n' % self.cmd.desc
@@ -185,10 +220,7 @@ class CodeGenerator(object):
         for subclass in self.subclass:
             self.code += subclass + "\n"
 
-        fp = open(self.outputFolder + "/cloudstackAPI/%s.py" % self.cmd.name,
-                  "w")
-        fp.write(self.code)
-        fp.close()
+        self.writeFile("%s.py" % self.cmd.name, self.code)
         self.code = ""
         self.subclass = []
 
@@ -197,8 +229,27 @@ class CodeGenerator(object):
 
         header = '"""Test Client for CloudStack API"""\n'
         imports = "import copy\n"
-        initCmdsList = '__all__ = ['
+        imports += "from marvin.apiLoader import responseClass\n"
+        imports += "from apiIndex import COMMANDS\n"
         body = ''
+        body += self.newline
+        body += '_PACKAGE = __name__.rpartition(".")[0]\n'
+        body += self.newline
+
+        # The methods of the commands are created on their first use,
+        # the response module of a command is only imported then
+        #            def _command(name, responseType):
+        #                def request(self, command, method="GET"):
+        #                    ...
+        body += 'def _command(name, responseType):\n'
+        body += self.space + 'def request(self, command, method="GET"):\n'
+        body += self.space * 2
+        body += 'return self.connection.marvinRequest(command,'
+        body += ' response_type=responseType(), method=method)\n'
+        body += self.space + 'request.__name__ = name\n'
+        body += self.space + 'return request\n'
+        body += self.newline
+
         body += "class CloudStackAPIClient(object):\n"
         body += self.space + 'def __init__(self, connection):\n'
         body += self.space + self.space + 'self.connection = connection\n'
@@ -230,48 +281,184 @@ class CodeGenerator(object):
         body += self.space * 2 + 'self._id = identifier' + self.newline
         body += self.newline
 
-        for cmdName in self.cmdsName:
-            body += self.space
-            body += 'def %s(self, command, method="GET"):\n' % cmdName
-            body += self.space + self.space
-            body += 'response = %sResponse()\n' % cmdName
-            body += self.space + self.space
-            body += 'response = self.connection.marvinRequest(command,'
-            body += ' response_type=response, method=method)\n'
-            body += self.space + self.space + 'return response\n'
-            body += self.newline
-
-            imports += 'from %s import %sResponse\n' % (cmdName, cmdName)
-            initCmdsList += '"%s",' % cmdName
-
-        fp = open(self.outputFolder + '/cloudstackAPI/cloudstackAPIClient.py',
-                  'w')
-        fp.write(self.license)
-        for item in [header, imports, body]:
-            fp.write(item)
-        fp.close()
+        body += self.lazyMethods("CloudStackAPIClient")
 
-        '''generate __init__.py'''
-        initCmdsList = self.license + initCmdsList + '"cloudstackAPIClient"]'
-        fp = open(self.outputFolder + '/cloudstackAPI/__init__.py', 'w')
-        fp.write(initCmdsList)
-        fp.close()
+        self.writeFile('cloudstackAPIClient.py',
+                       self.license + header + imports + body)
+
+        self.finalizeAsyncClient()
+        self.finalizeIndex()
+
+        '''generate __init__.py, the command modules are bound lazily'''
+        init = self.license
+        init += 'from marvin.apiLoader import install\n'
+        init += 'from apiIndex import COMMANDS\n'
+        init += '__all__ = sorted(COMMANDS) + '
+        init += '["cloudstackAPIClient", "cloudstackAPIAsyncClient"]\n'
+        init += 'install(globals(), __name__, __all__)\n'
+        self.writeFile('__init__.py', init)
 
-        fp = open(self.outputFolder + '/cloudstackAPI/baseCmd.py', 'w')
         basecmd = self.license
         basecmd += '"""Base Command"""\n'
         basecmd += 'class baseCmd(object):\n'
         basecmd += self.space + 'pass\n'
-        fp.write(basecmd)
-        fp.close()
+        self.writeFile('baseCmd.py', basecmd)
 
-        fp = open(self.outputFolder + '/cloudstackAPI/baseResponse.py', 'w')
         basecmd = self.license
         basecmd += '"""Base class for response"""\n'
         basecmd += 'class baseResponse(object):\n'
         basecmd += self.space + 'pass\n'
-        fp.write(basecmd)
+        self.writeFile('baseResponse.py', basecmd)
+
+        self.saveManifest()
+
+    def apiPath(self, name):
+        return os.path.join(self.outputFolder, "cloudstackAPI", name)
+
+    def writeFile(self, name, content):
+        '''
+        write cloudstackAPI/<name>, unless it already holds this content:
+        unchanged files keep their mtime and their compiled .pyc
+        '''
+        path = self.apiPath(name)
+        data = content.encode("utf-8") if isinstance(content, unicode) \
+            else content
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                if hashlib.sha1(fp.read()).digest() == \
+                        hashlib.sha1(data).digest():
+                    self.filesUnchanged += 1
+                    return False
+        fp = open(path, "w")
+        fp.write(content)
         fp.close()
+        self.filesWritten += 1
+        return True
+
+    def loadManifest(self):
+        '''
+        the spec hashes of the commands generated by the previous run,
+        none when it was another version of the generator
+        '''
+        try:
+            with open(self.apiPath(self.MANIFEST)) as fp:
+                manifest = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get("generator") != self.generator:
+            return {}
+        return manifest.get("commands", {})
+
+    def saveManifest(self):
+        with open(self.apiPath(self.MANIFEST), "w") as fp:
+            json.dump({"generator": self.generator,
+                       "commands": self.specHashes}, fp, sort_keys=True)
+
+    def loadSpecCache(self, key):
+        '''
+        @Name : loadSpecCache
+        @Desc : the commands parsed earlier from the spec identified by
+                key, None when they are not in the cache
+        '''
+        if not self.useCache or key is None:
+            return None
+        try:
+            with open(os.path.join(self.cacheFolder, key + ".json")) as fp:
+                return [cmdFromDict(cmd) for cmd in json.load(fp)]
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def saveSpecCache(self, key, cmds):
+        if not self.useCache or key is None:
+            return
+        try:
+            if not os.path.isdir(self.cacheFolder):
+                os.makedirs(self.cacheFolder)
+            path = os.path.join(self.cacheFolder, key + ".json")
+            with open(path + ".tmp", "w") as fp:
+                json.dump([cmdToDict(cmd) for cmd in cmds], fp)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            print "Failed to cache the api spec in %s: %s" % \
+                (self.cacheFolder, e)
+
+    def lazyMethods(self, className):
+        '''
+        generate the __getattr__ of an api client, it creates the method
+        of a command with _command on its first use and keeps it on the
+        class
+        '''
+        body = self.space + 'def __getattr__(self, name):\n'
+        body += self.space * 2 + 'if name not in COMMANDS:\n'
+        body += self.space * 3 + 'raise AttributeError("\'%s\' object has' \
+            % className
+        body += ' no attribute \'%s\'" % name)\n'
+        body += self.space * 2
+        body += 'setattr(%s, name,\n' % className
+        body += self.space * 4
+        body += '_command(name, responseClass(_PACKAGE, name)))\n'
+        body += self.space * 2 + 'return getattr(self, name)\n'
+        body += self.newline
+        return body
+
+    def finalizeIndex(self):
+        '''
+        generate apiIndex.py, the commands with whether they are async,
+        their required and all their parameters, known without importing
+        the command modules
+        '''
+        index = self.license
+        index += '"""Index of the CloudStack API commands:\n'
+        index += 'name: (isAsync, required parameters, parameters)"""\n'
+        index += 'COMMANDS = {\n'
+        for cmdName in sorted(self.cmdsName):
+            isAsync, required, params = self.cmdsIndex.get(cmdName,
+                                                           (False, (), ()))
+            index += self.space + '%r: (%r, %r, %r),\n' % \
+                (str(cmdName), isAsync, required, params)
+        index += '}\n'
+        self.writeFile('apiIndex.py', index)
+
+    def finalizeAsyncClient(self):
+        '''
+        generate the asynchronous api client, its methods return a
+        Future of the response (see marvin.asyncClient) and share the
+        command and response classes of the synchronous client
+        '''
+        header = '"""Asynchronous Test Client for CloudStack API"""\n'
+        imports = "import copy\n"
+        imports += "from marvin.apiLoader import responseClass\n"
+        imports += "from apiIndex import COMMANDS\n"
+        body = ''
+        body += self.newline
+        body += '_PACKAGE = __name__.rpartition(".")[0]\n'
+        body += self.newline
+
+        body += 'def _command(name, responseType):\n'
+        body += self.space
+        body += 'def request(self, command, method="GET", wait=True):\n'
+        body += self.space * 2
+        body += 'return self.connection.request(command,'
+        body += ' response_type=responseType(), method=method,'
+        body += ' wait=wait)\n'
+        body += self.space + 'request.__name__ = name\n'
+        body += self.space + 'return request\n'
+        body += self.newline
+
+        body += "class CloudStackAPIAsyncClient(object):\n"
+        body += self.space + 'def __init__(self, connection):\n'
+        body += self.space + self.space + 'self.connection = connection\n'
+        body += self.newline
+
+        body += self.space + 'def __copy__(self):\n'
+        body += self.space + self.space
+        body += 'return CloudStackAPIAsyncClient(copy.copy(self.connection))\n'
+        body += self.newline
+
+        body += self.lazyMethods("CloudStackAPIAsyncClient")
+
+        self.writeFile('cloudstackAPIAsyncClient.py',
+                       self.license + header + imports + body)
 
     def constructResponseFromXML(self, response):
         paramProperty = cmdParameterProperty()
@@ -292,61 +479,69 @@ class CodeGenerator(object):
         return paramProperty
 
     def loadCmdFromXML(self, dom):
-        cmds = []
-        for cmd in dom.getElementsByTagName("command"):
-            csCmd = cloudStackCmd()
-            csCmd.name = getText(cmd.getElementsByTagName('name'))
-            assert csCmd.name
+        return [self.loadCmdFromXMLNode(cmd)
+                for cmd in dom.getElementsByTagName("command")]
 
-            desc = getText(cmd.getElementsByTagName('description'))
-            if desc:
-                csCmd.desc = desc
+    def loadCmdFromXMLNode(self, cmd):
+        csCmd = cloudStackCmd()
+        csCmd.name = getText(cmd.getElementsByTagName('name'))
+        assert csCmd.name
 
-            async = getText(cmd.getElementsByTagName('isAsync'))
-            if async:
-                csCmd.async = async
+        desc = getText(cmd.getElementsByTagName('description'))
+        if desc:
+            csCmd.desc = desc
 
-            argList = cmd.getElementsByTagName("request")[0].\
-                getElementsByTagName("arg")
-            for param in argList:
-                paramProperty = cmdParameterProperty()
+        async = getText(cmd.getElementsByTagName('isAsync'))
+        if async:
+            csCmd.async = async
 
-                paramProperty.name =\
-                    getText(param.getElementsByTagName('name'))
-                assert paramProperty.name
+        argList = cmd.getElementsByTagName("request")[0].\
+            getElementsByTagName("arg")
+        for param in argList:
+            paramProperty = cmdParameterProperty()
 
-                required = param.getElementsByTagName('required')
-                if required:
-                    paramProperty.required = getText(required)
+            paramProperty.name =\
+                getText(param.getElementsByTagName('name'))
+            assert paramProperty.name
 
-                requestDescription = param.getElementsByTagName('description')
-                if requestDescription:
-                    paramProperty.desc = getText(requestDescription)
+            required = param.getElementsByTagName('required')
+            if required:
+                paramProperty.required = getText(required)
 
-                type = param.getElementsByTagName("type")
-                if type:
-                    paramProperty.type = getText(type)
+            requestDescription = param.getElementsByTagName('description')
+            if requestDescription:
+                paramProperty.desc = getText(requestDescription)
 
-                dataType = param.getElementsByTagName('dataType')
-                if dataType:
-                    paramProperty.dataType = getText(dataType)
+            type = param.getElementsByTagName("type")
+            if type:
+                paramProperty.type = getText(type)
 
-                csCmd.request.append(paramProperty)
+            dataType = param.getElementsByTagName('dataType')
+            if dataType:
+                paramProperty.dataType = getText(dataType)
 
-            responseEle = cmd.getElementsByTagName("response")[0]
-            for response in responseEle.getElementsByTagName("arg"):
-                if response.parentNode != responseEle:
-                    continue
+            csCmd.request.append(paramProperty)
 
-                paramProperty = self.constructResponseFromXML(response)
-                csCmd.response.append(paramProperty)
+        responseEle = cmd.getElementsByTagName("response")[0]
+        for response in responseEle.getElementsByTagName("arg"):
+            if response.parentNode != responseEle:
+                continue
 
-            cmds.append(csCmd)
-        return cmds
+            paramProperty = self.constructResponseFromXML(response)
+            csCmd.response.append(paramProperty)
+        return csCmd
 
     def generateCodeFromXML(self, apiSpecFile):
-        dom = xml.dom.minidom.parse(apiSpecFile)
-        cmds = self.loadCmdFromXML(dom)
+        '''
+        the commands are parsed one at a time from the spec file, which
+        is never held in memory as a whole
+        '''
+        key = "xml-%s" % fileDigest(apiSpecFile)
+        cmds = self.loadSpecCache(key)
+        if cmds is None:
+            cmds = [self.loadCmdFromXMLNode(cmd)
+                    for cmd in iterCommandsFromXML(apiSpecFile)]
+            self.saveSpecCache(key, cmds)
         for cmd in cmds:
             self.generate(cmd)
         self.finalize()
@@ -374,9 +569,7 @@ class CodeGenerator(object):
         if apiStream is None:
             raise Exception("No APIs found through discovery")
 
-        jsonOut = apiStream.readlines()
-        assert len(jsonOut) > 0
-        apiDict = json.loads(jsonOut[0])
+        apiDict = json.load(apiStream)
         if 'listapisresponse' not in apiDict:
             raise Exception("API discovery plugin response failed")
         if 'count' not in apiDict['listapisresponse']:
@@ -431,8 +624,13 @@ class CodeGenerator(object):
         @return: The classes in cloudstackAPI/ formed from api discovery json
         """
         if endpointUrl.find('response=json') >= 0:
-            apiStream = urllib2.urlopen(endpointUrl)
-            cmds = self.loadCmdFromJSON(apiStream)
+            version = serverVersion(endpointUrl)
+            key = "api-%s" % version if version else None
+            cmds = self.loadSpecCache(key)
+            if cmds is None:
+                apiStream = urllib2.urlopen(endpointUrl)
+                cmds = self.loadCmdFromJSON(apiStream)
+                self.saveSpecCache(key, cmds)
             for cmd in cmds:
                 self.generate(cmd)
             self.finalize()
@@ -441,6 +639,118 @@ class CodeGenerator(object):
 def getText(elements):
     return elements[0].childNodes[0].nodeValue.strip()
 
+
+class _XmlText(object):
+    __slots__ = ("nodeValue",)
+
+    def __init__(self, value):
+        self.nodeValue = value
+
+
+class _XmlNode(object):
+
+    '''
+    minidom like view of an ElementTree element, what loadCmdFromXMLNode
+    uses of it: getElementsByTagName, childNodes and parentNode
+    '''
+    __slots__ = ("element", "parentNode")
+
+    def __init__(self, element, parentNode=None):
+        self.element = element
+        self.parentNode = parentNode
+
+    @property
+    def childNodes(self):
+        return [_XmlText(self.element.text or "")]
+
+    def getElementsByTagName(self, tag):
+        found = []
+        pending = [(self, iter(self.element))]
+        while pending:
+            parent, children = pending[-1]
+            child = next(children, None)
+            if child is None:
+                pending.pop()
+                continue
+            node = _XmlNode(child, parent)
+            if child.tag == tag:
+                found.append(node)
+            pending.append((node, iter(child)))
+        return found
+
+
+def iterCommandsFromXML(apiSpecFile):
+    '''
+    @Name : iterCommandsFromXML
+    @Desc : streams the command elements of an api spec file, each one
+            is dropped once the caller moved to the next one
+    '''
+    for event, element in ElementTree.iterparse(apiSpecFile):
+        if element.tag == "command":
+            yield _XmlNode(element)
+            element.clear()
+
+
+def cmdToDict(cmd):
+    def prop(pro):
+        return {"name": pro.name, "required": pro.required,
+                "desc": pro.desc, "type": pro.type,
+                "dataType": pro.dataType,
+                "subProperties": [prop(sub) for sub in pro.subProperties]}
+    return {"name": cmd.name, "desc": cmd.desc, "async": cmd.async,
+            "request": [prop(req) for req in cmd.request],
+            "response": [prop(res) for res in cmd.response]}
+
+
+def cmdFromDict(values):
+    def prop(values):
+        pro = cmdParameterProperty()
+        for name in ("name", "required", "desc", "type", "dataType"):
+            setattr(pro, name, values[name])
+        pro.subProperties = [prop(sub) for sub in values["subProperties"]]
+        return pro
+    cmd = cloudStackCmd()
+    cmd.name = values["name"]
+    cmd.desc = values["desc"]
+    cmd.async = values["async"]
+    cmd.request = [prop(req) for req in values["request"]]
+    cmd.response = [prop(res) for res in values["response"]]
+    return cmd
+
+
+def fileDigest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def generatorDigest():
+    '''
+    the hash of this module, generated files of another version of the
+    generator are not reused
+    '''
+    try:
+        return fileDigest(os.path.splitext(__file__)[0] + ".py")
+    except (IOError, OSError):
+        return None
+
+
+def serverVersion(endpointUrl):
+    '''
+    @Name : serverVersion
+    @Desc : the version of the management server of the discovery
+            endpoint, None when listCapabilities does not answer
+    '''
+    url = endpointUrl.replace("command=listApis", "command=listCapabilities")
+    try:
+        capabilities = json.load(urllib2.urlopen(url))
+        return capabilities["listcapabilitiesresponse"]["capability"][
+            "cloudstackversion"]
+    except Exception:
+        return None
+
 if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-o", "--output", dest="output",
@@ -452,6 +762,12 @@ if __name__ == "__main__":
     parser.add_option("-e", "--endpoint", dest="endpoint",
                       help="The endpoint mgmt server (with open 8096) where\
  apis are discovered, default is localhost")
+    parser.add_option("-c", "--cache", dest="cache",
+                      help="The folder of the cache of parsed api specs,\
+ default is <output>/.apiSpecCache")
+    parser.add_option("--no-cache", dest="useCache", action="store_false",
+                      default=True,
+                      help="Parse the api spec even if it is in the cache")
 
     (options, args) = parser.parse_args()
 
@@ -476,10 +792,12 @@ if __name__ == "__main__":
             print parser.print_help()
             exit(1)
 
-    cg = CodeGenerator(folder)
+    cg = CodeGenerator(folder, options.cache, options.useCache)
     if options.spec is not None:
         cg.generateCodeFromXML(apiSpecFile)
     elif options.endpoint is not None:
         endpointUrl = 'http://%s:8096/client/api?command=listApis&\
 response=json' % options.endpoint
         cg.generateCodeFromJSON(endpointUrl)
+    print "%d commands, %d files written, %d unchanged" % \
+        (len(cg.specHashes), cg.filesWritten, cg.filesUnchanged)
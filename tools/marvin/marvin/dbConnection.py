@@ -21,40 +21,295 @@ from mysql import connector
 from mysql.connector import errors
 from contextlib import closing
 from marvin import cloudstackException
+import re
+import sqlite3
 import sys
 import os
+import threading
+import time
+
+
+class MySqlConnector(object):
+
+    '''
+    @Desc : Opens and checks the mysql.connector connections of a
+            DbConnection pool
+    '''
+    emptyResultErrors = (errors.InterfaceError,)
+    connectionErrors = (errors.OperationalError, errors.InterfaceError)
+
+    def connect(self, dbConn, db):
+        conn = mysql.connector.connect(host=str(dbConn.host),
+                                       port=int(dbConn.port),
+                                       user=str(dbConn.user),
+                                       password=str(dbConn.passwd),
+                                       db=str(db))
+        conn.autocommit = True
+        return conn
+
+    def cursor(self, conn):
+        return conn.cursor(buffered=True)
+
+    def execute(self, cursor, sql, params):
+        cursor.execute(sql, params)
+
+    def ping(self, conn):
+        conn.ping(reconnect=False)
+
+
+class SqliteConnector(object):
+
+    '''
+    @Desc : SQLite backed stand-in for MySqlConnector, lets DbConnection
+            and its callers be exercised without a MySQL server.
+            The database name passed to DbConnection (or to execute) is
+            the path of the SQLite file, %s placeholders are translated
+            to the qmark style SQLite understands
+    '''
+    emptyResultErrors = ()
+    connectionErrors = (sqlite3.ProgrammingError,)
+
+    def connect(self, dbConn, db):
+        return sqlite3.connect(str(db), check_same_thread=False,
+                               isolation_level=None)
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+    def execute(self, cursor, sql, params):
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql.replace("%s", "?"), params)
+
+    def ping(self, conn):
+        conn.execute("select 1").fetchall()
+
+
+class QueryStats(object):
+
+    '''
+    @Desc : Per statement latency of the queries run through a
+            DbConnection. Literal numbers and strings are folded into
+            ? so that queries built with inline values are accounted
+            under the same statement
+    '''
+    __literals = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|"
+                            r"\b\d+(?:\.\d+)?\b")
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__statements = {}
+
+    def statement(self, sql):
+        return " ".join(QueryStats.__literals.sub("?", sql).split())[:200]
+
+    def add(self, sql, elapsed, failed=False):
+        key = self.statement(sql)
+        with self.__lock:
+            entry = self.__statements.get(key)
+            if entry is None:
+                entry = self.__statements[key] = {"count": 0, "errors": 0,
+                                                  "total": 0.0, "max": 0.0}
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            if failed:
+                entry["errors"] += 1
+
+    def toDict(self):
+        with self.__lock:
+            stats = {}
+            for key, entry in self.__statements.iteritems():
+                stats[key] = dict(entry)
+                stats[key]["avg"] = entry["total"] / entry["count"]
+            return stats
 
 
 class DbConnection(object):
 
+    '''
+    @Desc : Connection to the CloudStack database.
+            Connections are kept in a bounded pool and reused across
+            queries instead of being opened for every query.
+    @Input : poolSize : maximum connections opened at the same time,
+                        callers block for a free one beyond that
+             readOnly : only allow statements which do not modify data
+             healthCheckInterval : seconds a pooled connection can stay
+                                   idle before it is pinged on reuse
+             connector : MySqlConnector (default) or SqliteConnector
+    '''
+    __readStatements = ("select", "show", "describe", "desc", "explain")
+
     def __init__(self, host="localhost", port=3306, user='cloud',
-                 passwd='cloud', db='cloud'):
+                 passwd='cloud', db='cloud', poolSize=5, readOnly=False,
+                 healthCheckInterval=30, connector=None):
         self.host = host
         self.port = port
         self.user = str(user)  # Workaround: http://bugs.mysql.com/?id=67306
         self.passwd = passwd
         self.database = db
+        self.poolSize = max(int(poolSize), 1)
+        self.readOnly = readOnly
+        self.healthCheckInterval = healthCheckInterval
+        self.connector = connector if connector is not None \
+            else MySqlConnector()
+        self.__cond = threading.Condition()
+        self.__idle = []
+        self.__opened = 0
+        self.__stats = QueryStats()
+
+    def __acquire(self, db):
+        '''
+        Returns an open connection to db, reusing an idle one when
+        possible; blocks while poolSize connections are in use
+        '''
+        with self.__cond:
+            while True:
+                entry = self.__takeIdle(db)
+                if entry is not None:
+                    break
+                if self.__opened >= self.poolSize and self.__idle:
+                    '''
+                    Make room by closing an idle connection to
+                    another database
+                    '''
+                    self.__close(self.__idle.pop(0)[0])
+                    self.__opened -= 1
+                if self.__opened < self.poolSize:
+                    self.__opened += 1
+                    break
+                self.__cond.wait()
+        if entry is not None:
+            conn, db, lastUsed = entry
+            if time.time() - lastUsed <= self.healthCheckInterval:
+                return conn
+            try:
+                self.connector.ping(conn)
+                return conn
+            except Exception:
+                self.__close(conn)
+        try:
+            return self.connector.connect(self, db)
+        except:
+            self.__discard()
+            raise
+
+    def __takeIdle(self, db):
+        '''
+        Most recently used idle connection to db, caller holds the lock
+        '''
+        for entry in reversed(self.__idle):
+            if entry[1] == db:
+                self.__idle.remove(entry)
+                return entry
+        return None
+
+    def __release(self, conn, db):
+        with self.__cond:
+            self.__idle.append((conn, db, time.time()))
+            self.__cond.notify()
+
+    def __discard(self, conn=None):
+        '''
+        Forgets a connection that failed, freeing its slot in the pool
+        '''
+        if conn is not None:
+            self.__close(conn)
+        with self.__cond:
+            self.__opened -= 1
+            self.__cond.notify()
+
+    def __close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def __checkReadOnly(self, sql):
+        if self.readOnly:
+            statement = sql.lstrip().split(None, 1)
+            if not statement or \
+                    statement[0].lower() not in self.__readStatements:
+                raise cloudstackException.dbException(
+                    "DbConnection is read only, refusing: %s" % sql)
+
+    def __run(self, cursor, sql, params):
+        self.__checkReadOnly(sql)
+        start = time.time()
+        try:
+            self.connector.execute(cursor, sql, params)
+            try:
+                resultRow = cursor.fetchall()
+            except self.connector.emptyResultErrors:
+                # Raised on empty result - DML
+                resultRow = []
+        except:
+            self.__stats.add(sql, time.time() - start, failed=True)
+            raise
+        self.__stats.add(sql, time.time() - start)
+        return resultRow
+
+    def __query(self, queries, db):
+        db = str(self.database) if not db else db
+        conn = self.__acquire(db)
+        try:
+            with contextlib.closing(self.connector.cursor(conn)) as cursor:
+                results = [self.__run(cursor, sql, params)
+                           for sql, params in queries]
+        except Exception as e:
+            if isinstance(e, self.connector.connectionErrors):
+                self.__discard(conn)
+            else:
+                self.__release(conn, db)
+            raise
+        self.__release(conn, db)
+        return results
 
     def execute(self, sql=None, params=None, db=None):
         if sql is None:
             return None
+        return self.__query([(sql, params)], db)[0]
 
-        resultRow = []
-        with contextlib.\
-            closing(mysql.connector.connect(host=str(self.host),
-                                            port=int(self.port),
-                                            user=str(self.user),
-                                            password=str(self.passwd),
-                                            db=str(self.database) if not db else db)) as conn:
-            conn.autocommit = True
-            with contextlib.closing(conn.cursor(buffered=True)) as cursor:
-                cursor.execute(sql, params)
-                try:
-                    resultRow = cursor.fetchall()
-                except errors.InterfaceError:
-                    # Raised on empty result - DML
-                    resultRow = []
-        return resultRow
+    def executeMany(self, queries, db=None):
+        '''
+        @Name : executeMany
+        @Desc : Runs a batch of queries over a single pooled connection
+        @Input : queries : list of sql strings or (sql, params) tuples
+        @Output : list with the result rows of every query, in order
+        '''
+        batch = []
+        for query in queries:
+            if isinstance(query, basestring):
+                batch.append((query, None))
+            else:
+                batch.append((query[0], query[1]))
+        if not batch:
+            return []
+        return self.__query(batch, db)
+
+    def getStats(self):
+        '''
+        @Name : getStats
+        @Desc : Returns the per statement count, errors, total/avg/max
+                latency (seconds) and the pool usage
+        '''
+        with self.__cond:
+            pool = {"opened": self.__opened, "idle": len(self.__idle),
+                    "poolSize": self.poolSize}
+        return {"pool": pool, "queries": self.__stats.toDict()}
+
+    def close(self):
+        '''
+        @Name : close
+        @Desc : Closes the idle pooled connections
+        '''
+        with self.__cond:
+            idle = self.__idle
+            self.__idle = []
+            self.__opened -= len(idle)
+        for conn, db, lastUsed in idle:
+            self.__close(conn)
 
     def executeSqlFromFile(self, fileName=None):
         if fileName is None:
@@ -69,6 +324,24 @@ class DbConnection(object):
         return self.execute(sqls)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        '''
+        python dbConnection.py <sqlite file> exercises the pool against
+        the SQLite stand-in
+        '''
+        db = DbConnection(db=sys.argv[1], connector=SqliteConnector())
+        db.execute("create table if not exists async_job (id integer, "
+                   "uuid varchar(40), job_status integer, created text, "
+                   "last_updated text)")
+        db.executeMany([("insert into async_job values (%s, %s, 1, "
+                         "datetime('now'), datetime('now'))",
+                         (i, "job-%d" % i)) for i in range(100)])
+        for i in range(100):
+            db.execute("select job_status, created, last_updated from "
+                       "async_job where id=%d" % i)
+        print db.getStats()
+        db.close()
+        sys.exit(0)
     db = DbConnection()
     '''
     try:
@@ -30,6 +30,7 @@ from marvin.codes import (SUCCESS,
                           EXCEPTION
                           )
 from marvin.tcExecuteEngine import TestCaseExecuteEngine
+from marvin.parallelRunner import ParallelRunner
 
 
 class VerifyAndExit(object):
@@ -97,10 +98,11 @@ class MarvinCliCommands(object):
         'runtest':
             {
                 'summary': 'for running test cases, either test suite (or) directory of test suites',
-                'options': ['*config-file', '*tc-path', 'required_hardware', 'zone', 'hyp-type'],
+                'options': ['*config-file', '*tc-path', 'required_hardware', 'zone', 'hyp-type', 'workers'],
                 'help': 'marvincli runtest config-file=<path_to_marvin_config> tc-path=test/integration/smoke'
-                'required_hardware=<true\\false> zone=<name of zone> hyp-type=<xenserver\\kvm\\vmware> etc',
-                'desc': 'runs marvin integration tests against CS using config file, test suite path or directory of test suites are provided as input for running tests',
+                'required_hardware=<true\\false> zone=<name of zone> hyp-type=<xenserver\\kvm\\vmware> workers=<parallel test processes> etc',
+                'desc': 'runs marvin integration tests against CS using config file, test suite path or directory of test suites are provided as input for running tests. '
+                'With workers greater than 1, the test classes are sharded over that many nose processes and the xunit reports merged',
             },
         'sync_and_install':
             {
@@ -181,6 +183,7 @@ class MarvinCli(cmd.Cmd, object):
         self.__logFolderPath = None
         self.__testRunner = None
         self.__requiredHw = False
+        self.__workers = 1
         self.__csFolder = "."
         cmd.Cmd.__init__(self)
 
@@ -220,6 +223,7 @@ class MarvinCli(cmd.Cmd, object):
             self.__hypervisorType = out_dict.get("hyp-type", None)
             self.__tcPath = out_dict.get("tc-path",)
             self.__requiredHw = out_dict.get("required-hardware")
+            self.__workers = int(out_dict.get("workers", 1))
             if not all([self.__tcPath, self.__configFile]):
                 return FAILED
             print "\n==== Parsing Input Options Successful ===="
@@ -254,13 +258,27 @@ class MarvinCli(cmd.Cmd, object):
         print "\n==== Started Running Test Cases ===="
         xunit_out_path = "/tmp/marvin_xunit_out" + \
                          str(random.randrange(1, 10000)) + ".xml"
+        if self.__workers > 1:
+            attr = "tags=advanced"
+            if self.__requiredHw:
+                attr += ",required_hardware=%s" % self.__requiredHw
+            runner = ParallelRunner(
+                self.__configFile, [self.__tcPath],
+                workers=self.__workers,
+                attrs=[attr],
+                xunitFile=xunit_out_path,
+                zone=self.__zone,
+                hypervisor=self.__hypervisorType)
+            runner.run()
+            print "\n==== Running Test Cases Successful ===="
+            return
         marvin_tc_run_cmd = "nosetests-2.7 -s --with-marvin --marvin-config=%s --with-xunit --xunit-file=%s  %s  -a tags=advanced, required_hardware=%s  --zone=%s --hypervisor=%s"
         if os.path.isfile(self.__tcPath):
             marvin_tc_run_cmd = marvin_tc_run_cmd % (self.__configFile,
-                                                     xunit_out_path, self.__requiredHw, self.__zone, self.__hypervisorType)
+                                                     xunit_out_path, self.__tcPath, self.__requiredHw, self.__zone, self.__hypervisorType)
         if os.path.isdir(self.__tcPath):
             marvin_tc_run_cmd = marvin_tc_run_cmd % (self.__configFile,
-                                                     xunit_out_path, self.__requiredHw, self.__zone, self.__hypervisorType)
+                                                     xunit_out_path, self.__tcPath, self.__requiredHw, self.__zone, self.__hypervisorType)
         os.system(marvin_tc_run_cmd)
         '''
         engine = TestCaseExecuteEngine(self.__testClient,
@@ -33,9 +33,12 @@ from marvin.cloudstackAPI import *
 from marvin.codes import (FAILED, SUCCESS)
 from marvin.lib.utils import (random_gen)
 from marvin.config.test_data import test_data
+from marvin.taskGraph import TaskGraph
 from sys import exit
 import os
 import pickle
+import threading
+import time
 from time import sleep, strftime, localtime
 from optparse import OptionParser
 
@@ -47,13 +50,18 @@ class DeployDataCenters(object):
             Once the Deployment is successful, it will export
             the DataCenter settings to an obj file
             ( can be used if wanted to delete the created DC)
+            Zones, pods, clusters, host additions and storages which
+            do not depend on each other are created concurrently, by
+            at most workers (or the deployWorkers setting of the
+            config, 5 by default) threads
     '''
 
     def __init__(self,
                  test_client,
                  cfg,
                  logger=None,
-                 log_folder_path=None
+                 log_folder_path=None,
+                 workers=None
                  ):
         self.__testClient = test_client
         self.__config = cfg
@@ -61,6 +69,9 @@ class DeployDataCenters(object):
         self.__logFolderPath = log_folder_path
         self.__apiClient = None
         self.__cleanUp = {}
+        self.__cleanUpLock = threading.Lock()
+        self.__deferCleanUp = False
+        self.__workers = workers or getattr(cfg, "deployWorkers", None) or 5
 
     def __persistDcConfig(self):
         try:
@@ -82,6 +93,12 @@ class DeployDataCenters(object):
                   GetDetailExceptionInfo(e)
 
     def __cleanAndExit(self):
+        if self.__deferCleanUp:
+            '''
+            Called from a deployment task: abort the task graph, the
+            clean up is done once the running tasks are over
+            '''
+            exit(1)
         try:
             print "\n===deploy dc failed, so cleaning the created entries==="
             if not test_data.get("deleteDC", None):
@@ -91,7 +108,8 @@ class DeployDataCenters(object):
                 "===Deploy DC Failed, So Cleaning to Exit===")
             remove_dc_obj = DeleteDataCenters(self.__testClient,
                                               dc_cfg=self.__cleanUp,
-                                              tc_run_logger=self.__tcRunLogger
+                                              tc_run_logger=self.__tcRunLogger,
+                                              workers=self.__workers
                                               )
             if remove_dc_obj:
                 if remove_dc_obj.removeDataCenter() == FAILED:
@@ -108,13 +126,36 @@ class DeployDataCenters(object):
                   GetDetailExceptionInfo(e)
 
     def __addToCleanUp(self, type, id):
-        if type not in self.__cleanUp.keys():
-            self.__cleanUp[type] = []
-        self.__cleanUp[type].append(id)
-        if "order" not in self.__cleanUp.keys():
-            self.__cleanUp["order"] = []
-        if type not in self.__cleanUp["order"]:
-            self.__cleanUp["order"].append(type)
+        with self.__cleanUpLock:
+            if type not in self.__cleanUp.keys():
+                self.__cleanUp[type] = []
+            self.__cleanUp[type].append(id)
+            if "order" not in self.__cleanUp.keys():
+                self.__cleanUp["order"] = []
+            if type not in self.__cleanUp["order"]:
+                self.__cleanUp["order"].append(type)
+
+    def addHost(self, host, zoneId, podId, clusterId, hypervisor):
+        hostcmd = addHost.addHostCmd()
+        hostcmd.clusterid = clusterId
+        hostcmd.hosttags = host.hosttags
+        hostcmd.hypervisor = host.hypervisor
+        hostcmd.password = host.password
+        hostcmd.podid = podId
+        hostcmd.url = host.url
+        hostcmd.username = host.username
+        hostcmd.zoneid = zoneId
+        hostcmd.hypervisor = hypervisor
+        if hostcmd.hypervisor.lower() == "baremetal":
+            hostcmd.hostmac=host.hostmac
+            hostcmd.cpunumber=host.cpunumber
+            hostcmd.cpuspeed=host.cpuspeed
+            hostcmd.memory=host.memory
+            hostcmd.hosttags=host.hosttags
+        ret = self.__apiClient.addHost(hostcmd)
+        if ret:
+            self.__tcRunLogger.debug("=== Add Host Successful ===")
+            self.__addToCleanUp("Host", ret[0].id)
 
     def addHosts(self, hosts, zoneId, podId, clusterId, hypervisor):
         if hosts is None:
@@ -123,26 +164,7 @@ class DeployDataCenters(object):
         failed_cnt = 0
         for host in hosts:
             try:
-                hostcmd = addHost.addHostCmd()
-                hostcmd.clusterid = clusterId
-                hostcmd.hosttags = host.hosttags
-                hostcmd.hypervisor = host.hypervisor
-                hostcmd.password = host.password
-                hostcmd.podid = podId
-                hostcmd.url = host.url
-                hostcmd.username = host.username
-                hostcmd.zoneid = zoneId
-                hostcmd.hypervisor = hypervisor
-                if hostcmd.hypervisor.lower() == "baremetal":
-                    hostcmd.hostmac=host.hostmac
-                    hostcmd.cpunumber=host.cpunumber
-                    hostcmd.cpuspeed=host.cpuspeed
-                    hostcmd.memory=host.memory
-                    hostcmd.hosttags=host.hosttags
-                ret = self.__apiClient.addHost(hostcmd)
-                if ret:
-                    self.__tcRunLogger.debug("=== Add Host Successful ===")
-                    self.__addToCleanUp("Host", ret[0].id)
+                self.addHost(host, zoneId, podId, clusterId, hypervisor)
             except Exception as e:
                 failed_cnt = failed_cnt + 1
                 print "Exception Occurred :%s" % GetDetailExceptionInfo(e)
@@ -198,22 +220,7 @@ class DeployDataCenters(object):
                 self.addVmWareDataCenter(vmwareDc)
 
             for cluster in clusters:
-                clustercmd = addCluster.addClusterCmd()
-                clustercmd.clustername = cluster.clustername
-                clustercmd.clustertype = cluster.clustertype
-                clustercmd.hypervisor = cluster.hypervisor
-                clustercmd.password = cluster.password
-                clustercmd.podid = podId
-                clustercmd.url = cluster.url
-                clustercmd.username = cluster.username
-                clustercmd.zoneid = zoneId
-                clusterresponse = self.__apiClient.addCluster(clustercmd)
-                if clusterresponse[0].id:
-                    clusterId = clusterresponse[0].id
-                    self.__tcRunLogger.\
-                        debug("Cluster Name : %s Id : %s Created Successfully"
-                              % (str(cluster.clustername), str(clusterId)))
-                    self.__addToCleanUp("Cluster", clusterId)
+                clusterId = self.createCluster(cluster, zoneId, podId)
                 if cluster.hypervisor.lower() != "vmware":
                     self.addHosts(cluster.hosts, zoneId, podId, clusterId,
                                   cluster.hypervisor)
@@ -231,22 +238,42 @@ class DeployDataCenters(object):
                                          str(cluster.clustername))
             self.__cleanAndExit()
 
-    def waitForHost(self, zoneId, clusterId):
+    def createCluster(self, cluster, zoneId, podId):
+        clustercmd = addCluster.addClusterCmd()
+        clustercmd.clustername = cluster.clustername
+        clustercmd.clustertype = cluster.clustertype
+        clustercmd.hypervisor = cluster.hypervisor
+        clustercmd.password = cluster.password
+        clustercmd.podid = podId
+        clustercmd.url = cluster.url
+        clustercmd.username = cluster.username
+        clustercmd.zoneid = zoneId
+        clusterresponse = self.__apiClient.addCluster(clustercmd)
+        if clusterresponse[0].id:
+            clusterId = clusterresponse[0].id
+            self.__tcRunLogger.\
+                debug("Cluster Name : %s Id : %s Created Successfully"
+                      % (str(cluster.clustername), str(clusterId)))
+            self.__addToCleanUp("Cluster", clusterId)
+            return clusterId
+
+    def waitForHost(self, zoneId, clusterId, timeout=60, interval=5):
         """
-        Wait for the hosts in the zoneid, clusterid to be up
-        2 retries with 30s delay
+        Wait for the hosts in the zoneid, clusterid to be up,
+        checking every interval seconds for up to timeout seconds
         """
         try:
-            retry, timeout = 2, 30
             cmd = listHosts.listHostsCmd()
             cmd.clusterid, cmd.zoneid = clusterId, zoneId
-            hosts = self.__apiClient.listHosts(cmd)
-            while retry != 0:
-                for host in hosts:
-                    if host.state != 'Up':
-                        break
-                sleep(timeout)
-                retry = retry - 1
+            deadline = time.time() + timeout
+            while True:
+                hosts = self.__apiClient.listHosts(cmd)
+                if hosts and \
+                        len([h for h in hosts if h.state != 'Up']) == 0:
+                    break
+                if time.time() >= deadline:
+                    break
+                sleep(interval)
         except Exception as e:
             print "\nException Occurred:%s" %\
                   GetDetailExceptionInfo(e)
@@ -297,23 +324,7 @@ class DeployDataCenters(object):
             if pods is None:
                 return
             for pod in pods:
-                createpod = createPod.createPodCmd()
-                createpod.name = pod.name
-                createpod.gateway = pod.gateway
-                createpod.netmask = pod.netmask
-                createpod.startip = pod.startip
-                createpod.endip = pod.endip
-                createpod.zoneid = zoneId
-                createpodResponse = self.__apiClient.createPod(createpod)
-                if createpodResponse.id:
-                    podId = createpodResponse.id
-                    self.__tcRunLogger.debug("Pod Name : %s Id : %s "
-                                             "Created Successfully" %
-                                             (str(pod.name), str(podId)))
-                    self.__addToCleanUp("Pod", podId)
-                if pod.guestIpRanges is not None and networkId is not None:
-                    self.createVlanIpRanges("Basic", pod.guestIpRanges, zoneId,
-                                            podId, networkId)
+                podId = self.createPod(pod, zoneId, networkId)
                 self.createClusters(pod.clusters, zoneId, podId,
                                     vmwareDc=pod.vmwaredc)
         except Exception as e:
@@ -323,6 +334,27 @@ class DeployDataCenters(object):
                           "Failed=====" % str(pod.name))
             self.__cleanAndExit()
 
+    def createPod(self, pod, zoneId, networkId=None):
+        podId = None
+        createpod = createPod.createPodCmd()
+        createpod.name = pod.name
+        createpod.gateway = pod.gateway
+        createpod.netmask = pod.netmask
+        createpod.startip = pod.startip
+        createpod.endip = pod.endip
+        createpod.zoneid = zoneId
+        createpodResponse = self.__apiClient.createPod(createpod)
+        if createpodResponse.id:
+            podId = createpodResponse.id
+            self.__tcRunLogger.debug("Pod Name : %s Id : %s "
+                                     "Created Successfully" %
+                                     (str(pod.name), str(podId)))
+            self.__addToCleanUp("Pod", podId)
+        if pod.guestIpRanges is not None and networkId is not None:
+            self.createVlanIpRanges("Basic", pod.guestIpRanges, zoneId,
+                                    podId, networkId)
+        return podId
+
     def createVlanIpRanges(self, mode, ipranges, zoneId, podId=None,
                            networkId=None, forvirtualnetwork=None):
         try:
@@ -743,118 +775,264 @@ class DeployDataCenters(object):
             self.__tcRunLogger.exception("====Create Zone Failed ===")
             return FAILED
 
+    def deployZone(self, zone):
+        '''
+        @Name : deployZone
+        @Desc : Creates the zone, its physical networks and the guest
+                network of basic and security group enabled zones
+        @Output : (zone id, guest network id or None)
+        '''
+        zonecmd = createZone.createZoneCmd()
+        zonecmd.dns1 = zone.dns1
+        zonecmd.dns2 = zone.dns2
+        zonecmd.internaldns1 = zone.internaldns1
+        zonecmd.internaldns2 = zone.internaldns2
+        zonecmd.name = zone.name
+        zonecmd.securitygroupenabled = zone.securitygroupenabled
+        zonecmd.localstorageenabled = zone.localstorageenabled
+        zonecmd.networktype = zone.networktype
+        zonecmd.domain = zone.domain
+        if zone.securitygroupenabled != "true":
+            zonecmd.guestcidraddress = zone.guestcidraddress
+        zoneId = self.createZone(zonecmd)
+        if zoneId == FAILED:
+            self.__tcRunLogger.\
+                exception(
+                    "====Zone: %s Creation Failed. So Exiting=====" %
+                    str(zone.name))
+            self.__cleanAndExit()
+        for pnet in zone.physical_networks:
+            phynetwrk = self.createPhysicalNetwork(pnet, zoneId)
+            self.configureProviders(phynetwrk, pnet.providers)
+            self.updatePhysicalNetwork(phynetwrk.id, "Enabled",
+                                       vlan=pnet.vlan)
+        networkId = None
+        if zone.networktype == "Basic":
+            listnetworkoffering =\
+                listNetworkOfferings.listNetworkOfferingsCmd()
+            listnetworkoffering.name =\
+                "DefaultSharedNetscalerEIPandELBNetworkOffering" \
+                if len(filter(lambda x:
+                              x.typ == 'Public',
+                              zone.physical_networks[0].
+                              traffictypes)) > 0 \
+                else "DefaultSharedNetworkOfferingWithSGService"
+            if zone.networkofferingname is not None:
+                listnetworkoffering.name = zone.networkofferingname
+            listnetworkofferingresponse = \
+                self.__apiClient.listNetworkOfferings(
+                    listnetworkoffering)
+            guestntwrk = configGenerator.network()
+            guestntwrk.displaytext = "guestNetworkForBasicZone"
+            guestntwrk.name = "guestNetworkForBasicZone"
+            guestntwrk.zoneid = zoneId
+            guestntwrk.networkofferingid = \
+                listnetworkofferingresponse[0].id
+            networkId = self.createNetworks([guestntwrk], zoneId)
+        elif (zone.networktype == "Advanced"
+              and zone.securitygroupenabled == "true"):
+            listnetworkoffering =\
+                listNetworkOfferings.listNetworkOfferingsCmd()
+            listnetworkoffering.name =\
+                "DefaultSharedNetworkOfferingWithSGService"
+            if zone.networkofferingname is not None:
+                listnetworkoffering.name = zone.networkofferingname
+            listnetworkofferingresponse = \
+                self.__apiClient.listNetworkOfferings(
+                    listnetworkoffering)
+            networkcmd = createNetwork.createNetworkCmd()
+            networkcmd.displaytext = "Shared SG enabled network"
+            networkcmd.name = "Shared SG enabled network"
+            networkcmd.networkofferingid =\
+                listnetworkofferingresponse[0].id
+            networkcmd.zoneid = zoneId
+            ipranges = zone.ipranges
+            if ipranges:
+                iprange = ipranges.pop()
+                networkcmd.startip = iprange.startip
+                networkcmd.endip = iprange.endip
+                networkcmd.gateway = iprange.gateway
+                networkcmd.netmask = iprange.netmask
+                networkcmd.vlan = iprange.vlan
+            networkcmdresponse = self.__apiClient.createNetwork(
+                networkcmd)
+            if networkcmdresponse.id:
+                self.__addToCleanUp("Network", networkcmdresponse.id)
+                self.__tcRunLogger.\
+                    debug("create Network Successful. NetworkId : %s "
+                          % str(networkcmdresponse.id))
+            networkId = networkcmdresponse.id
+        return zoneId, networkId
+
     def createZones(self, zones):
+        '''
+        @Name : createZones
+        @Desc : Deploys the zones through a dependency graph, see
+                __addZoneTasks, and reports the time taken by each of
+                its tasks
+        '''
+        graph = TaskGraph(self.__workers, self.__tcRunLogger)
+        for index, zone in enumerate(zones):
+            self.__addZoneTasks(graph, index, zone)
+        self.__deferCleanUp = True
         try:
-            for zone in zones:
-                zonecmd = createZone.createZoneCmd()
-                zonecmd.dns1 = zone.dns1
-                zonecmd.dns2 = zone.dns2
-                zonecmd.internaldns1 = zone.internaldns1
-                zonecmd.internaldns2 = zone.internaldns2
-                zonecmd.name = zone.name
-                zonecmd.securitygroupenabled = zone.securitygroupenabled
-                zonecmd.localstorageenabled = zone.localstorageenabled
-                zonecmd.networktype = zone.networktype
-                zonecmd.domain = zone.domain
-                if zone.securitygroupenabled != "true":
-                    zonecmd.guestcidraddress = zone.guestcidraddress
-                zoneId = self.createZone(zonecmd)
-                if zoneId == FAILED:
-                    self.__tcRunLogger.\
-                        exception(
-                            "====Zone: %s Creation Failed. So Exiting=====" %
-                            str(zone.name))
+            try:
+                ret = graph.run()
+            except SystemExit:
+                ret = FAILED
+        finally:
+            self.__deferCleanUp = False
+            self.__reportTimings(graph)
+        if ret == FAILED:
+            print "\n==== Create Zones Failed ==="
+            self.__tcRunLogger.error("==== Create Zones Failed ===")
+            self.__cleanAndExit()
+
+    def __reportTimings(self, graph):
+        report = graph.report()
+        print "\n==== Deploy DC Timings ====\n%s" % report
+        self.__tcRunLogger.debug("\n==== Deploy DC Timings ====\n%s" % report)
+        if self.__logFolderPath:
+            try:
+                with open(self.__logFolderPath + "/dc_timings.txt",
+                          "w") as fp:
+                    fp.write(report + "\n")
+            except IOError as e:
+                print "Exception Occurred  while writing DC timings: %s" % \
+                      GetDetailExceptionInfo(e)
+
+    def __addZoneTasks(self, graph, index, zone):
+        '''
+        @Name : __addZoneTasks
+        @Desc : Adds the tasks deploying a zone to graph:
+                zone (with its physical networks and guest network)
+                  -> pods -> clusters -> hosts -> wait for hosts
+                     -> cluster primary storages
+                  -> zone ip ranges
+                  -> cache and secondary storages
+                all of them -> zone wide primary storages -> enable zone
+        '''
+        zoneTask = "zone[%d]:%s" % (index, zone.name)
+        ctx = {"zoneId": None, "networkId": None}
+
+        def runZone():
+            ctx["zoneId"], ctx["networkId"] = self.deployZone(zone)
+
+        graph.add(zoneTask, runZone)
+        zoneTasks = [zoneTask]
+
+        ipRangesMode = None
+        if zone.networktype == "Basic" and self.isEipElbZone(zone):
+            ipRangesMode = True
+        elif zone.networktype == "Advanced" and \
+                zone.securitygroupenabled != "true":
+            ipRangesMode = False
+        if ipRangesMode is not None:
+            zoneTasks.append(graph.add(
+                zoneTask + "/ipranges",
+                lambda: self.createVlanIpRanges(
+                    zone.networktype, zone.ipranges, ctx["zoneId"],
+                    forvirtualnetwork=True if ipRangesMode else None),
+                [zoneTask]))
+
+        if zone.networktype in ("Basic", "Advanced"):
+            for podIndex, pod in enumerate(zone.pods or []):
+                zoneTasks.extend(self.__addPodTasks(
+                    graph, "%s/pod[%d]:%s" % (zoneTask, podIndex, pod.name),
+                    zoneTask, ctx, pod))
+
+        '''Note: Swift needs cache storage first'''
+        zoneTasks.append(graph.add(
+            zoneTask + "/storages",
+            lambda: (self.createCacheStorages(zone.cacheStorages,
+                                              ctx["zoneId"]),
+                     self.createSecondaryStorages(zone.secondaryStorages,
+                                                  ctx["zoneId"])),
+            [zoneTask]))
+
+        def finishZone():
+            #add zone wide primary storages if any
+            if zone.primaryStorages:
+                self.createPrimaryStorages(zone.primaryStorages,
+                                           ctx["zoneId"],
+                                           )
+            enabled = getattr(zone, 'enabled', 'True')
+            if enabled == 'True' or enabled is None:
+                self.enableZone(ctx["zoneId"], "Enabled")
+            details = getattr(zone, 'details')
+            if details is not None:
+                det = [d.__dict__ for d in details]
+                self.updateZoneDetails(ctx["zoneId"], det)
+
+        graph.add(zoneTask + "/enable", finishZone, zoneTasks)
+
+    def __addPodTasks(self, graph, podTask, zoneTask, ctx, pod):
+        '''
+        @Name : __addPodTasks
+        @Desc : Adds the tasks deploying a pod and its clusters, every
+                host of a cluster is added by its own task
+        @Output : the tasks added
+        '''
+        podCtx = {"podId": None}
+
+        def deployPod():
+            podCtx["podId"] = self.createPod(pod, ctx["zoneId"],
+                                             ctx["networkId"])
+            if pod.clusters is not None and pod.vmwaredc is not None:
+                pod.vmwaredc.zoneid = ctx["zoneId"]
+                self.addVmWareDataCenter(pod.vmwaredc)
+
+        tasks = [graph.add(podTask, deployPod, [zoneTask])]
+        for clusterIndex, cluster in enumerate(pod.clusters or []):
+            clusterTask = "%s/cluster[%d]:%s" % (podTask, clusterIndex,
+                                                 cluster.clustername)
+            clusterCtx = {"clusterId": None, "failed": 0}
+
+            def deployCluster(cluster=cluster, clusterCtx=clusterCtx):
+                clusterCtx["clusterId"] = self.createCluster(
+                    cluster, ctx["zoneId"], podCtx["podId"])
+
+            tasks.append(graph.add(clusterTask, deployCluster, [podTask]))
+            hostTasks = [clusterTask]
+            hosts = []
+            if cluster.hypervisor.lower() != "vmware":
+                if cluster.hosts is None:
+                    print "\n === Invalid Hosts Information ===="
+                hosts = cluster.hosts or []
+            for hostIndex, host in enumerate(hosts):
+
+                def deployHost(host=host, cluster=cluster,
+                               clusterCtx=clusterCtx):
+                    try:
+                        self.addHost(host, ctx["zoneId"], podCtx["podId"],
+                                     clusterCtx["clusterId"],
+                                     cluster.hypervisor)
+                    except Exception as e:
+                        clusterCtx["failed"] += 1
+                        print "Exception Occurred :%s" % \
+                            GetDetailExceptionInfo(e)
+                        self.__tcRunLogger.exception(
+                            "=== Adding Host Failed :%s===" % str(host.url))
+
+                hostTasks.append(graph.add(
+                    "%s/host[%d]:%s" % (clusterTask, hostIndex, host.url),
+                    deployHost, [clusterTask]))
+            tasks.extend(hostTasks[1:])
+
+            def finishCluster(cluster=cluster, clusterCtx=clusterCtx,
+                              hosts=hosts):
+                if hosts and clusterCtx["failed"] == len(hosts):
                     self.__cleanAndExit()
-                for pnet in zone.physical_networks:
-                    phynetwrk = self.createPhysicalNetwork(pnet, zoneId)
-                    self.configureProviders(phynetwrk, pnet.providers)
-                    self.updatePhysicalNetwork(phynetwrk.id, "Enabled",
-                                               vlan=pnet.vlan)
-                if zone.networktype == "Basic":
-                    listnetworkoffering =\
-                        listNetworkOfferings.listNetworkOfferingsCmd()
-                    listnetworkoffering.name =\
-                        "DefaultSharedNetscalerEIPandELBNetworkOffering" \
-                        if len(filter(lambda x:
-                                      x.typ == 'Public',
-                                      zone.physical_networks[0].
-                                      traffictypes)) > 0 \
-                        else "DefaultSharedNetworkOfferingWithSGService"
-                    if zone.networkofferingname is not None:
-                        listnetworkoffering.name = zone.networkofferingname
-                    listnetworkofferingresponse = \
-                        self.__apiClient.listNetworkOfferings(
-                            listnetworkoffering)
-                    guestntwrk = configGenerator.network()
-                    guestntwrk.displaytext = "guestNetworkForBasicZone"
-                    guestntwrk.name = "guestNetworkForBasicZone"
-                    guestntwrk.zoneid = zoneId
-                    guestntwrk.networkofferingid = \
-                        listnetworkofferingresponse[0].id
-                    networkid = self.createNetworks([guestntwrk], zoneId)
-                    self.createPods(zone.pods, zoneId, networkid)
-                    if self.isEipElbZone(zone):
-                        self.createVlanIpRanges(
-                            zone.networktype, zone.ipranges,
-                            zoneId, forvirtualnetwork=True)
-                isPureAdvancedZone = (zone.networktype == "Advanced"
-                                      and zone.securitygroupenabled != "true")
-                if isPureAdvancedZone:
-                    self.createPods(zone.pods, zoneId)
-                    self.createVlanIpRanges(zone.networktype, zone.ipranges,
-                                            zoneId)
-                elif (zone.networktype == "Advanced"
-                      and zone.securitygroupenabled == "true"):
-                    listnetworkoffering =\
-                        listNetworkOfferings.listNetworkOfferingsCmd()
-                    listnetworkoffering.name =\
-                        "DefaultSharedNetworkOfferingWithSGService"
-                    if zone.networkofferingname is not None:
-                        listnetworkoffering.name = zone.networkofferingname
-                    listnetworkofferingresponse = \
-                        self.__apiClient.listNetworkOfferings(
-                            listnetworkoffering)
-                    networkcmd = createNetwork.createNetworkCmd()
-                    networkcmd.displaytext = "Shared SG enabled network"
-                    networkcmd.name = "Shared SG enabled network"
-                    networkcmd.networkofferingid =\
-                        listnetworkofferingresponse[0].id
-                    networkcmd.zoneid = zoneId
-                    ipranges = zone.ipranges
-                    if ipranges:
-                        iprange = ipranges.pop()
-                        networkcmd.startip = iprange.startip
-                        networkcmd.endip = iprange.endip
-                        networkcmd.gateway = iprange.gateway
-                        networkcmd.netmask = iprange.netmask
-                        networkcmd.vlan = iprange.vlan
-                    networkcmdresponse = self.__apiClient.createNetwork(
-                        networkcmd)
-                    if networkcmdresponse.id:
-                        self.__addToCleanUp("Network", networkcmdresponse.id)
-                        self.__tcRunLogger.\
-                            debug("create Network Successful. NetworkId : %s "
-                                  % str(networkcmdresponse.id))
-                    self.createPods(zone.pods, zoneId, networkcmdresponse.id)
-                '''Note: Swift needs cache storage first'''
-                self.createCacheStorages(zone.cacheStorages, zoneId)
-                self.createSecondaryStorages(zone.secondaryStorages, zoneId)
-                #add zone wide primary storages if any
-                if zone.primaryStorages:
-                    self.createPrimaryStorages(zone.primaryStorages,
-                                               zoneId,
-                                               )
-                enabled = getattr(zone, 'enabled', 'True')
-                if enabled == 'True' or enabled is None:
-                    self.enableZone(zoneId, "Enabled")
-                details = getattr(zone, 'details')
-                if details is not None:
-                    det = [d.__dict__ for d in details]
-                    self.updateZoneDetails(zoneId, det)
-            return
-        except Exception as e:
-            print "\nException Occurred %s" % GetDetailExceptionInfo(e)
-            self.__tcRunLogger.exception("==== Create Zones Failed ===")
+                self.waitForHost(ctx["zoneId"], clusterCtx["clusterId"])
+                if cluster.hypervisor.lower() != "baremetal":
+                    self.createPrimaryStorages(cluster.primaryStorages,
+                                               ctx["zoneId"],
+                                               podCtx["podId"],
+                                               clusterCtx["clusterId"])
+
+            tasks.append(graph.add(clusterTask + "/storages", finishCluster,
+                                   hostTasks))
+        return tasks
 
     def isEipElbZone(self, zone):
         if (zone.networktype == "Basic"
@@ -958,19 +1136,24 @@ class DeleteDataCenters:
             dc_cfg: If dc_cfg_file, is not available, we can use
             the dictionary of elements to delete.
             tc_run_logger: Logger to dump log messages.
+            workers: Entries of the same type are deleted concurrently
+            by up to workers threads, types are deleted in the reverse
+            order of their creation
     '''
 
     def __init__(self,
                  tc_client,
                  dc_cfg_file=None,
                  dc_cfg=None,
-                 tc_run_logger=None
+                 tc_run_logger=None,
+                 workers=5
                  ):
         self.__dcCfgFile = dc_cfg_file
         self.__dcCfg = dc_cfg
         self.__tcRunLogger = tc_run_logger
         self.__apiClient = None
         self.__testClient = tc_client
+        self.__workers = workers
 
     def __deleteCmds(self, cmd_name, cmd_obj):
         '''
@@ -994,14 +1177,16 @@ class DeleteDataCenters:
                 '''
                 list_host_cmd = listHosts.listHostsCmd()
                 list_host_cmd.id = cmd_obj.id
-                retries = 3
-                for i in xrange(retries):
+                deadline = time.time() + 90
+                while True:
                     list_host_resp = self.__apiClient.\
                         listHosts(list_host_cmd)
                     if (list_host_resp) and\
                             (list_host_resp[0].resourcestate == 'Maintenance'):
                         break
-                    sleep(30)
+                    if time.time() >= deadline:
+                        break
+                    sleep(5)
         if cmd_name.lower() == "deletestoragepoolcmd":
             cmd_obj.forced = "true"
             store_maint_cmd = enableStorageMaintenance.\
@@ -1012,14 +1197,16 @@ class DeleteDataCenters:
             if store_maint_resp:
                 list_store_cmd = listStoragePools.listStoragePoolsCmd()
                 list_store_cmd.id = cmd_obj.id
-                retries = 3
-                for i in xrange(retries):
+                deadline = time.time() + 90
+                while True:
                     store_maint_resp = self.__apiClient.\
                         listStoragePools(list_store_cmd)
                     if (store_maint_resp) and \
                             (store_maint_resp[0].state == 'Maintenance'):
                         break
-                    sleep(30)
+                    if time.time() >= deadline:
+                        break
+                    sleep(5)
         return cmd_obj
 
     def __setClient(self):
@@ -1029,48 +1216,58 @@ class DeleteDataCenters:
         '''
         self.__apiClient = self.__testClient.getApiClient()
 
+    def __deleteEntry(self, type, id):
+        del_mod = "delete" + type
+        del_cmd = getattr(
+            globals()[del_mod],
+            del_mod + "Cmd")
+        del_cmd_obj = del_cmd()
+        del_cmd_obj.id = id
+        del_cmd_obj = self.__deleteCmds(
+            del_mod +
+            "Cmd",
+            del_cmd_obj)
+        del_func = getattr(self.__apiClient, del_mod)
+        del_cmd_resp = del_func(del_cmd_obj)
+        if del_cmd_resp:
+            self.__tcRunLogger.debug(
+                "====%s CleanUp Failed. ID: %s ===" %
+                (type, id))
+        else:
+            self.__tcRunLogger.debug(
+                "====%s CleanUp Successful. ID : %s===" %
+                (type, id))
+
     def __cleanEntries(self):
         '''
         @Name : __cleanAndEntries
-        @Description: Cleans up the created DC in order of creation
+        @Description: Cleans up the created DC in the reverse order of
+                      creation. The entries of one type are deleted
+                      concurrently once all the entries of the type
+                      created after it are gone
         '''
         try:
             ret = FAILED
             if "order" in self.__dcCfg.keys() and len(self.__dcCfg["order"]):
                 self.__dcCfg["order"].reverse()
             print "\n====Clean Up Entries===", self.__dcCfg
+            graph = TaskGraph(self.__workers, self.__tcRunLogger)
+            previous = []
             for type in self.__dcCfg["order"]:
-                self.__tcRunLogger.debug(
-                    "====CleanUp Started For Type: %s====" %
-                    type)
                 if type:
                     temp_ids = self.__dcCfg[type]
                     ids = [items for items in temp_ids if items]
-                    for id in ids:
-                        del_mod = "delete" + type
-                        del_cmd = getattr(
-                            globals()[del_mod],
-                            del_mod + "Cmd")
-                        del_cmd_obj = del_cmd()
-                        del_cmd_resp = getattr(
-                            globals()[del_mod],
-                            del_mod + "Response")
-                        del_cmd_obj.id = id
-                        del_cmd_obj = self.__deleteCmds(
-                            del_mod +
-                            "Cmd",
-                            del_cmd_obj)
-                        del_func = getattr(self.__apiClient, del_mod)
-                        del_cmd_resp = del_func(del_cmd_obj)
-                        if del_cmd_resp:
-                            self.__tcRunLogger.debug(
-                                "====%s CleanUp Failed. ID: %s ===" %
-                                (type, id))
-                        else:
-                            self.__tcRunLogger.debug(
-                                "====%s CleanUp Successful. ID : %s===" %
-                                (type, id))
-            ret = SUCCESS
+                    tasks = [graph.add("%s[%d]:%s" % (type, index, id),
+                                       lambda type=type, id=id:
+                                       self.__deleteEntry(type, id),
+                                       previous)
+                             for index, id in enumerate(ids)]
+                    if tasks:
+                        previous = tasks
+            ret = graph.run()
+            report = graph.report()
+            print "\n====Clean Up Timings====\n%s" % report
+            self.__tcRunLogger.debug("====Clean Up Timings====\n%s" % report)
         except Exception as e:
             print "\n==== Exception Under __cleanEntries: %s ==== % " \
                   % GetDetailExceptionInfo(e)
@@ -1129,6 +1326,11 @@ if __name__ == "__main__":
                       default=None, dest="remove",
                       help="path to file\
                       where the created dc entries are kept")
+
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      default=None, dest="workers",
+                      help="zones, pods, clusters and hosts\
+                      deployed or removed concurrently, default 5")
     (options, args) = parser.parse_args()
 
     '''
@@ -1188,7 +1390,8 @@ if __name__ == "__main__":
         deploy = DeployDataCenters(obj_tc_client,
                                    cfg,
                                    tc_run_logger,
-                                   log_folder_path=log_folder_path)
+                                   log_folder_path=log_folder_path,
+                                   workers=options.workers)
         if deploy.deploy() == FAILED:
             print "\n===Deploy Failed==="
             tc_run_logger.debug("\n===Deploy Failed===");
@@ -1201,7 +1404,8 @@ if __name__ == "__main__":
         '''
         remove_dc_obj = DeleteDataCenters(obj_tc_client,
                                           dc_cfg_file=options.remove,
-                                          tc_run_logger=tc_run_logger
+                                          tc_run_logger=tc_run_logger,
+                                          workers=options.workers or 5
                                           )
         if remove_dc_obj:
             if remove_dc_obj.removeDataCenter() == FAILED:
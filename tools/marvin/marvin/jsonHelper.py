@@ -17,32 +17,81 @@
 import cloudstackException
 import json
 import inspect
+import threading
 from marvin.cloudstackAPI import *
 
 
 class jsonLoader(object):
 
-    '''The recursive class for building and representing objects with.'''
-
-    def __init__(self, obj):
-        for k in obj:
-            v = obj[k]
-            if isinstance(v, dict):
-                setattr(self, k, jsonLoader(v))
-            elif isinstance(v, (list, tuple)):
-                if len(v) > 0 and isinstance(v[0], dict):
-                    setattr(self, k, [jsonLoader(elem) for elem in v])
-                else:
-                    setattr(self, k, v)
+    '''The recursive class for building and representing objects with.
+    The parsed json dictionary is kept as is and a nested dictionary (or
+    list of dictionaries) is only turned into jsonLoader objects the first
+    time it is accessed, so large responses cost one json parse plus the
+    fields actually used by the test.
+    @Input : obj : dictionary to represent
+             copy : False when obj is owned by the new object (freshly
+                    parsed api responses), it is then converted in place
+                    instead of being shallow copied level by level'''
+    __slots__ = ('__data', '__copy')
+
+    def __init__(self, obj, copy=True):
+        object.__setattr__(self, '_jsonLoader__data',
+                           dict(obj) if copy else obj)
+        object.__setattr__(self, '_jsonLoader__copy', copy)
+
+    def __load(self, k, v):
+        if isinstance(v, dict):
+            v = jsonLoader(v, self.__copy)
+        elif isinstance(v, (list, tuple)):
+            if len(v) > 0 and isinstance(v[0], dict):
+                v = [jsonLoader(elem, self.__copy) for elem in v]
+            elif isinstance(v, tuple):
+                v = list(v)
             else:
-                setattr(self, k, v)
+                return v
+        else:
+            return v
+        self.__data[k] = v
+        return v
 
     def __getattr__(self, val):
-        if val in self.__dict__:
-            return self.__dict__[val]
+        if val.startswith('__') or val.startswith('_jsonLoader__'):
+            raise AttributeError(val)
+        data = self.__data
+        if val in data:
+            return self.__load(val, data[val])
         else:
             return None
 
+    def __setattr__(self, key, value):
+        self.__data[key] = value
+
+    def __delattr__(self, key):
+        try:
+            del self.__data[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    @property
+    def __dict__(self):
+        '''
+        Attributes of the object, top level values are materialized so
+        that callers iterating or copying it see jsonLoader objects
+        '''
+        data = self.__data
+        for k, v in data.items():
+            self.__load(k, v)
+        return data
+
+    def __getstate__(self):
+        # A dictionary of its own, copy.copy would otherwise share the
+        # attributes with the original object
+        return (dict(self.__dict__), self.__copy)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_jsonLoader__data', state[0])
+        object.__setattr__(self, '_jsonLoader__copy', state[1])
+
     def __repr__(self):
         return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
                                       in self.__dict__.iteritems()))
@@ -83,9 +132,45 @@ class jsonDump(object):
         return jsonDump.__serialize(obj)
 
 
+_responseClassCache = {}
+_responseFieldsCache = {}
+_responseCacheLock = threading.Lock()
+
+
 def getclassFromName(cmd, name):
-    module = inspect.getmodule(cmd)
-    return getattr(module, name)()
+    '''
+    @Name : getclassFromName
+    @Desc : Instantiates the class name from the module cmd belongs to.
+            The resolution is cached per (module, name), failed lookups
+            included, so it is only done once per response type
+    '''
+    if inspect.ismodule(cmd):
+        key = (cmd.__name__, name)
+    else:
+        key = (getattr(cmd, '__module__', None), name)
+    cls = _responseClassCache.get(key, False)
+    if cls is False:
+        cls = getattr(inspect.getmodule(cmd), name, None)
+        with _responseCacheLock:
+            _responseClassCache[key] = cls
+    if cls is None:
+        raise AttributeError(name)
+    return cls()
+
+
+def getResponseFields(responsecls):
+    '''
+    @Name : getResponseFields
+    @Desc : Returns the field names of a response instance, cached per
+            response class
+    '''
+    cls = responsecls.__class__
+    fields = _responseFieldsCache.get(cls)
+    if fields is None:
+        fields = frozenset(responsecls.__dict__)
+        with _responseCacheLock:
+            _responseFieldsCache[cls] = fields
+    return fields
 
 
 def finalizeResultObj(result, responseName, responsecls):
@@ -109,8 +194,9 @@ def finalizeResultObj(result, responseName, responsecls):
                                              responsecls)
         return result
     elif responsecls is not None:
-        for k, v in result.__dict__.iteritems():
-            if k in responsecls.__dict__:
+        fields = getResponseFields(responsecls)
+        for k in result.__dict__:
+            if k in fields:
                 return result
 
         attr = result.__dict__.keys()[0]
@@ -120,8 +206,8 @@ def finalizeResultObj(result, responseName, responsecls):
             return result
 
         findObj = False
-        for k, v in value.__dict__.iteritems():
-            if k in responsecls.__dict__:
+        for k in value.__dict__:
+            if k in fields:
                 findObj = True
                 break
         if findObj:
@@ -142,7 +228,10 @@ def getResultObj(returnObj, responsecls=None):
     if len(response) == 0:
         return None
 
-    result = jsonLoader(response)
+    '''
+    The response was parsed for us, let jsonLoader convert it in place
+    '''
+    result = jsonLoader(response, copy=False)
     if result.errorcode is not None:
         errMsg = "errorCode: %s, errorText:%s" % (result.errorcode,
                                                   result.errortext)
@@ -150,7 +239,7 @@ def getResultObj(returnObj, responsecls=None):
         raise cloudstackException.CloudstackAPIException(respname, errMsg)
 
     if result.count is not None:
-        for key in result.__dict__.iterkeys():
+        for key in response.keys():
             if key == "count":
                 continue
             else:
@@ -159,6 +248,128 @@ def getResultObj(returnObj, responsecls=None):
         return finalizeResultObj(result, responseName, responsecls)
 
 if __name__ == "__main__":
+    import optparse
+    import resource
+    import subprocess
+    import sys
+    import time
+
+    parser = optparse.OptionParser()
+    parser.add_option("-b", "--benchmark", action="store_true",
+                      dest="benchmark", default=False,
+                      help="compare parse time and peak RSS of the lazy "
+                      "loader against the former eager one over a large "
+                      "listVirtualMachines response")
+    parser.add_option("-p", "--payload", dest="payload",
+                      help="recorded listVirtualMachines json response, "
+                      "a synthetic one is generated when not given")
+    parser.add_option("-n", "--vms", dest="vms", type="int", default=20000,
+                      help="virtual machines in the synthetic response")
+    parser.add_option("--loader", dest="loader", help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    class eagerLoader(object):
+
+        '''jsonLoader as it was before lazy materialization'''
+
+        def __init__(self, obj):
+            for k in obj:
+                v = obj[k]
+                if isinstance(v, dict):
+                    setattr(self, k, eagerLoader(v))
+                elif isinstance(v, (list, tuple)):
+                    if len(v) > 0 and isinstance(v[0], dict):
+                        setattr(self, k, [eagerLoader(elem) for elem in v])
+                    else:
+                        setattr(self, k, v)
+                else:
+                    setattr(self, k, v)
+
+        def __getattr__(self, val):
+            if val in self.__dict__:
+                return self.__dict__[val]
+            else:
+                return None
+
+    def syntheticVms(count):
+        vms = []
+        for i in range(count):
+            nics = [{"id": "nic-%d-%d" % (i, n),
+                     "networkid": "net-%d" % n,
+                     "networkname": "network-%d" % n,
+                     "netmask": "255.255.255.0",
+                     "gateway": "10.%d.0.1" % n,
+                     "ipaddress": "10.%d.%d.%d" % (n, i / 250, i % 250),
+                     "broadcasturi": "vlan://%d" % (100 + n),
+                     "isolationuri": "vlan://%d" % (100 + n),
+                     "traffictype": "Guest", "type": "Isolated",
+                     "isdefault": n == 0,
+                     "macaddress": "02:00:%02x:%02x:00:%02x" %
+                     (i / 256 % 256, i % 256, n)} for n in range(2)]
+            vms.append({"id": "vm-%08d" % i, "name": "i-2-%d-VM" % i,
+                        "displayname": "vm-%d" % i, "account": "admin",
+                        "domainid": "domain-1", "domain": "ROOT",
+                        "created": "2014-01-15T18:30:11+0530",
+                        "state": "Running", "haenable": False,
+                        "zoneid": "zone-1", "zonename": "zone1",
+                        "hostid": "host-%d" % (i % 50),
+                        "hostname": "host%d" % (i % 50),
+                        "templateid": "template-1",
+                        "templatename": "CentOS 5.6(64-bit) no GUI",
+                        "templatedisplaytext": "CentOS 5.6(64-bit) no GUI",
+                        "passwordenabled": False,
+                        "serviceofferingid": "offering-1",
+                        "serviceofferingname": "Small Instance",
+                        "cpunumber": 1, "cpuspeed": 500, "memory": 512,
+                        "cpuused": "0.01%", "networkkbsread": 1024,
+                        "networkkbswrite": 512, "guestosid": "os-1",
+                        "rootdeviceid": 0,
+                        "rootdevicetype": "ROOT",
+                        "securitygroup": [], "nic": nics,
+                        "hypervisor": "XenServer",
+                        "affinitygroup": [],
+                        "tags": [{"key": "owner", "value": "marvin",
+                                  "resourcetype": "UserVm",
+                                  "resourceid": "vm-%08d" % i}],
+                        "isdynamicallyscalable": False,
+                        "ostypeid": 12})
+        return json.dumps({"listvirtualmachinesresponse":
+                           {"count": count, "virtualmachine": vms}})
+
+    if options.benchmark and options.loader:
+        '''
+        One loader per process, so that the peak RSS is its own
+        '''
+        if options.payload:
+            text = open(options.payload).read()
+        else:
+            text = syntheticVms(options.vms)
+        baseRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        returnObj = json.loads(text)
+        parsed = time.time()
+        if options.loader == "lazy":
+            vms = getResultObj(returnObj)
+        else:
+            responseName = filter(lambda a: a != u'cloudstack-version',
+                                  returnObj.keys())[0]
+            vms = eagerLoader(returnObj[responseName]).virtualmachine
+        loaded = time.time()
+        for vm in vms:
+            vm.id, vm.state, vm.nic[0].ipaddress
+        accessed = time.time()
+        peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print "%-6s vms: %d json: %.3fs objects: %.3fs access: %.3fs " \
+            "peak RSS: %.1f MB (+%.1f MB)" % \
+            (options.loader, len(vms), parsed - start, loaded - parsed,
+             accessed - loaded, peakRss / 1024.0,
+             (peakRss - baseRss) / 1024.0)
+        sys.exit(0)
+    elif options.benchmark:
+        for loader in ["eager", "lazy"]:
+            subprocess.check_call([sys.executable, __file__] + sys.argv[1:] +
+                                  ["--loader", loader])
+        sys.exit(0)
 
     result = '''{ "listnetworkserviceprovidersresponse" : { "count" : 1,
       "networkserviceprovider" : [ { "destinationphysicalnetworkid" : "0",
@@ -200,6 +411,17 @@ if __name__ == "__main__":
 }'''
     zones = getResultObj(result)
     print zones[0].id
+
+    import copy
+    zone = copy.copy(zones[0])
+    zone.name = "test1"
+    zone.dns1 = None
+    assert (zones[0].name, zones[0].dns1) == ("test0", "8.8.8.8"), \
+        "Changing a copy changed the original"
+    assert zone.id == zones[0].id
+    zone = copy.deepcopy(zones[0])
+    zone.name = "test2"
+    assert zones[0].name == "test0", "Changing a deep copy changed the original"
     res = authorizeSecurityGroupIngress.authorizeSecurityGroupIngressResponse()
     result = '''{
     "queryasyncjobresultresponse" : {
@@ -24,9 +24,10 @@ from marvin.cloudstackAPI import *
 from marvin.codes import (FAILED, FAIL, PASS, RUNNING, STOPPED,
                           STARTING, DESTROYED, EXPUNGING,
                           STOPPING, BACKED_UP, BACKING_UP,
-                          HOST_RS_MAINTENANCE)
+                          HOST_RS_MAINTENANCE, EMPTY_LIST)
 from marvin.cloudstackException import GetDetailExceptionInfo, CloudstackAPIException
 from marvin.lib.utils import validateList, is_server_ssh_ready, random_gen, wait_until
+from marvin.waitEngine import WaitEngine, PROGRESS
 # Import System modules
 import time
 import hashlib
@@ -679,29 +680,25 @@ class VirtualMachine:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
+        projectid = None
+        if hasattr(self, "projectid"):
+            projectid = self.projectid
+
+        def inState(vm):
+            if vm is None:
+                raise Exception("VM list validation failed: %s" % EMPTY_LIST)
+            return str(vm.state).lower().decode("string_escape") == str(state).lower()
+
+        watch = WaitEngine.getEngine(apiclient).wait(
+            "VirtualMachine", VirtualMachine.list, self.id, inState,
+            timeout, listArgs={"projectid": projectid, "listall": True})
+        if watch.satisfied:
+            return [PASS, None]
+        if watch.error is not None:
+            return [FAIL, watch.error]
+        return [FAIL, "VM state not trasited to %s,\
                         operation timed out" % state]
 
-        while timeout > 0:
-            try:
-                projectid = None
-                if hasattr(self, "projectid"):
-                    projectid = self.projectid
-                vms = VirtualMachine.list(apiclient, projectid=projectid,
-                        id=self.id, listAll=True)
-                validationresult = validateList(vms)
-                if validationresult[0] == FAIL:
-                    raise Exception("VM list validation failed: %s" % validationresult[2])
-                elif str(vms[0].state).lower().decode("string_escape") == str(state).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
-
     def resetSshKey(self, apiclient, **kwargs):
         """Resets SSH key"""
 
@@ -1028,37 +1025,33 @@ class Volume:
         return Volume(apiclient.uploadVolume(cmd).__dict__)
 
     def wait_for_upload(self, apiclient, timeout=10, interval=60):
-        """Wait for upload"""
-        # Sleep to ensure template is in proper state before download
-        time.sleep(interval)
-
-        while True:
-            volume_response = Volume.list(
-                apiclient,
-                id=self.id,
-                zoneid=self.zoneid,
-            )
-            if isinstance(volume_response, list):
-
-                volume = volume_response[0]
-                # If volume is ready,
-                # volume.state = Allocated
-                if volume.state == 'Uploaded':
-                    break
-
-                elif 'Uploading' in volume.state:
-                    time.sleep(interval)
-
-                elif 'Installing' not in volume.state:
-                    raise Exception(
-                        "Error in uploading volume: status - %s" %
-                        volume.state)
-            elif timeout == 0:
-                break
-
-            else:
-                time.sleep(interval)
-                timeout = timeout - 1
+        """Wait for upload. The first check is done about a second after
+        the call rather than after interval, a volume whose state is not
+        set yet is waited for"""
+
+        def uploaded(volume):
+            # If volume is ready,
+            # volume.state = Allocated
+            if volume is None or not volume.state:
+                return False
+            if volume.state == 'Uploaded':
+                return True
+            elif 'Uploading' in volume.state:
+                return PROGRESS
+            elif 'Installing' not in volume.state:
+                raise Exception(
+                    "Error in uploading volume: status - %s" %
+                    volume.state)
+            return False
+
+        # timeout is a number of intervals while the volume is not listed,
+        # it is not consumed while the upload is in progress
+        watch = WaitEngine.getEngine(apiclient).wait(
+            "Volume", Volume.list, self.id, uploaded,
+            timeout * interval, maxInterval=interval,
+            listArgs={"zoneid": self.zoneid})
+        if watch.error is not None:
+            raise watch.error
         return
 
     @classmethod
@@ -1326,41 +1319,37 @@ class Template:
         apiclient.deleteTemplate(cmd)
 
     def download(self, apiclient, timeout=5, interval=60):
-        """Download Template"""
-        # Sleep to ensure template is in proper state before download
-        time.sleep(interval)
-
-        while True:
-            template_response = Template.list(
-                apiclient,
-                id=self.id,
-                zoneid=self.zoneid,
-                templatefilter='self'
-            )
-            if isinstance(template_response, list):
-
-                template = template_response[0]
-                # If template is ready,
-                # template.status = Download Complete
-                # Downloading - x% Downloaded
-                # Error - Any other string
-                if template.status == 'Download Complete':
-                    break
-
-                elif 'Downloaded' in template.status:
-                    time.sleep(interval)
-
-                elif 'Installing' not in template.status:
-                    raise Exception(
-                        "Error in downloading template: status - %s" %
-                        template.status)
-
-            elif timeout == 0:
-                break
-
-            else:
-                time.sleep(interval)
-                timeout = timeout - 1
+        """Download Template. The first check is done about a second
+        after the call rather than after interval, a template whose
+        status is not set yet is waited for"""
+
+        def downloaded(template):
+            # If template is ready,
+            # template.status = Download Complete
+            # Downloading - x% Downloaded
+            # Error - Any other string
+            if template is None:
+                return False
+            if template.status == 'Download Complete':
+                return True
+            if not template.status:
+                return False
+            elif 'Downloaded' in template.status:
+                return PROGRESS
+            elif 'Installing' not in template.status:
+                raise Exception(
+                    "Error in downloading template: status - %s" %
+                    template.status)
+            return False
+
+        # timeout is a number of intervals while the template is not
+        # listed, it is not consumed while the download is in progress
+        watch = WaitEngine.getEngine(apiclient).wait(
+            "Template", Template.list, self.id, downloaded,
+            timeout * interval, maxInterval=interval,
+            listArgs={"zoneid": self.zoneid, "templatefilter": 'self'})
+        if watch.error is not None:
+            raise watch.error
         return
 
     def updatePermissions(self, apiclient, **kwargs):
@@ -2648,26 +2637,21 @@ class Host:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
+        def inState(host):
+            if host is None:
+                raise Exception("Host list validation failed: %s" % EMPTY_LIST)
+            return str(host.state).lower().decode("string_escape") == str(state).lower() and str(host.resourcestate).lower().decode("string_escape") == str(resourcestate).lower()
+
+        watch = WaitEngine.getEngine(apiclient).wait(
+            "Host", Host.list, hostid, inState, timeout,
+            listArgs={"listall": True})
+        if watch.satisfied:
+            return [PASS, None]
+        if watch.error is not None:
+            return [FAIL, watch.error]
+        return [FAIL, "VM state not trasited to %s,\
                         operation timed out" % state]
 
-        while timeout > 0:
-            try:
-                hosts = Host.list(apiclient,
-                          id=hostid, listall=True)
-                validationresult = validateList(hosts)
-                if validationresult[0] == FAIL:
-                    raise Exception("Host list validation failed: %s" % validationresult[2])
-                elif str(hosts[0].state).lower().decode("string_escape") == str(state).lower() and str(hosts[0].resourcestate).lower().decode("string_escape") == str(resourcestate).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
-
 class StoragePool:
     """Manage Storage pools (Primary Storage)"""
 
@@ -2796,26 +2780,21 @@ class StoragePool:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
+        def inState(pool):
+            if pool is None:
+                raise Exception("Pool list validation failed: %s" % EMPTY_LIST)
+            return str(pool.state).lower().decode("string_escape") == str(state).lower()
+
+        watch = WaitEngine.getEngine(apiclient).wait(
+            "StoragePool", StoragePool.list, poolid, inState, timeout,
+            listArgs={"listall": True})
+        if watch.satisfied:
+            return [PASS, None]
+        if watch.error is not None:
+            return [FAIL, watch.error]
+        return [FAIL, "VM state not trasited to %s,\
                         operation timed out" % state]
 
-        while timeout > 0:
-            try:
-                pools = StoragePool.list(apiclient,
-                          id=poolid, listAll=True)
-                validationresult = validateList(pools)
-                if validationresult[0] == FAIL:
-                    raise Exception("Pool list validation failed: %s" % validationresult[2])
-                elif str(pools[0].state).lower().decode("string_escape") == str(state).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
-
 class Network:
     """Manage Network pools"""
 
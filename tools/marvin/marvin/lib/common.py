@@ -59,7 +59,8 @@ from marvin.cloudstackAPI import (listConfigurations,
                                   listVPCOfferings,
                                   migrateSystemVm)
 from marvin.sshClient import SshClient
-from marvin.codes import (PASS, FAILED, ISOLATED_NETWORK, VPC_NETWORK,
+from marvin.codes import (PASS, FAILED, SUCCESS, ISOLATED_NETWORK,
+                          VPC_NETWORK,
                           BASIC_ZONE, FAIL, NAT_RULE, STATIC_NAT_RULE,
                           RESOURCE_PRIMARY_STORAGE, RESOURCE_SECONDARY_STORAGE,
                           RESOURCE_CPU, RESOURCE_MEMORY, PUBLIC_TRAFFIC,
@@ -70,6 +71,10 @@ from marvin.lib.utils import (validateList,
                               get_process_status,
                               random_gen,
                               format_volume_to_ext3)
+from marvin.waitEngine import WaitEngine, poll, PROGRESS
+from marvin.lookupCache import (lookupCache, ZONE, DOMAIN, TEMPLATE,
+                                SERVICE_OFFERING)
+from marvin.taskGraph import TaskGraph
 from marvin.lib.base import (PhysicalNetwork,
                              PublicIPAddress,
                              NetworkOffering,
@@ -100,6 +105,9 @@ import random
 import hashlib
 
 # Import System modules
+import contextlib
+import copy
+import threading
 import time
 
 
@@ -195,25 +203,30 @@ def get_region(apiclient, region_id=None, region_name=None):
     return FAILED if validateList(cmd_out)[0] != PASS else cmd_out[0]
 
 
-def get_domain(apiclient, domain_id=None, domain_name=None):
+def get_domain(apiclient, domain_id=None, domain_name=None, use_cache=True):
     '''
     @name : get_domain
     @Desc : Returns the Domain Information for a given domain id or domain name
     @Input : domain id : Id of the Domain
              domain_name : Name of the Domain
+             use_cache : False to bypass the lookup cache
     @Output : 1. Domain  Information for the passed inputs else first Domain
               2. FAILED In case the cmd failed
     '''
-    cmd = listDomains.listDomainsCmd()
+    def lookup():
+        cmd = listDomains.listDomainsCmd()
+
+        if domain_name is not None:
+            cmd.name = domain_name
+        if domain_id is not None:
+            cmd.id = domain_id
+        cmd_out = apiclient.listDomains(cmd)
+        if validateList(cmd_out)[0] != PASS:
+            return FAILED
+        return cmd_out[0]
 
-    if domain_name is not None:
-        cmd.name = domain_name
-    if domain_id is not None:
-        cmd.id = domain_id
-    cmd_out = apiclient.listDomains(cmd)
-    if validateList(cmd_out)[0] != PASS:
-        return FAILED
-    return cmd_out[0]
+    return lookupCache.get(apiclient, DOMAIN, (domain_id, domain_name),
+                           lookup, use_cache)
 
 
 def find_storage_pool_type(apiclient, storagetype='NetworkFileSystem'):
@@ -235,30 +248,35 @@ def find_storage_pool_type(apiclient, storagetype='NetworkFileSystem'):
     return False
 
 
-def get_zone(apiclient, zone_name=None, zone_id=None):
+def get_zone(apiclient, zone_name=None, zone_id=None, use_cache=True):
     '''
     @name : get_zone
     @Desc :Returns the Zone Information for a given zone id or Zone Name
     @Input : zone_name: Name of the Zone
              zone_id : Id of the zone
+             use_cache : False to bypass the lookup cache
     @Output : 1. Zone Information for the passed inputs else first zone
               2. FAILED In case the cmd failed
     '''
-    cmd = listZones.listZonesCmd()
-    if zone_name is not None:
-        cmd.name = zone_name
-    if zone_id is not None:
-        cmd.id = zone_id
+    def lookup():
+        cmd = listZones.listZonesCmd()
+        if zone_name is not None:
+            cmd.name = zone_name
+        if zone_id is not None:
+            cmd.id = zone_id
 
-    cmd_out = apiclient.listZones(cmd)
+        cmd_out = apiclient.listZones(cmd)
 
-    if validateList(cmd_out)[0] != PASS:
-        return FAILED
-    '''
-    Check if input zone name and zone id is None,
-    then return first element of List Zones command
-    '''
-    return cmd_out[0]
+        if validateList(cmd_out)[0] != PASS:
+            return FAILED
+        '''
+        Check if input zone name and zone id is None,
+        then return first element of List Zones command
+        '''
+        return cmd_out[0]
+
+    return lookupCache.get(apiclient, ZONE, (zone_name, zone_id), lookup,
+                           use_cache)
 
 def get_physical_networks(apiclient, zoneid):
     '''
@@ -299,16 +317,30 @@ def get_pod(apiclient, zone_id=None, pod_id=None, pod_name=None):
 def get_template(
         apiclient, zone_id=None, ostype_desc=None, template_filter="featured", template_type='BUILTIN',
         template_id=None, template_name=None, account=None, domain_id=None, project_id=None,
-        hypervisor=None):
+        hypervisor=None, use_cache=True):
     '''
     @Name : get_template
     @Desc : Retrieves the template Information based upon inputs provided
             Template is retrieved based upon either of the inputs matched
             condition
     @Input : returns a template"
+             use_cache : False to bypass the lookup cache
     @Output : FAILED in case of any failure
               template Information matching the inputs
     '''
+    return lookupCache.get(
+        apiclient, TEMPLATE,
+        (zone_id, template_filter, template_type, template_id, template_name,
+         account, domain_id, project_id, hypervisor),
+        lambda: _get_template(apiclient, zone_id, template_filter,
+                              template_type, template_id, template_name,
+                              account, domain_id, project_id, hypervisor),
+        use_cache)
+
+
+def _get_template(apiclient, zone_id, template_filter, template_type,
+                  template_id, template_name, account, domain_id, project_id,
+                  hypervisor):
     cmd = listTemplates.listTemplatesCmd()
     cmd.templatefilter = template_filter
     if domain_id is not None:
@@ -404,7 +436,8 @@ def download_systemplates_sec_storage(server, services):
             server["ipaddress"],
             server["port"],
             server["username"],
-            server["password"]
+            server["password"],
+            pooled=True
         )
     except Exception:
         raise Exception("SSH access failed for server with IP address: %s" %
@@ -442,44 +475,38 @@ def download_systemplates_sec_storage(server, services):
 def wait_for_ssvms(apiclient, zoneid, podid, interval=60):
     """After setup wait for SSVMs to come Up"""
 
-    time.sleep(interval)
-    timeout = 40
-    while True:
-        list_ssvm_response = list_ssvms(
-            apiclient,
-            systemvmtype='secondarystoragevm',
-            zoneid=zoneid,
-            podid=podid
-        )
-        ssvm = list_ssvm_response[0]
-        if ssvm.state != 'Running':
-            # Sleep to ensure SSVMs are Up and Running
-            time.sleep(interval)
-            timeout = timeout - 1
-        elif ssvm.state == 'Running':
-            break
-        elif timeout == 0:
-            raise Exception("SSVM failed to come up")
-            break
+    timeout = 40 * interval
+    engine = WaitEngine.getEngine(apiclient)
 
-    timeout = 40
-    while True:
+    def listed(systemvmtype):
         list_ssvm_response = list_ssvms(
             apiclient,
-            systemvmtype='consoleproxy',
+            systemvmtype=systemvmtype,
             zoneid=zoneid,
             podid=podid
         )
-        cpvm = list_ssvm_response[0]
-        if cpvm.state != 'Running':
-            # Sleep to ensure SSVMs are Up and Running
-            time.sleep(interval)
-            timeout = timeout - 1
-        elif cpvm.state == 'Running':
-            break
-        elif timeout == 0:
-            raise Exception("CPVM failed to come up")
-            break
+        return isinstance(list_ssvm_response, list) and \
+            len(list_ssvm_response) > 0, list_ssvm_response
+
+    def running(systemvm):
+        return systemvm is not None and systemvm.state == 'Running'
+
+    # Both system VMs are watched together, one list call answers both
+    watches = []
+    for systemvmtype, name in (('secondarystoragevm', "SSVM"),
+                               ('consoleproxy', "CPVM")):
+        found, list_ssvm_response = poll(
+            lambda: listed(systemvmtype), timeout, maxInterval=interval,
+            name="wait_for_ssvms")
+        if not found:
+            raise Exception("%s failed to come up" % name)
+        watches.append((name, engine.watch(
+            "SystemVm", list_ssvms, list_ssvm_response[0].id, running,
+            timeout, maxInterval=interval)))
+    for name, watch in watches:
+        engine.result(watch)
+        if not watch.satisfied:
+            raise Exception("%s failed to come up" % name)
     return
 
 
@@ -504,6 +531,27 @@ def get_builtin_template_info(apiclient, zoneid):
     return extract_response.url, b_template.hypervisor, b_template.format
 
 
+def _template_downloaded(template):
+    """Predicate of the template download watches"""
+
+    # If template is ready,
+    # template.status = Download Complete
+    # Downloading - x% Downloaded
+    # Error - Any other string
+    if template is None:
+        return False
+    if template.isready or template.status == 'Download Complete':
+        return True
+    if not template.status:
+        return False
+    if 'Downloaded' in template.status:
+        return PROGRESS
+    if 'Installing' not in template.status:
+        raise Exception("Error in downloading template %s: status - %s" %
+                        (template.name, template.status))
+    return False
+
+
 def download_builtin_templates(apiclient, zoneid, hypervisor, host,
                                linklocalip, interval=60):
     """After setup wait till builtin templates are downloaded"""
@@ -517,49 +565,325 @@ def download_builtin_templates(apiclient, zoneid, hypervisor, host,
         linklocalip,
         "iptables -P INPUT ACCEPT"
     )
-    time.sleep(interval)
-    # Find the BUILTIN Templates for given Zone, Hypervisor
-    list_template_response = list_templates(
-        apiclient,
-        hypervisor=hypervisor,
-        zoneid=zoneid,
-        templatefilter='self'
-    )
 
-    if not isinstance(list_template_response, list):
-        raise Exception("Failed to download BUILTIN templates")
-
-    # Ensure all BUILTIN templates are downloaded
-    templateid = None
-    for template in list_template_response:
-        if template.templatetype == "BUILTIN":
-            templateid = template.id
-
-    # Sleep to ensure that template is in downloading state after adding
-    # Sec storage
-    time.sleep(interval)
-    while True:
-        template_response = list_templates(
+    # Find the BUILTIN Templates for given Zone, Hypervisor
+    def listed():
+        list_template_response = list_templates(
             apiclient,
-            id=templateid,
+            hypervisor=hypervisor,
             zoneid=zoneid,
             templatefilter='self'
         )
-        template = template_response[0]
-        # If template is ready,
-        # template.status = Download Complete
-        # Downloading - x% Downloaded
-        # Error - Any other string
-        if template.status == 'Download Complete':
-            break
+        builtin = [template for template in
+                   list_template_response or []
+                   if template.templatetype == "BUILTIN"]
+        return len(builtin) > 0, builtin
+
+    found, builtin = poll(listed, 2 * interval, maxInterval=interval,
+                          name="download_builtin_templates")
+    if not found:
+        raise Exception("Failed to download BUILTIN templates")
 
-        elif 'Downloaded' in template.status:
-            time.sleep(interval)
+    # Ensure the BUILTIN template is downloaded, the timeout is not
+    # consumed while the download makes progress
+    watch = WaitEngine.getEngine(apiclient).wait(
+        "Template", list_templates, builtin[-1].id, _template_downloaded,
+        10 * interval, maxInterval=interval,
+        listArgs={"zoneid": zoneid, "templatefilter": 'self'})
+    if watch.error is not None:
+        raise watch.error
+    if not watch.satisfied:
+        raise Exception("ErrorInDownload")
+    return
 
-        elif 'Installing' not in template.status:
-            raise Exception("ErrorInDownload")
 
-    return
+class EnvironmentReadiness(object):
+
+    """
+    @Name : EnvironmentReadiness
+    @Desc : Brings every zone of the environment to a testable state
+            concurrently: its system VMs (SSVM and CPVM) running and its
+            templates registered and downloaded. Each zone step is a task
+            of a TaskGraph. The waits go through the shared WaitEngine,
+            so one listSystemVms call answers the system VMs of all the
+            zones and one listTemplates call per zone the templates of
+            that zone. wait is the single "environment ready" barrier.
+            EX: readiness = EnvironmentReadiness(apiclient)
+                readiness.requireTemplate("tiny", services=tiny)
+                readiness.start()    # optional, wait starts it otherwise
+                ...
+                readiness.wait()
+                print readiness.report()
+    @Input : zoneids : zones to bring up, defaults to every zone
+             systemVms : whether to wait for the system VMs
+             timeout : seconds a single wait may last, the timeout of a
+                       template download restarts while it progresses
+             interval : cap of the interval between two list calls
+             workers : steps running at the same time, all by default
+    """
+    SYSTEM_VMS = (('secondarystoragevm', "SSVM"), ('consoleproxy', "CPVM"))
+
+    def __init__(self, apiclient, zoneids=None, systemVms=True,
+                 timeout=2400, interval=60, workers=None, logger=None):
+        self.apiclient = apiclient
+        zones = list_zones(apiclient)
+        if not isinstance(zones, list):
+            raise Exception("No zone found")
+        if zoneids is not None:
+            zones = [zone for zone in zones if zone.id in zoneids]
+            if len(zones) != len(set(zoneids)):
+                raise Exception("Unknown zone among %s" % list(zoneids))
+        self.zones = zones
+        self.systemVms = systemVms
+        self.timeout = timeout
+        self.interval = interval
+        self.workers = workers
+        self.logger = logger
+        self.templates = {}
+        self.ready = threading.Event()
+        self.__requirements = []
+        self.__steps = dict((zone.id, []) for zone in zones)
+        self.__lock = threading.Lock()
+        self.__graph = None
+        self.__thread = None
+        self.__result = None
+        self.__origin = None
+        self.__elapsed = None
+
+    def requireTemplate(self, label, zoneid=None, services=None,
+                        templateid=None, hypervisor=None,
+                        templatefilter='self'):
+        """
+        @Name : requireTemplate
+        @Desc : Adds a template to be downloaded before the environment
+                is ready, registered from services if given, else the
+                template templateid, else the BUILTIN template of the
+                zone. Once ready it is in self.templates[zoneid, label]
+        @Input : label : name of the template in the report
+                 zoneid : zone of the template, None for every zone
+        """
+        if self.__graph is not None:
+            raise Exception("EnvironmentReadiness already started")
+        for zone in self.zones:
+            if zoneid is None or zone.id == zoneid:
+                self.__requirements.append(
+                    (zone, label, services, templateid, hypervisor,
+                     templatefilter))
+
+    @contextlib.contextmanager
+    def __step(self, zone, step):
+        record = {"step": step, "start": time.time(), "end": None,
+                  "outcome": "FAILED"}
+        with self.__lock:
+            self.__steps[zone.id].append(record)
+        yield
+        record["outcome"] = "PASSED"
+        record["end"] = time.time()
+
+    def __close(self, zone):
+        with self.__lock:
+            for record in self.__steps[zone.id]:
+                if record["end"] is None:
+                    record["end"] = time.time()
+
+    def __waitSystemVms(self, zone):
+        apiclient = copy.copy(self.apiclient)
+        engine = WaitEngine.getEngine(apiclient)
+        types = dict(EnvironmentReadiness.SYSTEM_VMS)
+
+        def listed():
+            vms = list_ssvms(apiclient, zoneid=zone.id)
+            vms = [vm for vm in vms or [] if vm.systemvmtype in types]
+            return set(vm.systemvmtype for vm in vms) == set(types), vms
+
+        def running(systemvm):
+            return systemvm is not None and systemvm.state == 'Running'
+
+        try:
+            with self.__step(zone, "systemVms:listed"):
+                found, vms = poll(listed, self.timeout,
+                                  maxInterval=self.interval,
+                                  name="EnvironmentReadiness")
+                if not found:
+                    raise Exception("System VMs of zone %s failed to be "
+                                    "created" % zone.name)
+            with self.__step(zone, "systemVms:running"):
+                # No zone in the list arguments: the watches of every
+                # zone share one listall call
+                watches = [(vm, engine.watch(
+                    "SystemVm", list_ssvms, vm.id, running, self.timeout,
+                    maxInterval=self.interval)) for vm in vms]
+                for vm, watch in watches:
+                    engine.result(watch)
+                    if watch.error is not None:
+                        raise watch.error
+                    if not watch.satisfied:
+                        raise Exception("%s %s of zone %s failed to come up"
+                                        % (types[vm.systemvmtype], vm.name,
+                                           zone.name))
+        finally:
+            self.__close(zone)
+
+    def __waitTemplate(self, zone, label, services, templateid, hypervisor,
+                       templatefilter):
+        apiclient = copy.copy(self.apiclient)
+        try:
+            if services is not None:
+                with self.__step(zone, "template:%s:register" % label):
+                    template = Template.register(apiclient, services,
+                                                 zoneid=zone.id,
+                                                 hypervisor=hypervisor)
+                    if template is None:
+                        raise Exception("Failed to register template %s "
+                                        "in zone %s" % (label, zone.name))
+                    templateid = template.id
+            elif templateid is None:
+                with self.__step(zone, "template:%s:listed" % label):
+                    def listed():
+                        templates = list_templates(
+                            apiclient, zoneid=zone.id,
+                            hypervisor=hypervisor,
+                            templatefilter=templatefilter)
+                        builtin = [t for t in templates or []
+                                   if t.templatetype == "BUILTIN"]
+                        return len(builtin) > 0, builtin
+                    found, builtin = poll(listed, self.timeout,
+                                          maxInterval=self.interval,
+                                          name="EnvironmentReadiness")
+                    if not found:
+                        raise Exception("No BUILTIN template in zone %s" %
+                                        zone.name)
+                    templateid = builtin[0].id
+            with self.__step(zone, "template:%s:download" % label):
+                watch = WaitEngine.getEngine(apiclient).wait(
+                    "Template", list_templates, templateid,
+                    _template_downloaded, self.timeout,
+                    maxInterval=self.interval,
+                    listArgs={"zoneid": zone.id,
+                              "templatefilter": templatefilter})
+                if watch.error is not None:
+                    raise watch.error
+                if not watch.satisfied:
+                    raise Exception("Template %s of zone %s not downloaded "
+                                    "after %ss" % (label, zone.name,
+                                                   self.timeout))
+            self.templates[zone.id, label] = watch.item
+        finally:
+            self.__close(zone)
+
+    def __run(self):
+        try:
+            self.__result = self.__graph.run()
+        except BaseException:
+            self.__result = FAILED
+        self.__elapsed = time.time() - self.__origin
+        if self.__result == SUCCESS:
+            self.ready.set()
+
+    def start(self):
+        """
+        @Name : start
+        @Desc : Starts bringing the zones up in the background
+        """
+        if self.__graph is not None:
+            return self
+        tasks = [("%s:systemVms" % zone.name,
+                  lambda zone=zone: self.__waitSystemVms(zone))
+                 for zone in self.zones if self.systemVms]
+        tasks += [("%s:template:%s" % (req[0].name, req[1]),
+                   lambda req=req: self.__waitTemplate(*req))
+                  for req in self.__requirements]
+        self.__graph = TaskGraph(workers=self.workers or len(tasks) or 1,
+                                 logger=self.logger)
+        for name, fn in tasks:
+            self.__graph.add(name, fn)
+        self.__origin = time.time()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="EnvironmentReadiness")
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """
+        @Name : wait
+        @Desc : The environment ready barrier, blocks until every zone
+                is ready
+        @Output : the timings, see getTimings; raises an Exception
+                  naming the failed steps if a zone did not come up
+        """
+        self.start()
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.__thread.is_alive():
+            if deadline is not None and time.time() >= deadline:
+                raise Exception("Environment not ready after %ss" % timeout)
+            self.__thread.join(1)
+        if self.__result != SUCCESS:
+            errors = ["%s: %s" % (task["name"], task["error"])
+                      for task in self.__graph.getTimings()
+                      if task["error"]]
+            raise Exception("Environment not ready: %s" %
+                            "; ".join(errors or ["aborted"]))
+        return self.getTimings()
+
+    def getTimings(self):
+        """
+        @Name : getTimings
+        @Desc : Per zone breakdown of the readiness, timestamps are
+                seconds since start
+        @Output : {"elapsed": seconds, "zones": {zone name: {"ready":
+                  seconds, "steps": [{"step", "start", "took",
+                  "outcome"}]}}}
+        """
+        origin = self.__origin or time.time()
+        zones = {}
+        with self.__lock:
+            for zone in self.zones:
+                steps = [{"step": record["step"],
+                          "start": round(record["start"] - origin, 3),
+                          "took": round(record["end"] - record["start"], 3)
+                          if record["end"] else None,
+                          "outcome": record["outcome"]
+                          if record["end"] else "RUNNING"}
+                         for record in self.__steps[zone.id]]
+                ends = [record["end"] for record in self.__steps[zone.id]]
+                zones[zone.name] = {
+                    "ready": round(max(ends) - origin, 3)
+                    if ends and None not in ends else None,
+                    "steps": steps}
+        return {"elapsed": round(self.__elapsed, 3)
+                if self.__elapsed is not None else None,
+                "zones": zones}
+
+    def report(self):
+        """
+        @Name : report
+        @Desc : Printable table of the per zone timings
+        """
+        timings = self.getTimings()
+        lines = ["%-20s %-40s %9s %9s %-8s" %
+                 ("Zone", "Step", "Start(s)", "Took(s)", "Outcome")]
+        for name in sorted(timings["zones"]):
+            zone = timings["zones"][name]
+            for step in sorted(zone["steps"], key=lambda s: s["start"]):
+                lines.append("%-20s %-40s %9.3f %9s %-8s" %
+                             (name[:20], step["step"][:40], step["start"],
+                              "%.3f" % step["took"]
+                              if step["took"] is not None else "-",
+                              step["outcome"]))
+            if zone["ready"] is not None:
+                lines.append("%-20s ready after %.3fs" %
+                             (name[:20], zone["ready"]))
+        ready = [(zone["ready"], name)
+                 for (name, zone) in timings["zones"].items()
+                 if zone["ready"] is not None]
+        if timings["elapsed"] is not None:
+            lines.append("Environment %s in %.3fs%s" %
+                         ("ready" if self.ready.is_set() else "NOT ready",
+                          timings["elapsed"],
+                          ", last zone: %s" % max(ready)[1]
+                          if ready else ""))
+        return "\n".join(lines)
 
 
 def update_resource_limit(apiclient, resourcetype, account=None,
@@ -832,14 +1156,19 @@ def list_disk_offering(apiclient, **kwargs):
     return(apiclient.listDiskOfferings(cmd))
 
 
-def list_service_offering(apiclient, **kwargs):
-    """Lists all available service offerings."""
+def list_service_offering(apiclient, use_cache=True, **kwargs):
+    """Lists all available service offerings.
+    use_cache=False bypasses the lookup cache"""
 
-    cmd = listServiceOfferings.listServiceOfferingsCmd()
-    [setattr(cmd, k, v) for k, v in kwargs.items()]
-    if 'account' in kwargs.keys() and 'domainid' in kwargs.keys():
-        cmd.listall=True
-    return(apiclient.listServiceOfferings(cmd))
+    def lookup():
+        cmd = listServiceOfferings.listServiceOfferingsCmd()
+        [setattr(cmd, k, v) for k, v in kwargs.items()]
+        if 'account' in kwargs.keys() and 'domainid' in kwargs.keys():
+            cmd.listall=True
+        return(apiclient.listServiceOfferings(cmd))
+
+    return lookupCache.get(apiclient, SERVICE_OFFERING,
+                           repr(sorted(kwargs.items())), lookup, use_cache)
 
 
 def list_vlan_ipranges(apiclient, **kwargs):
@@ -1370,20 +1699,11 @@ def createSnapshotFromVirtualMachineVolume(apiclient, account, vmid):
 
 def isVmExpunged(apiclient, vmid, projectid=None, timeout=600):
     """Verify if VM is expunged or not"""
-    vmExpunged= False
-    while timeout>=0:
-        try:
-            vms = VirtualMachine.list(apiclient, id=vmid, projectid=projectid)
-            if vms is None:
-                vmExpunged = True
-                break
-            timeout -= 60
-            time.sleep(60)
-        except Exception:
-            vmExpunged = True
-            break
-     #end while
-    return vmExpunged
+    watch = WaitEngine.getEngine(apiclient).wait(
+        "VirtualMachine", VirtualMachine.list, vmid,
+        lambda vm: vm is None, timeout,
+        listArgs={"projectid": projectid}, absentOnError=True)
+    return watch.satisfied
 
 def isDomainResourceCountEqualToExpectedCount(apiclient, domainid, expectedcount,
                                               resourcetype):
@@ -1408,16 +1728,12 @@ def isDomainResourceCountEqualToExpectedCount(apiclient, domainid, expectedcount
 
 def isNetworkDeleted(apiclient, networkid, timeout=600):
     """ List the network and check that the list is empty or not"""
-    networkDeleted = False
-    while timeout >= 0:
-        networks = Network.list(apiclient, id=networkid)
-        if networks is None:
-            networkDeleted = True
-            break
-        timeout -= 60
-        time.sleep(60)
-    #end while
-    return networkDeleted
+    watch = WaitEngine.getEngine(apiclient).wait(
+        "Network", Network.list, networkid,
+        lambda network: network is None, timeout)
+    if watch.error is not None:
+        raise watch.error
+    return watch.satisfied
 
 
 def createChecksum(service=None,
@@ -1564,27 +1880,26 @@ def compareChecksum(
 
 def verifyRouterState(apiclient, routerid, state, listall=True):
     """List router and check if the router state matches the given state"""
-    retriesCount = 10
+    timeout = 600
     isRouterInDesiredState = False
     exceptionOccured = False
     exceptionMessage = ""
-    try:
-        while retriesCount >= 0:
-            routers = Router.list(apiclient, id=routerid, listall=listall)
-            assert validateList(
-                routers)[0] == PASS, "Routers list validation failed"
-            if str(routers[0].state).lower() == state:
-                isRouterInDesiredState = True
-                break
-            retriesCount -= 1
-            time.sleep(60)
-        if not isRouterInDesiredState:
-            exceptionMessage = "Router state should be %s, it is %s" %\
-                                (state, routers[0].state)
-    except Exception as e:
+
+    def inState(router):
+        assert router is not None, "Routers list validation failed"
+        return str(router.state).lower() == state
+
+    watch = WaitEngine.getEngine(apiclient).wait(
+        "Router", Router.list, routerid, inState, timeout,
+        listArgs={"listall": listall})
+    if watch.error is not None:
         exceptionOccured = True
-        exceptionMessage = e
+        exceptionMessage = watch.error
         return [exceptionOccured, isRouterInDesiredState, exceptionMessage]
+    isRouterInDesiredState = watch.satisfied
+    if not isRouterInDesiredState:
+        exceptionMessage = "Router state should be %s, it is %s" %\
+                            (state, watch.item.state)
     return [exceptionOccured, isRouterInDesiredState, exceptionMessage]
 
 def isIpRangeInUse(api_client, publicIpRange):
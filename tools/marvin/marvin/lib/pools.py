@@ -0,0 +1,463 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""Pools of pre-provisioned fixtures (accounts, networks, VMs) leased
+to the test classes which do not need a resource of their own.
+
+A pool keeps `size` resources ready, created in the background. A
+lease hands one over, and its release resets the resource in the
+background (EX: the VMs of an account are destroyed, a VM is restored
+and started) before the next lease. A resource which can not be reset,
+or released as dirty, is destroyed and replaced. Leased resources
+must not be added to the cleanup list of the test.
+
+    pool = pools.get("account", lambda: accountPool(
+        cls.apiclient, cls.services["account"], domainid=cls.domain.id))
+    cls.accountLease = pool.lease()
+    cls.account = cls.accountLease.resource
+    ...
+    cls.accountLease.release()    # in tearDownClass
+
+The registry `pools` is shared by every test class of the process, the
+marvin plugin closes its pools (destroying their resources) at the end
+of the run.
+"""
+
+import collections
+import copy
+import Queue
+import threading
+import time
+from marvin.cloudstackException import GetDetailExceptionInfo
+from marvin.lib.base import (Account, Network, VirtualMachine)
+from marvin.lib.utils import cleanup_resources, CLEANUP_WORKERS
+
+
+class Lease(object):
+    """A resource lent by a pool, release gives it back. As a context
+    manager an exception in the block releases it as dirty"""
+
+    def __init__(self, pool, resource):
+        self.pool = pool
+        self.resource = resource
+        self.leased = time.time()
+        self.released = False
+
+    def release(self, dirty=False):
+        self.pool.release(self, dirty)
+
+    def __enter__(self):
+        return self.resource
+
+    def __exit__(self, excType, exc, tb):
+        self.release(dirty=excType is not None)
+        return False
+
+
+class FixturePool(object):
+    """
+    @Name : FixturePool
+    @Desc : Pool of interchangeable resources of one kind
+    @Input : name : name of the pool in the report
+             apiclient : client copied for the pool, so that the
+                         background work never uses the test's one
+             create : callable(apiclient) returning a new resource
+             reset : callable(apiclient, resource) making a released
+                     resource clean again, returns False (or raises) if
+                     it can not; None reuses the resources as they are
+             destroy : callable(apiclient, resource), defaults to
+                       resource.delete(apiclient)
+             size : resources kept ready
+             maxSize : resources alive at the same time, leased or not
+             workers : background threads creating, resetting and
+                       destroying the resources
+    """
+
+    def __init__(self, name, apiclient, create, reset=None, destroy=None,
+                 size=2, maxSize=None, workers=2, logger=None):
+        self.name = name
+        self.apiclient = copy.copy(apiclient)
+        self.apiclient.id = getattr(apiclient, "id", None) or \
+            "FixturePool-%s" % name
+        self.create = create
+        self.reset = reset
+        self.destroy = destroy or \
+            (lambda apiclient, resource: resource.delete(apiclient))
+        self.size = size
+        self.maxSize = max(maxSize or size * 2, size, 1)
+        self.logger = logger
+        self.lastError = None
+        self.__cond = threading.Condition()
+        self.__idle = collections.deque()
+        self.__alive = 0
+        self.__creating = 0
+        self.__waiting = 0
+        self.__leased = 0
+        self.__closed = False
+        self.__tasks = Queue.Queue()
+        self.__stats = {"leases": 0, "hits": 0, "misses": 0,
+                        "waitTime": 0.0, "created": 0, "createTime": 0.0,
+                        "resets": 0, "resetTime": 0.0, "replaced": 0,
+                        "destroyed": 0, "failures": 0}
+        self.__threads = []
+        for i in range(max(workers, 1)):
+            thread = threading.Thread(target=self.__worker,
+                                      name="FixturePool-%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def __debug(self, msg):
+        if self.logger is not None:
+            self.logger.debug(msg)
+
+    def __failed(self, action, e):
+        self.lastError = e
+        with self.__cond:
+            self.__stats["failures"] += 1
+        if self.logger is not None:
+            self.logger.exception("=== %s %s failed: %s ===" %
+                                  (self.name, action,
+                                   GetDetailExceptionInfo(e)))
+
+    def __worker(self):
+        while True:
+            task = self.__tasks.get()
+            try:
+                if task is None:
+                    return
+                task[0](*task[1:])
+            except Exception as e:
+                self.__failed("task", e)
+            finally:
+                self.__tasks.task_done()
+
+    def __new(self):
+        '''
+        Creates a resource, the caller counted it in __alive and
+        __creating
+        '''
+        start = time.time()
+        try:
+            resource = self.create(self.apiclient)
+        except Exception:
+            with self.__cond:
+                self.__alive -= 1
+                self.__creating -= 1
+                self.__cond.notify_all()
+            raise
+        with self.__cond:
+            self.__creating -= 1
+            self.__stats["created"] += 1
+            self.__stats["createTime"] += time.time() - start
+        return resource
+
+    def __createIdle(self):
+        try:
+            resource = self.__new()
+        except Exception as e:
+            self.__failed("create", e)
+            return
+        with self.__cond:
+            closed = self.__closed
+            if not closed:
+                self.__idle.append(resource)
+                self.__cond.notify_all()
+        if closed:
+            self.__destroy(resource)
+            return
+        self.__debug("=== %s: resource created ===" % self.name)
+
+    def __replenish(self):
+        with self.__cond:
+            if self.__closed:
+                return
+            while len(self.__idle) + self.__creating < self.size and \
+                    self.__alive < self.maxSize:
+                self.__alive += 1
+                self.__creating += 1
+                self.__tasks.put((self.__createIdle,))
+
+    def __destroy(self, resource):
+        try:
+            self.destroy(self.apiclient, resource)
+        except Exception as e:
+            self.__failed("destroy", e)
+        with self.__cond:
+            self.__alive -= 1
+            self.__stats["destroyed"] += 1
+            self.__cond.notify_all()
+        self.__replenish()
+
+    def __recycle(self, resource):
+        start = time.time()
+        try:
+            clean = self.reset(self.apiclient, resource) is not False
+        except Exception as e:
+            self.__failed("reset", e)
+            clean = False
+        with self.__cond:
+            self.__stats["resets"] += 1
+            self.__stats["resetTime"] += time.time() - start
+            if clean and not self.__closed:
+                self.__idle.append(resource)
+                self.__cond.notify_all()
+                return
+            if not clean:
+                self.__stats["replaced"] += 1
+        self.__destroy(resource)
+
+    def prefill(self):
+        '''
+        @Name : prefill
+        @Desc : Starts creating the resources in the background, so that
+                they are ready when the tests lease them
+        '''
+        self.__replenish()
+        return self
+
+    def lease(self, timeout=1800):
+        '''
+        @Name : lease
+        @Desc : Hands over a ready resource, else creates one on the
+                calling thread if the pool may grow, else waits for one
+                being created or reset
+        @Output : Lease, see Lease.resource
+        '''
+        start = time.time()
+        deadline = start + timeout
+        create = False
+        waited = False
+        with self.__cond:
+            while True:
+                if self.__closed:
+                    raise Exception("Fixture pool %s is closed" %
+                                    self.name)
+                if self.__idle:
+                    resource = self.__idle.popleft()
+                    self.__stats["misses" if waited else "hits"] += 1
+                    break
+                if self.__creating <= self.__waiting and \
+                        self.__alive < self.maxSize:
+                    self.__alive += 1
+                    self.__creating += 1
+                    self.__stats["misses"] += 1
+                    create = True
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("No %s available from its pool after "
+                                    "%ss" % (self.name, timeout))
+                waited = True
+                self.__waiting += 1
+                try:
+                    self.__cond.wait(min(remaining, 5))
+                finally:
+                    self.__waiting -= 1
+        if create:
+            resource = self.__new()
+        with self.__cond:
+            self.__leased += 1
+            self.__stats["leases"] += 1
+            self.__stats["waitTime"] += time.time() - start
+        self.__replenish()
+        self.__debug("=== %s leased after %.3fs ===" %
+                     (self.name, time.time() - start))
+        return Lease(self, resource)
+
+    def release(self, lease, dirty=False):
+        '''
+        @Name : release
+        @Desc : Gives a leased resource back, it is reset in the
+                background; a dirty one is destroyed and replaced
+        '''
+        if lease.released:
+            return
+        lease.released = True
+        with self.__cond:
+            self.__leased -= 1
+            closed = self.__closed
+        if dirty or closed:
+            if dirty:
+                with self.__cond:
+                    self.__stats["replaced"] += 1
+            self.__tasks.put((self.__destroy, lease.resource))
+        elif self.reset is None:
+            with self.__cond:
+                self.__idle.append(lease.resource)
+                self.__cond.notify_all()
+        else:
+            self.__tasks.put((self.__recycle, lease.resource))
+
+    def close(self):
+        '''
+        @Name : close
+        @Desc : Destroys the idle resources and waits for the background
+                work, the resources still leased are destroyed when
+                released
+        '''
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            idle = list(self.__idle)
+            self.__idle.clear()
+            self.__cond.notify_all()
+        for resource in idle:
+            self.__tasks.put((self.__destroy, resource))
+        self.__tasks.join()
+        for thread in self.__threads:
+            self.__tasks.put(None)
+        for thread in self.__threads:
+            thread.join(60)
+
+    def getStats(self):
+        with self.__cond:
+            stats = dict(self.__stats)
+            stats.update({"idle": len(self.__idle), "alive": self.__alive,
+                          "leased": self.__leased})
+        return stats
+
+    def summary(self):
+        stats = self.getStats()
+        stats["name"] = self.name
+        return ("%(name)-20s %(leases)6d %(hits)6d %(misses)6d "
+                "%(waitTime)10.1f %(created)7d %(createTime)10.1f "
+                "%(resets)6d %(replaced)8d %(failures)8d %(leased)6d" %
+                stats)
+
+
+class PoolRegistry(object):
+    """Pools shared by the test classes of a process, by name"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pools = collections.OrderedDict()
+
+    def get(self, name, factory):
+        '''
+        @Name : get
+        @Desc : Returns the pool registered under name, else registers
+                the pool returned by factory() and starts filling it
+        '''
+        with self.__lock:
+            pool = self.__pools.get(name)
+            if pool is None:
+                pool = factory()
+                self.__pools[name] = pool.prefill()
+            return pool
+
+    def closeAll(self):
+        with self.__lock:
+            pools = list(self.__pools.values())
+            self.__pools.clear()
+        for pool in pools:
+            pool.close()
+        return pools
+
+    def summary(self, closed=None):
+        pools = closed if closed is not None else \
+            list(self.__pools.values())
+        if not pools:
+            return ""
+        lines = ["%-20s %6s %6s %6s %10s %7s %10s %6s %8s %8s %6s" %
+                 ("Fixture pool", "Leases", "Hits", "Misses", "Wait(s)",
+                  "Created", "Create(s)", "Resets", "Replaced",
+                  "Failures", "Leased")]
+        lines.extend(pool.summary() for pool in pools)
+        return "\n".join(lines)
+
+
+pools = PoolRegistry()
+
+
+def _accountResources(apiclient, account):
+    vms = VirtualMachine.list(apiclient, account=account.name,
+                              domainid=account.domainid, listall=True)
+    networks = Network.list(apiclient, account=account.name,
+                            domainid=account.domainid, listall=True)
+    return [VirtualMachine(vm.__dict__, {}) for vm in vms or []] + \
+        [Network(network.__dict__) for network in networks or []]
+
+
+def resetAccount(apiclient, account):
+    """Deletes the VMs and networks left in the account"""
+    cleanup_resources(apiclient, _accountResources(apiclient, account),
+                      reorder=True, workers=CLEANUP_WORKERS)
+    return True
+
+
+def resetNetwork(apiclient, network):
+    """Deletes the VMs left in the network"""
+    vms = VirtualMachine.list(apiclient, networkid=network.id, listall=True)
+    cleanup_resources(apiclient,
+                      [VirtualMachine(vm.__dict__, {}) for vm in vms or []],
+                      reorder=True, workers=CLEANUP_WORKERS)
+    return True
+
+
+def resetVirtualMachine(apiclient, vm, pristine=False):
+    """Restores the root disk of the VM from its template if pristine,
+    then makes sure the VM is running"""
+    if pristine:
+        vm.restore(apiclient)
+    vms = VirtualMachine.list(apiclient, id=vm.id)
+    state = vms[0].state if isinstance(vms, list) and vms else None
+    if state == VirtualMachine.STOPPED:
+        vm.start(apiclient)
+    elif state != VirtualMachine.RUNNING:
+        return False
+    return True
+
+
+def accountPool(apiclient, services, domainid=None, admin=False, **kwargs):
+    """Pool of accounts, emptied of their VMs and networks between
+    leases"""
+    return FixturePool(
+        "account", apiclient,
+        lambda client: Account.create(client, services, admin=admin,
+                                      domainid=domainid),
+        resetAccount, **kwargs)
+
+
+def networkPool(apiclient, services, account, networkofferingid=None,
+                zoneid=None, **kwargs):
+    """Pool of isolated networks of an account, emptied of their VMs
+    between leases"""
+    return FixturePool(
+        "network", apiclient,
+        lambda client: Network.create(client, services,
+                                      accountid=account.name,
+                                      domainid=account.domainid,
+                                      networkofferingid=networkofferingid,
+                                      zoneid=zoneid),
+        resetNetwork, **kwargs)
+
+
+def virtualMachinePool(apiclient, services, account, templateid=None,
+                       serviceofferingid=None, zoneid=None, networkids=None,
+                       mode='default', pristine=False, **kwargs):
+    """Pool of VMs of an account, started again between leases and,
+    if pristine, restored from their template"""
+    return FixturePool(
+        "virtualmachine", apiclient,
+        lambda client: VirtualMachine.create(
+            client, services, templateid=templateid,
+            accountid=account.name, domainid=account.domainid,
+            serviceofferingid=serviceofferingid, zoneid=zoneid,
+            networkids=networkids, mode=mode),
+        lambda client, vm: resetVirtualMachine(client, vm, pristine),
+        **kwargs)
@@ -18,7 +18,10 @@
 """
 
 import marvin
+import copy
 import os
+import re
+import sys
 import time
 import logging
 import string
@@ -28,10 +31,13 @@ import email
 import socket
 import urlparse
 import datetime
+import threading
 from marvin.cloudstackAPI import cloudstackAPIClient, listHosts, listRouters
 from platform import system
 from marvin.cloudstackException import GetDetailExceptionInfo
 from marvin.sshClient import SshClient
+from marvin.waitEngine import poll
+from marvin.taskGraph import TaskGraph
 from marvin.codes import (
                           SUCCESS,
                           FAIL,
@@ -63,7 +69,7 @@ def _configure_timeout(hypervisor):
 
 def _execute_ssh_command(hostip, port, username, password, ssh_command):
     #SSH to the machine
-    ssh = SshClient(hostip, port, username, password)
+    ssh = SshClient(hostip, port, username, password, pooled=True)
     # Ensure the SSH login is successful
     while True:
         res = ssh.execute(ssh_command)
@@ -152,10 +158,276 @@ def random_gen(id=None, size=6, chars=string.ascii_uppercase + string.digits):
     return randomstr
 
 
-def cleanup_resources(api_client, resources):
-    """Delete resources"""
+'''
+Number of items fetched per API call by list_paged
+'''
+LIST_PAGE_SIZE = 500
+
+
+class _PageFetch(threading.Thread):
+    """Fetches one page in the background, get() returns or raises
+    what the list call did"""
+
+    def __init__(self, fetch, page):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fetch = fetch
+        self.page = page
+        self.items = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.items = self.fetch(self.page)
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.items
+
+
+def list_paged(list_method, apiclient, pagesize=None, prefetch=True,
+               **kwargs):
+    """
+    @Name: list_paged
+    @Desc: Lazily iterates over everything a list call returns, fetching
+           it page by page instead of in one huge response. The next
+           page is fetched in the background while the current one is
+           consumed, so breaking out of the loop early never loads more
+           than one extra page
+    @Input: list_method: any list classmethod of lib/base.py
+                         (EX: VirtualMachine.list) or list_* helper of
+                         lib/common.py; it is called with page and
+                         pagesize added to kwargs
+            apiclient: api client to list with
+            pagesize: items per page, defaults to LIST_PAGE_SIZE
+            prefetch: False to fetch the pages only on demand
+            kwargs: list criteria, EX: zoneid=zone.id, listall=True
+    @Output: generator over the listed items
+    """
+    pagesize = pagesize or LIST_PAGE_SIZE
+
+    def fetch(page):
+        items = list_method(apiclient, page=page, pagesize=pagesize,
+                            **kwargs)
+        return items if isinstance(items, list) else []
+
+    page = 1
+    if not prefetch:
+        while True:
+            items = fetch(page)
+            for item in items:
+                yield item
+            if len(items) < pagesize:
+                return
+            page += 1
+
+    pending = _PageFetch(fetch, page)
+    while pending is not None:
+        items = pending.get()
+        pending = None
+        if len(items) >= pagesize:
+            page += 1
+            pending = _PageFetch(fetch, page)
+        for item in items:
+            yield item
+
+
+# Deletion order inferred from the resource types when cleanup_resources
+# is asked to reorder, lower levels are deleted first. Types not listed
+# here keep their position in the list given to cleanup_resources
+CLEANUP_LEVELS = {
+    # Rules and other leaves hanging off IPs, networks and VMs
+    "NATRule": 0, "StaticNATRule": 0, "FireWallRule": 0,
+    "EgressFireWallRule": 0, "LoadBalancerRule": 0,
+    "ApplicationLoadBalancer": 0, "NetworkACL": 0, "StaticRoute": 0,
+    "VpnUser": 0, "Vpn": 0, "Tag": 0, "SnapshotPolicy": 0,
+    "ProjectInvitation": 0, "RolePermission": 0, "VmSnapshot": 0,
+    # VMs
+    "VirtualMachine": 1,
+    # What the VMs were using
+    "Volume": 2, "Snapshot": 2, "PublicIPAddress": 2, "SecurityGroup": 2,
+    "AffinityGroup": 2, "SSHKeyPair": 2, "InstanceGroup": 2,
+    "Template": 2, "Iso": 2, "VpnCustomerGateway": 2,
+    # Networks
+    "PrivateGateway": 3, "Network": 3,
+    "NetworkACLList": 4, "VPC": 5,
+    # Offerings, projects then the accounts owning everything above
+    "ServiceOffering": 6, "DiskOffering": 6, "NetworkOffering": 6,
+    "VpcOffering": 6, "Project": 6,
+    "User": 7, "Account": 8, "Role": 9, "Domain": 9,
+}
+
+CLEANUP_WORKERS = 4
+
+# Types whose resources may contain each other (EX: deleting a parent
+# domain removes its children), they are deleted one at a time in the
+# order of the list even among the resources of the same level
+CLEANUP_SERIAL_TYPES = ("Domain",)
+
+# Errors worth retrying: the resource is still being released by an
+# operation which has not completed yet
+CLEANUP_TRANSIENT_ERRORS = re.compile(
+    r"\bin use\b|being used|in progress|\bbusy\b|try again|\blocked\b|"
+    r"concurrent|has active|Connection aborted|timed out", re.IGNORECASE)
+
+
+class CleanupStats(object):
+    """Process wide time spent deleting each resource type"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__types = {}
+
+    def add(self, restype, took, retries, failed):
+        with self.__lock:
+            stats = self.__types.setdefault(restype, {
+                "count": 0, "time": 0.0, "maxTime": 0.0,
+                "retries": 0, "failed": 0})
+            stats["count"] += 1
+            stats["time"] += took
+            stats["maxTime"] = max(stats["maxTime"], took)
+            stats["retries"] += retries
+            if failed:
+                stats["failed"] += 1
+
+    def toDict(self):
+        with self.__lock:
+            return dict((k, dict(v)) for (k, v) in self.__types.items())
+
+    def report(self):
+        stats = self.toDict()
+        lines = ["%-28s %6s %10s %10s %8s %7s" %
+                 ("Type", "Count", "Time(s)", "Max(s)", "Retries", "Failed")]
+        for restype in sorted(stats, key=lambda t: -stats[t]["time"]):
+            s = stats[restype]
+            lines.append("%-28s %6d %10.3f %10.3f %8d %7d" %
+                         (restype, s["count"], s["time"], s["maxTime"],
+                          s["retries"], s["failed"]))
+        return "\n".join(lines)
+
+
+cleanup_stats = CleanupStats()
+
+
+def _cleanup_client(api_client):
+    """Client for a cleanup worker: a copy with its own connection, which
+    still shares the pooled transport and async job poller"""
+    client = copy.copy(api_client)
+    if client is not api_client and hasattr(api_client, "__dict__"):
+        for k, v in vars(api_client).items():
+            if k != "connection":
+                setattr(client, k, v)
+    return client
+
+
+def _cleanup_order(resources):
+    """Groups the resources into segments separated by the resources of
+    unknown type, each segment is a list of levels to delete in turn.
+    The resources of a level keep their order in the list"""
+    segments = []
+    levels = {}
     for obj in resources:
-        obj.delete(api_client)
+        level = CLEANUP_LEVELS.get(obj.__class__.__name__)
+        if level is None:
+            if levels:
+                segments.append([levels[l] for l in sorted(levels)])
+                levels = {}
+            segments.append([[obj]])
+        else:
+            levels.setdefault(level, []).append(obj)
+    if levels:
+        segments.append([levels[l] for l in sorted(levels)])
+    return [level for segment in segments for level in segment]
+
+
+def cleanup_resources(api_client, resources, reorder=False, workers=1,
+                      retries=0, retry_interval=2):
+    """
+    @Name: cleanup_resources
+    @Desc: Deletes resources one at a time, in the order of the list, in
+           the calling thread; the first failure is raised.
+           With reorder, dependents are deleted first (rules, then VMs,
+           then volumes/IPs, networks, VPCs, offerings and accounts
+           last, see CLEANUP_LEVELS), and with workers above 1, the
+           resources of the same level concurrently, except those of
+           CLEANUP_SERIAL_TYPES. Async deletions of the workers share
+           one job poller, so their waits are answered by the same
+           listAsyncJobs sweeps. When reordering, None entries (the
+           resources whose creation failed) are skipped, and once a
+           deletion fails, no new one is started and its exception is
+           raised after the running ones are done
+    @Input: reorder: delete in the order of CLEANUP_LEVELS rather than
+                     the order of the list
+            workers: deletions running at the same time when reordering,
+                     EX: CLEANUP_WORKERS; 1 deletes one resource at a time
+            retries: attempts after a transient failure (see
+                     CLEANUP_TRANSIENT_ERRORS), none by default
+            retry_interval: seconds before the first retry, doubled for
+                            every following one
+    @Output: None, the time spent per resource type is accumulated in
+             cleanup_stats
+    """
+    workers = workers if reorder and workers else 1
+    errors = []
+    local = threading.local()
+
+    def delete(obj):
+        if not hasattr(local, "client"):
+            local.client = _cleanup_client(api_client) \
+                if workers > 1 else api_client
+        restype = obj.__class__.__name__
+        start = time.time()
+        attempt = 0
+        while True:
+            try:
+                obj.delete(local.client)
+                cleanup_stats.add(restype, time.time() - start, attempt,
+                                  False)
+                return
+            except Exception as e:
+                if attempt >= retries or \
+                        not CLEANUP_TRANSIENT_ERRORS.search(str(e)):
+                    cleanup_stats.add(restype, time.time() - start,
+                                      attempt, True)
+                    errors.append(sys.exc_info())
+                    raise
+                time.sleep(retry_interval * (2 ** attempt))
+                attempt += 1
+
+    if not reorder:
+        for obj in resources:
+            delete(obj)
+        return
+    resources = [obj for obj in resources if obj is not None]
+    if not resources:
+        return
+    graph = TaskGraph(workers=min(workers, len(resources)))
+    previous = []
+    index = 0
+    for level in _cleanup_order(resources):
+        current = []
+        serial = None
+        for obj in level:
+            inOrder = workers == 1 or \
+                obj.__class__.__name__ in CLEANUP_SERIAL_TYPES
+            task = graph.add(
+                "%d:%s:%s" % (index, obj.__class__.__name__,
+                              getattr(obj, "id", None)),
+                lambda obj=obj: delete(obj),
+                previous + [serial] if inOrder and serial else previous)
+            if inOrder:
+                serial = task
+            current.append(task)
+            index += 1
+        previous = current
+    graph.run()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
 
 
 def is_server_ssh_ready(ipaddress, port, username, password, retries=20, retryinterv=30, timeout=10.0, keyPairFileLocation=None):
@@ -346,7 +618,8 @@ def is_snapshot_on_nfs(apiclient, dbconn, config, zoneid, snapshotid):
             mgtSvr,
             22,
             user,
-            passwd
+            passwd,
+            pooled=True
         )
 
         pathSeparator = "" #used to form host:dir format
@@ -530,14 +803,14 @@ def wait_until(retry_interval=2, no_of_times=2, callback=None, *callback_args):
     if callback is None:
         raise ("Bad value for callback method !")
 
-    wait_result = False 
-    for i in range(0,no_of_times):
-        time.sleep(retry_interval)
+    def check():
         wait_result, return_val = callback(*callback_args)
         if not(isinstance(wait_result, bool)):
             raise ("Bad parameter returned from callback !")
-        if wait_result :
-            break
+        return wait_result, return_val
 
-    return wait_result, return_val
+    return poll(check, retry_interval * no_of_times,
+                maxInterval=retry_interval, initialInterval=retry_interval,
+                jitter=0, attempts=no_of_times,
+                name=getattr(callback, "__name__", None))
 
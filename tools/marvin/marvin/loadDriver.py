@@ -0,0 +1,344 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Holds N virtual users against a management server from one
+       thread, through the asynchronous API client (see asyncClient).
+       Every virtual user is a coroutine repeating a scenario for the
+       duration of the run. StubServer is a minimal management server
+       to measure the client side of the load generation locally
+       Usage : python -m marvin.loadDriver --users 1000 --duration 30
+'''
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import urlparse
+import uuid
+from optparse import OptionParser
+from marvin.apiInstrumentation import Histogram
+from marvin.asyncClient import (Reactor, AsyncConnection, Future, gather)
+from marvin.cloudstackAPI import (listZones, deployVirtualMachine)
+from marvin.cloudstackAPI.cloudstackAPIAsyncClient import \
+    CloudStackAPIAsyncClient
+from marvin.cloudstackConnection import CSConnection
+from marvin.configGenerator import getSetupConfig
+from marvin.jsonHelper import jsonLoader
+
+
+def defaultScenario(api, user, iteration):
+    '''
+    @Name : defaultScenario
+    @Desc : Lists the zones, then deploys a VM and waits for it
+    '''
+    zones = yield api.listZones(listZones.listZonesCmd())
+    cmd = deployVirtualMachine.deployVirtualMachineCmd()
+    cmd.zoneid = zones[0].id if zones else None
+    cmd.serviceofferingid = "load-offering"
+    cmd.templateid = "load-template"
+    yield api.deployVirtualMachine(cmd)
+
+
+class LoadDriver(object):
+
+    '''
+    @Desc : Runs virtual users on a reactor
+    @Input : connection : AsyncConnection
+             scenario : callable(api, user, iteration) returning the
+                        coroutine of one iteration of a virtual user
+             users : number of virtual users
+             duration : seconds during which iterations are started
+             rampUp : seconds over which the users are started
+             thinkTime : pause of a user between two iterations
+    '''
+
+    def __init__(self, connection, scenario=defaultScenario, users=100,
+                 duration=60, rampUp=0, thinkTime=0):
+        self.connection = connection
+        self.reactor = connection.reactor
+        self.api = CloudStackAPIAsyncClient(connection)
+        self.scenario = scenario
+        self.users = users
+        self.duration = duration
+        self.rampUp = rampUp
+        self.thinkTime = thinkTime
+        self.latency = Histogram()
+        self.iterations = 0
+        self.errors = 0
+        self.lastError = None
+        self.active = 0
+        self.peakActive = 0
+
+    def __user(self, index, deadline):
+        if self.rampUp:
+            yield self.reactor.sleep(self.rampUp * index / self.users)
+        iteration = 0
+        while time.time() < deadline:
+            started = time.time()
+            self.active += 1
+            self.peakActive = max(self.peakActive, self.active)
+            try:
+                yield self.reactor.spawn(self.scenario(self.api, index,
+                                                       iteration))
+                self.iterations += 1
+            except Exception as e:
+                self.errors += 1
+                self.lastError = e
+            finally:
+                self.active -= 1
+            self.latency.add(time.time() - started)
+            iteration += 1
+            if self.thinkTime:
+                yield self.reactor.sleep(
+                    self.thinkTime * random.uniform(0.5, 1.5))
+
+    def run(self):
+        '''
+        @Name : run
+        @Desc : Runs the users until the duration is over and the
+                iterations in progress are done
+        @Output : report of the run, see format
+        '''
+        started = time.time()
+        deadline = started + self.duration
+        users = [self.reactor.spawn(self.__user(index, deadline))
+                 for index in range(self.users)]
+        self.reactor.run(gather(users))
+        elapsed = time.time() - started
+        total = self.connection.stats.getTotal()
+        return {"users": self.users,
+                "peakActiveUsers": self.peakActive,
+                "elapsed": round(elapsed, 3),
+                "iterations": self.iterations,
+                "errors": self.errors,
+                "lastError": str(self.lastError) if self.lastError else None,
+                "iterationsPerSecond": round(self.iterations / elapsed, 3),
+                "apiCalls": total.calls,
+                "apiCallsPerSecond": round(total.calls / elapsed, 3),
+                "apiErrors": total.errors,
+                "iterationLatency": self.latency.toDict(),
+                "http": total.phases["http"].toDict(),
+                "pool": dict(self.connection.pool.stats)}
+
+    @staticmethod
+    def format(report):
+        latency = report["iterationLatency"]
+        lines = ["%(users)d users (peak %(peakActiveUsers)d active) for "
+                 "%(elapsed).1fs: %(iterations)d iterations "
+                 "(%(iterationsPerSecond).1f/s), %(errors)d errors, "
+                 "%(apiCalls)d API calls (%(apiCallsPerSecond).1f/s)" %
+                 report]
+        if latency["count"]:
+            lines.append("Iteration latency: mean %.3fs, p50 %.3fs, "
+                         "p90 %.3fs, p99 %.3fs, max %.3fs" %
+                         (latency["mean"], latency["p50"], latency["p90"],
+                          latency["p99"], latency["max"]))
+        lines.append("HTTP pool: %s" % report["pool"])
+        if report["lastError"]:
+            lines.append("Last error: %s" % report["lastError"])
+        return "\n".join(lines)
+
+
+class _StubConnection(object):
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.inbox = ""
+        self.outbox = ""
+        server.reactor.watch(sock, Reactor.READ | Reactor.ERROR,
+                             self.__onEvent)
+
+    def __close(self):
+        self.server.reactor.watch(self.sock, 0, None)
+        self.sock.close()
+
+    def __onEvent(self, event):
+        try:
+            if event & Reactor.WRITE and self.outbox:
+                self.outbox = self.outbox[self.sock.send(self.outbox):]
+                if not self.outbox:
+                    self.server.reactor.watch(
+                        self.sock, Reactor.READ | Reactor.ERROR,
+                        self.__onEvent)
+                return
+            chunk = self.sock.recv(65536)
+        except socket.error:
+            self.__close()
+            return
+        if not chunk:
+            self.__close()
+            return
+        self.inbox += chunk
+        while True:
+            end = self.inbox.find("\r\n\r\n")
+            if end < 0:
+                return
+            head = self.inbox[:end].split("\r\n")
+            length = 0
+            for line in head[1:]:
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            if len(self.inbox) < end + 4 + length:
+                return
+            body = self.inbox[end + 4:end + 4 + length]
+            self.inbox = self.inbox[end + 4 + length:]
+            url = urlparse.urlparse(head[0].split()[1])
+            params = dict(urlparse.parse_qsl(body or url.query))
+            self.server.reactor.callLater(self.server.latency,
+                                          self.__respond, params)
+
+    def __respond(self, params):
+        body = json.dumps(self.server.answer(params))
+        self.outbox += "HTTP/1.1 200 OK\r\nContent-Type: application/json" \
+                       "\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        self.server.reactor.watch(self.sock, Reactor.WRITE | Reactor.ERROR,
+                                  self.__onEvent)
+
+
+class StubServer(object):
+
+    '''
+    @Desc : Single threaded stand-in of a management server on
+            127.0.0.1, answering listZones, the VM life cycle commands
+            as async jobs taking jobDuration seconds, and the job
+            queries. Every request is answered after latency seconds
+    '''
+    ASYNC_COMMANDS = ("deployVirtualMachine", "destroyVirtualMachine",
+                      "startVirtualMachine", "stopVirtualMachine")
+
+    def __init__(self, jobDuration=1.0, latency=0.0):
+        self.jobDuration = jobDuration
+        self.latency = latency
+        self.reactor = Reactor()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1024)
+        self.sock.setblocking(0)
+        self.port = self.sock.getsockname()[1]
+        self.jobs = {}
+        self.requests = 0
+        self.__stopped = Future()
+        self.__thread = None
+
+    def start(self):
+        self.reactor.watch(self.sock, Reactor.READ, self.__accept)
+        self.__thread = threading.Thread(target=self.reactor.run,
+                                         args=(self.__stopped,),
+                                         name="StubServer")
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops the server thread, a connection wakes its reactor up
+        '''
+        self.reactor.callSoon(self.__stopped.set, None)
+        socket.create_connection(("127.0.0.1", self.port)).close()
+        self.__thread.join(10)
+        self.sock.close()
+
+    def __accept(self, event):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error:
+                return
+            sock.setblocking(0)
+            _StubConnection(self, sock)
+
+    def answer(self, params):
+        self.requests += 1
+        command = params.get("command", "")
+        name = command.lower() + "response"
+        now = time.time()
+        if command == "listZones":
+            return {name: {"count": 1, "zone": [{"id": "zone-1",
+                                                 "name": "zone1"}]}}
+        if command in StubServer.ASYNC_COMMANDS:
+            jobid = str(uuid.uuid4())
+            self.jobs[jobid] = now + self.jobDuration
+            return {name: {"jobid": jobid, "id": str(uuid.uuid4())}}
+        if command == "queryAsyncJobResult":
+            jobid = params.get("jobid")
+            done = self.jobs.get(jobid, 0) <= now
+            result = {"jobid": jobid, "jobstatus": 1 if done else 0}
+            if done:
+                self.jobs.pop(jobid, None)
+                result["jobresult"] = {"virtualmachine": {
+                    "id": jobid, "state": "Running"}}
+            return {name: result}
+        if command == "listAsyncJobs":
+            jobs = [{"jobid": jobid, "jobstatus": 1 if end <= now else 0}
+                    for jobid, end in self.jobs.iteritems()]
+            return {name: {"count": len(jobs), "asyncjobs": jobs}
+                    if jobs else {}}
+        return {name: {}}
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-u", "--users", type="int", default=100,
+                      dest="users", help="number of virtual users")
+    parser.add_option("-d", "--duration", type="float", default=30,
+                      dest="duration", help="seconds of load")
+    parser.add_option("--ramp-up", type="float", default=0, dest="rampUp",
+                      help="seconds over which the users are started")
+    parser.add_option("--think-time", type="float", default=0,
+                      dest="thinkTime",
+                      help="pause of a user between two iterations")
+    parser.add_option("--connections", type="int", default=100,
+                      dest="connections", help="HTTP connection pool size")
+    parser.add_option("-c", "--marvin-config", dest="configFile",
+                      default=None,
+                      help="load the management server of this config "
+                           "rather than a local stub")
+    parser.add_option("--job-duration", type="float", default=1.0,
+                      dest="jobDuration",
+                      help="seconds the stub takes to complete a job")
+    parser.add_option("--latency", type="float", default=0.0,
+                      dest="latency", help="response delay of the stub")
+    (options, args) = parser.parse_args(args)
+    stub = None
+    if options.configFile:
+        mgmtDetails = getSetupConfig(options.configFile).mgtSvr[0]
+    else:
+        stub = StubServer(options.jobDuration, options.latency).start()
+        mgmtDetails = jsonLoader({"mgtSvrIp": "127.0.0.1",
+                                  "port": stub.port,
+                                  "apiKey": "load", "securityKey": "load"})
+    reactor = Reactor()
+    connection = AsyncConnection(CSConnection(mgmtDetails),
+                                 reactor,
+                                 maxConnections=options.connections)
+    driver = LoadDriver(connection, users=options.users,
+                        duration=options.duration, rampUp=options.rampUp,
+                        thinkTime=options.thinkTime)
+    report = driver.run()
+    print LoadDriver.format(report)
+    print connection.stats.summary()
+    if stub is not None:
+        stub.stop()
+    return 0 if not report["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
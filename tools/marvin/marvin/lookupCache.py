@@ -0,0 +1,248 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Process wide cache of the lookups of slow changing infrastructure
+       objects (zones, domains, templates, service offerings) done by
+       the setUpClass of nearly every test through lib.common.
+       An entry is keyed by the management server, the api key of the
+       client and the lookup arguments, and lives for ttl seconds.
+       Every API call creating, updating or deleting an object of a
+       kind (EX: updateZone, registerTemplate) drops the entries of that
+       kind, whichever client made it; the API calls are only watched
+       for it once something may be cached. The callers get their own copy
+       of a cached object.
+       Opting out: use_cache=False on the lookup, lookupCache.bypass()
+       around the code changing these objects, or MARVIN_LOOKUP_CACHE=0
+'''
+import contextlib
+import copy
+import os
+import threading
+import time
+from marvin.apiInstrumentation import (instrumentation, InstrumentationHook)
+from marvin.codes import FAILED
+
+ZONE = "zone"
+DOMAIN = "domain"
+TEMPLATE = "template"
+SERVICE_OFFERING = "serviceOffering"
+
+'''
+The objects of a kind are changed by the API commands which are not
+lookups and whose name holds one of these words
+'''
+CHANGED_BY = {ZONE: ("Zone",),
+              DOMAIN: ("Domain",),
+              TEMPLATE: ("Template",),
+              SERVICE_OFFERING: ("ServiceOffering",)}
+LOOKUP_PREFIXES = ("list", "get", "query")
+
+
+class _Invalidator(InstrumentationHook):
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.__kinds = {}
+
+    def kinds(self, command):
+        kinds = self.__kinds.get(command)
+        if kinds is None:
+            kinds = ()
+            if not command.startswith(LOOKUP_PREFIXES):
+                kinds = tuple(kind for (kind, words) in CHANGED_BY.items()
+                              if [w for w in words if w in command])
+            self.__kinds[command] = kinds
+        return kinds
+
+    def callEnded(self, call):
+        '''
+        A failed call may still have changed the object, the entries
+        are dropped either way
+        '''
+        for kind in self.kinds(call.command):
+            self.cache.invalidate(kind, "api:%s" % call.command)
+
+
+class LookupCache(object):
+
+    '''
+    @Desc : TTL cache of lookup results, thread safe
+    @Input : ttl : seconds an entry lives
+             enabled : if False, every lookup goes to the server
+    '''
+
+    def __init__(self, ttl=300, enabled=True):
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__entries = {}
+        self.__stats = {}
+        self.__invalidator = _Invalidator(self)
+        self.__enabled = enabled
+
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    @enabled.setter
+    def enabled(self, enabled):
+        '''
+        The invalidator is registered by the first cached lookup, and
+        unregistered along with the entries when the cache is disabled:
+        the API calls are not instrumented for a disabled cache
+        '''
+        self.__enabled = enabled
+        if not enabled:
+            instrumentation.unregister(self.__invalidator)
+            self.invalidate()
+
+    def __kindStats(self, kind):
+        return self.__stats.setdefault(kind, {"hits": 0, "misses": 0,
+                                              "expired": 0, "bypassed": 0,
+                                              "invalidations": 0})
+
+    @staticmethod
+    def __clientKey(apiclient):
+        connection = getattr(apiclient, "connection", None)
+        return (getattr(connection, "baseUrl", None),
+                getattr(connection, "apiKey", None))
+
+    def get(self, apiclient, kind, args, loader, use_cache=True):
+        '''
+        @Name : get
+        @Desc : Returns a copy of the cached result of the lookup, else
+                calls loader and caches its result unless it is FAILED
+                or None
+        @Input : kind : ZONE, DOMAIN, TEMPLATE or SERVICE_OFFERING
+                 args : hashable arguments of the lookup
+                 loader : callable doing the lookup
+                 use_cache : False to go to the server, the result is
+                             not cached either
+        '''
+        if not (use_cache and self.enabled) or \
+                getattr(self.__local, "bypass", 0):
+            with self.__lock:
+                self.__kindStats(kind)["bypassed"] += 1
+            return loader()
+        instrumentation.register(self.__invalidator)
+        key = (kind, self.__clientKey(apiclient), args)
+        now = time.time()
+        with self.__lock:
+            stats = self.__kindStats(kind)
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    stats["hits"] += 1
+                    value = entry[2]
+                else:
+                    stats["expired"] += 1
+                    del self.__entries[key]
+                    entry = None
+            if entry is None:
+                stats["misses"] += 1
+                generation = self.__generation(kind)
+        if entry is not None:
+            return copy.deepcopy(value)
+        value = loader()
+        if value is None or value is FAILED:
+            return value
+        with self.__lock:
+            '''
+            Not cached if the kind was invalidated during the lookup
+            '''
+            if self.__generation(kind) == generation:
+                self.__entries[key] = (now + self.ttl, kind,
+                                       copy.deepcopy(value))
+        return value
+
+    def __generation(self, kind):
+        return self.__kindStats(kind)["invalidations"]
+
+    def invalidate(self, kind=None, reason=None):
+        '''
+        @Name : invalidate
+        @Desc : Drops the entries of a kind, of every kind if None
+        '''
+        with self.__lock:
+            for key in [k for k in self.__entries
+                        if kind is None or k[0] == kind]:
+                del self.__entries[key]
+            for name in [kind] if kind is not None else \
+                    list(set(self.__stats) | set(CHANGED_BY)):
+                self.__kindStats(name)["invalidations"] += 1
+
+    @contextlib.contextmanager
+    def bypass(self):
+        '''
+        @Name : bypass
+        @Desc : The lookups of the calling thread go to the server inside
+                the block, EX: with lookupCache.bypass(): ... ; the
+                changes made in the block still invalidate the entries
+        '''
+        self.__local.bypass = getattr(self.__local, "bypass", 0) + 1
+        try:
+            yield
+        finally:
+            self.__local.bypass -= 1
+
+    def getStats(self):
+        '''
+        @Name : getStats
+        @Desc : Per kind hits, misses, expired entries, bypassed lookups
+                and invalidations, along with the hit ratio
+        '''
+        with self.__lock:
+            stats = dict((kind, dict(values))
+                         for (kind, values) in self.__stats.items())
+            entries = len(self.__entries)
+        for values in stats.values():
+            lookups = values["hits"] + values["misses"]
+            values["hitRatio"] = round(float(values["hits"]) / lookups, 3) \
+                if lookups else None
+        return {"entries": entries, "kinds": stats}
+
+    def summary(self):
+        stats = self.getStats()
+        lines = ["Lookup cache: %d entries, ttl %ss%s" %
+                 (stats["entries"], self.ttl,
+                  "" if self.enabled else " (disabled)"),
+                 "%-18s %8s %8s %8s %8s %8s %8s" %
+                 ("Kind", "Hits", "Misses", "Expired", "Bypassed",
+                  "Invalid.", "Ratio")]
+        for kind in sorted(stats["kinds"]):
+            values = stats["kinds"][kind]
+            if not (values["hits"] or values["misses"] or
+                    values["bypassed"]):
+                continue
+            lines.append("%-18s %8d %8d %8d %8d %8d %8s" %
+                         (kind, values["hits"], values["misses"],
+                          values["expired"], values["bypassed"],
+                          values["invalidations"],
+                          "%.1f%%" % (values["hitRatio"] * 100)
+                          if values["hitRatio"] is not None else "-"))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self.__lock:
+            self.__entries = {}
+            self.__stats = {}
+
+
+lookupCache = LookupCache(
+    ttl=float(os.environ.get("MARVIN_LOOKUP_CACHE_TTL", 300)),
+    enabled=os.environ.get("MARVIN_LOOKUP_CACHE", "1").lower()
+    not in ("0", "false", "no"))
@@ -19,6 +19,7 @@ from sys import stdout, exit
 import logging
 import time
 import os
+import json
 import nose.core
 from marvin.cloudstackTestCase import cloudstackTestCase
 from marvin.marvinInit import MarvinInit
@@ -28,6 +29,10 @@ from marvin.codes import (SUCCESS,
                           EXCEPTION)
 from marvin.lib.utils import random_gen
 from marvin.cloudstackException import GetDetailExceptionInfo
+from marvin.testProfiler import (profiler, DurationStore, DurationReport)
+from marvin.apiInstrumentation import (instrumentation, ApiStats, ApiTracer)
+from marvin.lookupCache import lookupCache
+from marvin.lib.pools import pools
 
 
 class MarvinPlugin(Plugin):
@@ -68,6 +73,17 @@ class MarvinPlugin(Plugin):
         The Log Path provided by user where all logs are routed to
         '''
         self.__userLogPath = None
+        '''
+        Duration history database, see testProfiler
+        '''
+        self.__profileDb = None
+        self.__profile = True
+        '''
+        API call statistics and traces, see apiInstrumentation
+        '''
+        self.__apiStats = None
+        self.__apiTracer = None
+        self.__traceApi = False
         Plugin.__init__(self)
 
     def configure(self, options, conf):
@@ -86,6 +102,11 @@ class MarvinPlugin(Plugin):
         self.__zoneForTests = options.zone
         self.__hypervisorType = options.hypervisor_type
         self.__userLogPath = options.logFolder
+        self.__profileDb = options.profileDb
+        self.__profile = not options.noProfile
+        self.__traceApi = options.traceApi
+        if options.noLookupCache:
+            lookupCache.enabled = False
         self.conf = conf
         if self.startMarvin() == FAILED:
             print "\nStarting Marvin Failed, exiting. Please Check"
@@ -123,6 +144,27 @@ class MarvinPlugin(Plugin):
                           help="Collects all logs under the user specified"
                                "folder"
                           )
+        parser.add_option("--profile-db", action="store",
+                          default=env.get('MARVIN_PROFILE_DB'),
+                          dest="profileDb",
+                          help="SQLite database keeping the test and API "
+                               "call durations of the runs, defaults to "
+                               "marvin_durations.db under the log root")
+        parser.add_option("--no-profile", action="store_true",
+                          default=False,
+                          dest="noProfile",
+                          help="Does not record the test durations")
+        parser.add_option("--trace-api", action="store_true",
+                          default=False,
+                          dest="traceApi",
+                          help="Records a trace span per API call, nested "
+                               "under the test making it, exported to "
+                               "api_trace.json in the log folder")
+        parser.add_option("--no-lookup-cache", action="store_true",
+                          default=False,
+                          dest="noLookupCache",
+                          help="Does not cache the zone, domain, template "
+                               "and service offering lookups across tests")
         Plugin.options(self, parser, env)
 
     def wantClass(self, cls):
@@ -183,7 +225,9 @@ class MarvinPlugin(Plugin):
         if self.__tcRunLogger:
             self.__tcRunLogger.debug("::::::::::::STARTED : TC: " +
                                      str(self.__testName) + " :::::::::::")
+        self.__testResult = SUCCESS
         self.__startTime = time.time()
+        profiler.startTest(test.id())
 
     def printMsg(self, status, tname, err):
         if status in [FAILED, EXCEPTION] and self.__tcRunLogger:
@@ -200,7 +244,7 @@ class MarvinPlugin(Plugin):
         Adds the Success Messages to logs
         '''
         self.printMsg(SUCCESS, self.__testName, "Test Case Passed")
-        self.__testresult = SUCCESS
+        self.__testResult = SUCCESS
 
     def handleError(self, test, err):
         '''
@@ -247,6 +291,10 @@ class MarvinPlugin(Plugin):
                                    descriptions=True,
                                    verbosity=2,
                                    config=self.conf)
+                self.__startProfiler()
+                self.__apiStats = instrumentation.register(ApiStats())
+                if self.__traceApi:
+                    self.__apiTracer = instrumentation.register(ApiTracer())
                 return SUCCESS
             return FAILED
         except Exception as e:
@@ -254,11 +302,72 @@ class MarvinPlugin(Plugin):
                   GetDetailExceptionInfo(e)
             return FAILED
 
+    def __getLogRoot(self):
+        if self.__userLogPath:
+            return self.__userLogPath + "/MarvinLogs"
+        log_cfg = self.__parsedConfig.logger
+        return log_cfg.__dict__.get('LogFolderPath') + "/MarvinLogs"
+
+    def __startProfiler(self):
+        '''
+        @Name : __startProfiler
+        @Desc : Opens the duration history and starts recording the
+                run, the tests still run if the database can not be used
+        '''
+        if not self.__profile:
+            return
+        try:
+            path = self.__profileDb or \
+                os.path.join(self.__getLogRoot(), "marvin_durations.db")
+            profiler.startRun(DurationStore(path),
+                              label=os.path.basename(
+                                  str(self.__logFolderPath)))
+        except Exception as e:
+            print "=== Test durations will not be recorded: %s ===" % \
+                  GetDetailExceptionInfo(e)
+
+    def __stopProfiler(self):
+        store = profiler.store
+        if store is None:
+            return
+        try:
+            runId = profiler.endRun()
+            report = DurationReport(store).format(runId, top=10)
+            self.__resultStream.write(report + "\n")
+            print report
+            print "===test durations are recorded in: %s===" % store.path
+        finally:
+            store.close()
+
+    def __exportApiStats(self):
+        '''
+        @Name : __exportApiStats
+        @Desc : Prints the API call summary of the run and saves the
+                statistics (and the trace) in the log folder
+        '''
+        for hook in (self.__apiStats, self.__apiTracer):
+            if hook is not None:
+                instrumentation.unregister(hook)
+        if self.__apiStats is None:
+            return
+        summary = self.__apiStats.summary() + "\n" + lookupCache.summary()
+        self.__resultStream.write(summary + "\n")
+        print summary
+        folder = str(self.__logFolderPath)
+        self.__apiStats.exportJson(os.path.join(folder, "api_stats.json"))
+        self.__apiStats.exportCsv(os.path.join(folder, "api_stats.csv"))
+        with open(os.path.join(folder, "lookup_cache.json"), "w") as fp:
+            json.dump(lookupCache.getStats(), fp, indent=2, sort_keys=True)
+        if self.__apiTracer is not None:
+            self.__apiTracer.exportJson(os.path.join(folder,
+                                                     "api_trace.json"))
+
     def stopTest(self, test):
         """
         Currently used to record end time for tests
         """
         endTime = time.time()
+        profiler.stopTest(self.__testResult)
         if self.__startTime:
             totTime = int(endTime - self.__startTime)
             if self.__tcRunLogger:
@@ -288,14 +397,27 @@ class MarvinPlugin(Plugin):
                                                test.AcctType)
 
     def finalize(self, result):
+        try:
+            summary = pools.summary(pools.closeAll())
+            if summary:
+                self.__resultStream.write(summary + "\n")
+                print summary
+        except Exception as e:
+            print "=== Exception occurred while destroying the fixture " \
+                  "pools :%s ===" % str(GetDetailExceptionInfo(e))
+        try:
+            self.__stopProfiler()
+        except Exception as e:
+            print "=== Exception occurred while saving the test durations " \
+                  ":%s ===" % str(GetDetailExceptionInfo(e))
+        try:
+            self.__exportApiStats()
+        except Exception as e:
+            print "=== Exception occurred while saving the API statistics " \
+                  ":%s ===" % str(GetDetailExceptionInfo(e))
         try:
             src = self.__logFolderPath
-            tmp = ''
-            if not self.__userLogPath:
-                log_cfg = self.__parsedConfig.logger
-                tmp = log_cfg.__dict__.get('LogFolderPath') + "/MarvinLogs"
-            else:
-                tmp = self.__userLogPath + "/MarvinLogs"
+            tmp = self.__getLogRoot()
             dst = tmp + "//" + random_gen()
             mod_name = "test_suite"
             if self.__testModName:
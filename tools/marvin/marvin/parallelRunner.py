@@ -0,0 +1,463 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Runs marvin test classes in parallel shards.
+       Test classes are found without importing the test modules, the
+       nose attribute filters (EX: required_hardware=false) are applied
+       and the classes are spread over worker processes so that every
+       shard gets the same expected run time, based on the durations
+       recorded in previous xunit reports. Every shard is a separate
+       nose process with the marvin plugin, hence its own CSTestClient
+       and log folder. The xunit reports of the shards are merged into
+       one report, which also serves as history for the next run.
+'''
+import ast
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+from xml.etree import ElementTree
+from marvin.codes import (SUCCESS, FAILED)
+
+
+class TestClassSpec(object):
+
+    '''
+    @Desc : A test class found in a test module
+            path : file of the module
+            name : class name
+            tests : {test method name : nose attributes of the method}
+    '''
+
+    def __init__(self, path, name, attrs, tests):
+        self.path = path
+        self.name = name
+        self.attrs = attrs
+        self.tests = tests
+        self.module = os.path.splitext(os.path.basename(path))[0]
+        self.duration = None
+
+    @property
+    def key(self):
+        return "%s.%s" % (self.module, self.name)
+
+    @property
+    def selector(self):
+        return "%s:%s" % (self.path, self.name)
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def _noseAttrs(decorators):
+    '''
+    Attributes set with nose.plugins.attrib.attr, EX:
+    @attr(tags=["advanced"], required_hardware="false") or @attr("slow")
+    '''
+    attrs = {}
+    for dec in decorators:
+        if not isinstance(dec, ast.Call):
+            continue
+        func = dec.func
+        name = func.attr if isinstance(func, ast.Attribute) else \
+            getattr(func, "id", None)
+        if name != "attr":
+            continue
+        for arg in dec.args:
+            value = _literal(arg)
+            if isinstance(value, basestring):
+                attrs[value] = True
+        for keyword in dec.keywords:
+            attrs[keyword.arg] = _literal(keyword.value)
+    return attrs
+
+
+def discoverTestClasses(paths, baseClasses=("cloudstackTestCase",)):
+    '''
+    @Name : discoverTestClasses
+    @Desc : Finds the test classes of the test modules under paths by
+            parsing them, the modules are not imported
+    @Input : paths : test module files or folders holding them
+             baseClasses : names of the base classes of the test classes
+    @Output : list of TestClassSpec
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name)
+                             for name in sorted(names)
+                             if name.startswith("test") and
+                             name.endswith(".py"))
+        elif os.path.isfile(path):
+            files.append(path)
+    specs = []
+    for path in files:
+        try:
+            with open(path) as f:
+                tree = ast.parse(f.read(), path)
+        except SyntaxError as e:
+            print "==== Skipping %s: %s ====" % (path, e)
+            continue
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            bases = [b.attr if isinstance(b, ast.Attribute) else
+                     getattr(b, "id", None) for b in node.bases]
+            if not set(bases) & set(baseClasses):
+                continue
+            tests = {}
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and \
+                        item.name.startswith("test"):
+                    tests[item.name] = _noseAttrs(item.decorator_list)
+            if tests:
+                specs.append(TestClassSpec(path, node.name,
+                                           _noseAttrs(node.decorator_list),
+                                           tests))
+    return specs
+
+
+class AttrFilter(object):
+
+    '''
+    @Desc : Subset of the nose attrib plugin selection, used to leave
+            out the classes which would run no test
+            exprs : values given to -a; within one value the key=value
+                    conditions separated by commas must all hold, a test
+                    is selected if any of the values matches
+    '''
+
+    def __init__(self, exprs):
+        self.groups = []
+        for expr in exprs or []:
+            conditions = []
+            for cond in expr.split(","):
+                cond = cond.strip()
+                if not cond:
+                    continue
+                negate = cond.startswith("!")
+                cond = cond.lstrip("!")
+                key, sep, value = cond.partition("=")
+                conditions.append((key.strip(), value.strip() if sep
+                                   else None, negate))
+            if conditions:
+                self.groups.append(conditions)
+
+    @staticmethod
+    def __holds(attrs, key, value, negate):
+        actual = attrs.get(key)
+        if value is None:
+            found = bool(actual)
+        elif isinstance(actual, (list, tuple)):
+            found = value.lower() in [str(v).lower() for v in actual]
+        else:
+            found = actual is not None and \
+                str(actual).lower() == value.lower()
+        return found != negate
+
+    def matches(self, attrs):
+        if not self.groups:
+            return True
+        return any(all(self.__holds(attrs, *cond) for cond in group)
+                   for group in self.groups)
+
+    def selectedTests(self, spec):
+        selected = []
+        for test, attrs in sorted(spec.tests.items()):
+            merged = dict(spec.attrs)
+            merged.update(attrs)
+            if self.matches(merged):
+                selected.append(test)
+        return selected
+
+
+def loadDurations(xunitFiles):
+    '''
+    @Name : loadDurations
+    @Desc : Sums the recorded test times per test class
+    @Input : xunitFiles : xunit reports of previous runs, missing or
+                          unreadable ones are ignored
+    @Output : {"module.Class" : seconds}, the most recent report wins
+    '''
+    durations = {}
+    for path in xunitFiles:
+        if not path or not os.path.isfile(path):
+            continue
+        try:
+            root = ElementTree.parse(path).getroot()
+        except Exception as e:
+            print "==== Ignoring history %s: %s ====" % (path, e)
+            continue
+        report = {}
+        for case in root.iter("testcase"):
+            parts = case.get("classname", "").split(".")
+            if len(parts) < 2:
+                continue
+            key = "%s.%s" % (parts[-2], parts[-1])
+            report[key] = report.get(key, 0.0) + \
+                float(case.get("time") or 0)
+        durations.update(report)
+    return durations
+
+
+def planShards(specs, workers, durations, defaultDuration=None):
+    '''
+    @Name : planShards
+    @Desc : Spreads the test classes over the shards, longest first, each
+            class going to the shard with the least expected time
+    @Input : defaultDuration : expected time of the classes without
+                               history, defaults to the median of the
+                               known ones (60 seconds without history)
+    @Output : list of (expected seconds, [TestClassSpec])
+    '''
+    known = sorted(durations[s.key] for s in specs if s.key in durations)
+    if defaultDuration is None:
+        defaultDuration = known[len(known) / 2] if known else 60.0
+    for spec in specs:
+        spec.duration = durations.get(spec.key, defaultDuration)
+    shards = [[0.0, []] for i in range(max(min(workers, len(specs)), 1))]
+    for spec in sorted(specs, key=lambda s: (-s.duration, s.key)):
+        shard = min(shards, key=lambda s: s[0])
+        shard[0] += spec.duration
+        shard[1].append(spec)
+    return [(expected, classes) for (expected, classes) in shards
+            if classes]
+
+
+def mergeXunit(reports, output):
+    '''
+    @Name : mergeXunit
+    @Desc : Writes one xunit report holding the test cases of all the
+            reports, the totals are recomputed
+    @Output : totals of the merged report
+    '''
+    merged = ElementTree.Element("testsuite", name="nosetests")
+    totals = {"tests": 0, "errors": 0, "failures": 0, "skip": 0}
+    for path in reports:
+        if not os.path.isfile(path):
+            continue
+        try:
+            root = ElementTree.parse(path).getroot()
+        except Exception as e:
+            print "==== Unreadable xunit report %s: %s ====" % (path, e)
+            continue
+        for case in root.iter("testcase"):
+            merged.append(case)
+            totals["tests"] += 1
+            if case.find("error") is not None:
+                totals["errors"] += 1
+            elif case.find("failure") is not None:
+                totals["failures"] += 1
+            elif case.find("skipped") is not None:
+                totals["skip"] += 1
+    for key, value in totals.items():
+        merged.set(key, str(value))
+    folder = os.path.dirname(os.path.abspath(output))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    ElementTree.ElementTree(merged).write(output, encoding="UTF-8",
+                                          xml_declaration=True)
+    return totals
+
+
+class ParallelRunner(object):
+
+    '''
+    @Desc : Runs test classes in parallel nose processes
+    @Input : configFile : marvin config file
+             paths : test modules or folders of test modules
+             workers : number of shards
+             logFolder : root folder, each shard logs under
+                         <logFolder>/shard-<n>, the shards share the
+                         duration history <logFolder>/marvin_durations.db
+             attrs : nose -a selections, EX: ["tags=advanced,
+                     required_hardware=false"]
+             xunitFile : merged report, defaults to
+                         <logFolder>/xunit.xml
+             history : earlier xunit reports used to balance the shards,
+                       the previous merged report is always used
+             zone, hypervisor : passed on to the marvin plugin
+             deploy : deploys the data center once before the shards run
+             noseArgs : extra arguments for every nose process
+    '''
+
+    def __init__(self, configFile, paths, workers=4, logFolder=None,
+                 attrs=None, xunitFile=None, history=None, zone=None,
+                 hypervisor=None, deploy=False, noseArgs=None):
+        self.configFile = configFile
+        self.paths = paths
+        self.workers = max(int(workers), 1)
+        self.logFolder = os.path.abspath(
+            logFolder or "/tmp/MarvinParallel-%s" %
+            time.strftime("%b_%d_%Y_%H_%M_%S"))
+        self.attrs = attrs or []
+        self.xunitFile = xunitFile or os.path.join(self.logFolder,
+                                                   "xunit.xml")
+        self.history = list(history or [])
+        if self.xunitFile not in self.history:
+            self.history.append(self.xunitFile)
+        self.zone = zone
+        self.hypervisor = hypervisor
+        self.deploy = deploy
+        self.noseArgs = noseArgs or []
+        self.shards = []
+
+    def plan(self):
+        '''
+        @Name : plan
+        @Desc : Finds the test classes running at least one test under
+                the attribute selection and shards them
+        '''
+        selection = AttrFilter(self.attrs)
+        specs = [spec for spec in discoverTestClasses(self.paths)
+                 if selection.selectedTests(spec)]
+        self.shards = planShards(specs, self.workers,
+                                 loadDurations(self.history))
+        return self.shards
+
+    def __noseCommand(self, index, classes):
+        folder = os.path.join(self.logFolder, "shard-%d" % index)
+        cmd = [sys.executable, "-m", "nose", "--with-marvin",
+               "--marvin-config=%s" % self.configFile,
+               "--log-folder-path=%s" % folder,
+               "--profile-db=%s" % os.path.join(self.logFolder,
+                                                "marvin_durations.db"),
+               "--with-xunit",
+               "--xunit-file=%s" % os.path.join(folder, "xunit.xml")]
+        for attr in self.attrs:
+            cmd.extend(["-a", attr])
+        if self.zone:
+            cmd.append("--zone=%s" % self.zone)
+        if self.hypervisor:
+            cmd.append("--hypervisor=%s" % self.hypervisor)
+        cmd.extend(self.noseArgs)
+        cmd.extend(spec.selector for spec in classes)
+        return folder, cmd
+
+    def run(self):
+        '''
+        @Name : run
+        @Desc : Runs the shards and merges their reports
+        @Output : SUCCESS if every shard passed else FAILED
+        '''
+        if not self.shards:
+            self.plan()
+        if not self.shards:
+            print "==== No test class to run ===="
+            return FAILED
+        if self.deploy:
+            print "==== Deploying the data center ===="
+            if subprocess.call([sys.executable, "-m",
+                                "marvin.deployDataCenter",
+                                "-i", self.configFile]) != 0:
+                print "==== Deploy failed, not running the tests ===="
+                return FAILED
+        running = []
+        for index, (expected, classes) in enumerate(self.shards):
+            folder, cmd = self.__noseCommand(index, classes)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            out = open(os.path.join(folder, "nose.out"), "w")
+            print "==== Shard %d: %d classes, expected %.0fs ====" % \
+                  (index, len(classes), expected)
+            running.append({"index": index, "expected": expected,
+                            "classes": len(classes),
+                            "xunit": os.path.join(folder, "xunit.xml"),
+                            "out": out, "start": time.time(),
+                            "proc": subprocess.Popen(
+                                cmd, stdout=out,
+                                stderr=subprocess.STDOUT)})
+        start = time.time()
+        for shard in running:
+            shard["rc"] = shard["proc"].wait()
+            shard["took"] = time.time() - shard["start"]
+            shard["out"].close()
+        took = time.time() - start
+        totals = mergeXunit([shard["xunit"] for shard in running],
+                            self.xunitFile)
+        print "\n%-6s %8s %12s %10s %4s" % ("Shard", "Classes",
+                                            "Expected(s)", "Took(s)", "RC")
+        for shard in running:
+            print "%-6d %8d %12.0f %10.1f %4d" % \
+                  (shard["index"], shard["classes"], shard["expected"],
+                   shard["took"], shard["rc"])
+        print "==== %d tests, %d errors, %d failures, %d skipped in " \
+              "%.1fs; merged report: %s ====" % \
+              (totals["tests"], totals["errors"], totals["failures"],
+               totals["skip"], took, self.xunitFile)
+        if any(shard["rc"] != 0 for shard in running):
+            return FAILED
+        return SUCCESS
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options] <test module or folder>...")
+    parser.add_option("-c", "--marvin-config", dest="configFile",
+                      default=os.environ.get("MARVIN_CONFIG",
+                                             "./datacenter.cfg"),
+                      help="marvin config file")
+    parser.add_option("-n", "--workers", type="int", default=4,
+                      dest="workers", help="number of parallel shards")
+    parser.add_option("-a", "--attr", action="append", default=[],
+                      dest="attrs",
+                      help="nose attribute selection, EX: "
+                           "tags=advanced,required_hardware=false")
+    parser.add_option("--log-folder-path", dest="logFolder", default=None,
+                      help="root folder of the shard logs")
+    parser.add_option("--xunit-file", dest="xunitFile", default=None,
+                      help="merged xunit report")
+    parser.add_option("--history", action="append", default=[],
+                      dest="history",
+                      help="xunit report of an earlier run used to "
+                           "balance the shards")
+    parser.add_option("--zone", dest="zone", default=None)
+    parser.add_option("--hypervisor", dest="hypervisor", default=None)
+    parser.add_option("--deploy", action="store_true", default=False,
+                      dest="deploy", help="deploy the data center first")
+    parser.add_option("--dry-run", action="store_true", default=False,
+                      dest="dryRun", help="only print the shards")
+    (options, paths) = parser.parse_args(args)
+    if not paths:
+        parser.error("no test module or folder given")
+    runner = ParallelRunner(options.configFile, paths,
+                            workers=options.workers,
+                            logFolder=options.logFolder,
+                            attrs=options.attrs,
+                            xunitFile=options.xunitFile,
+                            history=options.history,
+                            zone=options.zone,
+                            hypervisor=options.hypervisor,
+                            deploy=options.deploy)
+    shards = runner.plan()
+    if options.dryRun:
+        for index, (expected, classes) in enumerate(shards):
+            print "Shard %d (expected %.0fs):" % (index, expected)
+            for spec in classes:
+                print "    %s (%.0fs)" % (spec.selector, spec.duration)
+        return 0
+    return 0 if runner.run() == SUCCESS else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
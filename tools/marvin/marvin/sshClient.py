@@ -19,10 +19,10 @@ from paramiko import (BadHostKeyException,
                       AuthenticationException,
                       SSHException,
                       SSHClient,
-                      AutoAddPolicy,
-                      Transport,
-                      SFTPClient)
+                      AutoAddPolicy)
+import atexit
 import socket
+import threading
 import time
 from marvin.cloudstackException import (
     internalError,
@@ -33,6 +33,183 @@ import logging
 from marvin.codes import (
     SUCCESS, FAILED, INVALID_INPUT
 )
+from marvin.testProfiler import (profiler, SSH)
+
+
+class SshSession(object):
+
+    '''
+    @Desc : One authenticated SSH connection, shared through
+            SshSessionPool by the SshClient objects using the same
+            host, port, user and credentials. Every command runs on its
+            own channel, so the users of a session can run commands and
+            SFTP transfers concurrently over the single transport
+    '''
+
+    def __init__(self, key, ssh):
+        self.key = key
+        self.ssh = ssh
+        self.refs = 0
+        self.broken = False
+        self.lastUsed = time.time()
+
+    def isAlive(self, timeout):
+        '''
+        @Name : isAlive
+        @Desc : Checks the transport is still usable by opening a
+                channel on it, a round trip instead of a new handshake
+        '''
+        transport = self.ssh.get_transport()
+        if self.broken or transport is None or not transport.is_active():
+            return False
+        try:
+            try:
+                channel = transport.open_session(timeout=timeout)
+            except TypeError:
+                '''
+                paramiko releases before 1.15 take no timeout
+                '''
+                channel = transport.open_session()
+            channel.close()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.ssh.close()
+        except Exception:
+            pass
+
+
+class SshSessionPool(object):
+
+    '''
+    @Desc : Process wide pool of authenticated SSH sessions keyed by
+            (host, port, user, password, key files).
+            idleTimeout : seconds after which an unused session is closed
+            checkAfter : seconds of inactivity after which a session is
+                         probed before being handed out again, so that
+                         sessions to rebooted or destroyed guests are
+                         replaced by a fresh connection
+    '''
+    idleTimeout = 300
+    checkAfter = 5
+    __sessions = {}
+    __lock = threading.Lock()
+    __stats = {"connects": 0, "reused": 0, "evictions": 0, "broken": 0}
+
+    @classmethod
+    def __evictIdle(cls, now):
+        '''
+        Unregisters the idle sessions nobody uses, caller holds the lock
+        and closes the returned sessions once it is released
+        '''
+        idle = [session for session in cls.__sessions.values()
+                if session.refs == 0 and
+                now - session.lastUsed > cls.idleTimeout]
+        for session in idle:
+            del cls.__sessions[session.key]
+            cls.__stats["evictions"] += 1
+        return idle
+
+    @classmethod
+    def acquire(cls, key, timeout):
+        '''
+        @Name : acquire
+        @Desc : Returns a live pooled session for key, None when a new
+                connection has to be established and registered
+        '''
+        now = time.time()
+        with cls.__lock:
+            idle = cls.__evictIdle(now)
+            session = cls.__sessions.get(key)
+            if session is not None:
+                session.refs += 1
+        for stale in idle:
+            stale.close()
+        if session is None:
+            return None
+        if now - session.lastUsed > cls.checkAfter and \
+                not session.isAlive(timeout):
+            cls.invalidate(session)
+            cls.release(session)
+            return None
+        session.lastUsed = now
+        with cls.__lock:
+            cls.__stats["reused"] += 1
+        return session
+
+    @classmethod
+    def register(cls, key, ssh):
+        '''
+        @Name : register
+        @Desc : Adds a freshly connected SSHClient to the pool
+        @Output : SshSession holding a reference for the caller
+        '''
+        session = SshSession(key, ssh)
+        session.refs = 1
+        with cls.__lock:
+            cls.__sessions[key] = session
+            cls.__stats["connects"] += 1
+        return session
+
+    @classmethod
+    def release(cls, session):
+        '''
+        @Name : release
+        @Desc : Drops a reference on the session. The session stays open
+                for reuse unless it is broken or was replaced in the pool
+        '''
+        with cls.__lock:
+            session.refs -= 1
+            session.lastUsed = time.time()
+            close = session.refs <= 0 and \
+                cls.__sessions.get(session.key) is not session
+        if close:
+            session.close()
+
+    @classmethod
+    def invalidate(cls, session):
+        '''
+        @Name : invalidate
+        @Desc : Removes a broken session from the pool, it is closed
+                once its last user releases it
+        '''
+        with cls.__lock:
+            session.broken = True
+            if cls.__sessions.get(session.key) is session:
+                del cls.__sessions[session.key]
+                cls.__stats["broken"] += 1
+            close = session.refs <= 0
+        if close:
+            session.close()
+
+    @classmethod
+    def closeAll(cls):
+        '''
+        @Name : closeAll
+        @Desc : Closes every pooled session
+        '''
+        with cls.__lock:
+            sessions = cls.__sessions.values()
+            cls.__sessions.clear()
+        for session in sessions:
+            session.close()
+
+    @classmethod
+    def getStats(cls):
+        '''
+        @Name : getStats
+        @Desc : Returns the connection/reuse/eviction counters of the pool
+        '''
+        with cls.__lock:
+            stats = dict(cls.__stats)
+            stats["sessions"] = len(cls.__sessions)
+        return stats
+
+
+atexit.register(SshSessionPool.closeAll)
 
 
 class SshClient(object):
@@ -46,17 +223,28 @@ class SshClient(object):
             passwd: Password for connection
             retries and delay applies for establishing connection
             timeout : Applies while executing command
+            pooled : Reuse the authenticated session already open to
+                     the same host with the same credentials, if any,
+                     see SshSessionPool. Off by default: a pooled
+                     client may succeed on a session opened before the
+                     path to the host was removed (EX: a deleted NAT
+                     rule), which the negative tests expect to fail.
+                     Only ask for it to reach hosts which stay
+                     reachable, such as management servers and
+                     hypervisors
     '''
 
     def __init__(self, host, port, user, passwd, retries=60, delay=10,
-                 log_lvl=logging.DEBUG, keyPairFiles=None, timeout=10.0):
+                 log_lvl=logging.DEBUG, keyPairFiles=None, timeout=10.0,
+                 pooled=False):
         self.host = None
         self.port = 22
         self.user = user
         self.passwd = passwd
         self.keyPairFiles = keyPairFiles
-        self.ssh = SSHClient()
-        self.ssh.set_missing_host_key_policy(AutoAddPolicy())
+        self.pooled = pooled
+        self.__session = None
+        self.ssh = None
         self.logger = logging.getLogger('sshClient')
         self.retryCnt = 0
         self.delay = 0
@@ -77,13 +265,49 @@ class SshClient(object):
             self.timeout = timeout
         if port is not None and port >= 0:
             self.port = port
+        with profiler.span(SSH):
+            connected = self.createConnection()
+        if connected == FAILED:
+            raise internalError("SSH Connection Failed")
+
+    def __poolKey(self):
+        keyFiles = self.keyPairFiles
+        if isinstance(keyFiles, list):
+            keyFiles = tuple(keyFiles)
+        return (self.host, int(self.port), self.user, self.passwd, keyFiles)
+
+    def __reconnect(self):
+        '''
+        Replaces a pooled session found broken while in use
+        '''
+        self.logger.debug("===SSH session to Host %s port : %s is broken, "
+                          "reconnecting===" % (str(self.host),
+                                               str(self.port)))
+        SshSessionPool.invalidate(self.__session)
+        SshSessionPool.release(self.__session)
+        self.__session = None
         if self.createConnection() == FAILED:
             raise internalError("SSH Connection Failed")
 
+    def __withSession(self, operation):
+        '''
+        Runs operation(ssh), retrying once on a fresh connection when
+        the pooled session turns out to be broken
+        '''
+        try:
+            return operation(self.ssh)
+        except (SSHException, socket.error, EOFError):
+            if self.__session is None:
+                raise
+            self.__reconnect()
+            return operation(self.ssh)
+
     def execute(self, command):
-        stdin, stdout, stderr = self.ssh.exec_command(command)
-        output = stdout.readlines()
-        errors = stderr.readlines()
+        with profiler.span(SSH):
+            stdin, stdout, stderr = self.__withSession(
+                lambda ssh: ssh.exec_command(command))
+            output = stdout.readlines()
+            errors = stderr.readlines()
         results = []
         if output is not None and len(output) == 0:
             if errors is not None and len(errors) > 0:
@@ -107,6 +331,17 @@ class SshClient(object):
         '''
         ret = FAILED
         except_msg = ''
+        if self.pooled:
+            self.__session = SshSessionPool.acquire(self.__poolKey(),
+                                                    self.timeout)
+            if self.__session is not None:
+                self.ssh = self.__session.ssh
+                self.logger.debug("===Reusing SSH session to Host %s "
+                                  "port : %s===" % (str(self.host),
+                                                    str(self.port)))
+                return SUCCESS
+        self.ssh = SSHClient()
+        self.ssh.set_missing_host_key_policy(AutoAddPolicy())
         while self.retryCnt >= 0:
             try:
                 self.logger.debug("====Trying SSH Connection: Host:%s User:%s\
@@ -130,6 +365,9 @@ class SshClient(object):
                                      )
                 self.logger.debug("===SSH to Host %s port : %s SUCCESSFUL==="
                                   % (str(self.host), str(self.port)))
+                if self.pooled:
+                    self.__session = SshSessionPool.register(
+                        self.__poolKey(), self.ssh)
                 ret = SUCCESS
                 break
             except BadHostKeyException as e:
@@ -170,15 +408,17 @@ class SshClient(object):
             return ret
         try:
             status_check = 1
-            stdin, stdout, stderr = self.ssh.\
-                exec_command(command, timeout=self.timeout)
-            if stdout is not None:
-                status_check = stdout.channel.recv_exit_status()
-                if status_check == 0:
-                    ret["status"] = SUCCESS
-                ret["stdout"] = stdout.readlines()
-                if stderr is not None:
-                    ret["stderr"] = stderr.readlines()
+            with profiler.span(SSH):
+                stdin, stdout, stderr = self.__withSession(
+                    lambda ssh: ssh.exec_command(command,
+                                                 timeout=self.timeout))
+                if stdout is not None:
+                    status_check = stdout.channel.recv_exit_status()
+                    if status_check == 0:
+                        ret["status"] = SUCCESS
+                    ret["stdout"] = stdout.readlines()
+                    if stderr is not None:
+                        ret["stderr"] = stderr.readlines()
         except Exception as e:
             ret["stderr"] = GetDetailExceptionInfo(e)
             self.logger.exception("SshClient: Exception under runCommand :%s" %
@@ -189,11 +429,20 @@ class SshClient(object):
             return ret
 
     def scp(self, srcFile, destPath):
-        transport = Transport((self.host, int(self.port)))
-        transport.connect(username=self.user, password=self.passwd)
-        sftp = SFTPClient.from_transport(transport)
+        '''
+        @Name: scp
+        @Desc: Copies srcFile to destPath over an SFTP channel of the
+               existing session, no new connection is made
+        '''
+        def put(ssh):
+            sftp = ssh.open_sftp()
+            try:
+                sftp.put(srcFile, destPath)
+            finally:
+                sftp.close()
         try:
-            sftp.put(srcFile, destPath)
+            with profiler.span(SSH):
+                self.__withSession(put)
         except IOError as e:
             raise e
 
@@ -201,13 +450,152 @@ class SshClient(object):
         self.close()
 
     def close(self):
-        if self.ssh is not None:
+        if self.__session is not None:
+            SshSessionPool.release(self.__session)
+            self.__session = None
+            self.ssh = None
+        elif self.ssh is not None:
             self.ssh.close()
             self.ssh = None
 
 
 if __name__ == "__main__":
-    with contextlib.closing(SshClient("127.0.0.1", 22, "root",
-                                      "asdf!@34")) as ssh:
-        ret = ssh.runCommand("ls -l")
-        print ret
+    '''
+    python sshClient.py runs a command on the local sshd, with --stub
+    it compares fresh connections against pooled sessions using an in
+    process paramiko server answering exec and sftp requests
+    '''
+    import optparse
+    import os
+    import shutil
+    import tempfile
+    import paramiko
+
+    parser = optparse.OptionParser()
+    parser.add_option("--stub", action="store_true", dest="stub",
+                      default=False, help="benchmark against a local "
+                      "paramiko server instead of the local sshd")
+    parser.add_option("-n", "--commands", dest="commands", type="int",
+                      default=50, help="commands run per scenario")
+    (options, args) = parser.parse_args()
+
+    if not options.stub:
+        with contextlib.closing(SshClient("127.0.0.1", 22, "root",
+                                          "asdf!@34")) as ssh:
+            ret = ssh.runCommand("ls -l")
+            print ret
+        raise SystemExit(0)
+
+    root = tempfile.mkdtemp()
+    hostKey = paramiko.RSAKey.generate(1024)
+    handshakes = []
+
+    class StubServer(paramiko.ServerInterface):
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def get_allowed_auths(self, username):
+            return "password"
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+        def check_channel_exec_request(self, channel, command):
+            def run():
+                '''
+                Let paramiko acknowledge the exec request first
+                '''
+                time.sleep(0.005)
+                channel.sendall("ran: %s\n" % command)
+                channel.send_exit_status(0)
+                channel.close()
+            threading.Thread(target=run).start()
+            return True
+
+    class StubHandle(paramiko.SFTPHandle):
+
+        def stat(self):
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.writefile.fileno()))
+
+    class StubSftp(paramiko.SFTPServerInterface):
+
+        def __path(self, path):
+            return os.path.join(root, os.path.basename(path))
+
+        def open(self, path, flags, attr):
+            handle = StubHandle(flags)
+            handle.writefile = handle.readfile = open(self.__path(path),
+                                                      "w+b")
+            return handle
+
+        def stat(self, path):
+            return paramiko.SFTPAttributes.from_stat(
+                os.stat(self.__path(path)))
+
+        lstat = stat
+
+        def chattr(self, path, attr):
+            return paramiko.SFTP_OK
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(100)
+    port = listener.getsockname()[1]
+
+    def serve():
+        while True:
+            conn, addr = listener.accept()
+            handshakes.append(addr)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(hostKey)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer,
+                                            StubSftp)
+            transport.start_server(server=StubServer())
+
+    server = threading.Thread(target=serve)
+    server.daemon = True
+    server.start()
+
+    def scenario(name, pooled):
+        del handshakes[:]
+        start = time.time()
+        for i in range(options.commands):
+            with contextlib.closing(SshClient("127.0.0.1", port, "root",
+                                              "password", retries=1,
+                                              pooled=pooled)) as ssh:
+                ret = ssh.runCommand("echo %d" % i)
+                assert ret["status"] == SUCCESS, ret
+        elapsed = time.time() - start
+        print "%-8s: %d commands in %.3fs (%.1f/sec), %d handshakes" % \
+            (name, options.commands, elapsed, options.commands / elapsed,
+             len(handshakes))
+
+    logging.getLogger('sshClient').setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+    scenario("fresh", False)
+    scenario("pooled", True)
+
+    del handshakes[:]
+    ssh = SshClient("127.0.0.1", port, "root", "password", retries=1,
+                    pooled=True)
+    results = []
+    threads = [threading.Thread(
+        target=lambda i=i: results.append(ssh.runCommand("echo %d" % i)))
+        for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    src = os.path.join(root, "src")
+    with open(src, "w") as fp:
+        fp.write("x" * 4096)
+    ssh.scp(src, "/tmp/copied")
+    print "parallel: %d/20 commands ok, scp %d bytes, %d handshakes" % \
+        (len([r for r in results if r["status"] == SUCCESS]),
+         os.path.getsize(os.path.join(root, "copied")), len(handshakes))
+    ssh.close()
+    print "pool    : %s" % SshSessionPool.getStats()
+    shutil.rmtree(root)
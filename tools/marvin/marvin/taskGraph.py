@@ -0,0 +1,295 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Runs a set of interdependent tasks (a DAG) with bounded
+       parallelism. A task starts as soon as all the tasks it depends
+       on are done, independent branches run concurrently. Every task
+       is timed, see TaskGraph.report
+'''
+import Queue
+import sys
+import threading
+import time
+from marvin.cloudstackException import (InvalidParameterException,
+                                        GetDetailExceptionInfo)
+from marvin.codes import (SUCCESS, FAILED)
+
+
+class TaskNode(object):
+
+    '''
+    @Desc : One task of a TaskGraph and its outcome
+            state : PENDING, RUNNING, DONE, FAILED or SKIPPED (not run
+                    because the graph was aborted)
+            queued, started, ended : timestamps of the task
+    '''
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+    SKIPPED = "SKIPPED"
+
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.dependents = []
+        self.waitingOn = len(self.deps)
+        self.state = TaskNode.PENDING
+        self.result = None
+        self.error = None
+        self.excInfo = None
+        self.queued = None
+        self.started = None
+        self.ended = None
+
+    def toDict(self, origin):
+        def offset(ts):
+            return round(ts - origin, 3) if ts is not None else None
+        return {"name": self.name,
+                "state": self.state,
+                "deps": self.deps,
+                "queued": offset(self.queued),
+                "started": offset(self.started),
+                "ended": offset(self.ended),
+                "duration": round(self.ended - self.started, 3)
+                if self.started and self.ended else None,
+                "error": str(self.error) if self.error else None}
+
+
+class TaskGraph(object):
+
+    '''
+    @Desc : Dependency aware executor
+    @Input : workers : maximum tasks running at the same time
+             logger : optional logger for the task start/end messages
+    Once a task fails no new task is started, even one already queued
+    for a worker, the running ones are waited for and run returns
+    FAILED. SystemExit and
+    KeyboardInterrupt raised by a task are re-raised by run after the
+    running tasks are done
+    '''
+
+    def __init__(self, workers=4, logger=None):
+        self.workers = max(int(workers), 1)
+        self.logger = logger
+        self.__nodes = {}
+        self.__order = []
+        self.__cond = threading.Condition()
+        self.__origin = None
+        self.__elapsed = None
+
+    def add(self, name, fn, deps=()):
+        '''
+        @Name : add
+        @Desc : Adds a task, deps must name tasks already added
+        @Input : name : unique name of the task
+                 fn : callable run without arguments
+                 deps : names of the tasks to complete first
+        @Output : name, so that it can be used in deps of later tasks
+        '''
+        if name in self.__nodes:
+            raise InvalidParameterException("Duplicate task: %s" % name)
+        for dep in deps:
+            if dep not in self.__nodes:
+                raise InvalidParameterException(
+                    "Task %s depends on unknown task %s" % (name, dep))
+        node = TaskNode(name, fn, deps)
+        for dep in deps:
+            self.__nodes[dep].dependents.append(node)
+        self.__nodes[name] = node
+        self.__order.append(node)
+        return name
+
+    def result(self, name):
+        '''
+        @Name : result
+        @Desc : Returns the value returned by the task
+        '''
+        return self.__nodes[name].result
+
+    def __debug(self, msg):
+        if self.logger is not None:
+            self.logger.debug(msg)
+
+    def __worker(self, ready, state):
+        while True:
+            node = ready.get()
+            if node is None:
+                return
+            with self.__cond:
+                if state["aborted"]:
+                    '''
+                    Queued before the failure, but not started yet
+                    '''
+                    node.state = TaskNode.SKIPPED
+                    state["running"] -= 1
+                    self.__cond.notify_all()
+                    continue
+            node.started = time.time()
+            self.__debug("=== Task %s Started ===" % node.name)
+            try:
+                node.result = node.fn()
+                node.state = TaskNode.DONE
+            except BaseException as e:
+                node.state = TaskNode.FAILED
+                node.error = e
+                node.excInfo = sys.exc_info()
+                if self.logger is not None:
+                    self.logger.exception("=== Task %s Failed: %s ===" %
+                                          (node.name,
+                                           GetDetailExceptionInfo(e)))
+            node.ended = time.time()
+            self.__debug("=== Task %s %s in %.3fs ===" %
+                         (node.name, node.state, node.ended - node.started))
+            with self.__cond:
+                state["running"] -= 1
+                if node.state == TaskNode.FAILED:
+                    state["aborted"] = True
+                elif not state["aborted"]:
+                    for dependent in node.dependents:
+                        dependent.waitingOn -= 1
+                        if dependent.waitingOn == 0:
+                            self.__schedule(dependent, ready, state)
+                self.__cond.notify_all()
+
+    def __schedule(self, node, ready, state):
+        node.state = TaskNode.RUNNING
+        node.queued = time.time()
+        state["running"] += 1
+        ready.put(node)
+
+    def run(self):
+        '''
+        @Name : run
+        @Desc : Runs the tasks and waits for them
+        @Output : SUCCESS if every task succeeded else FAILED
+        '''
+        self.__origin = time.time()
+        ready = Queue.Queue()
+        state = {"running": 0, "aborted": False}
+        threads = []
+        for i in range(min(self.workers, max(len(self.__order), 1))):
+            thread = threading.Thread(target=self.__worker,
+                                      args=(ready, state),
+                                      name="TaskGraph-%d" % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        with self.__cond:
+            for node in self.__order:
+                if node.waitingOn == 0:
+                    self.__schedule(node, ready, state)
+            while state["running"] > 0:
+                self.__cond.wait(1)
+        for thread in threads:
+            ready.put(None)
+        for thread in threads:
+            thread.join()
+        self.__elapsed = time.time() - self.__origin
+        failed = None
+        for node in self.__order:
+            if node.state == TaskNode.PENDING:
+                node.state = TaskNode.SKIPPED
+            elif node.state == TaskNode.FAILED and failed is None:
+                failed = node
+        if failed is not None and \
+                isinstance(failed.error, (SystemExit, KeyboardInterrupt)):
+            raise failed.excInfo[0], failed.excInfo[1], failed.excInfo[2]
+        return FAILED if failed is not None else SUCCESS
+
+    def getTimings(self):
+        '''
+        @Name : getTimings
+        @Desc : Returns the state and timings of every task, timestamps
+                are seconds since the start of run
+        '''
+        return [node.toDict(self.__origin or 0) for node in self.__order]
+
+    def report(self):
+        '''
+        @Name : report
+        @Desc : Returns a printable table of the task timings, along
+                with the critical path of the graph
+        '''
+        lines = ["%-60s %-8s %9s %9s %9s" %
+                 ("Task", "State", "Start(s)", "Wait(s)", "Took(s)")]
+        for node in sorted(self.__order,
+                           key=lambda n: n.started or sys.maxint):
+            start = node.started - self.__origin if node.started else None
+            wait = node.started - node.queued \
+                if node.started and node.queued else None
+            took = node.ended - node.started \
+                if node.started and node.ended else None
+            lines.append("%-60s %-8s %9s %9s %9s" %
+                         (node.name[:60], node.state,
+                          "%.3f" % start if start is not None else "-",
+                          "%.3f" % wait if wait is not None else "-",
+                          "%.3f" % took if took is not None else "-"))
+        path = self.__criticalPath()
+        if path:
+            lines.append("Critical path: %s" % " -> ".join(path))
+        if self.__elapsed is not None:
+            busy = sum(node.ended - node.started for node in self.__order
+                       if node.started and node.ended)
+            lines.append("Total: %.3fs wall clock, %.3fs of task time, "
+                         "%d workers" % (self.__elapsed, busy, self.workers))
+        return "\n".join(lines)
+
+    def __criticalPath(self):
+        '''
+        Chain of tasks ending with the last task to finish, following
+        at each step the dependency which finished last
+        '''
+        done = [node for node in self.__order if node.ended]
+        if not done:
+            return []
+        node = max(done, key=lambda n: n.ended)
+        path = [node.name]
+        while node.deps:
+            node = max((self.__nodes[dep] for dep in node.deps),
+                       key=lambda n: n.ended or 0)
+            path.insert(0, node.name)
+        return path
+
+
+if __name__ == "__main__":
+    '''
+    Self check: a failure skips the tasks queued behind it
+    '''
+    ran = []
+
+    def first():
+        raise Exception("first failed")
+
+    def sibling(name):
+        ran.append(name)
+
+    graph = TaskGraph(workers=1)
+    graph.add("first", first)
+    for i in range(3):
+        graph.add("sibling%d" % i, lambda i=i: sibling(i))
+    graph.add("child", lambda: sibling("child"), ["first"])
+    assert graph.run() == FAILED
+    assert ran == [], ran
+    states = dict((t["name"], t["state"]) for t in graph.getTimings())
+    assert states == {"first": TaskNode.FAILED,
+                      "sibling0": TaskNode.SKIPPED,
+                      "sibling1": TaskNode.SKIPPED,
+                      "sibling2": TaskNode.SKIPPED,
+                      "child": TaskNode.SKIPPED}, states
+    print "OK"
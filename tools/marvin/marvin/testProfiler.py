@@ -0,0 +1,528 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Duration history of the marvin test runs.
+       Every test and every API call is timed and stored in a SQLite
+       database kept under the log root, so that the runs can be
+       compared with each other. The wall time of a test is split into
+       API latency, async job wait, resource wait, SSH and sleep time.
+       The API calls are received through the apiInstrumentation hooks.
+       Usage : python -m marvin.testProfiler <db> [--run N] [--top N]
+'''
+import os
+import sqlite3
+import sys
+import threading
+import time
+from optparse import OptionParser
+from marvin.apiInstrumentation import (instrumentation,
+                                       InstrumentationHook, ASYNC_WAIT)
+
+'''
+Time categories of the breakdown, a span started while another one is
+open on the same thread is charged to the inner category only
+'''
+API = "api"
+ASYNC = "async"
+WAIT = "wait"
+SSH = "ssh"
+SLEEP = "sleep"
+CATEGORIES = (API, ASYNC, WAIT, SSH, SLEEP)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    label TEXT,
+    started REAL,
+    ended REAL
+);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT,
+    started REAL,
+    duration REAL,
+    api_time REAL,
+    async_time REAL,
+    wait_time REAL,
+    ssh_time REAL,
+    sleep_time REAL,
+    api_calls INTEGER
+);
+CREATE INDEX IF NOT EXISTS tests_name ON tests (name, run_id);
+CREATE TABLE IF NOT EXISTS api_calls (
+    run_id INTEGER NOT NULL,
+    test_id INTEGER,
+    command TEXT,
+    started REAL,
+    duration REAL,
+    async_wait REAL,
+    foreground INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS api_calls_test ON api_calls (test_id);
+'''
+
+
+class DurationStore(object):
+
+    '''
+    @Desc : SQLite database of the runs, tests and API call timings.
+            Several processes (EX: parallelRunner shards) can share
+            one database, the writes are short transactions
+    @Input : path : database file, created along with its folder
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False)
+        self.__db.executescript(SCHEMA)
+
+    def __write(self, sql, rows=None, many=False):
+        with self.__lock:
+            with self.__db:
+                if many:
+                    return self.__db.executemany(sql, rows)
+                return self.__db.execute(sql, rows or ())
+
+    def query(self, sql, args=()):
+        with self.__lock:
+            return self.__db.execute(sql, args).fetchall()
+
+    def startRun(self, label=None):
+        return self.__write("INSERT INTO runs (label, started) "
+                            "VALUES (?, ?)", (label, time.time())).lastrowid
+
+    def endRun(self, runId):
+        self.__write("UPDATE runs SET ended = ? WHERE id = ?",
+                     (time.time(), runId))
+
+    def addTest(self, runId, record):
+        return self.__write(
+            "INSERT INTO tests (run_id, name, status, started, duration, "
+            "api_time, async_time, wait_time, ssh_time, sleep_time, "
+            "api_calls) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (runId, record["name"], record["status"], record["started"],
+             record["duration"], record[API], record[ASYNC], record[WAIT],
+             record[SSH], record[SLEEP], record["apiCalls"])).lastrowid
+
+    def addApiCalls(self, runId, calls):
+        '''
+        @Input : calls : (test id, command, started, duration,
+                          async wait, foreground, error) tuples
+        '''
+        if calls:
+            self.__write("INSERT INTO api_calls (run_id, test_id, command, "
+                         "started, duration, async_wait, foreground, error) "
+                         "VALUES (%d, ?, ?, ?, ?, ?, ?, ?)" % int(runId),
+                         calls, many=True)
+
+    def lastRun(self):
+        rows = self.query("SELECT MAX(id) FROM runs")
+        return rows[0][0] if rows else None
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+class _Span(object):
+
+    '''
+    One open span of a thread, see TestProfiler.span
+    '''
+    __slots__ = ("category", "name", "started", "children", "nested")
+
+    def __init__(self, category, name):
+        self.category = category
+        self.name = name
+        self.started = time.time()
+        self.children = 0.0
+        '''
+        Time of the inner spans per category, the API calls keep the
+        async wait they contain
+        '''
+        self.nested = {}
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+
+class _SpanContext(object):
+
+    def __init__(self, profiler, category, name):
+        self.profiler = profiler
+        self.category = category
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.category, self.name)
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.profiler.leave(exc)
+        return False
+
+
+class ProfilerHook(InstrumentationHook):
+
+    '''
+    @Desc : Feeds the API calls to the profiler, the async wait of a
+            call is charged to ASYNC rather than to API
+    '''
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def callStarted(self, call):
+        self.profiler.enter(API, call.command)
+
+    def callEnded(self, call):
+        self.profiler.leave(call.error,
+                            inner={ASYNC: call.phases[ASYNC_WAIT]})
+
+
+class TestProfiler(object):
+
+    '''
+    @Desc : Process wide profiler fed by the API client hooks and by
+            the SSH and wait layers through span, a no-op as long as no
+            store is attached.
+            Only the thread running the test (the one which called
+            startTest) accounts for its breakdown, the API calls of
+            other threads (async job poller, wait engine, workers) are
+            recorded as background calls
+    '''
+    NULL_SPAN = _NullSpan()
+
+    def __init__(self):
+        self.store = None
+        self.runId = None
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__calls = []
+        self.__test = None
+        self.__testThread = None
+        self.__realSleep = time.sleep
+        self.__hook = ProfilerHook(self)
+
+    @property
+    def active(self):
+        return self.store is not None
+
+    def startRun(self, store, label=None, patchSleep=True):
+        '''
+        @Name : startRun
+        @Desc : Attaches the store and starts recording. time.sleep is
+                wrapped so that the explicit sleeps of the tests are
+                accounted, sleeps done inside a span are not
+        '''
+        self.store = store
+        self.runId = store.startRun(label)
+        instrumentation.register(self.__hook)
+        if patchSleep:
+            time.sleep = self.__sleep
+        return self.runId
+
+    def endRun(self):
+        '''
+        @Name : endRun
+        @Desc : Flushes the pending API calls, closes the run and stops
+                recording
+        '''
+        if self.store is None:
+            return None
+        instrumentation.unregister(self.__hook)
+        if time.sleep == self.__sleep:
+            time.sleep = self.__realSleep
+        with self.__lock:
+            calls, self.__calls = self.__calls, []
+        self.store.addApiCalls(self.runId, [(None,) + c[1:] for c in calls])
+        self.store.endRun(self.runId)
+        runId = self.runId
+        self.store = None
+        self.runId = None
+        return runId
+
+    def __sleep(self, seconds):
+        if self.__stack() or \
+                threading.current_thread() is not self.__testThread:
+            return self.__realSleep(seconds)
+        with self.span(SLEEP):
+            return self.__realSleep(seconds)
+
+    def __stack(self):
+        stack = getattr(self.__local, "stack", None)
+        if stack is None:
+            stack = self.__local.stack = []
+        return stack
+
+    def span(self, category, name=None):
+        '''
+        @Name : span
+        @Desc : Context manager timing the enclosed block under
+                category, EX: with profiler.span(API, "listZones"):
+        '''
+        if self.store is None:
+            return TestProfiler.NULL_SPAN
+        return _SpanContext(self, category, name)
+
+    def enter(self, category, name=None):
+        self.__stack().append(_Span(category, name))
+
+    def leave(self, error=None, inner=None):
+        '''
+        @Name : leave
+        @Desc : Closes the innermost span of the thread
+        @Input : inner : seconds per category spent within the span
+                         without a span of their own
+        '''
+        stack = self.__stack()
+        if not stack:
+            return
+        span = stack.pop()
+        elapsed = time.time() - span.started
+        for category, seconds in (inner or {}).iteritems():
+            if seconds:
+                span.children += seconds
+                span.nested[category] = \
+                    span.nested.get(category, 0.0) + seconds
+        if stack:
+            parent = stack[-1]
+            parent.children += elapsed
+            parent.nested[span.category] = \
+                parent.nested.get(span.category, 0.0) + elapsed
+        foreground = threading.current_thread() is self.__testThread
+        with self.__lock:
+            test = self.__test
+            if test is not None and foreground:
+                test[span.category] += elapsed - span.children
+                for category, seconds in (inner or {}).iteritems():
+                    test[category] += seconds
+                if span.category == API:
+                    test["apiCalls"] += 1
+            if span.category == API:
+                self.__calls.append(
+                    (test["token"] if test else None, span.name,
+                     span.started, round(elapsed, 6),
+                     round(span.nested.get(ASYNC, 0.0), 6),
+                     1 if foreground else 0,
+                     str(error)[:500] if error is not None else None))
+
+    def startTest(self, name):
+        '''
+        @Name : startTest
+        @Desc : Starts the breakdown of a test on the calling thread
+        '''
+        if self.store is None:
+            return
+        test = {"name": name, "started": time.time(), "status": None,
+                "apiCalls": 0, "token": object()}
+        for category in CATEGORIES:
+            test[category] = 0.0
+        with self.__lock:
+            self.__test = test
+            self.__testThread = threading.current_thread()
+
+    def stopTest(self, status):
+        '''
+        @Name : stopTest
+        @Desc : Stores the test, along with the API calls made while
+                it ran
+        @Output : the stored record, None when not recording
+        '''
+        if self.store is None or self.__test is None:
+            return None
+        with self.__lock:
+            test, self.__test = self.__test, None
+            calls, self.__calls = self.__calls, []
+            self.__testThread = None
+        test["duration"] = time.time() - test["started"]
+        test["status"] = str(status)
+        testId = self.store.addTest(self.runId, test)
+        self.store.addApiCalls(
+            self.runId,
+            [(testId if c[0] is test["token"] else None,) + c[1:]
+             for c in calls])
+        return test
+
+
+profiler = TestProfiler()
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class DurationReport(object):
+
+    '''
+    @Desc : Reads a DurationStore back
+    @Input : store : DurationStore
+             history : earlier runs a test is compared with
+             threshold : ratio to the median of the earlier runs from
+                         which a test is flagged as a regression
+             minDelta : seconds a test must also have slowed down by
+    '''
+
+    def __init__(self, store, history=5, threshold=1.5, minDelta=10.0):
+        self.store = store
+        self.history = history
+        self.threshold = threshold
+        self.minDelta = minDelta
+
+    def tests(self, runId):
+        '''
+        @Name : tests
+        @Desc : Returns the breakdown of the tests of a run, slowest
+                first. other is the wall time not explained by any of
+                the categories (test code, logging, setup)
+        '''
+        rows = self.store.query(
+            "SELECT name, status, duration, api_time, async_time, "
+            "wait_time, ssh_time, sleep_time, api_calls FROM tests "
+            "WHERE run_id = ? ORDER BY duration DESC", (runId,))
+        tests = []
+        for row in rows:
+            test = dict(zip(("name", "status", "duration", API, ASYNC, WAIT,
+                             SSH, SLEEP, "apiCalls"), row))
+            test["other"] = max(test["duration"] -
+                                sum(test[c] for c in CATEGORIES), 0.0)
+            tests.append(test)
+        return tests
+
+    def slowestCalls(self, runId, limit=10):
+        '''
+        @Name : slowestCalls
+        @Desc : Returns the commands with the largest total time in the
+                run: (command, calls, total, max, async wait, errors)
+        '''
+        return self.store.query(
+            "SELECT command, COUNT(*), SUM(duration), MAX(duration), "
+            "SUM(async_wait), COUNT(error) FROM api_calls "
+            "WHERE run_id = ? AND foreground = 1 GROUP BY command "
+            "ORDER BY SUM(duration) DESC LIMIT ?", (runId, limit))
+
+    def regressions(self, runId):
+        '''
+        @Name : regressions
+        @Desc : Tests of the run slower than threshold times their
+                median over the previous runs (and by minDelta seconds
+                at least)
+        @Output : (name, duration, median, ratio) tuples
+        '''
+        flagged = []
+        for name, duration in self.store.query(
+                "SELECT name, duration FROM tests WHERE run_id = ?",
+                (runId,)):
+            previous = [row[0] for row in self.store.query(
+                "SELECT duration FROM tests WHERE name = ? AND run_id < ? "
+                "AND status = ? ORDER BY run_id DESC LIMIT ?",
+                (name, runId, "SUCCESS", self.history))]
+            baseline = median(previous)
+            if not baseline:
+                continue
+            if duration > baseline * self.threshold and \
+                    duration - baseline >= self.minDelta:
+                flagged.append((name, duration, baseline,
+                                duration / baseline))
+        return sorted(flagged, key=lambda r: r[3], reverse=True)
+
+    def format(self, runId, top=20):
+        '''
+        @Name : format
+        @Desc : Returns the printable report of a run
+        '''
+        tests = self.tests(runId)
+        total = sum(t["duration"] for t in tests)
+        lines = ["Run %s: %d tests, %.1fs" % (runId, len(tests), total)]
+        header = "%-70s %-9s %8s" + " %8s" * 6 + " %6s"
+        lines.append(header % ("Test", "Status", "Wall", "API", "Async",
+                               "Wait", "SSH", "Sleep", "Other", "Calls"))
+        for t in tests[:top]:
+            lines.append(header % (
+                t["name"][-70:], t["status"], "%.1f" % t["duration"],
+                "%.1f" % t[API], "%.1f" % t[ASYNC], "%.1f" % t[WAIT],
+                "%.1f" % t[SSH], "%.1f" % t[SLEEP], "%.1f" % t["other"],
+                t["apiCalls"]))
+        if tests:
+            shares = ["%s %.0f%%" % (c, 100.0 * sum(t[c] for t in tests) /
+                                     total if total else 0)
+                      for c in CATEGORIES + ("other",)]
+            lines.append("Share of the wall time: %s" % ", ".join(shares))
+        calls = self.slowestCalls(runId)
+        if calls:
+            lines.append("Slowest commands (foreground):")
+            for command, count, spent, longest, asyncWait, errors in calls:
+                lines.append("    %-45s %6d calls %9.1fs total %7.1fs max "
+                             "%9.1fs async %4d errors" %
+                             (command, count, spent, longest, asyncWait,
+                              errors))
+        flagged = self.regressions(runId)
+        if flagged:
+            lines.append("Regressions (vs the median of the last %d runs):"
+                         % self.history)
+            for name, duration, baseline, ratio in flagged:
+                lines.append("    %s: %.1fs, was %.1fs (x%.2f)" %
+                             (name, duration, baseline, ratio))
+        return "\n".join(lines)
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog <duration db> [options]")
+    parser.add_option("--run", type="int", default=None, dest="run",
+                      help="run to report, defaults to the last one")
+    parser.add_option("--top", type="int", default=20, dest="top",
+                      help="number of tests listed")
+    parser.add_option("--history", type="int", default=5, dest="history",
+                      help="earlier runs used as the regression baseline")
+    parser.add_option("--threshold", type="float", default=1.5,
+                      dest="threshold",
+                      help="slow down ratio flagged as a regression")
+    (options, paths) = parser.parse_args(args)
+    if len(paths) != 1 or not os.path.isfile(paths[0]):
+        parser.error("no duration database given")
+    store = DurationStore(paths[0])
+    runId = options.run or store.lastRun()
+    if runId is None:
+        print "No run recorded in %s" % paths[0]
+        return 1
+    print DurationReport(store, options.history,
+                         options.threshold).format(runId, options.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,567 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+'''
+@Desc: Wait engine for CloudStack resources reaching a given state.
+       Resources are re-listed with an adaptive interval (fast first
+       checks, exponential growth, jitter, capped interval) rather than
+       fixed 60 second sleeps. Watches on resources of the same kind are
+       multiplexed: once enough of them are outstanding, one page listed
+       with their list arguments answers all of them. A watch can also be woken up by the async job
+       which changes the resource, or by new management server events.
+       Every wait is timed, see WaitEngine.getStats
+'''
+import collections
+import copy
+import random
+import threading
+import time
+from marvin.cloudstackAPI import listEvents
+from marvin.testProfiler import (profiler, WAIT)
+
+'''
+Predicate result telling that the resource is still making progress
+(EX: a template being downloaded), the timeout of the watch restarts
+'''
+PROGRESS = "PROGRESS"
+
+
+class WaitTelemetry(object):
+
+    '''
+    @Desc : Process wide record of the waits, shared by every engine
+            and by poll
+    '''
+
+    def __init__(self, historySize=500):
+        self.__lock = threading.Lock()
+        self.__history = collections.deque(maxlen=historySize)
+        self.__totals = {}
+
+    def add(self, record):
+        with self.__lock:
+            self.__history.append(record)
+            totals = self.__totals.setdefault(record["kind"], {
+                "waits": 0, "polls": 0, "waitTime": 0.0,
+                "timedOut": 0, "failed": 0})
+            totals["waits"] += 1
+            totals["polls"] += record["polls"]
+            totals["waitTime"] += record["waitTime"]
+            if record["outcome"] == "TIMEOUT":
+                totals["timedOut"] += 1
+            elif record["outcome"] == "FAILED":
+                totals["failed"] += 1
+
+    def toDict(self):
+        with self.__lock:
+            return {"byKind": copy.deepcopy(self.__totals),
+                    "recentWaits": list(self.__history)}
+
+    def reset(self):
+        with self.__lock:
+            self.__history.clear()
+            self.__totals = {}
+
+
+telemetry = WaitTelemetry()
+
+
+class Backoff(object):
+
+    '''
+    @Desc : Intervals between the checks of one wait
+    @Input : initialInterval : delay before the first check
+             maxInterval : cap of the interval
+             multiplier : growth factor of the interval between checks
+             jitter : random +/- fraction applied to every interval
+    '''
+
+    def __init__(self, initialInterval=1.0, maxInterval=15.0,
+                 multiplier=1.5, jitter=0.2):
+        self.initialInterval = min(initialInterval, maxInterval)
+        self.maxInterval = maxInterval
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def interval(self, polls):
+        interval = min(self.maxInterval,
+                       self.initialInterval * (self.multiplier ** polls))
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return interval
+
+
+def poll(check, timeout, maxInterval=15.0, name=None, initialInterval=1.0,
+         jitter=0.2, attempts=None):
+    '''
+    @Name : poll
+    @Desc : Calls check with an adaptive interval until it reports
+            completion or timeout expires. Used for the waits which can
+            not be multiplexed, EX: arbitrary wait_until callbacks
+    @Input : check : callable returning a tuple whose first element
+                     tells whether the wait is over
+             timeout : seconds to wait for
+             maxInterval : cap of the interval between two checks
+             initialInterval : delay before the first check
+             jitter : random +/- fraction applied to every interval
+             attempts : when given, check is called that many times at
+                        most whatever they take, rather than until
+                        timeout expires
+    @Output : last value returned by check
+    '''
+    backoff = Backoff(initialInterval, maxInterval, jitter=jitter)
+    start = time.time()
+    deadline = start + timeout
+    polls = 0
+    outcome = "TIMEOUT"
+    try:
+        while True:
+            delay = backoff.interval(polls)
+            if attempts is None:
+                delay = min(delay, deadline - time.time())
+            if delay > 0:
+                with profiler.span(WAIT):
+                    time.sleep(delay)
+            polls += 1
+            result = check()
+            if result[0]:
+                outcome = "PASSED"
+                return result
+            if polls >= attempts if attempts is not None \
+                    else time.time() >= deadline:
+                return result
+    except Exception:
+        outcome = "FAILED"
+        raise
+    finally:
+        telemetry.add({"kind": "poll",
+                       "name": name,
+                       "id": None,
+                       "polls": polls,
+                       "listCalls": polls,
+                       "events": 0,
+                       "waitTime": round(time.time() - start, 3),
+                       "outcome": outcome})
+
+
+class Watch(object):
+
+    '''
+    @Desc : One resource being waited upon
+            item : last listed entry of the resource, None if it was not
+                   listed
+            satisfied : whether the predicate was met
+            error : exception which ended the wait, if any
+    '''
+
+    def __init__(self, kind, listFn, listArgs, resid, predicate, timeout,
+                 backoff, job=None, absentOnError=False):
+        self.kind = kind
+        self.listFn = listFn
+        self.listArgs = listArgs
+        self.key = (listFn, repr(sorted(listArgs.items())))
+        self.resid = resid
+        self.predicate = predicate
+        self.timeout = timeout
+        self.backoff = backoff
+        self.job = job
+        self.absentOnError = absentOnError
+        self.startTime = time.time()
+        self.endTime = None
+        self.deadline = self.startTime + timeout
+        self.nextPoll = self.startTime + backoff.interval(0)
+        self.polls = 0
+        self.listCalls = 0
+        self.events = 0
+        self.item = None
+        self.satisfied = False
+        self.timedOut = False
+        self.error = None
+        self.done = threading.Event()
+
+    def toDict(self):
+        end = self.endTime or time.time()
+        if self.satisfied:
+            outcome = "PASSED"
+        elif self.timedOut:
+            outcome = "TIMEOUT"
+        else:
+            outcome = "FAILED"
+        return {"kind": self.kind,
+                "name": None,
+                "id": self.resid,
+                "polls": self.polls,
+                "listCalls": self.listCalls,
+                "events": self.events,
+                "waitTime": round(end - self.startTime, 3),
+                "outcome": outcome}
+
+
+class WaitEngine(object):
+
+    '''
+    @Desc : Waits for resources listed with one set of credentials.
+            One engine (and one thread, alive only while watches are
+            pending) is shared by every api client using the same
+            Management Server and api key
+    @Input : apiclient : client used for the list calls, copied so that
+                         the caller can keep using its own
+             initialInterval, maxInterval, multiplier, jitter : default
+                         backoff of the watches, see Backoff
+             sweepThreshold : outstanding watches of the same kind and
+                              list arguments from which a single list
+                              call answers them
+             sweepPageSize : resources listed by that call, a kind with
+                             more of them is not swept
+             useEvents : if True, new management server events (listEvents)
+                         make every watch due at once
+             eventInterval : seconds between two listEvents checks
+    '''
+    __registry = {}
+    __registryLock = threading.Lock()
+    defaults = {"initialInterval": 1.0,
+                "maxInterval": 15.0,
+                "multiplier": 1.5,
+                "jitter": 0.2,
+                "sweepThreshold": 2,
+                "sweepPageSize": 100,
+                "useEvents": False,
+                "eventInterval": 5.0}
+
+    def __init__(self, apiclient, **kwargs):
+        options = dict(WaitEngine.defaults)
+        options.update(kwargs)
+        self.apiclient = copy.copy(apiclient)
+        self.logger = getattr(apiclient.connection, "logger", None)
+        self.initialInterval = options["initialInterval"]
+        self.maxInterval = options["maxInterval"]
+        self.multiplier = options["multiplier"]
+        self.jitter = options["jitter"]
+        self.sweepThreshold = options["sweepThreshold"]
+        self.sweepPageSize = options["sweepPageSize"]
+        self.useEvents = options["useEvents"]
+        self.eventInterval = options["eventInterval"]
+        self.__cond = threading.Condition()
+        self.__pending = {}
+        self.__unswept = set()
+        self.__thread = None
+        self.__lastEvent = None
+        self.__nextEventCheck = 0
+        self.__totals = {"watches": 0, "sweeps": 0, "queries": 0,
+                         "eventChecks": 0, "eventWakeups": 0}
+
+    @classmethod
+    def configure(cls, **kwargs):
+        '''
+        @Name : configure
+        @Desc : Changes the defaults of the engines created afterwards,
+                EX: WaitEngine.configure(useEvents=True)
+        '''
+        for key in kwargs:
+            if key not in cls.defaults:
+                raise ValueError("Unknown WaitEngine option: %s" % key)
+        cls.defaults.update(kwargs)
+
+    @classmethod
+    def getEngine(cls, apiclient):
+        '''
+        @Name : getEngine
+        @Desc : Returns the engine shared by the api clients using the
+                same endpoint and credentials as apiclient
+        '''
+        connection = apiclient.connection
+        key = (getattr(connection, "baseUrl", None),
+               getattr(connection, "apiKey", None))
+        with cls.__registryLock:
+            engine = cls.__registry.get(key)
+            if engine is None:
+                engine = WaitEngine(apiclient)
+                cls.__registry[key] = engine
+            return engine
+
+    @staticmethod
+    def getStats():
+        '''
+        @Name : getStats
+        @Desc : Returns the per kind totals and the recent waits of the
+                whole process
+        '''
+        return telemetry.toDict()
+
+    def getEngineStats(self):
+        '''
+        @Name : getEngineStats
+        @Desc : Returns the list calls done by this engine
+        '''
+        with self.__cond:
+            stats = dict(self.__totals)
+            stats["pending"] = len(self.__pending)
+        return stats
+
+    def __debug(self, msg):
+        if self.logger is not None:
+            self.logger.debug(msg)
+
+    def watch(self, kind, listFn, resid, predicate, timeout=600,
+              maxInterval=None, listArgs=None, jobid=None,
+              absentOnError=False):
+        '''
+        @Name : watch
+        @Desc : Registers a wait without blocking, so that several waits
+                can be outstanding (and answered by the same list calls)
+                before the caller collects them through result
+        @Input : kind : label of the wait in the telemetry
+                 listFn : list method called as
+                          listFn(apiclient, id=resid, **listArgs),
+                          EX: VirtualMachine.list
+                 resid : id of the resource
+                 predicate : called with the listed entry of the resource
+                             (None if it is not listed); returns True once
+                             the wait is over, False to keep waiting,
+                             PROGRESS to keep waiting with the timeout
+                             restarted; an exception fails the wait
+                 timeout : seconds to wait for
+                 maxInterval : cap of the interval between two checks
+                 jobid : async job changing the resource, the resource is
+                         only checked once the job is complete
+                 absentOnError : treat a failing list call as the
+                                 resource not being listed
+        @Output : Watch to be passed to result
+        '''
+        cap = self.maxInterval
+        if maxInterval is not None:
+            cap = min(maxInterval, cap)
+        backoff = Backoff(self.initialInterval, cap, self.multiplier,
+                          self.jitter)
+        job = None
+        if jobid is not None:
+            job = self.apiclient.connection.getAsyncJobPoller().track(
+                jobid, timeout=timeout)
+        w = Watch(kind, listFn, listArgs or {}, resid, predicate, timeout,
+                  backoff, job, absentOnError)
+        with self.__cond:
+            self.__pending[id(w)] = w
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name="WaitEngine")
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__cond.notify()
+        return w
+
+    def result(self, w):
+        '''
+        @Name : result
+        @Desc : Blocks until the watch is over
+        @Output : the watch, see Watch.satisfied, Watch.item, Watch.error
+        '''
+        with profiler.span(WAIT):
+            while not w.done.wait(self.maxInterval + 1):
+                pass
+        self.__debug("=== Wait %s:%s %s after %.3fs, Polls:%d ===" %
+                     (w.kind, w.resid, w.toDict()["outcome"],
+                      w.endTime - w.startTime, w.polls))
+        return w
+
+    def wait(self, kind, listFn, resid, predicate, timeout=600, **kwargs):
+        '''
+        @Name : wait
+        @Desc : Blocks until predicate is met for the resource, see watch
+        @Output : the watch
+        '''
+        return self.result(self.watch(kind, listFn, resid, predicate,
+                                      timeout, **kwargs))
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if not self.__pending:
+                    self.__thread = None
+                    return
+                watches = self.__pending.values()
+                nextPoll = min(w.nextPoll for w in watches)
+                if self.useEvents:
+                    nextPoll = min(nextPoll, self.__nextEventCheck)
+                delay = nextPoll - time.time()
+                if delay > 0:
+                    self.__cond.wait(delay)
+                    continue
+            try:
+                self.__tick(watches)
+            except Exception as e:
+                '''
+                Never let the thread die with waiters still pending
+                '''
+                for w in watches:
+                    w.error = e
+                    self.__finish(w)
+
+    def __tick(self, watches):
+        now = time.time()
+        if self.useEvents and now >= self.__nextEventCheck:
+            self.__nextEventCheck = now + self.eventInterval
+            if self.__newEvents():
+                for w in watches:
+                    if w.nextPoll > now:
+                        w.events += 1
+                        w.nextPoll = now
+        groups = collections.defaultdict(list)
+        for w in watches:
+            if w.job is not None:
+                if not w.job.done.is_set():
+                    if now >= w.deadline:
+                        w.timedOut = True
+                        self.__finish(w)
+                    continue
+                '''
+                The job changing the resource is over, check it at once
+                '''
+                w.job = None
+                w.nextPoll = now
+            groups[w.key].append(w)
+        for group in groups.values():
+            due = [w for w in group if w.nextPoll <= now]
+            if not due:
+                continue
+            if len(group) >= self.sweepThreshold and \
+                    group[0].key not in self.__unswept:
+                self.__sweep(group, due, now)
+            else:
+                for w in due:
+                    self.__query(w, now)
+
+    def __list(self, w, **kwargs):
+        # API parameters are case insensitive, EX: listAll is listall
+        overridden = set(k.lower() for k in kwargs)
+        args = dict((k, v) for (k, v) in w.listArgs.items()
+                    if k.lower() not in overridden)
+        args.update(kwargs)
+        return w.listFn(self.apiclient, **args)
+
+    def __sweep(self, group, due, now):
+        '''
+        @Name : __sweep
+        @Desc : The first page of the resources listed with the list
+                arguments of the group (EX: its zone, project or
+                listall) answers every watch of the group, due or not.
+                The resources missing from it are queried one by one, as
+                list calls without id may leave out some states (EX:
+                destroyed VMs). A full page which misses some of them
+                means that more resources are listed than a page holds:
+                the group is not swept anymore, per resource queries
+                are cheaper than paging through all of them
+        '''
+        with self.__cond:
+            self.__totals["sweeps"] += 1
+        try:
+            items = self.__list(group[0], page=1,
+                                pagesize=self.sweepPageSize)
+        except Exception as e:
+            self.__debug("=== %s sweep failed, falling back to per "
+                         "resource queries: %s ===" % (group[0].kind, e))
+            for w in due:
+                self.__query(w, now)
+            return
+        items = items if isinstance(items, list) else []
+        byId = {}
+        for item in items:
+            byId[getattr(item, "id", None)] = item
+        if len(items) >= self.sweepPageSize and \
+                any(w.resid not in byId for w in group):
+            self.__debug("=== More than %d %s listed, not sweeping them "
+                         "anymore ===" % (self.sweepPageSize, group[0].kind))
+            self.__unswept.add(group[0].key)
+        for w in group:
+            w.listCalls += 1
+            if w.resid in byId:
+                self.__evaluate(w, byId[w.resid], now)
+            elif w in due:
+                self.__query(w, now)
+
+    def __query(self, w, now):
+        with self.__cond:
+            self.__totals["queries"] += 1
+        w.listCalls += 1
+        try:
+            items = self.__list(w, id=w.resid)
+        except Exception as e:
+            if not w.absentOnError:
+                w.polls += 1
+                w.error = e
+                self.__finish(w)
+                return
+            items = None
+        item = None
+        if isinstance(items, list) and len(items) > 0:
+            item = items[0]
+        self.__evaluate(w, item, now)
+
+    def __evaluate(self, w, item, now):
+        w.polls += 1
+        w.item = item
+        try:
+            status = w.predicate(item)
+        except Exception as e:
+            w.error = e
+            self.__finish(w)
+            return
+        if status is True:
+            w.satisfied = True
+            self.__finish(w)
+            return
+        if status == PROGRESS:
+            w.deadline = now + w.timeout
+        if now >= w.deadline:
+            w.timedOut = True
+            self.__finish(w)
+            return
+        w.nextPoll = min(now + w.backoff.interval(w.polls), w.deadline)
+
+    def __newEvents(self):
+        '''
+        @Name : __newEvents
+        @Desc : Tells whether events were generated since the last check,
+                the events are listed newest first
+        '''
+        with self.__cond:
+            self.__totals["eventChecks"] += 1
+        try:
+            cmd = listEvents.listEventsCmd()
+            cmd.listall = True
+            cmd.page = 1
+            cmd.pagesize = 1
+            events = self.apiclient.listEvents(cmd)
+        except Exception as e:
+            self.__debug("=== listEvents failed: %s ===" % e)
+            return False
+        latest = events[0].id if isinstance(events, list) and events \
+            else None
+        changed = self.__lastEvent is not None and \
+            latest != self.__lastEvent
+        self.__lastEvent = latest
+        if changed:
+            with self.__cond:
+                self.__totals["eventWakeups"] += 1
+        return changed
+
+    def __finish(self, w):
+        with self.__cond:
+            if self.__pending.pop(id(w), None) is None:
+                return
+            w.endTime = time.time()
+            self.__totals["watches"] += 1
+        telemetry.add(w.toDict())
+        w.done.set()
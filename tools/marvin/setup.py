@@ -59,6 +59,7 @@ setup(name="Marvin",
       zip_safe=False,
       entry_points={
           'nose.plugins': ['marvinPlugin = marvin.marvinPlugin:MarvinPlugin'],
-          'console_scripts': ['marvincli = marvin.deployAndRun:main']
+          'console_scripts': ['marvincli = marvin.deployAndRun:main',
+                              'marvinparallel = marvin.parallelRunner:main']
       },
       )